@@ -13,6 +13,7 @@ set -euo pipefail
 ## https://opensource.org/licenses/MIT
 
 S3_PREFIX="s3://rpd-workflows-out/"
+FASTQ_MANIFEST=$(dirname $(readlink -f $0))/../tools/fastq_manifest.py
 
 LOCKFILE="";# set later depending on input
 LOCKFD=99
@@ -130,6 +131,17 @@ if aws s3 ls $uri >/dev/null; then
 fi
 
 
+# fastqs of bcl2fastq runs come with a checksum manifest: make sure
+# they are unchanged, so that its checksums hold for the staged out copy
+if [ -e $wdirbase/out/fastq_manifest.tsv ]; then
+    if ! $FASTQ_MANIFEST -d $wdirbase/out; then
+	log "FATAL: fastqs in $wdir don't match manifest"
+	unlock
+	exit 1
+    fi
+fi
+
+
 # we need a tarball because we might have symlinks which are not supported in s3
 # streaming tar is a nice idea, but can hang in pratice. So let's create a copy first
 # tar c --exclude '*/.snakemake/*' $wdirbase | aws s3 cp - ${s3prefix}/$tarball
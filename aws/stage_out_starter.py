@@ -1,5 +1,10 @@
 #!/usr/bin/env python3
-"""Stage data out
+"""Stage data out: completed workflows in the downstream output
+directory are uploaded to S3. If a shared event journal is configured
+(see lib/eventjournal.py), only workflows logged as complete there are
+looked at, otherwise (or with --scan, e.g. once for workflows
+completed before the journal existed) all output directories are
+checked for the completion flag
 """
 
 #--- standard library imports
@@ -9,6 +14,7 @@ import os
 import argparse
 import logging
 import glob
+import fnmatch
 import subprocess
 
 #--- third-party imports
@@ -24,7 +30,10 @@ if LIB_PATH not in sys.path:
 from pipelines import DOWNSTREAM_OUTDIR_TEMPLATE
 from pipelines import WORKFLOW_COMPLETION_FLAGFILE
 from pipelines import is_devel_version
+from pipelines import get_event_journal
 from config import site_cfg
+from eventjournal import JournalReader
+from eventjournal import WORKFLOW_COMPLETE
 
 
 # global logger
@@ -44,6 +53,9 @@ S3_BUCKET = "s3://rpd-workflows-out"
 def main():
 
     parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--scan', action='store_true',
+                        help="Look for completion flags in all output directories"
+                        " even if an event journal is configured")
     parser.add_argument('-v', '--verbose', action='count', default=0,
                         help="Increase verbosity")
     parser.add_argument('-q', '--quiet', action='count', default=0,
@@ -64,20 +76,38 @@ def main():
         basedir=basedir, user="*", pipelineversion="*", pipelinename="*", timestamp="*")
     logger.debug("dirglob is %s", dirglob)
 
-    for flagfile in glob.glob(os.path.join(
-            dirglob, WORKFLOW_COMPLETION_FLAGFILE)):
-        dir = os.path.abspath(os.path.dirname(flagfile))
+    journal_file = get_event_journal()
+    if journal_file and not args.scan:
+        journal = JournalReader("stage_out_starter", journal_file)
+        # compare resolved paths: logged dirs might go through symlinks or not
+        completed = [(event['dir'], event) for event in journal.events([WORKFLOW_COMPLETE])
+                     if fnmatch.fnmatch(os.path.realpath(event['dir']), os.path.realpath(dirglob))]
+    else:
+        journal = None
+        completed = [(os.path.abspath(os.path.dirname(flagfile)), None)
+                     for flagfile in glob.glob(os.path.join(dirglob, WORKFLOW_COMPLETION_FLAGFILE))]
+
+    for dir, event in completed:
+        if not os.path.exists(os.path.join(dir, WORKFLOW_COMPLETION_FLAGFILE)):
+            # staged out already (and removed)
+            logger.debug("Skipping %s without completion flag", dir)
+            continue
         
         logger.info("Starting staging out of %s", dir)
         try:
             s3prefix = S3_BUCKET
-            s3prefix = os.path.join(s3prefix, os.path.normpath(os.path.join(os.path.relpath(dir, basedir), "..")))
+            s3prefix = os.path.join(s3prefix, os.path.normpath(os.path.join(os.path.relpath(
+                os.path.realpath(dir), os.path.realpath(basedir)), "..")))
             cmd = [STAGE_OUT_WORKER, '-p', s3prefix, '-r', dir]
             _ = subprocess.check_output(cmd)
         except subprocess.CalledProcessError as e:
-            logger.fatal("%s failed with exit code %s: %s. Will try to continue", 
+            logger.fatal("%s failed with exit code %s: %s. Will try again next time", 
                          ' '.join(cmd), e.returncode, e.output)
+            if journal:
+                journal.defer(event)
             continue
+    if journal:
+        journal.commit()
 
 
 if __name__ == "__main__":
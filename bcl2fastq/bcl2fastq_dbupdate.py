@@ -1,7 +1,11 @@
 #!/usr/bin/env python3
-"""Crawl DB for started bcl2fastq runs and resp. output folders for
-flag files indicating completion, upon which DB needs update
+"""Update DB for completed bcl2fastq runs, which the pipeline signals
+with trigger files in its output folder.
 
+If a shared event journal is configured (see lib/eventjournal.py),
+only trigger files logged there are processed. Otherwise (or with
+--scan) the DB is crawled for started runs and their output folders
+are checked for trigger files.
 """
 
 
@@ -31,6 +35,10 @@ from mongodb import mongodb_conn
 from pipelines import generate_window
 from pipelines import PipelineHandler
 from utils import timestamp_from_string
+from pipelines import get_event_journal
+from eventjournal import JournalReader
+from eventjournal import BCL2FASTQ_DBUPDATE
+from manifest import MANIFEST
 
 
 __author__ = "Andreas Wilm"
@@ -103,14 +111,17 @@ class MongoUpdate(object):
             return True
 
 
-    def update_mux(self, status, mux_id, mux_dir):
-        """update status for mux
+    def update_mux(self, status, mux_id, mux_dir, manifest=None):
+        """update status for mux. checksums of its fastqs are added
+        from manifest if given
         """
         logger.info("Updating status for mux %s of analysis %s in run %s to %s",
                     mux_id, self.analysis_id, self.run_num, status)
         cmd = [self.mongo_status_per_mux_script, '-r', self.run_num,
                '-a', self.analysis_id, '-s', status,
                '-i', mux_id, '-d', mux_dir]
+        if manifest:
+            cmd.extend(['-m', manifest])
 
         if self.testing:
             cmd.append("-t")
@@ -178,6 +189,94 @@ def mux_dir_complete(muxdir, completed_after=None):
     return True
 
 
+def process_update(outdir, update_info, testing=False, dryrun=False):
+    """Update run and mux status in DB for completed run in outdir
+    (update_info has run_num, analysis_id and status). Returns False
+    if the update should be tried again later
+    """
+    # load mux info from config instead of relying on filesystem
+    #
+    logger.debug("Loading config for %s", outdir)
+    config_file = os.path.join(outdir, PipelineHandler.PIPELINE_CFGFILE)
+    if not os.path.exists(config_file):
+        logger.critical("Missing config file %s. Skipping this directory", config_file)
+        return False
+    with open(config_file) as fh:
+        cfg = yaml.safe_load(fh)
+    muxes = dict([(x['mux_id'], x['mux_dir']) for x in cfg['units'].values()])
+
+    mongo_updater = MongoUpdate(update_info['run_num'],
+                                update_info['analysis_id'],
+                                testing, dryrun)
+
+    res = mongo_updater.update_run(update_info['status'], outdir)
+    if not res:
+        # don't processe muxes. try again later
+        logger.critical("Skipping this analysis (%s) for run %s",
+                        update_info['analysis_id'], update_info['run_num'])
+        return False
+
+    # update per MUX
+    #
+    for mux_id, mux_dir_base in muxes.items():
+        mux_dir = os.path.join(outdir, "out", mux_dir_base)# ugly
+        if mux_dir_complete(mux_dir):
+            # skip the ones completed before
+            completed_after = timestamp_from_string(update_info['analysis_id'])
+            if not mux_dir_complete(mux_dir, completed_after=completed_after):
+                continue
+            no_archive = cfg.get('no_archive', None)
+            if no_archive:
+                status = 'NOARCHIVE'
+            else:
+                status = 'SUCCESS'
+        else:
+            status = 'FAILED'
+
+        manifest = os.path.join(outdir, "out", MANIFEST)
+        if status == 'FAILED' or not os.path.exists(manifest):
+            manifest = None
+        res = mongo_updater.update_mux(status, mux_id, mux_dir_base, manifest)
+        if not res:
+            # try again later
+            logger.critical("Skipping rest of analysis %s for run %s",
+                            update_info['analysis_id'], update_info['run_num'])
+            return False
+    return True
+
+
+def process_trigger_file(outdir, trigger_file, testing=False, dryrun=False):
+    """Process trigger file in outdir, which is deleted if the update
+    succeeded. Returns False if the update should be tried again later
+    """
+    logger.debug("Processing trigger file %s", trigger_file)
+    with open(trigger_file) as fh:
+        update_info = yaml.safe_load(fh)
+
+    # don't delete trigger if update failed. try again later
+    if not process_update(outdir, update_info, testing, dryrun):
+        return False
+    if not dryrun:
+        os.unlink(trigger_file)
+    return True
+
+
+def process_trigger_files(outdirs, testing=False, dryrun=False):
+    """Process trigger files in outdirs. Returns number of trigger
+    files found
+    """
+    num_triggers = 0
+    for outdir in outdirs:
+        for i in range(DBUPDATE_TRIGGER_FILE_MAXNUM+1):
+            # multiple trigger files per directory allowed (but rare)
+            trigger_file = os.path.join(outdir, DBUPDATE_TRIGGER_FILE_FMT.format(num=i))
+            if not os.path.exists(trigger_file):
+                continue
+            num_triggers += 1
+            process_trigger_file(outdir, trigger_file, testing, dryrun)
+    return num_triggers
+
+
 def main():
     """main function
     """
@@ -190,10 +289,13 @@ def main():
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument('-t', "--testing", action='store_true',
                         help="Use MongoDB test server")
+    parser.add_argument('--scan', action='store_true',
+                        help="Look for trigger files in output folders of started runs"
+                        " even if an event journal is configured")
     parser.add_argument('-w', '--win', type=int,
-                        help="Restrict to runs within last x days)")
+                        help="Restrict scan to runs within last x days)")
     parser.add_argument('--outdirs', nargs="*",
-                        help="Ignore DB entries and go through this list"
+                        help="Ignore DB entries and scan this list"
                         " of directories (DEBUGGING)")
     parser.add_argument('-n', '--dry-run', action='store_true')
     parser.add_argument('-v', '--verbose', action='count', default=0,
@@ -214,80 +316,43 @@ def main():
     # script -qqq -> no logging at all
     logger.setLevel(logging.WARN + 10*args.quiet - 10*args.verbose)
 
-    if args.outdirs:
-        logger.warning("Using manually defined outdirs")
-        outdirs = args.outdirs
-    else:
-        # generator!
-        outdirs = get_started_outdirs_from_db(args.testing, args.win)
-
-    num_triggers = 0
-    for outdir in outdirs:
-
-        # load mux info from config instead of relying on filesystem
-        #
-        logger.debug("Loading config for %s", outdir)
-        config_file = os.path.join(outdir, PipelineHandler.PIPELINE_CFGFILE)
-        if not os.path.exists(config_file):
-            logger.critical("Missing config file %s. Skipping this directory", config_file)
+    journal_file = get_event_journal()
+    if args.outdirs or args.scan or not journal_file:
+        if args.outdirs:
+            logger.warning("Using manually defined outdirs")
+            outdirs = args.outdirs
+        else:
+            # generator!
+            outdirs = get_started_outdirs_from_db(args.testing, args.win)
+        num_triggers = process_trigger_files(outdirs, args.testing, args.dry_run)
+        logger.info("%s dirs with triggers", num_triggers)
+        return
+
+    journal = JournalReader("bcl2fastq_dbupdate.testing" if args.testing else "bcl2fastq_dbupdate",
+                            journal_file)
+    events = journal.events([BCL2FASTQ_DBUPDATE])
+    for event in events:
+        logger.debug("Processing event %s", event)
+        trigger_file = event.get('flag')
+        if not trigger_file:
+            logger.warning("Ignoring event without trigger file for %s", event['dir'])
             continue
-        with open(config_file) as fh:
-            cfg = yaml.safe_load(fh)
-        muxes = dict([(x['mux_id'], x['mux_dir']) for x in cfg['units'].values()])
-
-        # look for trigger files. use their info for update and delete
-        #
-        for i in range(DBUPDATE_TRIGGER_FILE_MAXNUM+1):
-            # multiple trigger files per directory allowed (but rare)
-            trigger_file = os.path.join(outdir, DBUPDATE_TRIGGER_FILE_FMT.format(num=i))
-            if not os.path.exists(trigger_file):
-                continue
-
-            logger.debug("Processing trigger file %s", trigger_file)
-            num_triggers += 1
-            with open(trigger_file) as fh:
-                update_info = yaml.safe_load(fh)
-
-            mongo_updater = MongoUpdate(update_info['run_num'],
-                                        update_info['analysis_id'],
-                                        args.testing, args.dry_run)
-
-            res = mongo_updater.update_run(update_info['status'], outdir)
-            if not res:
-                # don't delete trigger. don't processe muxes. try again later
-                logger.critical("Skipping this analysis (%s) for run %s",
-                                update_info['analysis_id'], update_info['run_num'])
-                continue
-
-            # update per MUX
-            #
-            keep_trigger = False
-            for mux_id, mux_dir_base in muxes.items():
-                mux_dir = os.path.join(outdir, "out", mux_dir_base)# ugly
-                if mux_dir_complete(mux_dir):
-                    # skip the ones completed before
-                    completed_after = timestamp_from_string(update_info['analysis_id'])
-                    if not mux_dir_complete(mux_dir, completed_after=completed_after):
-                        continue
-                    no_archive = cfg.get('no_archive', None)
-                    if no_archive:
-                        status = 'NOARCHIVE'
-                    else:
-                        status = 'SUCCESS'
-                else:
-                    status = 'FAILED'
-
-                res = mongo_updater.update_mux(status, mux_id, mux_dir_base)
-                if not res:
-                    # don't delete trigger. try again later
-                    logger.critical("Skipping rest of analysis %s for run %s",
-                                    update_info['analysis_id'], update_info['run_num'])
-                    keep_trigger = True
-                    break
-
-            if not args.dry_run and not keep_trigger:
-                os.unlink(trigger_file)
-    logger.info("%s dirs with triggers", num_triggers)
+        if not os.path.exists(trigger_file):
+            # processed by a scan already
+            logger.debug("Skipping non-existing trigger file %s", trigger_file)
+            continue
+        # one broken event must not stop the others (and the commit)
+        try:
+            if not process_trigger_file(event['dir'], trigger_file, args.testing, args.dry_run):
+                journal.defer(event)
+        except OSError as err:
+            logger.critical("Processing %s failed: %s. Will try again next time", trigger_file, err)
+            journal.defer(event)
+        except (yaml.YAMLError, KeyError, TypeError) as err:
+            logger.critical("Ignoring malformed trigger file %s: %s", trigger_file, err)
+    if not args.dry_run:
+        journal.commit()
+    logger.info("%s update events", len(events))
 
 if __name__ == "__main__":
     main()
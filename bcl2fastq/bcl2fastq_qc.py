@@ -16,6 +16,16 @@ have to be summed up.
 'Undetermined' specific info is separately listed in
 default/Undetermined/unknown/lane.html
 
+The same per lane metrics are derived much faster from Stats.json,
+which bcl2fastq writes to the stats dir of each MUX. The html reports
+are only parsed if Stats.json is missing or unreadable.
+
+Lane, MUX and sample metrics of every checked run are recorded in the
+QC metrics database (see lib/qcmetricsdb.py). Lane metrics are
+compared against the history of the same instrument. Outliers are
+reported, but only fail the checks with --fail-on-outliers. Historical
+runs can be added by running this script with --no-mail on their
+bcl2fastq directories.
 """
 
 #--- standard library imports
@@ -24,10 +34,15 @@ import sys
 import os
 import glob
 import re
+import json
 import pprint
 from collections import OrderedDict
+from collections import namedtuple
 import argparse
 import logging
+import sqlite3
+from datetime import datetime
+import xml.etree.ElementTree as ET
 
 #--- third-party imports
 #
@@ -46,6 +61,11 @@ from pipelines import is_devel_version
 from pipelines import email_for_user
 from pipelines import send_mail
 from pipelines import path_to_url
+from qcmetricsdb import QCMetricsDB
+from qcmetricsdb import qc_db_file
+from qcmetricsdb import stats_rows
+from qcmetricsdb import lane_rows
+from utils import timestamp_from_string
 
 __author__ = "Andreas Wilm"
 __email__ = "wilma@gis.a-star.edu.sg"
@@ -63,6 +83,13 @@ logger.addHandler(handler)
 
 DEMUX_HTML_FILE_PATTERN = r'.*Project_(\w+)/html/([\w-]+)/\w+/\w+/\w+/lane.html'
 
+STATS_JSON = "Stats.json"
+
+# per lane metrics checked. percentages are None if not applicable
+# (non-muxed input)
+LaneQC = namedtuple('LaneQC', ['pf_clusters', 'pct_pf_clusters', 'pct_perfect_barcode',
+                               'pct_q30_bases', 'pct_undetermined'])
+
 
 def get_machine_type_from_run_num(run_num):
     """these are the values to be used in config for machine dependent settings"""
@@ -220,30 +247,170 @@ def gather_demux_stats(demux_html_files):
 
 
 
+def percent(count, total):
+    """percentage rounded like in the bcl2fastq html reports. None
+    if total is zero
+
+    >>> percent(1, 3), percent(0, 0)
+    (33.33, None)
+    """
+    if not total:
+        return None
+    return round(100.0 * count / total, 2)
+
+
+def lane_qc_from_stats(stats):
+    """Per lane metrics (LaneQC) from parsed bcl2fastq Stats.json as
+    OrderedDict with lane numbers as keys. Computed like the
+    all/all/all and Undetermined lane summaries of the html reports,
+    i.e. percentages of perfect barcodes and Q30 bases are relative to
+    all PF clusters of the lane, undetermined included
+
+    >>> stats = {'ConversionResults': [{
+    ...     'LaneNumber': 1, 'TotalClustersRaw': 2000, 'TotalClustersPF': 1800,
+    ...     'DemuxResults': [{
+    ...         'NumberReads': 1500,
+    ...         'IndexMetrics': [{'MismatchCounts': {'0': 1350, '1': 150}}],
+    ...         'ReadMetrics': [{'Yield': 150000, 'YieldQ30': 135000}]}],
+    ...     'Undetermined': {
+    ...         'NumberReads': 300,
+    ...         'ReadMetrics': [{'Yield': 30000, 'YieldQ30': 15000}]}}]}
+    >>> lane_qc_from_stats(stats)[1]
+    LaneQC(pf_clusters=1800, pct_pf_clusters=90.0, pct_perfect_barcode=75.0, pct_q30_bases=83.33, pct_undetermined=16.67)
+
+    Same as parsed from the html reports of this lane:
+
+    >>> import tempfile, shutil
+    >>> from lane_merge import tables_to_html
+    >>> project_dir = os.path.join(tempfile.mkdtemp(), "Project_MUX1")
+    >>> for page, tables in [
+    ...     ('all/all/all', [[['FC1 / all / all / all']],
+    ...                      [['Clusters (Raw)', 'Clusters(PF)', 'Yield (MBases)'], ['2,000', '1,800', '0']],
+    ...                      [['Lane', 'PF Clusters', '% of the lane', '% Perfect barcode',
+    ...                        '% One mismatch barcode', 'Yield (Mbases)', '% PF Clusters',
+    ...                        '% >= Q30 bases', 'Mean Quality Score'],
+    ...                       ['1', '1,800', '100.00', '75.00', '8.33', '0', '90.00', '83.33', '35.00']]]),
+    ...     ('default/Undetermined/all', [[['FC1 / default / Undetermined / all']],
+    ...                      [['Clusters (Raw)', 'Clusters(PF)', 'Yield (MBases)'], ['300', '300', '0']],
+    ...                      [['Lane', 'PF Clusters', '% of the lane', '% Perfect barcode',
+    ...                        '% One mismatch barcode', 'Yield (Mbases)', '% PF Clusters',
+    ...                        '% >= Q30 bases', 'Mean Quality Score'],
+    ...                       ['1', '300', '16.67', 'NaN', 'NaN', '0', '100.00', '50.00', '30.00']]])]:
+    ...     os.makedirs(os.path.join(project_dir, 'html', 'FC1', page))
+    ...     with open(os.path.join(project_dir, 'html', 'FC1', page, 'lane.html'), 'w') as fh:
+    ...         _ = fh.write(tables_to_html(tables))
+    >>> lane_qc_from_html(project_dir) == lane_qc_from_stats(stats)
+    True
+    >>> shutil.rmtree(os.path.dirname(project_dir))
+    >>> del stats['ConversionResults'][0]['DemuxResults'][0]['IndexMetrics']
+    >>> lane_qc_from_stats(stats)[1].pct_perfect_barcode is None
+    True
+    """
+    lane_qc = OrderedDict()
+    for conv in stats['ConversionResults']:
+        samples = conv.get('DemuxResults', [])
+        undetermined = conv.get('Undetermined')
+        indexed = [s for s in samples if s.get('IndexMetrics')]
+        if indexed:
+            perfect = sum(m['MismatchCounts'].get('0', 0)
+                          for s in indexed for m in s['IndexMetrics'])
+            pct_perfect_barcode = percent(perfect, conv['TotalClustersPF'])
+            pct_undetermined = percent(undetermined['NumberReads'] if undetermined else 0,
+                                       conv['TotalClustersPF'])
+        else:
+            # no barcodes, no demultiplexing
+            pct_perfect_barcode = pct_undetermined = None
+        read_metrics = [r for s in samples + ([undetermined] if undetermined else [])
+                        for r in s.get('ReadMetrics', [])]
+        pct_q30_bases = percent(sum(r['YieldQ30'] for r in read_metrics),
+                                sum(r['Yield'] for r in read_metrics))
+        lane_qc[conv['LaneNumber']] = LaneQC(
+            pf_clusters=conv['TotalClustersPF'],
+            pct_pf_clusters=percent(conv['TotalClustersPF'], conv['TotalClustersRaw']),
+            pct_perfect_barcode=pct_perfect_barcode,
+            pct_q30_bases=pct_q30_bases,
+            pct_undetermined=pct_undetermined)
+    return lane_qc
+
+
+def lane_qc_from_html(project_dir):
+    """Per lane metrics (LaneQC) parsed from html reports in
+    project_dir. Slow fallback for missing Stats.json
+    """
+    g = os.path.join(project_dir, 'html/*/all/all/all/lane.html')
+    f = glob.glob(g)
+    assert len(f) == 1, (
+        "Was expecting exactly one matching demux html"
+        " but found {} for glob {}".format(f, g))
+    _, lane_table = gather_demux_stats(f)
+
+    # info about 'undetermined' sits elsewhere (only makes sense if demuxed)
+    # for non-demuxed input (empty input files) everything below still works as expected
+    g = os.path.join(project_dir, 'html/*/default/Undetermined/all/lane.html')
+    _, undet_lane_table = gather_demux_stats(glob.glob(g))
+
+    lane_qc = OrderedDict()
+    for lane, values in lane_table.items():
+        lane_qc[lane] = LaneQC(
+            pf_clusters=values['PF Clusters'],
+            pct_pf_clusters=values['% PF Clusters'],
+            pct_perfect_barcode=values['% Perfect barcode'],
+            pct_q30_bases=values['% >= Q30 bases'],
+            pct_undetermined=undet_lane_table.get(lane, {}).get('% of the lane'))
+    return lane_qc
+
+
+def gather_lane_qc(project_dirs, stats=None):
+    """Per lane metrics (LaneQC) of all project dirs (logically
+    representing one run), from Stats.json if possible, otherwise
+    from html reports. If stats (dict) is given, successfully parsed
+    Stats.json contents are added to it with project dir as key
+    """
+    lane_qc = OrderedDict()
+    for d in project_dirs:
+        stats_json = os.path.join(d, STATS_JSON)
+        this_lane_qc = None
+        if os.path.exists(stats_json):
+            try:
+                with open(stats_json) as fh:
+                    this_stats = json.load(fh)
+                this_lane_qc = lane_qc_from_stats(this_stats)
+                if stats is not None:
+                    stats[d] = this_stats
+            except (ValueError, KeyError, TypeError) as err:
+                logger.warning("Couldn't parse %s (%s). Falling back to html reports",
+                               stats_json, err)
+        else:
+            logger.info("%s missing. Falling back to html reports", stats_json)
+        if this_lane_qc is None:
+            this_lane_qc = lane_qc_from_html(d)
+
+        for lane in this_lane_qc.keys():
+            assert lane not in lane_qc.keys(), (
+                "Seen lane {} before, i.e. project dirs are not from same run".format(lane))
+        lane_qc.update(this_lane_qc)
+    return lane_qc
+
+
 def run_qc_checks(project_dirs, machine_type):
     """main function"""
-    qcfails = []
     assert len(project_dirs) >= 1
 
-    # determine all all/all/all/lane.html in project subdirs of given demux_dir
-    #
-    demux_html_files = []
-    for d in project_dirs:
-        g = os.path.join(d, 'html/*/all/all/all/lane.html')
-        f = glob.glob(g)
-        assert len(f) == 1, (
-            "Was expecting exactly one matching demux html"
-            " but found {} for glob {}".format(f, g))
-        demux_html_files.extend(f)
-    flowcell_table, lane_table = gather_demux_stats(demux_html_files)
-    logger.debug("# Combined Flowcell Summary")
-    logger.debug(pprint.pformat(flowcell_table))
+    lane_qc = gather_lane_qc(project_dirs)
+    return check_lane_qc(lane_qc, machine_type)
+
+
+def check_lane_qc(lane_qc, machine_type):
+    """Check per lane metrics against configured limits. Returns list
+    of failures
+    """
+    qcfails = []
     logger.debug("# Combined per Lane")
-    logger.debug(pprint.pformat(lane_table))
+    logger.debug(pprint.pformat(lane_qc))
 
-    for lane, values in lane_table.items():
+    for lane, values in lane_qc.items():
         # test: pf
-        v = int(values['PF Clusters'] / 1000000.0)
+        v = int(values.pf_clusters / 1000000.0)
         l = config['min-pf-cluster-in-mil'][machine_type]
         if v < float(l):
             qcfails.append(
@@ -254,7 +421,7 @@ def run_qc_checks(project_dirs, machine_type):
             continue
 
         # test: % PF clusters 
-        v = values['% PF Clusters']
+        v = values.pct_pf_clusters
         l = config['min-pf-clusters'][machine_type]
         if v < float(l):
             qcfails.append(
@@ -262,7 +429,7 @@ def run_qc_checks(project_dirs, machine_type):
                 " ({} < {}) for lane {}".format(v, l, lane))
         
         # test: perfect barcode
-        v = values['% Perfect barcode']
+        v = values.pct_perfect_barcode
         l = config['min-percent-perfect-barcode']
         if v is not None:# muxed input
             if v < float(l):
@@ -271,7 +438,7 @@ def run_qc_checks(project_dirs, machine_type):
                     " ({} < {}) for lane {}".format(v, l, lane))
 
         # test: Q30 bases
-        v = values['% >= Q30 bases']
+        v = values.pct_q30_bases
         l = config['min-percent-q30-bases'][machine_type]
         if v < float(l):
             qcfails.append(
@@ -289,24 +456,10 @@ def run_qc_checks(project_dirs, machine_type):
         """
         
 
-    # info about 'undetermined' sits elsewhere (only makes sense if demuxed)
-    #
-    undet_demux_html_files = []
-    for d in project_dirs:
-        g = os.path.join(d, 'html/*/default/Undetermined/all/lane.html')
-        f = glob.glob(g)
-        if f:
-            # otherwise probably non-muxed
-            undet_demux_html_files.extend(f)
-    # for non-demuxed input (empty input files) everything below still works as expected
-    _, undet_lane_table = gather_demux_stats(undet_demux_html_files)
-    logger.debug("# Undetermined combined per Lane")
-    logger.debug(pprint.pformat(undet_lane_table))
-
     # test: undetermined reads
     #
-    for lane, values in undet_lane_table.items():
-        v = values['% of the lane']
+    for lane, values in lane_qc.items():
+        v = values.pct_undetermined
         l = config['max-percent-undetermined']
         if v is not None:# muxed input
             if v > float(l):
@@ -316,6 +469,89 @@ def run_qc_checks(project_dirs, machine_type):
     return qcfails
 
 
+def analysis_date(bcl2fastq_dir):
+    """Epoch of analysis start encoded in the bcl2fastq directory name
+    (see bcl2fastq.py), otherwise modification time of its config
+
+    >>> from datetime import datetime
+    >>> d = analysis_date("/out/HS002/HS002-SR-R00224_BC9A6MACXX/bcl2fastq_2017-06-01T10-30-00.000000")
+    >>> datetime.fromtimestamp(d).isoformat()
+    '2017-06-01T10:30:00'
+    """
+    basename = os.path.basename(os.path.normpath(bcl2fastq_dir))
+    if basename.startswith("bcl2fastq_"):
+        try:
+            return timestamp_from_string(basename[len("bcl2fastq_"):]).timestamp()
+        except ValueError:
+            pass
+    return os.path.getmtime(os.path.join(bcl2fastq_dir, 'conf.yaml'))
+
+
+def date_from_run_folder_name(name):
+    """Epoch of the YYMMDD prefix of an Illumina run folder name (or
+    run id) or None
+
+    >>> d = date_from_run_folder_name("/seq/170601_NS500179_0123_AHXXXXXX/")
+    >>> datetime.fromtimestamp(d).isoformat()
+    '2017-06-01T00:00:00'
+    >>> date_from_run_folder_name("HS002-SR-R00224_BC9A6MACXX") is None
+    True
+    """
+    m = re.match(r'^(\d{6})_', os.path.basename(os.path.normpath(name)))
+    if not m:
+        return None
+    try:
+        return datetime.strptime(m.group(1), "%y%m%d").timestamp()
+    except ValueError:
+        return None
+
+
+def sequencing_date(rundir):
+    """Epoch of sequencing date of run in rundir: from the YYMMDD
+    prefix of the run folder or, since our run folders are renamed
+    after the run number, of the run id in RunInfo.xml, or from its
+    Date element. None if unknown
+    """
+    date = date_from_run_folder_name(rundir)
+    if date:
+        return date
+    try:
+        root = ET.parse(os.path.join(rundir, "RunInfo.xml")).getroot()
+    except (OSError, ET.ParseError):
+        return None
+    run = root.find("Run")
+    if run is None:
+        return None
+    date = date_from_run_folder_name(run.get("Id", ""))
+    if date:
+        return date
+    date = run.findtext("Date")
+    if date:
+        # YYMMDD or e.g. 6/1/2017 10:30:00 AM
+        for fmt in ["%y%m%d", "%m/%d/%Y %I:%M:%S %p"]:
+            try:
+                return datetime.strptime(date.strip(), fmt).timestamp()
+            except ValueError:
+                pass
+    return None
+
+
+def record_qc_metrics(db, run_num, bcl2fastq_dir, lane_qc, mux_stats, rundir=None):
+    """Record lane metrics (LaneQC) and metrics derived from parsed
+    Stats.json per mux id (mux_stats) of run in QC metrics database
+    db. Runs are dated by sequencing date (see sequencing_date()), if
+    unknown by analysis date. Returns number of recorded values
+    """
+    rows = lane_rows(OrderedDict((lane, values._asdict()) for lane, values in lane_qc.items()))
+    for mux_id, stats in mux_stats.items():
+        rows.extend(stats_rows(stats, mux_id))
+    run_date = sequencing_date(rundir) if rundir else None
+    if run_date is None:
+        logger.warning("Sequencing date of %s unknown: using analysis date", run_num)
+        run_date = analysis_date(bcl2fastq_dir)
+    return db.ingest_run(run_num, run_date, rows, bcl2fastq_dir)
+
+
 def main():
     """main function
     """
@@ -325,6 +561,14 @@ def main():
                         help="bcl2fastq directory (containing a conf.yaml)")
     parser.add_argument('--no-mail', action='store_true',
                         help="Don't send email on detected failures")
+    default = qc_db_file()
+    parser.add_argument('--db', default=default,
+                        help="QC metrics database (default: {})".format(default))
+    parser.add_argument('--no-db', action='store_true',
+                        help="Don't record metrics and don't check for outliers")
+    parser.add_argument('--fail-on-outliers', action='store_true',
+                        help="Treat outliers compared to previous runs of the"
+                        " same instrument as failures")
     parser.add_argument('-v', '--verbose', action='count', default=0,
                         help="Increase verbosity")
     parser.add_argument('-q', '--quiet', action='count', default=0,
@@ -354,18 +598,44 @@ def main():
     machine_type = get_machine_type_from_run_num(run_num)
 
     project_dirs = []
+    mux_ids = dict()
     for _, mux_info in bcl2fastq_cfg["units"].items():
         d = os.path.join(args.bcl2fastq_dir, "out", mux_info['mux_dir'])
         if not os.path.exists(d):
             logger.warning("Ignoring missing directory %s", d)
         else:
             project_dirs.append(d)
+            mux_ids[d] = mux_info.get('mux_id', mux_info['mux_dir'])
 
     if len(project_dirs) == 0:
         logger.error("Exiting because no project directories where found in %s", args.bcl2fastq_dir)
         sys.exit(1)
         
-    qcfails = run_qc_checks(project_dirs, machine_type)
+    stats = dict()
+    lane_qc = gather_lane_qc(project_dirs, stats)
+    qcfails = check_lane_qc(lane_qc, machine_type)
+
+    if not args.no_db:
+        # metrics history is nice to have: never let it break the checks
+        try:
+            db = QCMetricsDB(args.db)
+            n = record_qc_metrics(db, run_num, args.bcl2fastq_dir, lane_qc,
+                                  OrderedDict((mux_ids[d], stats[d]) for d in stats),
+                                  bcl2fastq_cfg.get('rundir'))
+            logger.info("Recorded %d QC metrics in %s", n, args.db)
+            outliers = db.outliers(run_num)
+            db.close()
+        except (sqlite3.Error, OSError, KeyError, TypeError, AssertionError) as err:
+            logger.warning("Couldn't record QC metrics in %s: %s", args.db, err)
+            outliers = []
+        for level, unit, metric, value, median, z in outliers:
+            msg = "{} {:.2f} is an outlier for {} {} compared to previous runs" \
+                  " of the instrument (median {:.2f}, robust z-score {})".format(
+                      metric, value, level, unit, median, z)
+            if args.fail_on_outliers:
+                qcfails.append(msg)
+            else:
+                logger.warning(msg)
 
     if qcfails:
         subject = "bcl2fastq QC checks failed for {} ({}):".format(
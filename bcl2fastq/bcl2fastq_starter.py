@@ -1,5 +1,15 @@
 #!/usr/bin/env python3
 """Cronjob for triggering bcl2fastq runs
+
+Pending runs are launched concurrently by a bounded pool of workers.
+Each run is locked while being launched and remembered once launched
+(see --lock-dir), so that neither overlapping cron invocations nor a
+run still waiting in the queue (analysis not yet set in the DB) cause
+a second start. Deliberate reruns within --relaunch-hours of the last
+launch (e.g. after removing the analysis from the DB) need --relaunch.
+Per-run launch latency (time since run completion and time spent in
+the wrapper) is logged and appended to launches.tsv in the lock
+directory.
 """
 
 
@@ -9,6 +19,10 @@ import sys
 import os
 import argparse
 import subprocess
+import time
+import fcntl
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 # project specific imports
 #
@@ -35,12 +49,134 @@ handler.setFormatter(logging.Formatter(
 logger.addHandler(handler)
 
 
+DEFAULT_LOCK_DIR = os.path.join(os.path.expanduser("~"), ".cache", "rpd", "bcl2fastq_starter")
+
+LAUNCHES_TSV = "launches.tsv"
+LAUNCHES_COLS = ['run', 'status', 'since_complete_s', 'launch_s', 'epoch']
+
+# launch outcomes
+LAUNCHED = "LAUNCHED"
+FAILED = "FAILED"
+SKIPPED = "SKIPPED"
+
+
+def last_launch(lock_file):
+    """epoch of last successful launch recorded in lock_file or None"""
+    if not os.path.exists(lock_file):
+        return None
+    with open(lock_file) as fh:
+        content = fh.read().strip()
+    return float(content) if content else None
+
+
+def recently_launched(launch_epoch, now, hours):
+    """Whether a launch at launch_epoch (None if never) is less than
+    hours ago
+
+    >>> recently_launched(None, 1000000, 24)
+    False
+    >>> recently_launched(1000000 - 3600, 1000000, 24)
+    True
+    >>> recently_launched(1000000 - 25*3600, 1000000, 24)
+    False
+    """
+    if launch_epoch is None:
+        return False
+    return now - launch_epoch < hours * 3600
+
+
+def log_launch(lock_dir, run_number, status, since_complete_s, launch_s):
+    """Append launch latency of run to launches.tsv in lock_dir"""
+    tsv = os.path.join(lock_dir, LAUNCHES_TSV)
+    values = [run_number, status, "{:.1f}".format(since_complete_s),
+              "{:.1f}".format(launch_s), "{:.0f}".format(time.time())]
+    with open(tsv, 'a') as fh:
+        # shared by concurrent workers and cron invocations
+        fcntl.lockf(fh, fcntl.LOCK_EX)
+        try:
+            if fh.tell() == 0:
+                fh.write("\t".join(LAUNCHES_COLS) + "\n")
+            fh.write("\t".join(values) + "\n")
+            fh.flush()
+        finally:
+            fcntl.lockf(fh, fcntl.LOCK_UN)
+
+
+def launch_run(record, cmd, lock_dir, relaunch_hours, dry_run, stop, stop_after_launch=False):
+    """Launch bcl2fastq wrapper cmd for runcomplete record unless
+    another process is launching it, it was launched within
+    relaunch_hours or stop (threading.Event) is set. Sets stop on
+    qmaster problems and, if stop_after_launch, after a successful
+    launch. Returns outcome (LAUNCHED, FAILED or SKIPPED) and wrapper
+    output
+    """
+    run_number = record['run']
+    if stop.is_set():
+        return SKIPPED, None
+    lock_file = os.path.join(lock_dir, "{}.lock".format(run_number))
+
+    if dry_run:
+        if recently_launched(last_launch(lock_file), time.time(), relaunch_hours):
+            logger.warning("Skipping %s: launched less than %d hours ago"
+                           " (use --relaunch to override)", run_number, relaunch_hours)
+        else:
+            logger.warning("Skipped following run: %s", ' '.join(cmd))
+        return SKIPPED, None
+
+    with open(lock_file, 'a+') as fh:
+        try:
+            fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logger.warning("Skipping %s: locked by another process", run_number)
+            return SKIPPED, None
+        # lock is released on close
+        fh.seek(0)
+        content = fh.read().strip()
+        if recently_launched(float(content) if content else None, time.time(), relaunch_hours):
+            logger.warning("Skipping %s: launched less than %d hours ago"
+                           " (use --relaunch to override)", run_number, relaunch_hours)
+            return SKIPPED, None
+
+        start = time.time()
+        since_complete_s = start - record['timestamp'] / 1000.0
+        try:
+            logger.info("Executing: %s", ' '.join(cmd))
+            res = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError as e:
+            log_launch(lock_dir, run_number, FAILED, since_complete_s, time.time() - start)
+            logger.critical("The following command failed with"
+                            " return code %s: %s", e.returncode, ' '.join(cmd))
+            logger.critical("Full error message was: %s", e.stdout)
+            if 'commlib error' in e.stdout.decode():
+                logger.critical(
+                    "Looks like a qmaster problem (commlib error). Exiting")
+                stop.set()
+            else:
+                # a failed run doesn't count, i.e. stop_after_launch
+                # shouldn't be triggered
+                logger.critical("Will keep going")
+            return FAILED, e.stdout.decode()
+
+        launch_s = time.time() - start
+        fh.seek(0)
+        fh.truncate()
+        fh.write("{:.0f}\n".format(start))
+        fh.flush()
+    if stop_after_launch:
+        logger.info("Stopping after first sequencing run")
+        stop.set()
+    log_launch(lock_dir, run_number, LAUNCHED, since_complete_s, launch_s)
+    logger.info("Launched %s %.1fs after run completion (wrapper took %.1fs)",
+                run_number, since_complete_s, launch_s)
+    return LAUNCHED, res.decode()
+
+
 def main():
     """main function"""
 
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument('-1', "--break-after-first", action='store_true',
-                        help="Only process first run returned")
+                        help="Only process first run returned (implies --jobs 1)")
     parser.add_argument('-n', "--dry-run", action='store_true',
                         help="Don't run anything")
     parser.add_argument('-t', "--testing", action='store_true',
@@ -51,6 +187,20 @@ def main():
     default = 14
     parser.add_argument('-w', '--win', type=int, default=default,
                         help="Number of days to look back (default {})".format(default))
+    default = 4
+    parser.add_argument('-j', '--jobs', type=int, default=default,
+                        help="Number of runs launched in parallel (default {})".format(default))
+    parser.add_argument('--lock-dir',
+                        help="Directory for per-run lock files and launch log"
+                        " (default: {}[.testing])".format(DEFAULT_LOCK_DIR))
+    default = 24
+    parser.add_argument('--relaunch-hours', type=int, default=default,
+                        help="Don't launch runs again that were launched less than this"
+                        " many hours ago, i.e. are probably still queued. 0 disables"
+                        " this check (default {})".format(default))
+    parser.add_argument('--relaunch', nargs="+", default=[], metavar="RUN",
+                        help="Launch these runs even if launched less than"
+                        " --relaunch-hours ago (deliberate reruns)")
     parser.add_argument('-v', '--verbose', action='count', default=0,
                         help="Increase verbosity")
     parser.add_argument('-q', '--quiet', action='count', default=0,
@@ -70,6 +220,14 @@ def main():
 
     bcl2fastq_wrapper = os.path.join(os.path.dirname(sys.argv[0]), "bcl2fastq.py")
 
+    lock_dir = args.lock_dir
+    if not lock_dir:
+        lock_dir = DEFAULT_LOCK_DIR + (".testing" if args.testing else "")
+    if not args.dry_run:
+        os.makedirs(lock_dir, exist_ok=True)
+    # first successful launch has to stop the others
+    jobs = 1 if args.break_after_first else args.jobs
+
     connection = mongodb_conn(args.testing)
     if connection is None:
         sys.exit(1)
@@ -81,41 +239,29 @@ def main():
                        "timestamp": {"$gt": epoch_back, "$lt": epoch_present}})
     # results is a pymongo.cursor.Cursor which works like an iterator i.e. dont use len()
     logger.info("Found %s runs", results.count())
-    for record in results:
-        run_number = record['run']
-        logger.debug("Processing record %s", record)
-        cmd = [bcl2fastq_wrapper, "-r", run_number, "-v"]
-        if args.testing:
-            cmd.append("-t")
-        if args.wrapper_args:
-            cmd.extend([x.lstrip('X') for x in args.wrapper_args])
-        if args.dry_run:
-            logger.warning("Skipped following run: %s", ' '.join(cmd))
-            continue
-        else:
-            try:
-                logger.info("Executing: %s", ' '.join(cmd))
-                res = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
-                if res:
-                    logger.info("bcl2fastq wrapper returned:\n%s",
-                                res.decode().rstrip())
-            except subprocess.CalledProcessError as e:
-                logger.critical("The following command failed with"
-                                " return code %s: %s", e.returncode, ' '.join(cmd))
-                logger.critical("Full error message was: %s", e.stdout)
-                if 'commlib error' in e.stdout.decode():
-                    logger.critical(
-                        "Looks like a qmaster problem (commlib error). Exiting")
-                    break
-                else:
-                    logger.critical("Will keep going")
-                # continue so that a failed run doesn't count,
-                # i.e. args.break_after_first shouldn't be trigger
-                continue
-
-        if args.break_after_first:
-            logger.info("Stopping after first sequencing run")
-            break
+
+    # set on commlib error or after first launch if break_after_first
+    stop = threading.Event()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = []
+        for record in results:
+            run_number = record['run']
+            logger.debug("Processing record %s", record)
+            cmd = [bcl2fastq_wrapper, "-r", run_number, "-v"]
+            if args.testing:
+                cmd.append("-t")
+            if args.wrapper_args:
+                cmd.extend([x.lstrip('X') for x in args.wrapper_args])
+            relaunch_hours = 0 if run_number in args.relaunch else args.relaunch_hours
+            futures.append((run_number, executor.submit(
+                launch_run, record, cmd, lock_dir, relaunch_hours, args.dry_run,
+                stop, args.break_after_first)))
+
+        for run_number, future in futures:
+            status, output = future.result()
+            if status == LAUNCHED and output:
+                logger.info("bcl2fastq wrapper for %s returned:\n%s",
+                            run_number, output.rstrip())
 
     # close the connection to MongoDB
     connection.close()
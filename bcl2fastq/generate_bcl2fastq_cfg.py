@@ -35,6 +35,10 @@ MuxUnit = namedtuple('MuxUnit', ['run_id', 'flowcell_id', 'mux_id', 'lane_ids',
                                  'mux_dir', 'barcode_mismatches', 'requestor_email',
                                  'samplesheet', 'bcl2fastq_custom_args', 'tool'])
 
+# run metadata, loaded once (see load_run())
+Read = namedtuple('Read', ['number', 'num_cycles', 'is_index'])
+Run = namedtuple('Run', ['flowcell_id', 'reads', 'rest_data'])
+
 __author__ = "Lavanya Veeravalli"
 __email__ = "veeravallil@gis.a-star.edu.sg"
 __copyright__ = "2016 Genome Institute of Singapore"
@@ -103,11 +107,34 @@ def get_ub_str_index(ub, create_index, bc, non_mux_tech, libraryId):
             ub += 'n*'+','
     return ub
 
-def generate_usebases(barcode_lens, runinfo, create_index, non_mux_tech, libraryId):
-    """generate use_bases param
+def load_run(runinfo, flowcell_id, rest_data):
+    """Parse RunInfo.xml once and combine with ELM run record
+    (rest_data) into a Run
+
+    >>> import tempfile
+    >>> fd, runinfo = tempfile.mkstemp(suffix=".xml")
+    >>> with open(runinfo, 'w') as fh:
+    ...     _ = fh.write('<RunInfo><Run><Reads>'
+    ...                  '<Read Number="1" NumCycles="151" IsIndexedRead="N"/>'
+    ...                  '<Read Number="2" NumCycles="8" IsIndexedRead="Y"/>'
+    ...                  '<Read Number="3" NumCycles="151" IsIndexedRead="N"/>'
+    ...                  '</Reads></Run></RunInfo>')
+    >>> run = load_run(runinfo, "FC1", {'lanes': [{'laneId': '2'}, {'laneId': '1'}]})
+    >>> [(r.num_cycles, r.is_index) for r in run.reads]
+    [(151, False), (8, True), (151, False)]
+    >>> os.close(fd); os.unlink(runinfo)
+    """
+    root = ET.parse(runinfo).getroot()
+    reads = tuple(Read(int(read.attrib['Number']), int(read.attrib['NumCycles']),
+                       read.attrib['IsIndexedRead'] == 'Y')
+                  for read in root.iter('Read'))
+    return Run(flowcell_id=flowcell_id,
+               reads=reads,
+               rest_data=rest_data)
+
+def generate_usebases(barcode_lens, reads, create_index, non_mux_tech, libraryId):
+    """generate use_bases param for reads of run (see load_run())
     """
-    tree = ET.parse(runinfo)
-    root = tree.getroot()
     ub_list = dict()
     readLength_list = []
     # for each lane and its barcode lengths
@@ -116,15 +143,14 @@ def generate_usebases(barcode_lens, runinfo, create_index, non_mux_tech, library
         assert len(set(v)) == 1, ("Different barcode length in lane {}".format(k))
         bc1, bc2 = v[0]# since all v's are the same
         ub = ""
-        for read in root.iter('Read'):
-            numcyc = int(read.attrib['NumCycles'])
-            if read.attrib['IsIndexedRead'] == 'N':
+        for read in reads:
+            if not read.is_index:
                 ub += 'Y*,'
-                readLength_list.append(numcyc)
-            elif read.attrib['IsIndexedRead'] == 'Y':
-                if read.attrib['Number'] == '2':   ### BC1
+                readLength_list.append(read.num_cycles)
+            else:
+                if read.number == 2:   ### BC1
                     ub = get_ub_str_index(ub, create_index, bc1, non_mux_tech, libraryId)
-                elif read.attrib['Number'] == '3':    ### BC2
+                elif read.number == 3:    ### BC2
                     ub = get_ub_str_index(ub, create_index, bc2, non_mux_tech, libraryId)
         ub = ub[:-1]
         ub_list[k] = ub
@@ -147,9 +173,12 @@ def get_rest_data(run_num, test_server=None):
     logger.debug("rest_data from %s: %s", rest_url, rest_data)
     return rest_data
 
-def generate_samplesheet(rest_data, flowcellid, outdir, runinfo):
+def generate_samplesheet(run, outdir):
     """Generates sample sheet, mux_info and bcl2fastq custom params
+    for run (see load_run())
     """
+    rest_data = run.rest_data
+    flowcellid = run.flowcell_id
     barcode_lens = {}
     mux_units = dict()
     lib_list = dict()
@@ -242,7 +271,7 @@ def generate_samplesheet(rest_data, flowcellid, outdir, runinfo):
         create_index = False
         if 'indexreads' in rows and rows['indexreads']:
             create_index = True
-        usebases, readLength_list = generate_usebases(barcode_lens, runinfo, create_index, \
+        usebases, readLength_list = generate_usebases(barcode_lens, run.reads, create_index, \
             non_mux_tech, rows['libraryId'])
         use_bases_mask = " --use-bases-mask " + rows['laneId'] + ":" + usebases[rows['laneId']]
         bcl2fastq_custom_args = use_bases_mask
@@ -344,7 +373,8 @@ def main():
         with open(status_cfg, 'w') as fh_out:
             fh_out.write("SEQRUNFAILED")
         sys.exit(0)
-    status = generate_samplesheet(rest_data, flowcellid, outdir, runinfo)
+    run = load_run(runinfo, flowcellid, rest_data)
+    status = generate_samplesheet(run, outdir)
     if not status:
         with open(status_cfg, 'w') as fh_out:
             fh_out.write("NON-BCL")
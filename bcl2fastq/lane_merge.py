@@ -0,0 +1,380 @@
+"""Merge per-lane bcl2fastq (or cellranger mkfastq) output of one mux
+into the standard layout
+
+Demultiplexing runs per lane into <muxdir>/lanes/<lane>/, each with
+its own fastqs, Stats.json and html reports. Merging moves fastqs
+into the usual Sample_ directories of the mux (and undetermined
+fastqs into the result dir) and combines the stats and reports:
+Stats.json and the xml stats are merged, AdapterTrimming.txt
+concatenated and per-lane summaries (DemuxSummary*, FastqSummary*)
+copied. Html report pages existing for several lanes get their
+flowcell summary summed and lane rows concatenated (which is how
+bcl2fastq_qc.py combines reports across muxes).
+
+Each lane job must only see its own lane: samplesheet rows and
+use-bases-mask of other lanes would make it write (empty) fastqs
+under the names of the other lanes' jobs. See lane_samplesheet() and
+lane_custom_args().
+"""
+
+#--- standard library imports
+#
+import os
+import glob
+import json
+import shlex
+import shutil
+import logging
+import xml.etree.ElementTree as ET
+
+#--- third-party imports
+#
+#/
+
+#--- project specific imports
+#
+from html_table_parser import HTMLTableParser
+
+
+__author__ = "Andreas Wilm"
+__email__ = "wilma@gis.a-star.edu.sg"
+__copyright__ = "2017 Genome Institute of Singapore"
+__license__ = "The MIT License (MIT)"
+
+
+# global logger
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(
+    '[{asctime}] {levelname:8s} {filename} {message}', style='{'))
+logger.addHandler(handler)
+
+
+LANES_DIR = "lanes"
+STATS_JSON = "Stats.json"
+# further bcl2fastq --stats-dir files
+XML_STATS = ["ConversionStats.xml", "DemultiplexingStats.xml"]
+TABLE_STATS = ["AdapterTrimming.txt"]
+PER_LANE_STATS = ["DemuxSummaryF*L*.txt", "FastqSummaryF*L*.txt"]
+
+
+def lane_dir(muxdir, lane):
+    """per-lane output directory of mux
+
+    >>> lane_dir("out/Project_MUX1", 2)
+    'out/Project_MUX1/lanes/2'
+    """
+    return os.path.join(muxdir, LANES_DIR, str(lane))
+
+
+def lane_samplesheet(samplesheet, lane, dst):
+    """Write copy of samplesheet to dst, keeping only [Data] rows of
+    given lane (all if there's no Lane column). Other sections are
+    kept as is
+
+    >>> import tempfile
+    >>> d = tempfile.mkdtemp()
+    >>> src, dst = os.path.join(d, "in.csv"), os.path.join(d, "out.csv")
+    >>> with open(src, 'w') as fh:
+    ...     _ = fh.write("[Data]\\nLane,Sample_ID,index\\n1,S1,AAAA\\n2,S1,AAAA\\n2,S2,CCCC\\n[Settings]\\nAdapter,AGATC\\n")
+    >>> lane_samplesheet(src, 2, dst)
+    >>> print(open(dst).read(), end="")
+    [Data]
+    Lane,Sample_ID,index
+    2,S1,AAAA
+    2,S2,CCCC
+    [Settings]
+    Adapter,AGATC
+    """
+    with open(samplesheet) as fh, open(dst, 'w') as fhout:
+        in_data = False
+        lane_col = None
+        header = None
+        for line in fh:
+            fields = line.strip().split(",")
+            if line.startswith("["):
+                in_data = line.strip() == "[Data]"
+                header = None
+            elif in_data and line.strip():
+                if header is None:
+                    header = fields
+                    lane_col = header.index("Lane") if "Lane" in header else None
+                elif lane_col is not None and fields[lane_col] != str(lane):
+                    continue
+            fhout.write(line)
+
+
+def lane_custom_args(custom_args, lane):
+    """Remove --use-bases-mask arguments for other lanes from custom
+    bcl2fastq arguments (masks of all lanes of a mux are listed)
+
+    >>> lane_custom_args(" --use-bases-mask 1:Y151,I8,Y151 --minimum-trimmed-read-length 20"
+    ...                  " --use-bases-mask 2:Y151,I6n*,Y151", 2)
+    '--minimum-trimmed-read-length 20 --use-bases-mask 2:Y151,I6n*,Y151'
+    >>> lane_custom_args("--use-bases-mask Y151,I8,Y151", 2)
+    '--use-bases-mask Y151,I8,Y151'
+    """
+    args = shlex.split(custom_args)
+    keep = []
+    i = 0
+    while i < len(args):
+        if args[i] == "--use-bases-mask" and i + 1 < len(args):
+            mask = args[i + 1]
+            if ":" not in mask or mask.split(":")[0] == str(lane):
+                keep.extend(args[i:i + 2])
+            i += 2
+            continue
+        keep.append(args[i])
+        i += 1
+    return " ".join(keep)
+
+
+def move_fastqs(lanedir, muxdir, undetermined_dir):
+    """Move sample fastqs of one lane into the mux' sample dirs and
+    undetermined fastqs into undetermined_dir. Refuses to overwrite
+    existing files. Returns number of moved files
+    """
+    moves = []
+    # project dir is named like the mux dir, but don't rely on it
+    for project_dir in glob.glob(os.path.join(lanedir, "Project_*")):
+        for root, _, files in os.walk(project_dir):
+            for f in files:
+                src = os.path.join(root, f)
+                moves.append((src, os.path.join(muxdir, os.path.relpath(src, project_dir))))
+    for src in glob.glob(os.path.join(lanedir, "Undetermined*")):
+        moves.append((src, os.path.join(undetermined_dir, os.path.basename(src))))
+
+    for src, dst in moves:
+        if os.path.exists(dst):
+            raise OSError("Refusing to overwrite {} with {}".format(dst, src))
+    for src, dst in moves:
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        os.rename(src, dst)
+    return len(moves)
+
+
+def merge_stats(stats_list):
+    """Combine per-lane Stats.json contents: run level values are
+    taken from the first, per-lane lists concatenated and sorted by
+    lane
+
+    >>> a = {'Flowcell': 'FC', 'ConversionResults': [{'LaneNumber': 2}], 'UnknownBarcodes': [{'Lane': 2}]}
+    >>> b = {'Flowcell': 'FC', 'ConversionResults': [{'LaneNumber': 1}], 'UnknownBarcodes': [{'Lane': 1}]}
+    >>> m = merge_stats([a, b])
+    >>> m['Flowcell'], [r['LaneNumber'] for r in m['ConversionResults']], [r['Lane'] for r in m['UnknownBarcodes']]
+    ('FC', [1, 2], [1, 2])
+    """
+    merged = dict(stats_list[0])
+    for key, value in merged.items():
+        if not isinstance(value, list):
+            continue
+        merged[key] = []
+        for stats in stats_list:
+            merged[key].extend(stats.get(key, []))
+        merged[key].sort(key=lambda x: x.get('LaneNumber', x.get('Lane', 0))
+                         if isinstance(x, dict) else 0)
+    return merged
+
+
+def merge_xml_trees(roots):
+    """Merge xml stats trees (ConversionStats.xml,
+    DemultiplexingStats.xml) of several lanes: elements with same tag
+    and attributes are merged recursively, others (e.g. Lane elements)
+    added. Returns merged root (the first, modified)
+
+    >>> a = ET.fromstring('<Stats><Flowcell flowcell-id="FC"><Sample name="S"><Lane number="1"><x>1</x></Lane></Sample></Flowcell></Stats>')
+    >>> b = ET.fromstring('<Stats><Flowcell flowcell-id="FC"><Sample name="S"><Lane number="2"><x>2</x></Lane></Sample></Flowcell></Stats>')
+    >>> ET.tostring(merge_xml_trees([a, b])).decode()
+    '<Stats><Flowcell flowcell-id="FC"><Sample name="S"><Lane number="1"><x>1</x></Lane><Lane number="2"><x>2</x></Lane></Sample></Flowcell></Stats>'
+    """
+    def merge(dst, src):
+        for child in src:
+            match = [c for c in dst if c.tag == child.tag and c.attrib == child.attrib]
+            if not match:
+                dst.append(child)
+            elif len(child):
+                merge(match[0], child)
+            # else: leaf present in both, keep first
+    merged = roots[0]
+    for root in roots[1:]:
+        merge(merged, root)
+    return merged
+
+
+def concat_tables(srcs, dst):
+    """Concatenate text tables (e.g. AdapterTrimming.txt), keeping the
+    header (first line) only once
+    """
+    header = None
+    with open(dst, 'w') as fhout:
+        for src in srcs:
+            with open(src) as fh:
+                for i, line in enumerate(fh):
+                    if i == 0:
+                        if header == line:
+                            continue
+                        header = header if header else line
+                    fhout.write(line)
+
+
+def merge_stats_files(lanedirs, report_dir):
+    """Combine bcl2fastq stats files other than Stats.json of several
+    lanes into report_dir
+    """
+    for f in XML_STATS:
+        srcs = [os.path.join(d, f) for d in lanedirs if os.path.exists(os.path.join(d, f))]
+        if srcs:
+            tree = ET.ElementTree(merge_xml_trees([ET.parse(s).getroot() for s in srcs]))
+            tree.write(os.path.join(report_dir, f), encoding='utf-8', xml_declaration=True)
+    for f in TABLE_STATS:
+        srcs = [os.path.join(d, f) for d in lanedirs if os.path.exists(os.path.join(d, f))]
+        if srcs:
+            concat_tables(srcs, os.path.join(report_dir, f))
+    for lanedir in lanedirs:
+        for pattern in PER_LANE_STATS:
+            for src in glob.glob(os.path.join(lanedir, pattern)):
+                dst = os.path.join(report_dir, os.path.basename(src))
+                if os.path.exists(dst):
+                    logger.warning("Not overwriting %s with %s", dst, src)
+                    continue
+                shutil.copyfile(src, dst)
+
+
+def _sum_cells(cells):
+    """Sum bcl2fastq formatted numbers (thousands separator) or return
+    the first value if not numeric
+
+    >>> _sum_cells(["1,000", "2,500"]), _sum_cells(["FC", "FC"])
+    ('3,500', 'FC')
+    """
+    try:
+        total = sum(int(c.replace(",", "")) for c in cells)
+    except ValueError:
+        return cells[0]
+    return "{:,}".format(total)
+
+
+def merge_report_tables(tables_list):
+    """Merge parsed tables of the same bcl2fastq report page from
+    several lanes: page title from the first, flowcell summary summed,
+    rows of all further tables (lane or lane-barcode summary, top
+    unknown barcodes) concatenated. Returns None if pages don't have
+    the same layout, i.e. number of tables and headers
+
+    >>> t1 = [[['FC1 / all']], [['Clusters (Raw)', 'Yield (MBases)'], ['1,000', '10']],
+    ...       [['Lane', 'PF Clusters'], ['1', '900']]]
+    >>> t2 = [[['FC1 / all']], [['Clusters (Raw)', 'Yield (MBases)'], ['2,000', '20']],
+    ...       [['Lane', 'PF Clusters'], ['2', '1,800']]]
+    >>> merge_report_tables([t1, t2])
+    [[['FC1 / all']], [['Clusters (Raw)', 'Yield (MBases)'], ['3,000', '30']], [['Lane', 'PF Clusters'], ['1', '900'], ['2', '1,800']]]
+    >>> merge_report_tables([t1, t2[:2]]) is None
+    True
+    """
+    first = tables_list[0]
+    if len(first) < 3 or len(first[1]) != 2:
+        return None
+    for tables in tables_list[1:]:
+        if len(tables) != len(first) or len(tables[1]) != 2 or \
+           any(t[0] != f[0] for t, f in zip(tables[1:], first[1:])):
+            return None
+    summary = [first[1][0]] + [[_sum_cells(list(cells)) for cells in zip(
+        *[tables[1][1] for tables in tables_list])]]
+    merged = [first[0], summary]
+    for i in range(2, len(first)):
+        merged.append([first[i][0]] + [row for tables in tables_list for row in tables[i][1:]])
+    return merged
+
+
+def tables_to_html(tables):
+    """Minimal html with tables (first row of each as header)"""
+    html = ["<html>", "<body>"]
+    for table in tables:
+        html.append("<table border=\"1\">")
+        for i, row in enumerate(table):
+            tag = "th" if i == 0 else "td"
+            html.append("<tr>" + "".join("<{0}>{1}</{0}>".format(tag, c) for c in row) + "</tr>")
+        html.append("</table>")
+    html.extend(["</body>", "</html>"])
+    return "\n".join(html) + "\n"
+
+
+def parse_report_tables(html_file):
+    """tables of a bcl2fastq html report page"""
+    parser = HTMLTableParser()
+    with open(html_file, encoding='utf-8') as fh:
+        parser.feed(fh.read())
+    return parser.tables
+
+
+def merge_reports(lanedirs, report_dir):
+    """Combine per-lane html report trees into report_dir/html. Pages
+    present in only one lane (and non-html files) are copied as is.
+    Pages which can't be merged get the tables of all lanes, one after
+    the other
+    """
+    pages = dict()
+    for lanedir in lanedirs:
+        html_dir = os.path.join(lanedir, "html")
+        for root, _, files in os.walk(html_dir):
+            for f in files:
+                src = os.path.join(root, f)
+                pages.setdefault(os.path.relpath(src, html_dir), []).append(src)
+
+    for relpath, srcs in sorted(pages.items()):
+        dst = os.path.join(report_dir, "html", relpath)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        merged = None
+        if len(srcs) > 1 and relpath.endswith(".html"):
+            tables_list = [parse_report_tables(s) for s in srcs]
+            merged = merge_report_tables(tables_list)
+            if not merged and any(tables_list):
+                logger.warning("Can't merge report page %s of %d lanes: listing their tables one"
+                               " after the other", relpath, len(srcs))
+                merged = [table for tables in tables_list for table in tables]
+        if merged:
+            with open(dst, 'w', encoding='utf-8') as fh:
+                fh.write(tables_to_html(merged))
+        else:
+            shutil.copyfile(srcs[0], dst)
+
+
+def merge_lanes(muxdir, lanes, undetermined_dir, report_dir):
+    """Merge per-lane output of mux into standard layout: fastqs into
+    sample dirs, stats and html reports into report_dir (the former
+    bcl2fastq --stats-dir and --reports-dir)
+
+    Same sample in two lanes:
+
+    >>> import tempfile
+    >>> outdir = tempfile.mkdtemp()
+    >>> muxdir = os.path.join(outdir, "Project_MUX1")
+    >>> for lane in [1, 2]:
+    ...     sampledir = os.path.join(lane_dir(muxdir, lane), "Project_MUX1", "Sample_S1")
+    ...     os.makedirs(sampledir)
+    ...     for f in [os.path.join(sampledir, "S1_S1_L00{}_R1_001.fastq.gz".format(lane)),
+    ...               os.path.join(lane_dir(muxdir, lane), "Undetermined_S0_L00{}_R1_001.fastq.gz".format(lane))]:
+    ...         open(f, 'w').close()
+    >>> merge_lanes(muxdir, [1, 2], outdir, muxdir)
+    >>> sorted(os.listdir(os.path.join(muxdir, "Sample_S1")))
+    ['S1_S1_L001_R1_001.fastq.gz', 'S1_S1_L002_R1_001.fastq.gz']
+    >>> sorted(glob.glob(os.path.join(outdir, "Undetermined*"))) == [
+    ...     os.path.join(outdir, "Undetermined_S0_L00{}_R1_001.fastq.gz".format(l)) for l in [1, 2]]
+    True
+    """
+    lanedirs = [lane_dir(muxdir, lane) for lane in lanes]
+    for lanedir in lanedirs:
+        n = move_fastqs(lanedir, muxdir, undetermined_dir)
+        logger.info("Moved %d files from %s", n, lanedir)
+
+    stats_list = []
+    for lanedir in lanedirs:
+        stats_json = os.path.join(lanedir, STATS_JSON)
+        if os.path.exists(stats_json):
+            with open(stats_json) as fh:
+                stats_list.append(json.load(fh))
+    if stats_list:
+        with open(os.path.join(report_dir, STATS_JSON), 'w') as fh:
+            json.dump(merge_stats(stats_list), fh, indent=2)
+    merge_stats_files(lanedirs, report_dir)
+
+    merge_reports(lanedirs, report_dir)
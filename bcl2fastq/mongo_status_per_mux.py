@@ -20,6 +20,8 @@ LIB_PATH = os.path.abspath(
 if LIB_PATH not in sys.path:
     sys.path.insert(0, LIB_PATH)
 from mongodb import mongodb_conn
+from manifest import read_manifest
+from manifest import subdir_entries
 
 
 __author__ = "Lavanya Veeravalli"
@@ -50,6 +52,8 @@ def main():
     parser.add_argument('-s', "--mux-status",
                         help="Analysis status", required=True,
                         choices=['SUCCESS', 'FAILED', 'NOARCHIVE'])
+    parser.add_argument('-m', "--manifest",
+                        help="Checksum manifest of run. Entries for mux-dir are stored with the status")
     parser.add_argument('-t', "--test-server", action='store_true')
     parser.add_argument('-n', "--dry-run", action='store_true',
                         help="Dry run")
@@ -75,6 +79,14 @@ def main():
         logger.warning("Not a production user. Skipping MongoDB update")
         sys.exit(1)
 
+    # fastq checksums as computed during demultiplexing, so that
+    # consumers can verify against the DB record
+    manifest = None
+    if args.manifest:
+        # paths stay relative to the run's result dir
+        manifest = list(subdir_entries(read_manifest(args.manifest), args.mux_dir).values())
+        logger.info("Adding %d manifest entries for %s", len(manifest), args.mux_dir)
+
     run_number = args.runid.rstrip()
     connection = mongodb_conn(args.test_server)
     if connection is None:
@@ -95,6 +107,7 @@ def main():
                                       "ArchiveSubmission" : "TODO",
                                       "DownstreamSubmission" : "TODO",
                                       "email_sent" : False,
+                                      "Manifest" : manifest,
 
                                   }}})
         except pymongo.errors.OperationFailure:
@@ -129,6 +142,7 @@ def main():
                                       "ArchiveSubmission" : "NOARCHIVE",
                                       "DownstreamSubmission" : "TODO",
                                       "email_sent" : True,
+                                      "Manifest" : manifest,
 
                                   }}})
         except pymongo.errors.OperationFailure:
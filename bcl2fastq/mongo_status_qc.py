@@ -20,6 +20,7 @@ if LIB_PATH not in sys.path:
 from pipelines import generate_window
 from pipelines import is_production_user
 from mongodb import mongodb_conn
+from qcmetricsdb import qc_db_file
 
 __author__ = "Lavanya Veeravalli"
 __email__ = "veeravallil@gis.a-star.edu.sg"
@@ -104,6 +105,9 @@ def main():
             bcl2fastq_qc_cmd = [bcl2fastq_qc_script, '-d', out_dir]
             if args.no_mail:
                 bcl2fastq_qc_cmd.append("--no-mail")
+            if args.testing:
+                # keep test runs out of the production metrics history
+                bcl2fastq_qc_cmd.extend(["--db", qc_db_file() + ".testing"])
             if args.dry_run:
                 logger.warning("Skipped following run: %s", out_dir)
                 continue
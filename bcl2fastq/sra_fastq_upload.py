@@ -20,6 +20,9 @@ if LIB_PATH not in sys.path:
     sys.path.insert(0, LIB_PATH)
 from config import rest_services
 from pipelines import email_for_user
+from manifest import MANIFEST
+from manifest import read_manifest
+from manifest import verify_files
 
 __author__ = "Lavanya Veeravalli"
 __email__ = "veeravallil@gis.a-star.edu.sg"
@@ -62,6 +65,22 @@ def sra_upload_req(libraryId, mux_id, run_num, sample_path, email, rest_url):
         logger.error("Uploading %s completed failed", sample_path)
         sys.exit(1)
 
+def verify_fastqs(fastq_data, result_dir):
+    """Verify fastqs against the checksum manifest written during
+    demultiplexing (cheap, no re-hashing). Exits on mismatch. Older
+    runs without manifest are not checked
+    """
+    manifest = os.path.join(result_dir, MANIFEST)
+    if not os.path.exists(manifest):
+        logger.warning("No manifest %s: can't verify fastqs", manifest)
+        return
+    problems = verify_files(read_manifest(manifest), result_dir,
+                            [os.path.relpath(f, result_dir) for f in fastq_data])
+    if problems:
+        for p in problems:
+            logger.fatal("Manifest mismatch: %s", p)
+        sys.exit(1)
+
 def get_lib_list(fastq_data):
     """Get the 10xGenomix library list
     """
@@ -137,6 +156,7 @@ def main():
                                 libraryId = child.split('_')[-1]
                                 if args.lib_id and args.lib_id != libraryId:
                                     break
+                                verify_fastqs(fastq_data, os.path.join(args.out_dir, "out"))
                                 status = sra_upload_req(libraryId, mux_id, run_num, sample_path, \
                                     email, rest_url)
                             else:
@@ -148,6 +168,7 @@ def main():
                     fastq_data = glob.glob(os.path.join(args.out_dir, "out", mux_dir, "*fastq.gz"))
                     if len(fastq_data) > 0:
                         lib_list = get_lib_list(fastq_data)
+                        verify_fastqs(fastq_data, os.path.join(args.out_dir, "out"))
                         sample_path = os.path.join(args.out_dir, "out", mux_dir)
                         for libraryId in lib_list:
                             if args.lib_id and args.lib_id != libraryId:
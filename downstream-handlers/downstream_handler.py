@@ -1,6 +1,10 @@
 #!/usr/bin/env python3
 """Basically a pipeline starter and logger
 
+If an event journal is configured (see lib/eventjournal.py), started
+analyses are taken from there instead of looking for starter flags in
+all output directories.
+
 see https://bitbucket.org/liewjx/rpd
 """
 
@@ -37,7 +41,10 @@ from pipelines import snakemake_log_status
 from pipelines import PipelineHandler
 from pipelines import is_devel_version
 from pipelines import get_site
+from pipelines import get_event_journal
 from starterflag import StarterFlag
+from eventjournal import JournalReader
+from eventjournal import ANALYSIS_STARTED
 path_devel = LIB_PATH + "/../"
 
 
@@ -142,12 +149,30 @@ def get_pipeline_path(site, pipeline_name, pipeline_version):
         pipeline_path = glob.glob(os.path.join(basedir, "*"+pipeline_version, pipeline_name))
         return pipeline_path[0]
 
-def list_starterflags(path):
-    """list starter flag files in path
+def list_starterflags(path, started=None):
+    """list starter flag files in path. if given, look them up in
+    started (see started_from_journal) instead of globbing
     """
+    if started is not None:
+        return [e['flag'] for e in started.get(os.path.realpath(path), [])
+                if os.path.exists(e['flag'])]
     return glob.glob(os.path.join(
         path, StarterFlag.pattern.format(timestamp="*")))
 
+
+def started_from_journal(journal):
+    """Returns dict of resolved output directory to list of start
+    events for analyses logged as started in journal (JournalReader)
+    and not processed yet
+    """
+    started = dict()
+    for event in journal.events([ANALYSIS_STARTED]):
+        if not event.get('flag') or not os.path.exists(event['flag']):
+            # processed already
+            continue
+        started.setdefault(os.path.realpath(event['dir']), []).append(event)
+    return started
+
 def set_completion_if(dbcol, dbid, out_dir, dryrun=False):
     """Update values for already started job based on log file in out_dir
     """
@@ -257,6 +282,9 @@ def main():
     default = 14
     parser.add_argument('-w', '--win', type=int, default=default,
                         help="Number of days to look back (default {})".format(default))
+    parser.add_argument('--scan', action='store_true',
+                        help="Look for starter flags in all output directories"
+                        " even if an event journal is configured")
     parser.add_argument('-v', '--verbose', action='count', default=0,
                         help="Increase verbosity")
     parser.add_argument('-q', '--quiet', action='count', default=0,
@@ -279,6 +307,17 @@ def main():
     site = get_site()
     epoch_now, epoch_then = generate_window(args.win)
     cursor = dbcol.find({"ctime": {"$gt": epoch_then, "$lt": epoch_now}, "site" : site})
+
+    journal_file = get_event_journal()
+    if journal_file and not args.scan:
+        # separate state for testing so that production doesn't miss events
+        consumer = "downstream_handler.testing" if args.testing else "downstream_handler"
+        journal = JournalReader(consumer, journal_file)
+        started = started_from_journal(journal)
+    else:
+        journal = None
+        started = None
+
     LOGGER.info("Looping through {} jobs".format(cursor.count()))
     for job in cursor:
         dbid = job['_id']
@@ -327,11 +366,11 @@ def main():
                 LOGGER.warning("Job {} could not be started".format(dbid))
         elif job['execution'].get('status') == "MANUAL":
             continue
-        elif list_starterflags(out_dir):# out_dir cannot be none because it's part of execution dict 
+        elif list_starterflags(out_dir, started):# out_dir cannot be none because it's part of execution dict 
             LOGGER.info('Job {} in {} started but not yet logged as such in DB'.format(
                 dbid, out_dir))
 
-            matches = list_starterflags(out_dir)
+            matches = list_starterflags(out_dir, started)
             assert len(matches) == 1, (
                 "Got several starter flags in {}".format(out_dir))
             sflag = StarterFlag(matches[0])
@@ -346,6 +385,15 @@ def main():
         else:
             # job complete
             LOGGER.debug('Job %s in %s should be completed', dbid, out_dir)
+
+    if journal:
+        # flags still around weren't matched to a job (yet): retry next time
+        for events in started.values():
+            for event in events:
+                if os.path.exists(event['flag']):
+                    journal.defer(event)
+        if not args.dryrun:
+            journal.commit()
     LOGGER.info("Successful program exit")
 
 if __name__ == "__main__":
@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
-"""FIXME
+"""Flag start of a downstream analysis (with given database id) in
+its output directory and log it in the event journal (if configured,
+see lib/eventjournal.py). Called from run.sh
 """
 
 #--- standard library imports
@@ -21,6 +23,8 @@ LIB_PATH = os.path.abspath(
 if LIB_PATH not in sys.path:
     sys.path.insert(0, LIB_PATH)
 from starterflag import StarterFlag
+from eventjournal import append_event
+from eventjournal import ANALYSIS_STARTED
 
 
 __author__ = "Andreas Wilm"
@@ -44,7 +48,7 @@ def main():
     """
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument('-o', '--outdir', required=True,
-                        help="Where to create start flag")
+                        help="Output directory of started analysis")
     parser.add_argument('-d', '--dbid', required=True,
                         help="Database id for started job")
     parser.add_argument('-v', '--verbose', action='count', default=0,
@@ -60,6 +64,8 @@ def main():
     sflag = StarterFlag()
     sflag.write(args.outdir, args.dbid)
     LOGGER.info("Created %s", sflag.filename)
+    append_event(ANALYSIS_STARTED, args.outdir, dbid=args.dbid,
+                 flag=os.path.abspath(sflag.filename))
 
 
 
@@ -0,0 +1,356 @@
+"""Thread and memory autotuning for bwa mem | samtools sort mapping
+rules based on input size, compute node profile and the memory
+reserved for the job, and thread autotuning for bcl2fastq based on
+the run layout (RunInfo.xml).
+
+Chosen values are written to a sidecar <rule>.autotune.log next to
+the rule's benchmark log and picked up by benchmarks.py, so that
+later resource model fits know what was used.
+"""
+
+#--- standard library imports
+#
+import os
+import re
+import math
+import logging
+import xml.etree.ElementTree as ET
+
+#--- third-party imports
+#
+import yaml
+
+#--- project specific imports
+#
+from benchmarks import input_bytes_for_job
+from benchmarks import input_bytes_from_cfg
+from benchmarks import cluster_mem_to_gb
+from benchmarks import BENCHMARK_SUFFIX
+from benchmarks import AUTOTUNE_SUFFIX
+
+
+__author__ = "Andreas Wilm"
+__email__ = "wilma@gis.a-star.edu.sg"
+__copyright__ = "2017 Genome Institute of Singapore"
+__license__ = "The MIT License (MIT)"
+
+
+# global logger
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(
+    '[{asctime}] {levelname:8s} {filename} {message}', style='{'))
+logger.addHandler(handler)
+
+
+# used if site config has no node_profile. tmpdir None means next to output
+DEFAULT_NODE_PROFILE = {'cores': 16, 'mem_gb': 64, 'tmpdir': None}
+
+# 32 is where bwa mem seems to max out in GIS
+MAX_BWA_THREADS = 32
+MIN_BWA_THREADS = 2
+# gzipped fastq input per bwa thread below which more threads don't pay off
+BYTES_PER_BWA_THREAD = 512 * 1024**2
+
+# bwa mem memory: index (human sized) plus per thread buffers
+BWA_BASE_MEM_GB = 6.0
+BWA_MEM_PER_THREAD_GB = 0.3
+# fraction of remaining job memory handed to samtools sort
+SORT_MEM_FRACTION = 0.8
+# samtools sort default is 768M; the old hardcoded value was 250M
+SORT_MIN_MEM_MB = 250
+SORT_MAX_MEM_MB = 4096
+# rough size of uncompressed BAM records in sort buffer relative to gzipped fastq
+SORT_BYTES_PER_INPUT_BYTE = 2.5
+
+# bcl2fastq work scales with tiles times cycles. one processing thread
+# per this many tile-cycles gives the old default of 12 threads for a
+# HiSeq 4000 lane (112 tiles, 2x151+8 cycles)
+BCL2FASTQ_TILE_CYCLES_PER_THREAD = 3000
+MIN_BCL2FASTQ_THREADS = 4
+MAX_BCL2FASTQ_THREADS = 32
+# used if RunInfo.xml can't be parsed
+DEFAULT_BCL2FASTQ_THREADS = 12
+# Illumina default for loading and writing threads
+BCL2FASTQ_IO_THREADS = 4
+
+
+def node_profile(config):
+    """Node profile from pipeline config (copied from site config at
+    launch) merged with defaults
+    """
+    profile = dict(DEFAULT_NODE_PROFILE)
+    profile.update(config.get('node_profile') or dict())
+    return profile
+
+
+def job_input_bytes(config, wildcards):
+    """Input size of a job (see benchmarks.input_bytes_for_job). Uses
+    sizes recorded in config at launch or determines them now
+    """
+    input_bytes = config.get('input_bytes')
+    if input_bytes is None:
+        input_bytes = input_bytes_from_cfg(config)
+    return input_bytes_for_job(dict(wildcards.items()), input_bytes)[0]
+
+
+def job_mem_gb(cluster_config, rule):
+    """Memory reserved for rule in cluster config or None if unknown
+
+    >>> job_mem_gb({'__default__': {'mem': '8G'}, 'map_sort': {'mem': '18G'}}, 'map_sort')
+    18.0
+    >>> job_mem_gb({}, 'map_sort') is None
+    True
+    """
+    if not cluster_config:
+        return None
+    cfg = cluster_config.get(rule, cluster_config.get('__default__', dict()))
+    if 'mem' not in cfg:
+        return None
+    return cluster_mem_to_gb(cfg['mem'])
+
+
+def bwa_threads(max_input_bytes, profile):
+    """Number of bwa threads (threads directive) for largest input,
+    capped by node cores
+
+    >>> p = {'cores': 24}
+    >>> bwa_threads(None, p), bwa_threads(1024**3, p), bwa_threads(100*1024**3, p)
+    (16, 2, 24)
+    """
+    if not max_input_bytes:
+        # unknown input: old default
+        return min(16, profile['cores'])
+    threads = int(math.ceil(max_input_bytes / float(BYTES_PER_BWA_THREAD)))
+    return max(MIN_BWA_THREADS, min(threads, MAX_BWA_THREADS, profile['cores']))
+
+
+def map_threads(config):
+    """bwa threads for the largest readunit of this analysis. Meant
+    for use in the threads directive
+    """
+    input_bytes = config.get('input_bytes')
+    if input_bytes is None:
+        input_bytes = input_bytes_from_cfg(config)
+    max_input = None
+    if input_bytes and input_bytes.get('units'):
+        max_input = max(input_bytes['units'].values())
+    return bwa_threads(max_input, node_profile(config))
+
+
+def tune_sort(input_bytes, threads, mem_gb, sort_threads=None,
+              base_mem_gb=BWA_BASE_MEM_GB):
+    """Pick samtools sort threads and memory per thread. mem_gb is
+    the memory reserved for the whole job (bwa and sort),
+    base_mem_gb what bwa needs for the index. Returns
+    dict with sort_threads, sort_mem (samtools format) and
+    spill_files (expected number of temporary files)
+
+    >>> tune_sort(4*1024**3, 16, 36)
+    {'sort_threads': 8, 'sort_mem': '1280M', 'spill_files': 1}
+    >>> tune_sort(40*1024**3, 16, 14)
+    {'sort_threads': 8, 'sort_mem': '256M', 'spill_files': 40}
+    >>> tune_sort(None, 2, 4, sort_threads=1)
+    {'sort_threads': 1, 'sort_mem': '250M', 'spill_files': None}
+    """
+    if sort_threads is None:
+        sort_threads = max(1, (threads + 1) // 2)
+    avail_gb = mem_gb - base_mem_gb - BWA_MEM_PER_THREAD_GB * threads
+    mem_mb = int(avail_gb * 1024 * SORT_MEM_FRACTION / sort_threads)
+    mem_mb = max(SORT_MIN_MEM_MB, min(mem_mb, SORT_MAX_MEM_MB))
+    spill_files = None
+    if input_bytes:
+        sort_bytes = input_bytes * SORT_BYTES_PER_INPUT_BYTE
+        # don't reserve more than needed to sort everything in memory
+        need_mb = int(math.ceil(sort_bytes / 1024.0**2 / sort_threads))
+        mem_mb = max(SORT_MIN_MEM_MB, min(mem_mb, need_mb))
+        spill_files = int(math.ceil(sort_bytes / (sort_threads * mem_mb * 1024.0**2)))
+    # round to 128M steps to keep things readable
+    if mem_mb > SORT_MIN_MEM_MB:
+        mem_mb = max(SORT_MIN_MEM_MB, mem_mb // 128 * 128)
+    return {'sort_threads': sort_threads, 'sort_mem': "{}M".format(mem_mb),
+            'spill_files': spill_files}
+
+
+def sort_tmp_prefix(output, profile):
+    """samtools sort -T argument: next to output (as before) or in
+    node profile's tmpdir (may contain shell variables like $TMPDIR).
+    Unset or empty variables fall back to the output's directory, so
+    that temporary files never end up in /
+
+    >>> sort_tmp_prefix('out/unit-1.bwamem.bam', {'tmpdir': None})
+    'out/unit-1.bwamem.bam.tmp'
+    >>> sort_tmp_prefix('out/unit-1.bwamem.bam', {'tmpdir': '$TMPDIR'})
+    '${TMPDIR:-out}/unit-1.bwamem.bam.tmp'
+    >>> sort_tmp_prefix('unit-1.bwamem.bam', {'tmpdir': '${TMPDIR}/sort/'})
+    '${TMPDIR:-.}/sort/unit-1.bwamem.bam.tmp'
+    >>> sort_tmp_prefix('out/unit-1.bwamem.bam', {'tmpdir': '${TMPDIR:-/scratch}'})
+    '${TMPDIR:-/scratch}/unit-1.bwamem.bam.tmp'
+    >>> sort_tmp_prefix('out/unit-1.bwamem.bam', {'tmpdir': '/scratch'})
+    '/scratch/unit-1.bwamem.bam.tmp'
+    """
+    if not profile.get('tmpdir'):
+        return output + ".tmp"
+    fallback = os.path.dirname(output) or "."
+    # $VAR and ${VAR}, but not ${VAR:-default}
+    tmpdir = re.sub(r'\$(?:\{(\w+)\}|(\w+))',
+                    lambda m: "${{{}:-{}}}".format(m.group(1) or m.group(2), fallback),
+                    profile['tmpdir'])
+    return "{}/{}.tmp".format(tmpdir.rstrip("/"), output.split("/")[-1])
+
+
+def autotune_log(benchmark):
+    """Sidecar log path for a benchmark log
+
+    >>> autotune_log('out/unit-1.bwamem.bam.map_sort.benchmark.log')
+    'out/unit-1.bwamem.bam.map_sort.autotune.log'
+    """
+    assert benchmark.endswith(BENCHMARK_SUFFIX)
+    return benchmark[:-len(BENCHMARK_SUFFIX)] + AUTOTUNE_SUFFIX
+
+
+class MapSortTuner(object):
+    """Per-job autotuning for a bwa mem | samtools sort rule. Use
+    methods as params functions, e.g. sort_mem = tuner.sort_mem.
+    Set sort_threads to use a fixed number of sort threads and
+    base_mem_gb for references much smaller than human
+    """
+
+    def __init__(self, config, cluster_config, rule, threads, sort_threads=None,
+                 base_mem_gb=BWA_BASE_MEM_GB):
+        self.config = config
+        self.profile = node_profile(config)
+        self.threads = threads
+        self.fixed_sort_threads = sort_threads
+        self.base_mem_gb = base_mem_gb
+        self.mem_gb = job_mem_gb(cluster_config, rule)
+        if self.mem_gb is None:
+            # local runs: fair share of node memory
+            self.mem_gb = self.profile['mem_gb'] * threads / float(self.profile['cores'])
+        self._cache = dict()
+
+
+    def tune(self, wildcards):
+        """tuning dict for job with given wildcards"""
+        key = tuple(sorted(dict(wildcards.items()).items()))
+        if key not in self._cache:
+            input_bytes = job_input_bytes(self.config, wildcards)
+            tune = tune_sort(input_bytes, self.threads, self.mem_gb,
+                             self.fixed_sort_threads, self.base_mem_gb)
+            tune['bwa_threads'] = self.threads
+            tune['input_bytes'] = input_bytes
+            tune['mem_gb'] = self.mem_gb
+            self._cache[key] = tune
+        return self._cache[key]
+
+
+    def sort_threads(self, wildcards):
+        """samtools sort threads"""
+        return self.tune(wildcards)['sort_threads']
+
+
+    def sort_mem(self, wildcards):
+        """samtools sort memory per thread"""
+        return self.tune(wildcards)['sort_mem']
+
+
+    def sort_tmp(self, output_template):
+        """Returns params function for samtools sort -T given the
+        rule's output file template, e.g. '{prefix}/unit-{unit}.bam'
+        """
+        return lambda wildcards: sort_tmp_prefix(
+            output_template.format(**dict(wildcards.items())), self.profile)
+
+
+    def summary(self, wildcards):
+        """one line yaml summary for the autotune sidecar log"""
+        return yaml.safe_dump(self.tune(wildcards), default_flow_style=True,
+                              width=float("inf")).strip()
+
+
+def runinfo_layout(runinfo):
+    """Lanes, tiles per lane and total cycles (all reads including
+    index reads) from RunInfo.xml. Returns None if file is missing or
+    lacks flowcell layout
+    """
+    if not os.path.exists(runinfo):
+        return None
+    try:
+        root = ET.parse(runinfo).getroot()
+    except ET.ParseError:
+        logger.warning("Couldn't parse %s", runinfo)
+        return None
+    return layout_from_runinfo(root)
+
+
+def layout_from_runinfo(root):
+    """Like runinfo_layout() but for an already parsed RunInfo.xml
+    (root element)
+
+    >>> root = ET.fromstring('<RunInfo><Run><Reads><Read Number="1" NumCycles="151"/>'
+    ...     '<Read Number="2" NumCycles="8"/></Reads><FlowcellLayout LaneCount="2"'
+    ...     ' SurfaceCount="2" SwathCount="2" TileCount="14"/></Run></RunInfo>')
+    >>> sorted(layout_from_runinfo(root).items())
+    [('cycles', 159), ('lanes', 2), ('tiles_per_lane', 56)]
+    """
+    layout = root.find("Run/FlowcellLayout")
+    if layout is None:
+        return None
+    tiles = 1
+    for attr in ['SurfaceCount', 'SwathCount', 'TileCount']:
+        tiles *= int(layout.get(attr, 1))
+    cycles = sum(int(r.get('NumCycles')) for r in root.findall("Run/Reads/Read"))
+    return {'lanes': int(layout.get('LaneCount', 1)), 'tiles_per_lane': tiles,
+            'cycles': cycles}
+
+
+def bcl2fastq_threads(layout, num_lanes, profile):
+    """Number of threads (job slots) for bcl2fastq on num_lanes lanes
+    of a run with given layout (see runinfo_layout()), capped by node
+    cores
+
+    >>> p = {'cores': 24}
+    >>> hiseq4k = {'lanes': 8, 'tiles_per_lane': 112, 'cycles': 310}
+    >>> bcl2fastq_threads(None, 1, p), bcl2fastq_threads(hiseq4k, 1, p), bcl2fastq_threads(hiseq4k, 8, p)
+    (12, 12, 24)
+    >>> bcl2fastq_threads({'lanes': 1, 'tiles_per_lane': 28, 'cycles': 316}, 1, p)
+    4
+    """
+    if not layout:
+        return min(DEFAULT_BCL2FASTQ_THREADS, profile['cores'])
+    tile_cycles = num_lanes * layout['tiles_per_lane'] * layout['cycles']
+    threads = int(math.ceil(tile_cycles / float(BCL2FASTQ_TILE_CYCLES_PER_THREAD)))
+    return max(MIN_BCL2FASTQ_THREADS, min(threads, MAX_BCL2FASTQ_THREADS, profile['cores']))
+
+
+def bcl2fastq_thread_split(threads):
+    """Split threads into bcl2fastq loading, processing and writing
+    threads. Loading and writing are I/O bound and can overlap with
+    processing, which gets all threads (as Illumina recommends)
+
+    >>> bcl2fastq_thread_split(12)
+    {'loading': 4, 'processing': 12, 'writing': 4}
+    >>> bcl2fastq_thread_split(2)
+    {'loading': 2, 'processing': 2, 'writing': 2}
+    """
+    io_threads = min(BCL2FASTQ_IO_THREADS, threads)
+    return {'loading': io_threads, 'processing': threads, 'writing': io_threads}
+
+
+def bcl2fastq_tuning(layout, num_lanes, threads):
+    """tuning summary for the autotune sidecar log: thread split plus
+    what it was based on, so that the model can be refined from
+    benchmark logs
+
+    >>> t = bcl2fastq_tuning({'lanes': 8, 'tiles_per_lane': 112, 'cycles': 310}, 2, 12)
+    >>> t['tile_cycles'], t['processing']
+    (69440, 12)
+    """
+    tuning = bcl2fastq_thread_split(threads)
+    tuning['threads'] = threads
+    tuning['lanes'] = num_lanes
+    if layout:
+        tuning['tiles_per_lane'] = layout['tiles_per_lane']
+        tuning['cycles'] = layout['cycles']
+        tuning['tile_cycles'] = num_lanes * layout['tiles_per_lane'] * layout['cycles']
+    return tuning
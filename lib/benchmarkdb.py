@@ -0,0 +1,342 @@
+"""Central SQLite store for snakemake benchmark records of completed
+analyses plus simple query functions for cross-run performance
+analysis
+"""
+
+#--- standard library imports
+#
+import os
+import json
+import sqlite3
+import logging
+from datetime import datetime
+
+#--- third-party imports
+#
+#/
+
+#--- project specific imports
+#
+from benchmarks import benchmarks_from_analysis
+from benchmarks import load_analysis_cfg
+from benchmarks import load_cluster_cfg
+from benchmarks import benchmark_logs_in_analysis
+from benchmarks import cluster_mem_to_gb
+from benchmarks import cluster_time_to_secs
+from benchmarks import BenchmarkRecord
+from retries import parse_submissions_log
+from retries import SUBMISSIONS_LOG
+
+
+__author__ = "Andreas Wilm"
+__email__ = "wilma@gis.a-star.edu.sg"
+__copyright__ = "2017 Genome Institute of Singapore"
+__license__ = "The MIT License (MIT)"
+
+
+# global logger
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(
+    '[{asctime}] {levelname:8s} {filename} {message}', style='{'))
+logger.addHandler(handler)
+
+
+# metrics that can be queried (columns of benchmarks table)
+METRICS = ['s', 'max_rss', 'io_in', 'io_out', 'mean_load', 'cpu_time']
+
+# attributes results can be grouped by
+GROUP_KEYS = ['rule', 'pipeline_name', 'pipeline_version', 'site', 'threads']
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS analyses(
+    analysis_dir        TEXT    PRIMARY KEY,
+    pipeline_name       TEXT,
+    pipeline_version    TEXT,
+    site                TEXT,
+    input_bytes         INTEGER,
+    ingested            TEXT    NOT NULL)''',
+    '''CREATE TABLE IF NOT EXISTS benchmarks(
+    analysis_dir        TEXT    NOT NULL,
+    path                TEXT    NOT NULL,
+    rule                TEXT    NOT NULL,
+    wildcards           TEXT,
+    threads             INTEGER,
+    input_bytes         INTEGER,
+    granularity         TEXT,
+    s                   REAL    NOT NULL,
+    max_rss             REAL,
+    io_in               REAL,
+    io_out              REAL,
+    mean_load           REAL,
+    cpu_time            REAL,
+    tuning              TEXT,
+    PRIMARY KEY (analysis_dir, path))''',
+    '''CREATE INDEX IF NOT EXISTS benchmarks_rule ON benchmarks(rule)''',
+    # resources requested per rule in the analysis' cluster config
+    # (rule __default__ for the default)
+    '''CREATE TABLE IF NOT EXISTS cluster_requests(
+    analysis_dir        TEXT    NOT NULL,
+    rule                TEXT    NOT NULL,
+    mem_gb              REAL,
+    time_s              INTEGER,
+    PRIMARY KEY (analysis_dir, rule))''',
+    # retried cluster jobs with resources and the previous attempt's
+    # usage (see retries.py)
+    '''CREATE TABLE IF NOT EXISTS retries(
+    analysis_dir        TEXT    NOT NULL,
+    rule                TEXT    NOT NULL,
+    wildcards           TEXT,
+    jid                 TEXT    NOT NULL,
+    attempt             INTEGER NOT NULL,
+    mem_gb              REAL,
+    time_s              INTEGER,
+    peak_gb             REAL,
+    wallclock_s         REAL,
+    PRIMARY KEY (analysis_dir, jid))''',
+]
+
+
+def percentile(values, pct):
+    """Percentile with linear interpolation between closest ranks
+
+    >>> percentile([1, 2, 3, 4], 50)
+    2.5
+    >>> percentile([5], 90)
+    5
+    >>> percentile([1, 2, 3, 4, 5], 100)
+    5
+    """
+    assert values
+    values = sorted(values)
+    if len(values) == 1:
+        return values[0]
+    k = (len(values) - 1) * pct / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    if lo == hi:
+        return values[lo]
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+class BenchmarkDB(object):
+    """SQLite backed benchmark warehouse
+    """
+
+    def __init__(self, dbfile):
+        self.dbfile = dbfile
+        self.conn = sqlite3.connect(dbfile)
+        for stmt in SCHEMA:
+            self.conn.execute(stmt)
+        # databases created before autotuning was recorded
+        cols = [row[1] for row in self.conn.execute("PRAGMA table_info(benchmarks)")]
+        if 'tuning' not in cols:
+            self.conn.execute("ALTER TABLE benchmarks ADD COLUMN tuning TEXT")
+        self.conn.commit()
+
+
+    def close(self):
+        """close db connection"""
+        self.conn.close()
+
+
+    def is_ingested(self, analysis_dir):
+        """true if analysis_dir was already ingested"""
+        analysis_dir = os.path.abspath(analysis_dir)
+        cur = self.conn.execute(
+            "SELECT 1 FROM analyses WHERE analysis_dir = ?", (analysis_dir,))
+        return cur.fetchone() is not None
+
+
+    def ingest_analysis(self, analysis_dir, overwrite=False):
+        """Ingest benchmark records of one analysis directory. Returns
+        number of added records (0 if already ingested and
+        overwrite is False)
+        """
+        analysis_dir = os.path.abspath(analysis_dir)
+        if self.is_ingested(analysis_dir) and not overwrite:
+            logger.debug("Skipping already ingested %s", analysis_dir)
+            return 0
+
+        cfg = load_analysis_cfg(analysis_dir)
+        elm = cfg.get('ELM', dict())
+        total_bytes = cfg.get('input_bytes', {}).get('total') if cfg.get('input_bytes') else None
+        records = benchmarks_from_analysis(analysis_dir)
+        cluster_cfg = load_cluster_cfg(analysis_dir)
+        submissions = []
+        for _, content in benchmark_logs_in_analysis(
+                analysis_dir, suffix=os.path.basename(SUBMISSIONS_LOG)):
+            submissions.extend(parse_submissions_log(content.splitlines()))
+
+        with self.conn:
+            self.conn.execute("DELETE FROM benchmarks WHERE analysis_dir = ?", (analysis_dir,))
+            self.conn.execute("DELETE FROM cluster_requests WHERE analysis_dir = ?", (analysis_dir,))
+            self.conn.execute("DELETE FROM retries WHERE analysis_dir = ?", (analysis_dir,))
+            self.conn.execute(
+                "INSERT OR REPLACE INTO analyses VALUES (?, ?, ?, ?, ?, ?)",
+                (analysis_dir, elm.get('pipeline_name'), elm.get('pipeline_version'),
+                 elm.get('site'), total_bytes, datetime.now().isoformat()))
+            for r in records:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO benchmarks VALUES"
+                    " (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (analysis_dir, r.path, r.rule, json.dumps(r.wildcards, sort_keys=True),
+                     r.threads, r.input_bytes, r.granularity, r.s, r.max_rss,
+                     r.io_in, r.io_out, r.mean_load, r.cpu_time,
+                     json.dumps(r.tuning, sort_keys=True) if r.tuning else None))
+            for rule, values in cluster_cfg.items():
+                if not isinstance(values, dict):
+                    continue
+                mem, time = values.get('mem'), values.get('time')
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO cluster_requests VALUES (?, ?, ?, ?)",
+                    (analysis_dir, rule, cluster_mem_to_gb(mem) if mem else None,
+                     cluster_time_to_secs(time) if time else None))
+            for r in submissions:
+                if r['attempt'] < 2:
+                    continue
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO retries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (analysis_dir, r['rule'], r['wildcards'], r['jid'], r['attempt'],
+                     r['mem_gb'], r['time_s'], r['peak_gb'], r['wallclock_s']))
+        return len(records)
+
+
+    def _select(self, columns, rule=None, pipeline_name=None,
+                pipeline_version=None, site=None):
+        """run select on joined tables with optional filters"""
+        where = []
+        values = []
+        for col, val in [('b.rule', rule), ('a.pipeline_name', pipeline_name),
+                         ('a.pipeline_version', pipeline_version), ('a.site', site)]:
+            if val is not None:
+                where.append("{} = ?".format(col))
+                values.append(val)
+        sql = "SELECT {} FROM benchmarks b JOIN analyses a USING (analysis_dir)".format(
+            ", ".join(columns))
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        return self.conn.execute(sql, values)
+
+
+    def records(self, **filters):
+        """Yield BenchmarkRecords matching filters (see _select())"""
+        cols = ['b.' + f for f in BenchmarkRecord._fields]
+        for row in self._select(cols, **filters):
+            row = list(row)
+            row[2] = json.loads(row[2]) if row[2] else dict()
+            row[-1] = json.loads(row[-1]) if row[-1] else None
+            yield BenchmarkRecord._make(row)
+
+
+    def percentiles(self, metric, pcts=(50, 90, 99),
+                    group_by=('rule',), **filters):
+        """Returns dict mapping group key tuples to list of (n,
+        percentile values...) for given metric, e.g. for metric 's'
+        percentiles of wall time per rule
+        """
+        assert metric in METRICS, ("Unknown metric {}".format(metric))
+        for g in group_by:
+            assert g in GROUP_KEYS, ("Can't group by {}".format(g))
+        group_cols = [('b.' if g in ['rule', 'threads'] else 'a.') + g for g in group_by]
+        grouped = dict()
+        for row in self._select(group_cols + ['b.' + metric], **filters):
+            if row[-1] is None:
+                continue
+            grouped.setdefault(tuple(row[:-1]), []).append(row[-1])
+        res = dict()
+        for k, values in grouped.items():
+            res[k] = [len(values)] + [percentile(values, p) for p in pcts]
+        return res
+
+
+    def regressions(self, pipeline_name, old_version, new_version,
+                    metric='s', pct=50, min_ratio=1.2, site=None):
+        """Compare given percentile of metric per rule between two
+        pipeline versions. Returns list of (rule, old, new, ratio)
+        for rules where new/old >= min_ratio
+        """
+        old = self.percentiles(metric, (pct,), ('rule',), pipeline_name=pipeline_name,
+                               pipeline_version=old_version, site=site)
+        new = self.percentiles(metric, (pct,), ('rule',), pipeline_name=pipeline_name,
+                               pipeline_version=new_version, site=site)
+        regs = []
+        for k in sorted(set(old) & set(new)):
+            o, n = old[k][1], new[k][1]
+            if o > 0 and n / o >= min_ratio:
+                regs.append((k[0], o, n, n / o))
+        return regs
+
+
+    def job_counts(self, **filters):
+        """Returns dict of rule to list of (number of jobs, number of
+        granules) per analysis, where granules are the distinct units
+        or samples the jobs ran on (1 for analysis-wide jobs). Used to
+        project the number of jobs of new analyses.
+        """
+        per_analysis = dict()
+        for analysis_dir, rule, granularity, wildcards in self._select(
+                ['b.analysis_dir', 'b.rule', 'b.granularity', 'b.wildcards'], **filters):
+            wildcards = json.loads(wildcards) if wildcards else dict()
+            granule = wildcards.get(granularity) if granularity in ['unit', 'sample'] else None
+            entry = per_analysis.setdefault((rule, analysis_dir), [0, set()])
+            entry[0] += 1
+            entry[1].add(granule)
+        counts = dict()
+        for (rule, _), (jobs, granules) in sorted(per_analysis.items()):
+            counts.setdefault(rule, []).append((jobs, len(granules)))
+        return counts
+
+
+    def analysis_totals(self, **filters):
+        """Returns dict of analysis_dir to tuple of CPU hours (threads
+        times wall time summed over all jobs) and total input bytes
+        """
+        where = []
+        values = []
+        for col in ['pipeline_name', 'pipeline_version', 'site']:
+            if filters.get(col) is not None:
+                where.append("a.{} = ?".format(col))
+                values.append(filters[col])
+        sql = "SELECT a.analysis_dir, SUM(COALESCE(b.threads, 1) * b.s) / 3600.0, a.input_bytes" \
+              " FROM benchmarks b JOIN analyses a USING (analysis_dir)"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " GROUP BY a.analysis_dir"
+        return dict((row[0], (row[1], row[2])) for row in self.conn.execute(sql, values))
+
+
+    def usage_records(self, **filters):
+        """Yield dicts with pipeline_version, ingested, rule, threads,
+        s, cpu_time, max_rss, io_in, io_out and mem_gb (memory
+        requested in cluster config; None if unknown) per job matching
+        filters (see _select())
+        """
+        keys = ['pipeline_version', 'ingested', 'rule', 'threads', 's',
+                'cpu_time', 'max_rss', 'io_in', 'io_out', 'mem_gb']
+        requested = "(SELECT c.mem_gb FROM cluster_requests c" \
+                    " WHERE c.analysis_dir = b.analysis_dir AND c.rule = {})"
+        cols = ['a.pipeline_version', 'a.ingested'] + ['b.' + k for k in keys[2:-1]] + [
+            "COALESCE({}, {})".format(requested.format("b.rule"), requested.format("'__default__'"))]
+        for row in self._select(cols, **filters):
+            yield dict(zip(keys, row))
+
+
+    def escalations(self, **filters):
+        """Returns dict of rule to tuple of number of retried jobs,
+        number of retries, maximum attempt and maximum memory (GB)
+        requested by a retry, for analyses matching filters
+        (pipeline_name, pipeline_version, site)
+        """
+        where = []
+        values = []
+        for col in ['pipeline_name', 'pipeline_version', 'site']:
+            if filters.get(col) is not None:
+                where.append("a.{} = ?".format(col))
+                values.append(filters[col])
+        sql = "SELECT r.rule, COUNT(DISTINCT r.analysis_dir || r.wildcards), COUNT(*)," \
+              " MAX(r.attempt), MAX(r.mem_gb) FROM retries r JOIN analyses a USING (analysis_dir)"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " GROUP BY r.rule"
+        return dict((row[0], tuple(row[1:])) for row in self.conn.execute(sql, values))
@@ -0,0 +1,578 @@
+"""Parsing of snakemake benchmark logs and benchmark derived resource
+models for cluster configs
+"""
+
+#--- standard library imports
+#
+import os
+import re
+import glob
+import json
+import tarfile
+import logging
+from io import StringIO
+from collections import namedtuple
+from datetime import datetime
+
+#--- third-party imports
+#
+import yaml
+
+#--- project specific imports
+#
+#/
+
+
+__author__ = "Andreas Wilm"
+__email__ = "wilma@gis.a-star.edu.sg"
+__copyright__ = "2017 Genome Institute of Singapore"
+__license__ = "The MIT License (MIT)"
+
+
+# only dump() and following do not automatically create aliases
+yaml.Dumper.ignore_aliases = lambda *args: True
+
+
+# global logger
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(
+    '[{asctime}] {levelname:8s} {filename} {message}', style='{'))
+logger.addHandler(handler)
+
+
+BENCHMARK_SUFFIX = ".benchmark.log"
+
+# optional sidecar next to benchmark logs, recording autotuned
+# settings (see autotune.py)
+AUTOTUNE_SUFFIX = ".autotune.log"
+
+# pipelint enforces benchmark logs to end in <rulename>.benchmark.log
+BENCHMARK_RULE_RE = re.compile(r'(?:^|[^\w])(\w+)\.benchmark\.log$')
+
+# snakemake (>=3.11) tab separated benchmark columns. everything
+# after s and h:m:s is optional and depends on the snakemake version
+BENCHMARK_NUMERIC_COLS = ['s', 'max_rss', 'max_vms', 'max_uss', 'max_pss',
+                          'io_in', 'io_out', 'mean_load', 'cpu_time']
+
+# one record per executed job (i.e. per benchmark log)
+BenchmarkRecord = namedtuple('BenchmarkRecord', [
+    'rule', 'path', 'wildcards', 'threads', 'input_bytes', 'granularity',
+    's', 'max_rss', 'io_in', 'io_out', 'mean_load', 'cpu_time', 'tuning'])
+
+# minimum number of observations per rule before we trust a linear fit
+MIN_OBS_FOR_FIT = 3
+
+# safety margin added on top of the worst observed under-prediction
+DEFAULT_MARGIN = 0.2
+
+# lower bounds for generated cluster values
+MIN_TIME_S = 15 * 60
+MIN_MEM_GB = 1
+
+
+def rule_from_benchmark_path(path):
+    """Derive rule name from benchmark log path (relies on naming
+    convention enforced by pipelint)
+
+    >>> rule_from_benchmark_path("out/s1/unit-x.bwamem.bam.map_sort.benchmark.log")
+    'map_sort'
+    >>> rule_from_benchmark_path("out/Project_MUX1/bcl2fastq.benchmark.log")
+    'bcl2fastq'
+    >>> rule_from_benchmark_path("out/foo.log") is None
+    True
+    """
+    m = BENCHMARK_RULE_RE.search(path)
+    if not m:
+        return None
+    return m.group(1)
+
+
+def parse_benchmark_log(fh):
+    """Parse benchmark log content from file handle. Supports the JSON
+    format of older snakemake versions and the tab separated format of
+    newer ones. If repeats are present, values are averaged. Returns a
+    dict with keys as in BENCHMARK_NUMERIC_COLS (None if unknown) or
+    None if content couldn't be parsed.
+
+    >>> import io
+    >>> d = parse_benchmark_log(io.StringIO('s\\th:m:s\\tmax_rss\\n12.5\\t0:00:12\\t100.1\\n'))
+    >>> d['s'], d['max_rss'], d['io_in']
+    (12.5, 100.1, None)
+    >>> d = parse_benchmark_log(io.StringIO('{"wall_clock_times": {"s": [3.0, 5.0], "h:m:s": ["", ""]}}'))
+    >>> d['s']
+    4.0
+    """
+    content = fh.read()
+    if isinstance(content, bytes):
+        content = content.decode()
+    content = content.strip()
+    if not content:
+        return None
+
+    values = dict((k, None) for k in BENCHMARK_NUMERIC_COLS)
+    if content.startswith("{"):
+        try:
+            secs = json.loads(content)['wall_clock_times']['s']
+        except (ValueError, KeyError):
+            return None
+        if not secs:
+            return None
+        values['s'] = sum(secs)/len(secs)
+        return values
+
+    lines = content.splitlines()
+    header = lines[0].split("\t")
+    rows = [l.split("\t") for l in lines[1:] if l.strip()]
+    if 's' not in header or not rows:
+        return None
+    for col in BENCHMARK_NUMERIC_COLS:
+        if col not in header:
+            continue
+        idx = header.index(col)
+        obs = []
+        for row in rows:
+            try:
+                obs.append(float(row[idx]))
+            except (ValueError, IndexError):
+                pass
+        if obs:
+            values[col] = sum(obs)/len(obs)
+    if values['s'] is None:
+        return None
+    return values
+
+
+def parse_wildcards_str(wcstr):
+    """Parse wildcards as printed by snakemake
+
+    >>> sorted(parse_wildcards_str("prefix=out, unit=ABC_L001").items())
+    [('prefix', 'out'), ('unit', 'ABC_L001')]
+    """
+    wildcards = dict()
+    for kv in wcstr.split(", "):
+        if "=" not in kv:
+            continue
+        k, v = kv.split("=", 1)
+        wildcards[k.strip()] = v.strip()
+    return wildcards
+
+
+def jobs_from_snakemake_log(log):
+    """Parse job info blocks from snakemake master log. Returns list
+    of dicts with keys rule, jobid, local, benchmark, wildcards,
+    threads, input, output and timestamp (datetime of the block
+    start or None).
+    """
+
+    jobs = []
+    job = None
+    last_time = None
+    with open(log) as fh:
+        for line in fh:
+            line = line.rstrip("\n")
+            # optional timestamp prefix or timestamp-only line
+            if line.startswith("["):
+                estr = line[1:].split("]")[0]
+                try:
+                    last_time = datetime.strptime(estr, '%a %b %d %H:%M:%S %Y')
+                except ValueError:
+                    pass
+                else:
+                    line = line[len(estr)+2:].lstrip()
+
+            m = re.match(r'^(local)?rule (\w+):$', line)
+            if m:
+                job = {'rule': m.group(2), 'local': m.group(1) is not None,
+                       'jobid': None, 'benchmark': None, 'wildcards': dict(),
+                       'threads': 1, 'input': [], 'output': [],
+                       'timestamp': last_time}
+                jobs.append(job)
+                continue
+            if job is None:
+                continue
+            if not line.startswith("    "):
+                # end of job info block
+                job = None
+                continue
+            key, _, value = line.strip().partition(": ")
+            if key == "jobid":
+                job['jobid'] = int(value)
+            elif key == "benchmark":
+                job['benchmark'] = value
+            elif key == "wildcards":
+                job['wildcards'] = parse_wildcards_str(value)
+            elif key == "threads":
+                job['threads'] = int(value)
+            elif key in ['input', 'output']:
+                job[key] = value.split(", ")
+    return jobs
+
+
+def readunit_input_sizes(readunits):
+    """Returns size in bytes of fastqs per readunit. Missing files are
+    counted as zero
+    """
+    sizes = dict()
+    for ru_key, ru in readunits.items():
+        size = 0
+        for k in ['fq1', 'fq2']:
+            f = ru.get(k)
+            if f and os.path.exists(f):
+                size += os.path.getsize(f)
+        sizes[ru_key] = size
+    return sizes
+
+
+def input_bytes_from_cfg(cfg):
+    """Determine input sizes in bytes per readunit and per sample as
+    well as total from pipeline config (requires readunits and
+    samples). Returns None if these are missing
+    """
+    if not cfg.get('readunits') or not cfg.get('samples'):
+        return None
+    unit_sizes = readunit_input_sizes(cfg['readunits'])
+    sample_sizes = dict()
+    for sample, units in cfg['samples'].items():
+        sample_sizes[sample] = sum([unit_sizes.get(u, 0) for u in units])
+    return {'units': unit_sizes,
+            'samples': sample_sizes,
+            'total': sum(unit_sizes.values())}
+
+
+def input_bytes_for_job(wildcards, input_bytes):
+    """Best guess of job input size based on its wildcards: unit size
+    for unit level jobs, sample size for sample level jobs and total
+    otherwise. Returns tuple of size and granularity
+
+    >>> ib = {'units': {'u1': 10}, 'samples': {'s1': 30}, 'total': 50}
+    >>> input_bytes_for_job({'unit': 'u1'}, ib)
+    (10, 'unit')
+    >>> input_bytes_for_job({'sample': 's1'}, ib)
+    (30, 'sample')
+    >>> input_bytes_for_job({}, ib)
+    (50, 'total')
+    """
+    if not input_bytes:
+        return None, None
+    if 'unit' in wildcards and wildcards['unit'] in input_bytes.get('units', {}):
+        return input_bytes['units'][wildcards['unit']], 'unit'
+    if 'sample' in wildcards and wildcards['sample'] in input_bytes.get('samples', {}):
+        return input_bytes['samples'][wildcards['sample']], 'sample'
+    return input_bytes.get('total'), 'total'
+
+
+def benchmark_logs_in_analysis(analysis_dir, suffix=BENCHMARK_SUFFIX):
+    """Yields tuples of relative path and file content for all
+    benchmark logs (or other logs with given suffix) in an analysis
+    directory, including the ones already bundled into log tarballs
+    by bundle_and_clean_logs()
+    """
+    for f in glob.glob(os.path.join(analysis_dir, "**/*" + suffix), recursive=True):
+        with open(f) as fh:
+            yield os.path.relpath(f, analysis_dir), fh.read()
+    for bundle in glob.glob(os.path.join(analysis_dir, "logs", "logs*.tar.gz")):
+        try:
+            with tarfile.open(bundle) as tarfh:
+                for member in tarfh.getmembers():
+                    if not member.isfile() or not member.name.endswith(suffix):
+                        continue
+                    yield member.name, tarfh.extractfile(member).read().decode()
+        except (tarfile.TarError, OSError) as err:
+            logger.warning("Skipping unreadable log bundle %s: %s", bundle, err)
+
+
+def load_analysis_cfg(analysis_dir):
+    """Load conf.yaml of an analysis or return empty dict if missing"""
+    cfgfile = os.path.join(analysis_dir, "conf.yaml")
+    if not os.path.exists(cfgfile):
+        return dict()
+    with open(cfgfile) as fh:
+        return yaml.safe_load(fh) or dict()
+
+
+def load_cluster_cfg(analysis_dir):
+    """Load cluster.yaml of an analysis or return empty dict if missing"""
+    cfgfile = os.path.join(analysis_dir, "cluster.yaml")
+    if not os.path.exists(cfgfile):
+        return dict()
+    with open(cfgfile) as fh:
+        return yaml.safe_load(fh) or dict()
+
+
+def benchmarks_from_analysis(analysis_dir):
+    """Mine all benchmark logs of one analysis directory and return
+    them as list of BenchmarkRecords. Threads and wildcards are taken
+    from the snakemake master log if present.
+    """
+    cfg = load_analysis_cfg(analysis_dir)
+    input_bytes = cfg.get('input_bytes')
+    if input_bytes is None and cfg:
+        input_bytes = input_bytes_from_cfg(cfg)
+
+    jobs_by_benchmark = dict()
+    masterlog = os.path.join(analysis_dir, "logs", "snakemake.log")
+    if os.path.exists(masterlog):
+        for job in jobs_from_snakemake_log(masterlog):
+            if job['benchmark']:
+                jobs_by_benchmark[os.path.normpath(job['benchmark'])] = job
+
+    # autotuned settings recorded next to benchmark logs (see autotune.py)
+    tunings = dict()
+    for relpath, content in benchmark_logs_in_analysis(analysis_dir, AUTOTUNE_SUFFIX):
+        try:
+            tuning = yaml.safe_load(content)
+        except yaml.YAMLError:
+            logger.debug("Skipping unparseable autotune log %s", relpath)
+            continue
+        benchmark = relpath[:-len(AUTOTUNE_SUFFIX)] + BENCHMARK_SUFFIX
+        tunings[os.path.normpath(benchmark)] = tuning
+
+    records = []
+    for relpath, content in benchmark_logs_in_analysis(analysis_dir):
+        values = parse_benchmark_log(StringIO(content))
+        if values is None:
+            logger.debug("Skipping unparseable benchmark log %s", relpath)
+            continue
+        job = jobs_by_benchmark.get(os.path.normpath(relpath))
+        if job:
+            rule, wildcards, threads = job['rule'], job['wildcards'], job['threads']
+        else:
+            rule, wildcards, threads = rule_from_benchmark_path(relpath), dict(), None
+        if not rule:
+            continue
+        job_input_bytes, granularity = input_bytes_for_job(wildcards, input_bytes)
+        records.append(BenchmarkRecord(
+            rule=rule, path=relpath, wildcards=wildcards, threads=threads,
+            input_bytes=job_input_bytes, granularity=granularity, s=values['s'], max_rss=values['max_rss'],
+            io_in=values['io_in'], io_out=values['io_out'],
+            mean_load=values['mean_load'], cpu_time=values['cpu_time'],
+            tuning=tunings.get(os.path.normpath(relpath))))
+    return records
+
+
+def linear_fit(xs, ys):
+    """Ordinary least squares fit of y = a + b*x. Falls back to a
+    constant (mean) model if x has no variance. Returns (a, b)
+
+    >>> linear_fit([1, 2, 3], [3, 5, 7])
+    (1.0, 2.0)
+    >>> linear_fit([2, 2], [1, 3])
+    (2.0, 0.0)
+    """
+    n = len(xs)
+    assert n == len(ys) and n > 0
+    mx = sum(xs)/n
+    my = sum(ys)/n
+    sxx = sum([(x-mx)**2 for x in xs])
+    if sxx == 0:
+        return my, 0.0
+    sxy = sum([(x-mx)*(y-my) for x, y in zip(xs, ys)])
+    b = sxy/sxx
+    a = my - b*mx
+    return a, b
+
+
+def fit_resource(xs, ys):
+    """Fit resource (time or mem) as function of input size and return
+    dict with intercept, slope and a safety factor covering the worst
+    observed under-prediction. If too few observations are given a
+    constant model using the maximum observed value is returned.
+    """
+    if len(ys) < MIN_OBS_FOR_FIT or any([x is None for x in xs]):
+        return {'a': max(ys), 'b': 0.0, 'safety': 1.0}
+    a, b = linear_fit(xs, ys)
+    if b < 0:
+        # resources don't shrink with input. use constant model
+        a, b = max(ys), 0.0
+    safety = 1.0
+    for x, y in zip(xs, ys):
+        pred = a + b*x
+        if pred > 0:
+            safety = max(safety, y/pred)
+    return {'a': a, 'b': b, 'safety': safety}
+
+
+def predict_resource(fit, x, margin=DEFAULT_MARGIN):
+    """Predict resource needs from fit for input size x
+
+    >>> predict_resource({'a': 10.0, 'b': 2.0, 'safety': 1.0}, 5, margin=0.5)
+    30.0
+    """
+    if x is None:
+        x = 0
+    return (fit['a'] + fit['b']*x) * fit['safety'] * (1.0 + margin)
+
+
+class ResourceModel(object):
+    """Per-rule resource model fitted on benchmark records. Wall time
+    (seconds) and peak memory (MB) are modelled as linear functions of
+    input size (GB), separately per number of threads used.
+    """
+
+    def __init__(self, rules=None, granularity=None):
+        # rule -> threads -> dict(time=fit, mem=fit, n=int)
+        self.rules = rules if rules else dict()
+        # rule -> 'unit', 'sample' or 'total' (see input_bytes_for_job())
+        self.granularity = granularity if granularity else dict()
+
+
+    @staticmethod
+    def _input_gb(record):
+        if record.input_bytes is None:
+            return None
+        return record.input_bytes / 1024.0**3
+
+
+    def fit(self, records):
+        """fit models from BenchmarkRecords"""
+        by_rule_threads = dict()
+        for r in records:
+            threads = r.threads if r.threads else 1
+            by_rule_threads.setdefault(r.rule, dict()).setdefault(threads, []).append(r)
+
+        self.rules = dict()
+        self.granularity = dict()
+        for rule, by_threads in by_rule_threads.items():
+            self.rules[rule] = dict()
+            grans = [r.granularity for recs in by_threads.values() for r in recs
+                     if r.granularity]
+            if grans:
+                self.granularity[rule] = max(set(grans), key=grans.count)
+            for threads, recs in by_threads.items():
+                xs = [self._input_gb(r) for r in recs]
+                entry = {'n': len(recs)}
+                entry['time'] = fit_resource(xs, [r.s for r in recs])
+                mems = [(x, r.max_rss) for x, r in zip(xs, recs) if r.max_rss is not None]
+                if mems:
+                    entry['mem'] = fit_resource([m[0] for m in mems], [m[1] for m in mems])
+                self.rules[rule][threads] = entry
+        return self
+
+
+    def predict(self, rule, input_bytes, threads=None, margin=DEFAULT_MARGIN):
+        """Returns tuple of predicted wall time in seconds and peak
+        memory in MB (either None if unknown). If no model for the
+        requested number of threads exists, the one with most
+        observations is used and time scaled linearly by threads.
+        """
+        if rule not in self.rules or not self.rules[rule]:
+            return None, None
+        by_threads = self.rules[rule]
+        if threads in by_threads:
+            used_threads = threads
+        else:
+            used_threads = max(by_threads, key=lambda t: by_threads[t]['n'])
+        entry = by_threads[used_threads]
+        x = input_bytes / 1024.0**3 if input_bytes is not None else None
+        time_s = predict_resource(entry['time'], x, margin)
+        if threads and threads != used_threads:
+            time_s *= used_threads / float(threads)
+        mem_mb = None
+        if 'mem' in entry:
+            mem_mb = predict_resource(entry['mem'], x, margin)
+        return time_s, mem_mb
+
+
+    def dump(self, filename):
+        """write model to yaml file"""
+        with open(filename, 'w') as fh:
+            yaml.dump({'rules': self.rules, 'granularity': self.granularity},
+                      fh, default_flow_style=False)
+
+
+    @classmethod
+    def load(cls, filename):
+        """load model from yaml file"""
+        with open(filename) as fh:
+            d = yaml.safe_load(fh)
+        return cls(d.get('rules', dict()), d.get('granularity', dict()))
+
+
+def secs_to_cluster_time(secs):
+    """Format seconds as h:m:s string as used in cluster configs
+
+    >>> secs_to_cluster_time(3725)
+    '01:02:05'
+    >>> secs_to_cluster_time(100*3600)
+    '100:00:00'
+    """
+    secs = int(round(secs))
+    return "{:02d}:{:02d}:{:02d}".format(secs // 3600, (secs % 3600) // 60, secs % 60)
+
+
+def cluster_time_to_secs(timestr):
+    """Parse cluster config time string
+
+    >>> cluster_time_to_secs("6:00:00")
+    21600
+    """
+    h, m, s = [int(x) for x in str(timestr).split(":")]
+    return h*3600 + m*60 + s
+
+
+def cluster_mem_to_gb(memstr):
+    """Parse cluster config memory string
+
+    >>> cluster_mem_to_gb("18G"), cluster_mem_to_gb("500M"), cluster_mem_to_gb("1g")
+    (18.0, 0.48828125, 1.0)
+    """
+    memstr = str(memstr).strip().upper()
+    units = {'K': 1.0/1024**2, 'M': 1.0/1024, 'G': 1.0, 'T': 1024.0}
+    if memstr[-1] in units:
+        return float(memstr[:-1]) * units[memstr[-1]]
+    # plain bytes
+    return float(memstr) / 1024**3
+
+
+def gb_to_cluster_mem(gb):
+    """Format memory in GB as cluster config string (rounded up)
+
+    >>> gb_to_cluster_mem(17.2)
+    '18G'
+    """
+    return "{:d}G".format(int(-(-gb // 1)))
+
+
+def apply_resource_model(cluster_cfg, model, input_bytes, margin=DEFAULT_MARGIN):
+    """Override time and mem in cluster config (dict as loaded from
+    cluster yaml) with model predictions. Predictions are made for the
+    largest job input, as the cluster config applies to all jobs of a
+    rule. Returns modified copy and dict of changed rules (old and new
+    values).
+
+    >>> m = ResourceModel({'map_sort': {16: {'n': 3, 'time': {'a': 3600.0, 'b': 0.0, 'safety': 1.0}}}},
+    ...                   {'map_sort': 'unit'})
+    >>> cfg = {'__default__': {'time': '02:00:00', 'mem': '1G'},
+    ...        'map_sort': {'time': '24:00:00', 'mem': '18G'}}
+    >>> new_cfg, changes = apply_resource_model(cfg, m, None, margin=0.0)
+    >>> new_cfg['map_sort']
+    {'time': '01:00:00', 'mem': '18G'}
+    """
+
+    cluster_cfg = dict((k, dict(v)) for k, v in cluster_cfg.items())
+    default = cluster_cfg.get('__default__', dict())
+    changes = dict()
+    for rule in model.rules:
+        # the largest unit or sample is what determines the requirements
+        size = None
+        if input_bytes:
+            granularity = model.granularity.get(rule, 'total')
+            if granularity == 'unit' and input_bytes.get('units'):
+                size = max(input_bytes['units'].values())
+            elif granularity == 'sample' and input_bytes.get('samples'):
+                size = max(input_bytes['samples'].values())
+            else:
+                size = input_bytes.get('total')
+        time_s, mem_mb = model.predict(rule, size, margin=margin)
+        if time_s is None:
+            continue
+        old = cluster_cfg.get(rule, default)
+        new = dict(old)
+        new['time'] = secs_to_cluster_time(max(MIN_TIME_S, time_s))
+        if mem_mb is not None:
+            new['mem'] = gb_to_cluster_mem(max(MIN_MEM_GB, mem_mb/1024.0))
+        if new != old:
+            changes[rule] = (dict(old), new)
+            cluster_cfg[rule] = new
+    return cluster_cfg, changes
@@ -15,6 +15,9 @@ import yaml
 # add lib dir for this pipeline installation to PYTHONPATH
 ETC_PATH = os.path.abspath(
     os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "etc"))
+# allow pointing at another config dir, e.g. for tools/offline_harness.py
+if os.environ.get('RPD_ETC'):
+    ETC_PATH = os.path.abspath(os.environ['RPD_ETC'])
     
 SITE_CFG_FILE = os.path.join(ETC_PATH, 'site.yaml')
 REST_CFG_FILE = os.path.join(ETC_PATH, 'rest.yaml')
@@ -0,0 +1,277 @@
+"""Critical path analysis of completed analyses
+
+Rebuilds the executed DAG from the snakemake master log (job blocks
+with inputs/outputs, submission and finish messages) and attributes
+the wall time of the critical path to:
+
+- compute: runtime according to the job's benchmark log
+- queue: cluster job wall time not explained by compute or
+  filesystem latency (queue wait, job startup)
+- fs_latency: time snakemake spent waiting for output files to
+  appear (--latency-wait)
+- local: jobs run as localrules on the master (serialized by
+  --local-cores)
+- scheduling: gaps between a job's predecessor finishing and the
+  job's submission (snakemake's own overhead, throttling via
+  --max-jobs-per-second)
+
+Timestamps in snakemake's log have a one second resolution, so
+numbers for very short jobs are rough.
+"""
+
+#--- standard library imports
+#
+import os
+import re
+import logging
+from datetime import datetime
+
+#--- third-party imports
+#
+#/
+
+#--- project specific imports
+#
+from benchmarks import cluster_mem_to_gb
+from rulegroups import MAX_GROUPED_S
+
+
+__author__ = "Andreas Wilm"
+__email__ = "wilma@gis.a-star.edu.sg"
+__copyright__ = "2017 Genome Institute of Singapore"
+__license__ = "The MIT License (MIT)"
+
+
+# global logger
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(
+    '[{asctime}] {levelname:8s} {filename} {message}', style='{'))
+logger.addHandler(handler)
+
+
+CATEGORIES = ['compute', 'queue', 'fs_latency', 'local', 'scheduling']
+
+# local rules on the critical path running longer than this should go to the cluster
+MAX_LOCAL_S = 60
+# rules whose critical path compute exceeds this are candidates for scattering
+MIN_SCATTER_S = 60 * 60
+# short cluster jobs spending more than this fraction queued are candidates for grouping
+MIN_GROUP_QUEUE_FRACTION = 0.5
+# reserved memory above this multiple of used memory (and wasting at
+# least MIN_RETUNE_GB) is a candidate for retuning
+MIN_RETUNE_MEM_FACTOR = 2.0
+MIN_RETUNE_GB = 2.0
+
+TIMESTAMP_FMT = '%a %b %d %H:%M:%S %Y'
+
+
+def job_times_from_snakemake_log(log):
+    """Parse job events from snakemake master log. Returns tuple of
+    log start time and dict of jobid to dict with keys start
+    (submission or start of local job), finish and wait (start of
+    waiting for missing output files or None). Restarted jobs keep
+    their last attempt.
+    """
+    times = dict()
+    log_start = None
+    last_time = None
+    waiting_since = None
+    with open(log) as fh:
+        for line in fh:
+            line = line.rstrip("\n")
+            if line.startswith("["):
+                estr = line[1:].split("]")[0]
+                try:
+                    last_time = datetime.strptime(estr, TIMESTAMP_FMT)
+                except ValueError:
+                    pass
+                else:
+                    line = line[len(estr)+2:].lstrip()
+                    if log_start is None:
+                        log_start = last_time
+            if last_time is None:
+                continue
+
+            m = re.match(r'^\s+jobid: (\d+)$', line)
+            if m:
+                # job info block: start for local jobs, overwritten by submission for cluster jobs
+                times[int(m.group(1))] = {'start': last_time, 'finish': None, 'wait': None}
+                continue
+            m = re.match(r'^Submitted (?:DRMAA )?job (\d+) ', line)
+            if m and int(m.group(1)) in times:
+                times[int(m.group(1))]['start'] = last_time
+                continue
+            if line.startswith("Waiting at most"):
+                waiting_since = last_time
+                continue
+            m = re.match(r'^Finished job (\d+)\.$', line)
+            if m and int(m.group(1)) in times:
+                t = times[int(m.group(1))]
+                t['finish'] = last_time
+                if waiting_since is not None and waiting_since >= t['start']:
+                    t['wait'] = waiting_since
+                waiting_since = None
+    return log_start, times
+
+
+def job_predecessors(jobs):
+    """Returns dict of jobid to list of jobids producing its inputs
+
+    >>> jobs = [{'jobid': 1, 'input': ['a'], 'output': ['b']},
+    ...         {'jobid': 2, 'input': ['b', 'c'], 'output': ['d']},
+    ...         {'jobid': 3, 'input': ['b', 'd'], 'output': []}]
+    >>> job_predecessors(jobs)
+    {1: [], 2: [1], 3: [1, 2]}
+    """
+    producer = dict()
+    for job in jobs:
+        for f in job['output']:
+            producer[f] = job['jobid']
+    preds = dict()
+    for job in jobs:
+        preds[job['jobid']] = sorted(set(producer[f] for f in job['input']
+                                         if f in producer and producer[f] != job['jobid']))
+    return preds
+
+
+def critical_path(times, preds):
+    """Walk back from the last finished job, always following the
+    predecessor that finished last. Returns list of jobids in
+    execution order
+
+    >>> t = lambda s: datetime(2017, 1, 1, 0, 0, s)
+    >>> times = {1: {'finish': t(10)}, 2: {'finish': t(20)}, 3: {'finish': t(15)}, 4: {'finish': t(30)}}
+    >>> critical_path(times, {1: [], 2: [1], 3: [1], 4: [2, 3]})
+    [1, 2, 4]
+    """
+    finished = [j for j in times if times[j]['finish'] is not None]
+    if not finished:
+        return []
+    path = [max(finished, key=lambda j: times[j]['finish'])]
+    while True:
+        cands = [p for p in preds.get(path[-1], []) if p in times and times[p]['finish'] is not None]
+        if not cands:
+            break
+        path.append(max(cands, key=lambda j: times[j]['finish']))
+    return path[::-1]
+
+
+def attribute_job(job, t, prev_finish, compute_s=None):
+    """Split the time from prev_finish to a job's finish into
+    categories. Returns dict of category to seconds
+
+    >>> t = lambda s: datetime(2017, 1, 1, 0, 0, s)
+    >>> times = {'start': t(5), 'finish': t(50), 'wait': t(40)}
+    >>> sorted(attribute_job({'local': False}, times, t(0), compute_s=20).items())
+    [('compute', 20.0), ('fs_latency', 10.0), ('local', 0.0), ('queue', 15.0), ('scheduling', 5.0)]
+    >>> attribute_job({'local': True}, times, t(0))['local']
+    45.0
+    """
+    secs = dict((c, 0.0) for c in CATEGORIES)
+    start = t['start']
+    if prev_finish is not None and start > prev_finish:
+        secs['scheduling'] = (start - prev_finish).total_seconds()
+    duration = max(0.0, (t['finish'] - start).total_seconds())
+    if job['local']:
+        secs['local'] = duration
+        return secs
+    if compute_s is None:
+        # no benchmark: can't tell compute from queue
+        compute_s = duration
+    secs['compute'] = float(min(compute_s, duration))
+    rest = duration - secs['compute']
+    if t.get('wait'):
+        secs['fs_latency'] = min(rest, max(0.0, (t['finish'] - t['wait']).total_seconds()))
+    secs['queue'] = rest - secs['fs_latency']
+    return secs
+
+
+def analyze(jobs, log_start, times, benchmarks):
+    """Critical path attribution. jobs as returned by
+    benchmarks.jobs_from_snakemake_log, benchmarks a dict of
+    normalized benchmark path to parsed benchmark values. Returns list
+    of per job dicts (rule, jobid, local, secs, benchmark values) along
+    the critical path
+    """
+    jobs_by_id = dict((j['jobid'], j) for j in jobs if j['jobid'] is not None)
+    times = dict((k, v) for k, v in times.items() if k in jobs_by_id)
+    path = critical_path(times, job_predecessors(list(jobs_by_id.values())))
+    result = []
+    prev_finish = log_start
+    for jobid in path:
+        job = jobs_by_id[jobid]
+        bench = benchmarks.get(os.path.normpath(job['benchmark'])) if job['benchmark'] else None
+        compute_s = bench['s'] if bench else None
+        secs = attribute_job(job, times[jobid], prev_finish, compute_s)
+        result.append({'rule': job['rule'], 'jobid': jobid, 'local': job['local'],
+                       'wildcards': job['wildcards'], 'secs': secs, 'benchmark': bench})
+        prev_finish = times[jobid]['finish']
+    return result
+
+
+def summarize_by_rule(path):
+    """Sum critical path seconds per rule. Returns dict of rule to
+    dict with categories (local seconds as local_s), num_jobs, local
+    (whether it's a local rule) and max_rss (MB or None)
+    """
+    rules = dict()
+    for item in path:
+        r = rules.get(item['rule'])
+        if r is None:
+            r = dict((c, 0.0) for c in CATEGORIES if c != 'local')
+            r.update({'local_s': 0.0, 'num_jobs': 0, 'local': item['local'], 'max_rss': None})
+            rules[item['rule']] = r
+        for c in CATEGORIES:
+            if c != 'local':
+                r[c] += item['secs'][c]
+        r['local_s'] += item['secs']['local']
+        r['num_jobs'] += 1
+        bench = item['benchmark']
+        if bench and bench.get('max_rss') is not None:
+            r['max_rss'] = max(r['max_rss'] or 0, bench['max_rss'])
+    return rules
+
+
+def proposals(rules, cluster_cfg=None):
+    """Suggestions per rule based on critical path summary. Returns
+    list of (rule, action, reason)
+
+    >>> rules = {'bam_index': {'compute': 10.0, 'queue': 600.0, 'fs_latency': 0.0, 'local': False,
+    ...                        'local_s': 0.0, 'scheduling': 0.0, 'num_jobs': 1, 'max_rss': 50.0},
+    ...          'map_sort': {'compute': 9000.0, 'queue': 60.0, 'fs_latency': 0.0, 'local': False,
+    ...                       'local_s': 0.0, 'scheduling': 0.0, 'num_jobs': 1, 'max_rss': 4096.0},
+    ...          'unit_merge': {'compute': 0.0, 'queue': 0.0, 'fs_latency': 0.0, 'local': True,
+    ...                         'local_s': 300.0, 'scheduling': 0.0, 'num_jobs': 1, 'max_rss': None}}
+    >>> cfg = {'__default__': {'mem': '1G'}, 'map_sort': {'mem': '32G'}}
+    >>> for p in proposals(rules, cfg): print(p[0], p[1])
+    bam_index group
+    map_sort scatter
+    map_sort retune
+    unit_merge cluster
+    """
+    cluster_cfg = cluster_cfg or dict()
+    default = cluster_cfg.get('__default__', dict())
+    props = []
+    for rule, r in sorted(rules.items()):
+        if r['local']:
+            if r['local_s'] > MAX_LOCAL_S:
+                props.append((rule, 'cluster', "serial local rule: {:.0f}s on critical path".format(
+                    r['local_s'])))
+            continue
+        wall = r['compute'] + r['queue'] + r['fs_latency']
+        if wall and r['compute'] / r['num_jobs'] <= MAX_GROUPED_S \
+           and r['queue'] / wall > MIN_GROUP_QUEUE_FRACTION:
+            props.append((rule, 'group', "{:.0f}% of {:.0f}s spent queued for {:.0f}s compute".format(
+                100.0 * r['queue'] / wall, wall, r['compute'])))
+        if r['compute'] > MIN_SCATTER_S:
+            props.append((rule, 'scatter', "{:.0f}s compute on critical path in {} job(s)".format(
+                r['compute'], r['num_jobs'])))
+        mem = cluster_cfg.get(rule, default).get('mem')
+        if mem and r['max_rss']:
+            reserved_gb, used_gb = cluster_mem_to_gb(mem), r['max_rss'] / 1024.0
+            if reserved_gb > MIN_RETUNE_MEM_FACTOR * used_gb \
+               and reserved_gb - used_gb > MIN_RETUNE_GB:
+                props.append((rule, 'retune', "reserves {:.1f}G but used {:.1f}G".format(
+                    reserved_gb, used_gb)))
+    return props
@@ -0,0 +1,145 @@
+"""CPU, memory and I/O efficiency of rules based on the benchmark
+warehouse (see benchmarkdb.py)
+
+Per rule (and pipeline version) the following is computed from
+benchmark logs and the requested resources in the analysis' cluster
+config:
+
+- cpu_util: CPU time divided by wall time times threads (1.0 means
+  all requested threads were busy all the time)
+- parallelism: CPU time divided by wall time, i.e. number of cores
+  effectively used
+- mem_headroom: share of requested memory not used (using the 90th
+  percentile of peak memory)
+- io_wait: share of wall time in which not even one core was busy.
+  Benchmark logs don't record iowait, so this is an upper bound
+  including sleeps, but for our tools it's dominated by I/O
+"""
+
+#--- standard library imports
+#
+import math
+import logging
+
+#--- third-party imports
+#
+#/
+
+#--- project specific imports
+#
+from benchmarkdb import percentile
+from critpath import MIN_RETUNE_MEM_FACTOR
+from critpath import MIN_RETUNE_GB
+
+
+__author__ = "Andreas Wilm"
+__email__ = "wilma@gis.a-star.edu.sg"
+__copyright__ = "2017 Genome Institute of Singapore"
+__license__ = "The MIT License (MIT)"
+
+
+# global logger
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(
+    '[{asctime}] {levelname:8s} {filename} {message}', style='{'))
+logger.addHandler(handler)
+
+
+EFFICIENCY_KEYS = ['n', 'threads', 'cpu_util', 'parallelism', 'mem_used_gb',
+                   'mem_req_gb', 'mem_headroom', 'io_wait', 'io_gb']
+
+# multi-threaded rules using less than this share of their threads waste slots
+MIN_CPU_UTIL = 0.5
+# rules idle for more than this share of their wall time are I/O bound
+MAX_IO_WAIT = 0.5
+# need at least this many jobs to flag a rule
+MIN_JOBS_FOR_FLAGS = 3
+
+
+def summarize_usage(records):
+    """Efficiency values for a list of usage records (dicts as
+    returned by BenchmarkDB.usage_records()). Values which can't be
+    computed are None
+
+    >>> recs = [{'threads': 4, 's': 100.0, 'cpu_time': 100.0, 'max_rss': 1024.0,
+    ...          'io_in': 512.0, 'io_out': 512.0, 'mem_gb': 8.0},
+    ...         {'threads': 4, 's': 300.0, 'cpu_time': 300.0, 'max_rss': 2048.0,
+    ...          'io_in': 0.0, 'io_out': 1024.0, 'mem_gb': 8.0}]
+    >>> s = summarize_usage(recs)
+    >>> s['threads'], s['cpu_util'], s['parallelism'], s['io_wait'], s['io_gb']
+    (4, 0.25, 1.0, 0.0, 1.0)
+    >>> round(s['mem_used_gb'], 2), s['mem_req_gb'], round(s['mem_headroom'], 2)
+    (1.9, 8.0, 0.76)
+    """
+    threads = [r['threads'] or 1 for r in records]
+    summary = dict((k, None) for k in EFFICIENCY_KEYS)
+    summary['n'] = len(records)
+    summary['threads'] = max(set(threads), key=threads.count)
+
+    timed = [(r, t) for r, t in zip(records, threads) if r['cpu_time'] is not None and r['s'] > 0]
+    if timed:
+        wall = sum(r['s'] for r, _ in timed)
+        cpu = sum(r['cpu_time'] for r, _ in timed)
+        summary['cpu_util'] = cpu / sum(r['s'] * t for r, t in timed)
+        summary['parallelism'] = cpu / wall
+        summary['io_wait'] = sum(max(0.0, r['s'] - r['cpu_time']) for r, _ in timed) / wall
+
+    used = [r['max_rss'] / 1024.0 for r in records if r['max_rss'] is not None]
+    requested = [r['mem_gb'] for r in records if r['mem_gb']]
+    if used:
+        summary['mem_used_gb'] = percentile(used, 90)
+    if requested:
+        summary['mem_req_gb'] = percentile(requested, 50)
+    if used and requested:
+        summary['mem_headroom'] = 1.0 - summary['mem_used_gb'] / summary['mem_req_gb']
+
+    io = [(r['io_in'] or 0.0) + (r['io_out'] or 0.0) for r in records
+          if r['io_in'] is not None or r['io_out'] is not None]
+    if io:
+        summary['io_gb'] = sum(io) / len(io) / 1024.0
+    return summary
+
+
+def efficiency_by_rule_version(records):
+    """Summarize usage records per rule and pipeline version. Returns
+    tuple of versions (ordered by first ingestion) and dict of (rule,
+    version) to summary (see summarize_usage())
+    """
+    grouped = dict()
+    first_seen = dict()
+    for r in records:
+        version = r['pipeline_version']
+        grouped.setdefault((r['rule'], version), []).append(r)
+        if version not in first_seen or r['ingested'] < first_seen[version]:
+            first_seen[version] = r['ingested']
+    versions = sorted(first_seen, key=lambda v: (first_seen[v], str(v)))
+    return versions, dict((k, summarize_usage(v)) for k, v in grouped.items())
+
+
+def efficiency_flags(summary):
+    """Returns list of (issue, reason) for a rule summary: wasted
+    threads, oversized memory request or I/O bound
+
+    >>> s = {'n': 10, 'threads': 4, 'cpu_util': 0.24, 'parallelism': 0.96,
+    ...      'mem_used_gb': 1.0, 'mem_req_gb': 8.0, 'mem_headroom': 0.875, 'io_wait': 0.1}
+    >>> for f in efficiency_flags(s): print(f[0])
+    threads
+    mem
+    """
+    flags = []
+    if summary['n'] < MIN_JOBS_FOR_FLAGS:
+        return flags
+    if summary['threads'] > 1 and summary['cpu_util'] is not None \
+       and summary['cpu_util'] < MIN_CPU_UTIL:
+        flags.append(('threads', "uses {:.1f} of {} threads: request {}".format(
+            summary['parallelism'], summary['threads'],
+            max(1, int(math.ceil(summary['parallelism']))))))
+    req, used = summary['mem_req_gb'], summary['mem_used_gb']
+    if req and used is not None and req > MIN_RETUNE_MEM_FACTOR * used \
+       and req - used > MIN_RETUNE_GB:
+        flags.append(('mem', "requests {:.1f}G but uses {:.1f}G".format(req, used)))
+    if summary['io_wait'] is not None and summary['io_wait'] > MAX_IO_WAIT:
+        flags.append(('io', "{:.0f}% of wall time without CPU use".format(
+            100.0 * summary['io_wait'])))
+    return flags
@@ -0,0 +1,195 @@
+"""Append-only event journal
+
+Writers (pipelines, the bcl2fastq Snakefile, the downstream starter)
+append one JSON line per event (e.g. analysis started, workflow
+complete, bcl2fastq DB update due) to a journal shared by all users
+of a site. Consumers (cron jobs) keep the byte offset up to which they
+have read and only look at events appended since, instead of globbing
+for flag files across large directory trees. Events a consumer can't
+handle yet are deferred, i.e. kept in its state and handed out again
+on the next read.
+
+The flag and trigger files in analysis directories remain the source
+of truth: events only point consumers to them (payload 'flag').
+
+The journal is configured per site (event_journal in site config,
+which has to be writable by all pipeline users) and exported by run.sh
+as RPD_EVENT_JOURNAL. Without it no events are logged and consumers
+fall back to looking for flag files.
+"""
+
+#--- standard library imports
+#
+import os
+import json
+import fcntl
+import logging
+
+#--- third-party imports
+#
+#/ by design: writers are called from any shell script with python3
+
+#--- project specific imports
+#
+from utils import generate_timestamp
+
+
+__author__ = "Andreas Wilm"
+__email__ = "wilma@gis.a-star.edu.sg"
+__copyright__ = "2017 Genome Institute of Singapore"
+__license__ = "The MIT License (MIT)"
+
+
+# global logger
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(
+    '[{asctime}] {levelname:8s} {filename} {message}', style='{'))
+logger.addHandler(handler)
+
+
+# event types
+ANALYSIS_STARTED = "analysis_started"
+WORKFLOW_COMPLETE = "workflow_complete"
+BCL2FASTQ_DBUPDATE = "bcl2fastq_dbupdate"
+
+
+def journal_path(journal=None):
+    """Journal to use: argument or environment. None if not
+    configured
+    """
+    if journal:
+        return journal
+    return os.environ.get('RPD_EVENT_JOURNAL')
+
+
+def append_event(event, dirname, journal=None, **payload):
+    """Append event for (analysis) directory dirname with optional
+    payload to journal. Returns the event as dict or None if no
+    journal is configured or it couldn't be written. The latter is
+    only logged so that callers (e.g. onsuccess handlers) carry on:
+    the flag files are still written and consumers can pick them up
+    with --scan
+
+    >>> append_event(WORKFLOW_COMPLETE, "/a", "/proc/no/such/journal.jsonl")
+    """
+    journal = journal_path(journal)
+    if not journal:
+        return None
+    entry = {'event': event,
+             'dir': os.path.abspath(dirname),
+             'timestamp': generate_timestamp()}
+    entry.update(payload)
+    line = json.dumps(entry, sort_keys=True) + "\n"
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(journal)), exist_ok=True)
+        with open(journal, 'a') as fh:
+            # appends of concurrent writers must not interleave
+            fcntl.lockf(fh, fcntl.LOCK_EX)
+            try:
+                fh.write(line)
+                fh.flush()
+            finally:
+                fcntl.lockf(fh, fcntl.LOCK_UN)
+    except OSError as err:
+        logger.warning("Couldn't log %s event for %s in %s: %s",
+                       event, entry['dir'], journal, err)
+        return None
+    return entry
+
+
+def read_events(journal, offset=0):
+    """Read events appended to journal since byte offset. Returns list
+    of events and new offset. Incomplete last lines (writer still
+    busy) are left for the next read. If the journal was truncated
+    (offset beyond its end), it is read from the start again.
+    Unparseable lines are skipped
+
+    >>> import tempfile
+    >>> fd, journal = tempfile.mkstemp(suffix=".jsonl")
+    >>> _ = append_event(WORKFLOW_COMPLETE, "/a", journal)
+    >>> events, offset = read_events(journal)
+    >>> [(e['event'], e['dir']) for e in events]
+    [('workflow_complete', '/a')]
+    >>> _ = append_event(ANALYSIS_STARTED, "/b", journal, dbid="123")
+    >>> events, offset = read_events(journal, offset)
+    >>> [e['dbid'] for e in events]
+    ['123']
+    >>> open(journal, 'w').close()# truncated
+    >>> _ = append_event(WORKFLOW_COMPLETE, "/c", journal)
+    >>> [e['dir'] for e in read_events(journal, offset)[0]]
+    ['/c']
+    >>> with open(journal, 'a') as fh:
+    ...     _ = fh.write("garbage\\n")
+    >>> _ = append_event(WORKFLOW_COMPLETE, "/d", journal)
+    >>> [e['dir'] for e in read_events(journal)[0]]
+    ['/c', '/d']
+    >>> os.close(fd); os.unlink(journal)
+    """
+    events = []
+    if not os.path.exists(journal):
+        return events, offset
+    with open(journal, 'rb') as fh:
+        truncated = offset > os.fstat(fh.fileno()).st_size
+        if offset and not truncated:
+            # offset always points past a newline
+            fh.seek(offset-1)
+            truncated = fh.read(1) != b"\n"
+        if truncated:
+            logger.warning("Offset %s doesn't match %s. Journal was truncated?"
+                           " Reading from start", offset, journal)
+            offset = 0
+        fh.seek(offset)
+        for line in fh:
+            if not line.endswith(b"\n"):
+                break
+            offset += len(line)
+            try:
+                events.append(json.loads(line.decode()))
+            except ValueError:
+                logger.warning("Skipping unparseable line in %s: %s", journal, line)
+    return events, offset
+
+
+class JournalReader(object):
+    """Consumer of the event journal. State (offset and deferred
+    events) is kept per consumer next to the journal
+    """
+
+    def __init__(self, consumer, journal=None):
+        self.journal = journal_path(journal)
+        assert self.journal, ("No event journal configured")
+        self.state_file = "{}.{}.state".format(self.journal, consumer)
+        self.offset = 0
+        self.deferred = []
+        if os.path.exists(self.state_file):
+            with open(self.state_file) as fh:
+                state = json.load(fh)
+            self.offset = state['offset']
+            self.deferred = state['deferred']
+
+
+    def events(self, types=None):
+        """Deferred plus newly appended events, optionally restricted
+        to given event types (others are skipped for good). Clears the
+        deferred list: call defer() for those to be retried
+        """
+        new_events, self.offset = read_events(self.journal, self.offset)
+        events = self.deferred + new_events
+        self.deferred = []
+        if types:
+            events = [e for e in events if e['event'] in types]
+        return events
+
+
+    def defer(self, event):
+        """Hand out event again on next read"""
+        self.deferred.append(event)
+
+
+    def commit(self):
+        """Save state. Without, the same events will be read again"""
+        tmp = self.state_file + ".tmp"
+        with open(tmp, 'w') as fh:
+            json.dump({'offset': self.offset, 'deferred': self.deferred}, fh)
+        os.rename(tmp, self.state_file)
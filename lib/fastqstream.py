@@ -0,0 +1,153 @@
+"""Single pass over gzipped fastq files
+
+Reads each compressed file once and at the same time validates the
+gzip stream (CRC and length of every member, like gzip -t), computes
+the MD5 checksum of the compressed file plus basic fastq statistics
+and passes the uncompressed data on to a consumer (e.g. fastqc reading
+from a named pipe).
+"""
+
+#--- standard library imports
+#
+import gzip
+import zlib
+import hashlib
+import logging
+
+#--- third-party imports
+#
+#/
+
+#--- project specific imports
+#
+#/
+
+
+__author__ = "Andreas Wilm"
+__email__ = "wilma@gis.a-star.edu.sg"
+__copyright__ = "2017 Genome Institute of Singapore"
+__license__ = "The MIT License (MIT)"
+
+
+# global logger
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(
+    '[{asctime}] {levelname:8s} {filename} {message}', style='{'))
+logger.addHandler(handler)
+
+
+CHUNK_SIZE = 4 * 1024 * 1024
+
+STATS_COLS = ['fastq', 'reads', 'bases', 'md5']
+
+
+class FastqCheckError(Exception):
+    """Corrupt gzip stream or malformed fastq"""
+    pass
+
+
+class HashingReader(object):
+    """File-like wrapper computing the MD5 of everything read"""
+
+    def __init__(self, fh):
+        self.fh = fh
+        self.md5 = hashlib.md5()
+
+
+    def read(self, size=-1):
+        """read and hash"""
+        data = self.fh.read(size)
+        self.md5.update(data)
+        return data
+
+
+    def hexdigest(self):
+        """hex digest of data read so far"""
+        return self.md5.hexdigest()
+
+
+class FastqCounter(object):
+    """Counts reads and bases of uncompressed fastq data fed in
+    arbitrary chunks (4-line records assumed)
+
+    >>> c = FastqCounter()
+    >>> c.update(b"@r1\\nACGT\\n+\\nIIII\\n@r2\\nAC")
+    >>> c.update(b"G\\n+\\nIII\\n")
+    >>> c.finish()
+    (2, 7)
+    >>> c = FastqCounter()
+    >>> c.update(b"@r1\\nACGT\\n+\\n")
+    >>> c.finish()
+    Traceback (most recent call last):
+    ...
+    fastqstream.FastqCheckError: Truncated fastq record (3 lines)
+    """
+
+    def __init__(self):
+        self.lines = 0
+        self.bases = 0
+        self.partial = b""
+
+
+    def update(self, data):
+        """count complete lines in data, keeping an incomplete last line"""
+        lines = (self.partial + data).split(b"\n")
+        self.partial = lines.pop()
+        # sequence is the second line of each record
+        offset = (1 - self.lines) % 4
+        self.bases += sum(map(len, lines[offset::4]))
+        self.lines += len(lines)
+
+
+    def finish(self):
+        """returns tuple of reads and bases. raises FastqCheckError if
+        the last record is incomplete"""
+        if self.partial:
+            self.update(b"\n")
+        if self.lines % 4:
+            raise FastqCheckError("Truncated fastq record ({} lines)".format(self.lines % 4))
+        return self.lines // 4, self.bases
+
+
+def check_fastq(fastq, out_fh=None, chunk_size=CHUNK_SIZE):
+    """Read gzipped fastq once: validate the gzip stream, count reads
+    and bases, compute the MD5 of the compressed file and write the
+    uncompressed data to out_fh (if given). Returns dict with keys
+    STATS_COLS. Raises FastqCheckError on corrupt input
+
+    >>> import os, tempfile
+    >>> fd, fq = tempfile.mkstemp(suffix=".fastq.gz")
+    >>> with gzip.open(fq, 'wb') as fh:
+    ...     _ = fh.write(b"@r1\\nACGT\\n+\\nIIII\\n")
+    >>> stats = check_fastq(fq)
+    >>> stats['reads'], stats['bases'], len(stats['md5'])
+    (1, 4, 32)
+    >>> with open(fq, 'r+b') as fh:
+    ...     _ = fh.truncate(os.path.getsize(fq) - 4)
+    >>> check_fastq(fq) # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    fastqstream.FastqCheckError: Corrupt gzip stream in ...
+    >>> os.close(fd); os.unlink(fq)
+    """
+    counter = FastqCounter()
+    with open(fastq, 'rb') as raw:
+        reader = HashingReader(raw)
+        gz = gzip.GzipFile(fileobj=reader, mode='rb')
+        while True:
+            try:
+                data = gz.read(chunk_size)
+            except (OSError, EOFError, zlib.error) as err:
+                raise FastqCheckError("Corrupt gzip stream in {}: {}".format(fastq, err))
+            if not data:
+                break
+            counter.update(data)
+            # consumer errors (e.g. broken pipe) are not ours to interpret
+            if out_fh is not None:
+                out_fh.write(data)
+        # hash trailing bytes gzip didn't need, if any
+        while reader.read(chunk_size):
+            pass
+    reads, bases = counter.finish()
+    return dict(fastq=fastq, reads=reads, bases=bases, md5=reader.hexdigest())
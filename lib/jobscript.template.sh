@@ -0,0 +1,19 @@
+#!/bin/sh
+# properties = {{properties}}
+# record job start for queue latency tracking (see lib/queuelatency.py).
+# job id and queue are set by SGE/UGE ($JOB_ID, $QUEUE) or PBS Pro
+# ($PBS_JOBID and the queue as requested, $PBS_O_QUEUE, since jobs are
+# routed to execution queues). never fail the job because of this
+printf "start\t%s\t%s\t%s\n" "$JOB_ID$PBS_JOBID" "$QUEUE$PBS_O_QUEUE" "$(date +%s)" >> {EVENTLOG} 2>/dev/null || true
+# record failed jobs, including scheduler kills announced by a signal
+# (e.g. PBS walltime, SGE s_rt/notify), so that their retries get more
+# resources (see lib/retries.py). usage is taken from accounting on
+# resubmission. jobs killed without warning (SIGKILL) can't be recorded
+log_failure() {{
+    printf "%s\t%s\t\t\n" "$(date +%s)" "$JOB_ID$PBS_JOBID" >> {FAILED_JOBS_LOG} 2>/dev/null || true
+}}
+trap 'log_failure; exit 1' TERM USR1 USR2 XCPU
+{{exec_job}}
+rc=$?
+[ $rc -eq 0 ] || log_failure
+exit $rc
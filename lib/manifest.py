@@ -0,0 +1,150 @@
+"""Per run checksum manifest of demultiplexed fastqs
+
+The bcl2fastq pipeline computes the MD5 of every fastq while checking
+and QC'ing it (see fastqstream.py) and collects them together with
+size and modification time into one manifest per run. Consumers
+(archiving, transfers, stage-out) verify files against the manifest
+with a stat() instead of reading terabytes again to re-hash them: if
+size and mtime are unchanged, the recorded checksum still holds.
+"""
+
+#--- standard library imports
+#
+import os
+import csv
+import logging
+from collections import OrderedDict
+
+#--- third-party imports
+#
+#/
+
+#--- project specific imports
+#
+#/
+
+
+__author__ = "Andreas Wilm"
+__email__ = "wilma@gis.a-star.edu.sg"
+__copyright__ = "2017 Genome Institute of Singapore"
+__license__ = "The MIT License (MIT)"
+
+
+# global logger
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(
+    '[{asctime}] {levelname:8s} {filename} {message}', style='{'))
+logger.addHandler(handler)
+
+
+# written to the bcl2fastq result dir. paths are relative to it
+MANIFEST = "fastq_manifest.tsv"
+
+MANIFEST_COLS = ['path', 'size', 'mtime', 'md5']
+
+
+def manifest_entry(path, md5, root):
+    """manifest entry for existing file path with known md5. path in
+    entry is relative to root
+    """
+    st = os.stat(path)
+    return OrderedDict([('path', os.path.relpath(path, root)),
+                        ('size', st.st_size),
+                        ('mtime', int(st.st_mtime)),
+                        ('md5', md5)])
+
+
+def manifest_entries(stats_files, root):
+    """manifest entries for all fastqs listed in fastq_check.py stats
+    files (see fastqstream.STATS_COLS), sorted by path
+    """
+    entries = dict()
+    for stats_file in stats_files:
+        with open(stats_file) as fh:
+            for row in csv.DictReader(fh, delimiter='\t'):
+                entry = manifest_entry(row['fastq'], row['md5'], root)
+                entries[entry['path']] = entry
+    return [entries[k] for k in sorted(entries)]
+
+
+def write_manifest(entries, manifest):
+    """write manifest entries to file manifest"""
+    with open(manifest, 'w') as fh:
+        fh.write("\t".join(MANIFEST_COLS) + "\n")
+        for entry in entries:
+            fh.write("\t".join(str(entry[k]) for k in MANIFEST_COLS) + "\n")
+
+
+def read_manifest(manifest):
+    """returns manifest entries as OrderedDict with path as key"""
+    with open(manifest) as fh:
+        return read_manifest_lines(fh)
+
+
+def read_manifest_lines(lines):
+    """like read_manifest() but for an iterable of lines"""
+    entries = OrderedDict()
+    for row in csv.DictReader(lines, delimiter='\t'):
+        row['size'] = int(row['size'])
+        row['mtime'] = int(row['mtime'])
+        entries[row['path']] = row
+    return entries
+
+
+def subdir_entries(entries, subdir):
+    """entries below subdir with paths made relative to it
+
+    >>> entries = read_manifest_lines(["path\\tsize\\tmtime\\tmd5",
+    ...     "Project_M1/Sample_A/A_R1.fastq.gz\\t10\\t1500000000\\tabc",
+    ...     "Project_M2/Sample_B/B_R1.fastq.gz\\t20\\t1500000000\\tdef"])
+    >>> list(subdir_entries(entries, "Project_M1").keys())
+    ['Sample_A/A_R1.fastq.gz']
+    """
+    prefix = os.path.normpath(subdir) + os.sep
+    return OrderedDict((path[len(prefix):], entry) for path, entry in entries.items()
+                       if path.startswith(prefix))
+
+
+def verify_file(entry, path, check_mtime=True):
+    """Checks whether file path still matches manifest entry by
+    size and (unless check_mtime is False, e.g. for copies not
+    preserving times) modification time. Returns None if it does,
+    otherwise the reason as string
+    """
+    if not os.path.exists(path):
+        return "{} missing".format(path)
+    st = os.stat(path)
+    if st.st_size != entry['size']:
+        return "{} size changed ({} != {})".format(path, st.st_size, entry['size'])
+    if check_mtime and int(st.st_mtime) != entry['mtime']:
+        return "{} modified since checksum was computed".format(path)
+    return None
+
+
+def verify_files(entries, root, paths=None, check_mtime=True):
+    """Verify files against manifest entries (paths relative to
+    root). If paths (relative to root as well) are given, only those
+    are checked and any not listed in the manifest is reported. Returns
+    list of problems, empty if all good
+    """
+    problems = []
+    if paths is None:
+        paths = entries.keys()
+    for path in paths:
+        path = os.path.normpath(path)
+        entry = entries.get(path)
+        if entry is None:
+            problems.append("{} not in manifest".format(path))
+            continue
+        problem = verify_file(entry, os.path.join(root, path), check_mtime)
+        if problem:
+            problems.append(problem)
+    return problems
+
+
+def write_md5sums(entries, md5sums):
+    """write entries in md5sum format (md5sum -c can check them)"""
+    with open(md5sums, 'w') as fh:
+        for path, entry in entries.items():
+            fh.write("{}  {}\n".format(entry['md5'], path))
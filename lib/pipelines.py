@@ -17,11 +17,13 @@ from datetime import datetime
 from datetime import timedelta
 import calendar
 import json
+import sqlite3
 import tarfile
 import glob
 #import argparse
 import copy
 from collections import deque
+from functools import lru_cache
 
 #--- third-party imports
 #
@@ -34,8 +36,29 @@ import dateutil.relativedelta
 from config import site_cfg
 from config import rest_services
 from utils import generate_timestamp
+from eventjournal import append_event
+from eventjournal import WORKFLOW_COMPLETE
 from utils import chroms_and_lens_from_fasta
 from utils import bed_and_fa_are_compat
+from benchmarks import ResourceModel
+from benchmarks import apply_resource_model
+from benchmarks import input_bytes_from_cfg
+from rulegroups import load_rule_groups
+from rulegroups import rule_runtimes
+from rulegroups import plan_rule_groups
+from rulegroups import group_args
+from rulegroups import add_group_cluster_cfg
+from rulegroups import write_rule_plan_include
+from rulegroups import RULE_PLAN_INCLUDE
+from projection import project_analysis
+from projection import choose_site
+from projection import is_runaway
+from projection import PROJECTION_KEYS
+from queuelatency import QueueLatencyDB
+from queuelatency import latency_thresholds
+from queuelatency import EVENT_LOG
+from retries import SUBMISSIONS_LOG
+from retries import FAILED_JOBS_LOG
 import configargparse
 
 
@@ -215,6 +238,14 @@ class PipelineHandler(object):
             assert os.path.exists(cluster_cfgfile)
         self.cluster_cfgfile = cluster_cfgfile
 
+        # input sizes are recorded for later benchmark based resource modelling
+        input_bytes = input_bytes_from_cfg(self.cfg_dict)
+        if input_bytes:
+            self.cfg_dict['input_bytes'] = input_bytes
+        # compute node properties used for autotuning rules (see autotune.py)
+        if site_cfg.get('node_profile'):
+            self.cfg_dict['node_profile'] = site_cfg['node_profile']
+
         self.pipeline_cfgfile_out = os.path.join(
             self.outdir, self.PIPELINE_CFGFILE)
 
@@ -251,6 +282,40 @@ class PipelineHandler(object):
 
         self.site = site
         self.master_walltime_h = master_walltime_h
+
+        # rule groups (cfg/groups.yaml next to cluster config) with
+        # local/grouped/cluster decisions based on runtime history
+        self.rule_groups = None
+        self.rule_runtimes = dict()
+        self.rule_plan = None
+        if self.cluster_cfgfile:
+            self.rule_groups = load_rule_groups(os.path.dirname(self.cluster_cfgfile))
+        if self.rule_groups:
+            dbfile = site_cfg.get('benchmark_db')
+            if dbfile and os.path.exists(dbfile):
+                self.rule_runtimes = rule_runtimes(dbfile, pipeline_name, site)
+            else:
+                logger.info("No benchmark database: rules not regrouped")
+            # rules are moved to the master or batched more eagerly if the queue is slow
+            latency_s = self.queue_latency(get_queue_latency_db())
+            max_local_s, max_grouped_s = latency_thresholds(latency_s)
+            self.rule_plan = plan_rule_groups(self.rule_groups, self.rule_runtimes,
+                                              max_local_s, max_grouped_s)
+            self.cfg_dict['rule_plan'] = self.rule_plan
+            # local decisions are declared in a generated include (see logging.rules)
+            if self.rule_plan['local']:
+                self.cfg_dict['rule_plan_include'] = os.path.abspath(
+                    os.path.join(self.outdir, RULE_PLAN_INCLUDE))
+
+        # projected resource usage and cost (see tools/project_analysis.py).
+        # opt-in and advisory only, i.e. must never prevent a launch
+        dbfile = site_cfg.get('benchmark_db')
+        if site_cfg.get('project_resources') and input_bytes and input_bytes['total'] \
+           and dbfile and os.path.exists(dbfile):
+            try:
+                self.project_resources(dbfile, input_bytes)
+            except Exception as err:
+                logger.warning("Couldn't project resource usage: %s", err)
         self.snakefile_abs = os.path.abspath(
             os.path.join(pipeline_subdir, "Snakefile"))
         assert os.path.exists(self.snakefile_abs)
@@ -264,6 +329,11 @@ class PipelineHandler(object):
         self.run_template = os.path.join(
             PIPELINE_ROOTDIR, "lib", "run.template.{}.sh".format(self.site))
         self.run_out = os.path.join(self.outdir, "run.sh")
+
+        # jobscript template (records job starts)
+        self.jobscript_template = os.path.join(
+            PIPELINE_ROOTDIR, "lib", "jobscript.template.sh")
+        self.jobscript_out = os.path.join(self.outdir, "jobscript.sh")
         assert os.path.exists(self.run_template)
 
         # we don't know for sure who's going to actually exectute
@@ -280,6 +350,56 @@ class PipelineHandler(object):
                          'log_path': log_path}
 
 
+    def queue_latency(self, dbfile):
+        """Rolling submission to start latency (seconds) of the slave
+        queue or None if unknown (see queuelatency.py)
+        """
+        # as requested, i.e. pooled if the scheduler picks (see QueueLatencyDB.queue_latency())
+        queue = self.slave_q
+        # never create the database here: it's filled by tools/queue_latency.py
+        if not dbfile or not os.path.exists(dbfile):
+            logger.info("No queue latency database: using default rule group thresholds")
+            return None
+        try:
+            db = QueueLatencyDB(dbfile)
+            try:
+                latency_s = db.queue_latency(queue)
+            finally:
+                db.close()
+        except (OSError, sqlite3.Error, ValueError, TypeError) as err:
+            logger.warning("Couldn't query queue latency database: %s", err)
+            return None
+        if latency_s is not None:
+            logger.info("Rolling latency of queue %s is %.0fs", queue if queue else "(any)", latency_s)
+        return latency_s
+
+
+    def project_resources(self, dbfile, input_bytes):
+        """Project resource usage and cost of this analysis for all
+        sites with known cost rates, store the projection for this
+        site in the config and warn about runaway analyses
+        """
+        cost_rates = site_cfg.get('cost_rates', dict())
+        sites = sorted(set(list(cost_rates) + [self.site]))
+        projections = project_analysis(dbfile, self.pipeline_name, input_bytes,
+                                       sites, cost_rates)
+        p = projections.get(self.site)
+        if not p:
+            return
+        self.cfg_dict['projection'] = dict((k, p[k]) for k in PROJECTION_KEYS + ['cost'])
+        logger.info("Projected %d jobs, %.1f CPU hours, %.1f GB memory hours, %.1fh wall time",
+                    p['num_jobs'], p['cpu_h'], p['mem_gb_h'], p['wall_h'])
+        if is_runaway(p):
+            logger.warning("Analysis projected to use %.0f CPU hours, far above %.0f"
+                           " based on previous %s analyses", p['cpu_h'],
+                           p['runaway_cpu_h'], self.pipeline_name)
+        for by, what in [('cost', 'cheaper'), ('wall_h', 'faster')]:
+            best = choose_site(projections, by)
+            if best and best != self.site and p.get(by) is not None:
+                logger.info("Analysis projected to be %s at %s (%.1f vs %.1f)",
+                            what, best, projections[best][by], p[by])
+
+
     @staticmethod
     def write_snakemake_init(rc_file, overwrite=False):
         """write snakemake init rc (loads miniconda and, activate source')
@@ -317,9 +437,32 @@ class PipelineHandler(object):
 
 
     def write_cluster_cfg(self):
-        """writes site dependend cluster config
+        """writes site dependend cluster config. time and mem are
+        overriden with predictions if a benchmark derived resource model
+        (see tools/resource_model.py) exists next to the cluster config.
+        Entries for rule groups are added as well.
         """
-        shutil.copyfile(self.cluster_cfgfile, self.cluster_cfgfile_out)
+        resource_model = get_resource_model_file(
+            os.path.dirname(self.cluster_cfgfile), self.site)
+        if not resource_model and not group_args(self.rule_plan):
+            shutil.copyfile(self.cluster_cfgfile, self.cluster_cfgfile_out)
+            return
+
+        with open(self.cluster_cfgfile) as fh:
+            cluster_cfg = yaml.safe_load(fh)
+        if resource_model:
+            model = ResourceModel.load(resource_model)
+            cluster_cfg, changes = apply_resource_model(
+                cluster_cfg, model, self.cfg_dict.get('input_bytes'))
+            for rule, (old, new) in sorted(changes.items()):
+                logger.info("Resource model %s: %s time %s -> %s, mem %s -> %s",
+                            resource_model, rule, old.get('time'), new['time'],
+                            old.get('mem'), new.get('mem'))
+        # group jobs are looked up by group name
+        cluster_cfg = add_group_cluster_cfg(
+            cluster_cfg, self.rule_groups, self.rule_plan, self.rule_runtimes)
+        with open(self.cluster_cfgfile_out, 'w') as fh:
+            yaml.dump(cluster_cfg, fh, default_flow_style=False)
 
 
     def write_run_template(self):
@@ -335,7 +478,12 @@ class PipelineHandler(object):
              'DEFAULT_RESTARTS': self.restarts,
              'MASTER_WALLTIME_H': self.master_walltime_h,
              'DEFAULT_SLAVE_Q': self.slave_q if self.slave_q else "",
-             'LOGGER_CMD': self.logger_cmd}
+             'LOGGER_CMD': self.logger_cmd,
+             'EVENT_JOURNAL': site_cfg.get('event_journal', ""),
+             'GROUP_ARGS': group_args(self.rule_plan),
+             'JOBSCRIPT': self.jobscript_out,
+             'CLUSTER_SUBMIT_CMD': os.path.join(PIPELINE_ROOTDIR, 'tools', 'cluster_submit.py'),
+             'CLUSTER_STATUS_CMD': os.path.join(PIPELINE_ROOTDIR, 'tools', 'cluster_status.py')}
 
         with open(self.run_template) as fh:
             templ = fh.read()
@@ -343,6 +491,17 @@ class PipelineHandler(object):
             fh.write(templ.format(**d))
 
 
+    def write_jobscript(self):
+        """writes snakemake jobscript from template
+        """
+        with open(self.jobscript_template) as fh:
+            templ = fh.read()
+        with open(self.jobscript_out, 'w') as fh:
+            fh.write(templ.format(
+                EVENTLOG=os.path.join(os.path.abspath(self.outdir), EVENT_LOG),
+                FAILED_JOBS_LOG=os.path.join(os.path.abspath(self.outdir), FAILED_JOBS_LOG)))
+
+
     def read_cfgfiles(self):
         """parse default config and replace all RPD env vars
         """
@@ -422,6 +581,9 @@ class PipelineHandler(object):
 
         if self.site != "local":
             self.write_cluster_cfg()
+            self.write_jobscript()
+        if self.cfg_dict.get('rule_plan_include'):
+            write_rule_plan_include(self.rule_plan, self.cfg_dict['rule_plan_include'])
         self.write_merged_cfg()
         self.write_snakemake_env()
         self.write_snakemake_init(self.snakemake_init_file)
@@ -592,6 +754,25 @@ def get_site():
     return site_cfg['name']
 
 
+def get_event_journal():
+    """Shared event journal of this site or None if not configured.
+    RPD_EVENT_JOURNAL (exported by run.sh) takes precedence
+    """
+    return os.environ.get('RPD_EVENT_JOURNAL', site_cfg.get('event_journal'))
+
+
+def get_queue_latency_db():
+    """Queue latency database shared by all users of this site or None
+    if not configured. RPD_QUEUE_LATENCY_DB takes precedence over
+    queue_latency_db of the site config, which defaults to
+    queue_latency.db next to the benchmark database
+    """
+    dbfile = os.environ.get('RPD_QUEUE_LATENCY_DB', site_cfg.get('queue_latency_db'))
+    if not dbfile and site_cfg.get('benchmark_db'):
+        dbfile = os.path.join(os.path.dirname(site_cfg['benchmark_db']), "queue_latency.db")
+    return dbfile
+
+
 def get_cluster_cfgfile(cfg_dir):
     """returns None for local runs
     """
@@ -602,6 +783,16 @@ def get_cluster_cfgfile(cfg_dir):
         return cfg
 
 
+def get_resource_model_file(cfg_dir, site):
+    """returns benchmark derived resource model file for site if
+    present, otherwise None
+    """
+    cfg = os.path.join(cfg_dir, "resources.{}.yaml".format(site))
+    if os.path.exists(cfg):
+        return cfg
+    return None
+
+
 def get_init_call():
     """return dotkit init call
     """
@@ -702,8 +893,10 @@ def get_bcl_runfolder_for_runid(runid_and_flowcellid):
     return rundir
 
 
+@lru_cache(maxsize=None)
 def user_mail_mapper(user_name):
-    """Rest service to get user email id from AD mapper
+    """Rest service to get user email id from AD mapper. Cached, since
+    called for the same few users over and over
     """
     if is_devel_version():
         user_email = rest_services['user_mail_mapper']['testing'] + user_name
@@ -922,8 +1115,11 @@ def bundle_and_clean_logs(pipeline_outdir, result_outdir="out/",
     # (cluster) log directory
     logfiles.extend(glob.glob(os.path.join(log_dir, "*")))
     # paranoid cleaning and some exclusion
+    # job event logs are kept for later ingestion (see queuelatency.py and retries.py)
+    keep = ["snakemake.log", os.path.basename(EVENT_LOG), os.path.basename(SUBMISSIONS_LOG),
+            os.path.basename(FAILED_JOBS_LOG)]
     logfiles = [f for f in logfiles if os.path.isfile(f)
-                and not f.endswith("snakemake.log")]
+                and not any(f.endswith(k) for k in keep)]
 
     with tarfile.open(bundle, "w:gz") as tarfh:
         for f in logfiles:
@@ -934,8 +1130,12 @@ def bundle_and_clean_logs(pipeline_outdir, result_outdir="out/",
 
 
 def mark_as_completed():
-    """Dropping a flag file marking analysis as complete"""
+    """Dropping a flag file marking analysis as complete and logging
+    completion in the event journal (if configured), which consumers
+    watch instead of globbing for flag files
+    """
     analysis_dir = os.getcwd()
     flag_file = os.path.join(analysis_dir, WORKFLOW_COMPLETION_FLAGFILE)
     with open(flag_file, 'a') as fh:
         fh.write("{}\n".format(generate_timestamp()))
+    append_event(WORKFLOW_COMPLETE, analysis_dir, flag=flag_file)
@@ -0,0 +1,216 @@
+"""Projection of CPU hours, memory hours, wall time and cost of an
+analysis before it is launched
+
+Based on the benchmark warehouse (see benchmarkdb.py), which joins
+per-job resource usage with input sizes: per-rule resource models
+(benchmarks.ResourceModel) predict the time and memory of each job
+from the size of its unit, sample or whole analysis, and the number
+of jobs per unit/sample is taken from previous analyses of the same
+pipeline.
+
+Wall time is estimated as the sum over rules of their longest job,
+i.e. assuming all jobs of a rule run in parallel and rules run one
+after another. Queueing is not included.
+
+Costs per site are computed from optional rates in the site config:
+
+    cost_rates:
+      GIS:
+        core_h: 0.02
+        gb_h: 0.005
+      AWS:
+        ...
+"""
+
+#--- standard library imports
+#
+import logging
+
+#--- third-party imports
+#
+#/
+
+#--- project specific imports
+#
+from benchmarks import ResourceModel
+from benchmarkdb import BenchmarkDB
+from benchmarkdb import percentile
+
+
+__author__ = "Andreas Wilm"
+__email__ = "wilma@gis.a-star.edu.sg"
+__copyright__ = "2017 Genome Institute of Singapore"
+__license__ = "The MIT License (MIT)"
+
+
+# global logger
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(
+    '[{asctime}] {levelname:8s} {filename} {message}', style='{'))
+logger.addHandler(handler)
+
+
+# analyses projected to use more than this multiple of the historical
+# CPU hours percentile below are flagged as runaway
+RUNAWAY_FACTOR = 3.0
+RUNAWAY_PCT = 90
+# minimum number of previous analyses needed for the runaway check
+RUNAWAY_MIN_ANALYSES = 3
+
+# keys in projections
+PROJECTION_KEYS = ['num_jobs', 'cpu_h', 'mem_gb_h', 'wall_h']
+
+
+def jobs_per_granule(job_counts):
+    """Median number of jobs per unit, sample or analysis (see
+    BenchmarkDB.job_counts()) per rule
+
+    >>> jobs_per_granule({'map_sort': [(4, 4), (2, 2)], 'gatk_hc': [(25, 1), (25, 1), (30, 1)]})
+    {'map_sort': 1.0, 'gatk_hc': 25.0}
+    """
+    return dict((rule, float(percentile([float(j) / g for j, g in counts], 50)))
+                for rule, counts in job_counts.items())
+
+
+def granule_sizes(granularity, input_bytes):
+    """List of input sizes in bytes of units, samples or whole
+    analysis, depending on granularity
+
+    >>> ib = {'units': {'u1': 10, 'u2': 20}, 'samples': {'s1': 30}, 'total': 30}
+    >>> granule_sizes('unit', ib), granule_sizes('sample', ib), granule_sizes('total', ib)
+    ([10, 20], [30], [30])
+    """
+    if granularity == 'unit':
+        return sorted(input_bytes['units'].values())
+    elif granularity == 'sample':
+        return sorted(input_bytes['samples'].values())
+    return [input_bytes['total']]
+
+
+def project(model, per_granule, input_bytes):
+    """Project resource usage of an analysis with given input sizes
+    (see benchmarks.input_bytes_from_cfg()) from a fitted
+    ResourceModel and jobs per granule. Predictions are made for the
+    number of threads observed most often per rule. Returns dict with
+    PROJECTION_KEYS and rules (per rule values)
+
+    >>> m = ResourceModel({'map_sort': {8: {'n': 5, 'time': {'a': 0.0, 'b': 3600.0, 'safety': 1.0},
+    ...                                     'mem': {'a': 1024.0, 'b': 0.0, 'safety': 1.0}}}},
+    ...                   {'map_sort': 'unit'})
+    >>> ib = {'units': {'u1': 2*1024**3, 'u2': 1024**3}, 'samples': {'s1': 3*1024**3}, 'total': 3*1024**3}
+    >>> p = project(m, {'map_sort': 1.0}, ib)
+    >>> p['num_jobs'], p['cpu_h'], p['mem_gb_h'], p['wall_h']
+    (2, 24.0, 3.0, 2.0)
+    """
+    totals = dict((k, 0) for k in PROJECTION_KEYS)
+    totals['rules'] = dict()
+    for rule, by_threads in sorted(model.rules.items()):
+        if not by_threads:
+            continue
+        threads = max(by_threads, key=lambda t: by_threads[t]['n'])
+        num_jobs = per_granule.get(rule, 1.0)
+        r = dict((k, 0.0) for k in PROJECTION_KEYS)
+        for size in granule_sizes(model.granularity.get(rule, 'total'), input_bytes):
+            time_s, mem_mb = model.predict(rule, size, threads, margin=0.0)
+            time_h = time_s / 3600.0
+            r['num_jobs'] += num_jobs
+            r['cpu_h'] += num_jobs * threads * time_h
+            if mem_mb is not None:
+                r['mem_gb_h'] += num_jobs * mem_mb / 1024.0 * time_h
+            r['wall_h'] = max(r['wall_h'], time_h)
+        r['num_jobs'] = int(round(r['num_jobs']))
+        totals['rules'][rule] = r
+        for k in PROJECTION_KEYS:
+            totals[k] += r[k]
+    return totals
+
+
+def cost(projection, rates):
+    """Cost of a projection given rates per core hour and per GB
+    memory hour. Returns None if no rates are known
+
+    >>> cost({'cpu_h': 100.0, 'mem_gb_h': 400.0}, {'core_h': 0.05, 'gb_h': 0.01})
+    9.0
+    >>> cost({'cpu_h': 100.0, 'mem_gb_h': 400.0}, None)
+    """
+    if not rates:
+        return None
+    return projection['cpu_h'] * rates.get('core_h', 0.0) \
+        + projection['mem_gb_h'] * rates.get('gb_h', 0.0)
+
+
+def runaway_limit(cpu_hours, factor=RUNAWAY_FACTOR, pct=RUNAWAY_PCT,
+                  min_analyses=RUNAWAY_MIN_ANALYSES):
+    """CPU hours above which an analysis counts as runaway, based on
+    CPU hours of previous analyses. None if there are too few
+
+    >>> runaway_limit([10, 20, 30, 40, 50])
+    138.0
+    >>> runaway_limit([10])
+    """
+    cpu_hours = [h for h in cpu_hours if h is not None]
+    if len(cpu_hours) < min_analyses:
+        return None
+    return factor * percentile(cpu_hours, pct)
+
+
+def project_analysis(dbfile, pipeline_name, input_bytes, sites,
+                     cost_rates=None):
+    """Project resource usage and cost of an analysis of given pipeline
+    per site. Models are fitted on the records of each site or on all
+    records if a site has none (model_site is then None). Returns dict
+    of site to projection (see project()) with added keys cost,
+    model_site and runaway_cpu_h (see runaway_limit()). Sites without
+    any records are missing.
+    """
+    cost_rates = cost_rates if cost_rates else dict()
+    db = BenchmarkDB(dbfile)
+    projections = dict()
+    try:
+        for site in sites:
+            model_site = site
+            records = list(db.records(pipeline_name=pipeline_name, site=site))
+            if not records:
+                model_site = None
+                records = list(db.records(pipeline_name=pipeline_name))
+            if not records:
+                logger.warning("No benchmark records for %s", pipeline_name)
+                continue
+            model = ResourceModel().fit(records)
+            per_granule = jobs_per_granule(db.job_counts(
+                pipeline_name=pipeline_name, site=model_site))
+            p = project(model, per_granule, input_bytes)
+            p['site'] = site
+            p['model_site'] = model_site
+            p['cost'] = cost(p, cost_rates.get(site))
+            totals = db.analysis_totals(pipeline_name=pipeline_name, site=model_site)
+            p['runaway_cpu_h'] = runaway_limit([v[0] for v in totals.values()])
+            projections[site] = p
+    finally:
+        db.close()
+    return projections
+
+
+def is_runaway(projection):
+    """True if projection exceeds its runaway limit"""
+    limit = projection.get('runaway_cpu_h')
+    return limit is not None and projection['cpu_h'] > limit
+
+
+def choose_site(projections, by='cost'):
+    """Returns site with lowest cost or wall time (by='wall_h') or None
+    if nothing to choose from. Sites without cost are ignored when
+    choosing by cost
+
+    >>> projections = {'GIS': {'cost': 20.0, 'wall_h': 30.0},
+    ...                'AWS': {'cost': 50.0, 'wall_h': 10.0},
+    ...                'NSCC': {'cost': None, 'wall_h': 20.0}}
+    >>> choose_site(projections), choose_site(projections, by='wall_h')
+    ('GIS', 'AWS')
+    """
+    assert by in ['cost', 'wall_h']
+    cands = [(p[by], site) for site, p in projections.items() if p.get(by) is not None]
+    if not cands:
+        return None
+    return min(cands)[1]
@@ -0,0 +1,451 @@
+"""Historical store of bcl2fastq QC metrics with trend queries and
+outlier detection
+
+bcl2fastq_qc.py records lane, mux and sample metrics (yield, % PF,
+% undetermined, % Q30, barcode quality and index balance) of every run
+it checks in a central SQLite database. Metrics are stored one value
+per row, with instrument and run date denormalized into each row, so
+that per-instrument trends of a metric are a single index range scan
+even over years of runs.
+
+Outliers are detected against the recent history of the same
+instrument with the median and the median absolute deviation (MAD),
+which unlike mean and standard deviation aren't skewed by the failed
+runs in the history. By default only lanes are checked: mux and
+sample values of size dependent metrics (reads, yield, index balance)
+differ with the mux composition and are not compared at all. The
+same statistics give learned limits, which can replace the static
+per machine type thresholds once enough runs are recorded.
+
+Runs are dated by sequencing date, so that reanalyses don't move a
+run to the end of the history.
+
+The database location can be overridden with the environment
+variable RPD_QC_METRICS_DB.
+"""
+
+#--- standard library imports
+#
+import os
+import sqlite3
+import logging
+import statistics
+from datetime import datetime
+from collections import OrderedDict
+
+#--- third-party imports
+#
+#/
+
+#--- project specific imports
+#
+#/
+
+
+__author__ = "Andreas Wilm"
+__email__ = "wilma@gis.a-star.edu.sg"
+__copyright__ = "2017 Genome Institute of Singapore"
+__license__ = "The MIT License (MIT)"
+
+
+# global logger
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(
+    '[{asctime}] {levelname:8s} {filename} {message}', style='{'))
+logger.addHandler(handler)
+
+
+DEFAULT_DB = os.path.join(os.path.expanduser("~"), ".cache", "rpd", "qc_metrics.db")
+
+LEVELS = ['lane', 'mux', 'sample']
+
+# metrics and which direction is bad: -1 low values, 1 high values,
+# 0 both
+METRICS = OrderedDict([
+    ('pf_clusters', -1),
+    ('pf_reads', -1),
+    ('yield_bases', -1),
+    ('pct_pf_clusters', -1),
+    ('pct_q30_bases', -1),
+    ('pct_perfect_barcode', -1),
+    ('pct_undetermined', 1),
+    # coefficient of variation (%) of reads per sample, i.e. index balance
+    ('index_cv', 1),
+    # share of the mux' reads per sample
+    ('pct_of_mux', 0),
+])
+# metrics depending on the size and composition of a mux (share of
+# the lane, number of samples), i.e. only comparable across lanes
+SIZE_DEPENDENT_METRICS = ['pf_clusters', 'pf_reads', 'yield_bases', 'index_cv', 'pct_of_mux']
+
+# robust z-score above which a value is an outlier (Iglewicz and Hoaglin)
+MAX_ROBUST_Z = 3.5
+# number of previous runs of the instrument used as history and
+# minimum needed for outlier detection
+HISTORY_RUNS = 100
+MIN_HISTORY = 10
+
+# MAD scaled by this is consistent with the standard deviation of
+# normally distributed data
+MAD_SCALE = 1.4826
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS runs(
+    run_num             TEXT    PRIMARY KEY,
+    machine_id          TEXT    NOT NULL,
+    run_date            REAL    NOT NULL,
+    bcl2fastq_dir       TEXT,
+    ingested            TEXT    NOT NULL)''',
+    '''CREATE INDEX IF NOT EXISTS runs_machine ON runs(machine_id, run_date)''',
+    # unit is the lane number, mux id or mux id/sample id
+    '''CREATE TABLE IF NOT EXISTS metrics(
+    run_num             TEXT    NOT NULL,
+    machine_id          TEXT    NOT NULL,
+    run_date            REAL    NOT NULL,
+    level               TEXT    NOT NULL,
+    unit                TEXT    NOT NULL,
+    metric              TEXT    NOT NULL,
+    value               REAL,
+    PRIMARY KEY (run_num, level, unit, metric))''',
+    '''CREATE INDEX IF NOT EXISTS metrics_trend
+    ON metrics(machine_id, level, metric, run_date, value)''',
+]
+
+
+def qc_db_file(dbfile=None):
+    """Database to use: argument, environment or default"""
+    if dbfile:
+        return dbfile
+    return os.environ.get('RPD_QC_METRICS_DB', DEFAULT_DB)
+
+
+def machine_id_from_run_num(run_num):
+    """instrument of run
+
+    >>> machine_id_from_run_num("HS002-SR-R00224_BC9A6MACXX")
+    'HS002'
+    """
+    return run_num.split('-')[0]
+
+
+def pct(count, total):
+    """percentage or None if total is zero"""
+    if not total:
+        return None
+    return 100.0 * count / total
+
+
+def cv(values):
+    """coefficient of variation in percent (population standard
+    deviation over mean). None for less than two values
+
+    >>> cv([100, 100, 100]), cv([50, 150]), cv([10])
+    (0.0, 50.0, None)
+    """
+    if len(values) < 2:
+        return None
+    mean = sum(values) / float(len(values))
+    if not mean:
+        return None
+    var = sum((v - mean) ** 2 for v in values) / len(values)
+    return 100.0 * var ** 0.5 / mean
+
+
+def _read_totals(entries):
+    """yield and Q30 yield summed over read metrics of entries"""
+    read_metrics = [r for e in entries for r in e.get('ReadMetrics', [])]
+    return sum(r['Yield'] for r in read_metrics), sum(r['YieldQ30'] for r in read_metrics)
+
+
+def stats_rows(stats, mux_id):
+    """Metrics derived from parsed bcl2fastq Stats.json of one mux as
+    list of (level, unit, metric, value): lane yield and index
+    balance (the other lane metrics are taken from bcl2fastq_qc's
+    LaneQC, see lane_rows()), plus mux and sample metrics
+
+    >>> stats = {'ConversionResults': [{'LaneNumber': 1, 'Yield': 1000,
+    ...     'DemuxResults': [
+    ...         {'SampleId': 'S1', 'NumberReads': 30, 'Yield': 300,
+    ...          'ReadMetrics': [{'Yield': 300, 'YieldQ30': 270}]},
+    ...         {'SampleId': 'S2', 'NumberReads': 10, 'Yield': 100,
+    ...          'ReadMetrics': [{'Yield': 100, 'YieldQ30': 90}]}]}]}
+    >>> for row in stats_rows(stats, "MUX1"):
+    ...     print(row)
+    ('lane', '1', 'yield_bases', 1000)
+    ('lane', '1', 'index_cv', 50.0)
+    ('mux', 'MUX1', 'pf_reads', 40)
+    ('mux', 'MUX1', 'yield_bases', 400)
+    ('mux', 'MUX1', 'pct_q30_bases', 90.0)
+    ('mux', 'MUX1', 'pct_perfect_barcode', None)
+    ('mux', 'MUX1', 'index_cv', 50.0)
+    ('sample', 'MUX1/S1', 'pf_reads', 30)
+    ('sample', 'MUX1/S1', 'yield_bases', 300)
+    ('sample', 'MUX1/S1', 'pct_q30_bases', 90.0)
+    ('sample', 'MUX1/S1', 'pct_perfect_barcode', None)
+    ('sample', 'MUX1/S1', 'pct_of_mux', 75.0)
+    ('sample', 'MUX1/S2', 'pf_reads', 10)
+    ('sample', 'MUX1/S2', 'yield_bases', 100)
+    ('sample', 'MUX1/S2', 'pct_q30_bases', 90.0)
+    ('sample', 'MUX1/S2', 'pct_perfect_barcode', None)
+    ('sample', 'MUX1/S2', 'pct_of_mux', 25.0)
+    """
+    rows = []
+    # samples accumulated over lanes
+    samples = OrderedDict()
+    for conv in stats['ConversionResults']:
+        lane = str(conv['LaneNumber'])
+        demux = conv.get('DemuxResults', [])
+        rows.append(('lane', lane, 'yield_bases', conv.get('Yield')))
+        rows.append(('lane', lane, 'index_cv', cv([s['NumberReads'] for s in demux])))
+        for s in demux:
+            samples.setdefault(s['SampleId'], []).append(s)
+
+    mux_reads = sum(s['NumberReads'] for entries in samples.values() for s in entries)
+    sample_rows = []
+    perfect_total = indexed_total = 0
+    for sample_id, entries in samples.items():
+        unit = "{}/{}".format(mux_id, sample_id)
+        reads = sum(s['NumberReads'] for s in entries)
+        yield_bases, yield_q30 = _read_totals(entries)
+        indexed = [s for s in entries if s.get('IndexMetrics')]
+        perfect = sum(m['MismatchCounts'].get('0', 0) for s in indexed for m in s['IndexMetrics'])
+        indexed_reads = sum(s['NumberReads'] for s in indexed)
+        perfect_total += perfect
+        indexed_total += indexed_reads
+        sample_rows.extend([
+            ('sample', unit, 'pf_reads', reads),
+            ('sample', unit, 'yield_bases', sum(s.get('Yield', 0) for s in entries)),
+            ('sample', unit, 'pct_q30_bases', pct(yield_q30, yield_bases)),
+            ('sample', unit, 'pct_perfect_barcode', pct(perfect, indexed_reads)),
+            ('sample', unit, 'pct_of_mux', pct(reads, mux_reads))])
+
+    all_entries = [s for entries in samples.values() for s in entries]
+    yield_bases, yield_q30 = _read_totals(all_entries)
+    rows.extend([
+        ('mux', mux_id, 'pf_reads', mux_reads),
+        ('mux', mux_id, 'yield_bases', sum(s.get('Yield', 0) for s in all_entries)),
+        ('mux', mux_id, 'pct_q30_bases', pct(yield_q30, yield_bases)),
+        ('mux', mux_id, 'pct_perfect_barcode', pct(perfect_total, indexed_total)),
+        ('mux', mux_id, 'index_cv', cv([sum(s['NumberReads'] for s in entries)
+                                         for entries in samples.values()]))])
+    rows.extend(sample_rows)
+    return rows
+
+
+def lane_rows(lane_qc):
+    """(level, unit, metric, value) rows for per lane metrics given as
+    dict of lane to dict of metric values (e.g. LaneQC._asdict())
+
+    >>> lane_rows({1: {'pf_clusters': 1800, 'pct_undetermined': None}})
+    [('lane', '1', 'pf_clusters', 1800), ('lane', '1', 'pct_undetermined', None)]
+    """
+    return [('lane', str(lane), metric, value)
+            for lane, values in lane_qc.items() for metric, value in values.items()]
+
+
+def median(values):
+    """median
+
+    >>> median([3, 1, 2]), median([1, 2, 3, 4])
+    (2, 2.5)
+    """
+    return statistics.median(values)
+
+
+def mad(values):
+    """median absolute deviation, scaled to be consistent with the
+    standard deviation of normally distributed data
+
+    >>> round(mad([1, 2, 3, 4, 100]), 4)
+    1.4826
+    """
+    m = median(values)
+    return MAD_SCALE * median([abs(v - m) for v in values])
+
+
+def robust_z(value, history):
+    """robust z-score of value given history values. None if history
+    has no spread
+
+    >>> robust_z(96, [90, 91, 92, 93, 94])
+    2.698
+    >>> robust_z(80, [90, 91, 92, 93, 94]) < -MAX_ROBUST_Z
+    True
+    >>> robust_z(1, [1, 1, 1])
+    """
+    spread = mad(history)
+    if not spread:
+        return None
+    return round((value - median(history)) / spread, 3)
+
+
+def is_outlier(z, direction, max_z=MAX_ROBUST_Z):
+    """Whether robust z-score z is an outlier in the bad direction of
+    a metric (see METRICS)
+
+    >>> is_outlier(-4, -1), is_outlier(4, -1), is_outlier(4, 0), is_outlier(None, 0)
+    (True, False, True, False)
+    """
+    if z is None:
+        return False
+    if direction < 0:
+        return z < -max_z
+    elif direction > 0:
+        return z > max_z
+    return abs(z) > max_z
+
+
+def learned_limits(history, direction, max_z=MAX_ROBUST_Z):
+    """Lower and upper limit (None if not applicable for the bad
+    direction of the metric) learned from history values
+
+    >>> learned_limits([90, 91, 92, 93, 94], -1)
+    (86.811, None)
+    >>> learned_limits([1, 2, 3, 4, 5], 1)
+    (None, 8.189)
+    """
+    m = median(history)
+    spread = mad(history)
+    lower = round(m - max_z * spread, 3) if direction <= 0 else None
+    upper = round(m + max_z * spread, 3) if direction >= 0 else None
+    return lower, upper
+
+
+class QCMetricsDB(object):
+    """SQLite backed store of per run QC metrics
+    """
+
+    def __init__(self, dbfile=None):
+        self.dbfile = qc_db_file(dbfile)
+        dbdir = os.path.dirname(self.dbfile)
+        if dbdir and not os.path.exists(dbdir):
+            os.makedirs(dbdir)
+        self.conn = sqlite3.connect(self.dbfile)
+        for stmt in SCHEMA:
+            self.conn.execute(stmt)
+        self.conn.commit()
+
+
+    def close(self):
+        """close db connection"""
+        self.conn.close()
+
+
+    def ingest_run(self, run_num, run_date, rows, bcl2fastq_dir=None):
+        """Record (level, unit, metric, value) rows of a run (epoch
+        sequencing date run_date), replacing previously recorded ones,
+        e.g. of an earlier bcl2fastq run. Returns number of stored values
+        """
+        machine_id = machine_id_from_run_num(run_num)
+        rows = [r for r in rows if r[-1] is not None]
+        for level, _, metric, _ in rows:
+            assert level in LEVELS, ("Unknown level {}".format(level))
+            assert metric in METRICS, ("Unknown metric {}".format(metric))
+        with self.conn:
+            self.conn.execute("DELETE FROM metrics WHERE run_num = ?", (run_num,))
+            self.conn.execute(
+                "INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?)",
+                (run_num, machine_id, run_date,
+                 os.path.abspath(bcl2fastq_dir) if bcl2fastq_dir else None,
+                 datetime.now().isoformat()))
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO metrics VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(run_num, machine_id, run_date, level, unit, metric, value)
+                 for level, unit, metric, value in rows])
+        return len(rows)
+
+
+    def run_date(self, run_num):
+        """recorded run date (epoch) of run or None"""
+        row = self.conn.execute(
+            "SELECT run_date FROM runs WHERE run_num = ?", (run_num,)).fetchone()
+        return row[0] if row else None
+
+
+    def trend(self, machine_id, metric, level='lane', since=None, until=None):
+        """Returns list of (run_num, run_date, unit, value) of metric
+        for instrument machine_id, ordered by run date, optionally
+        restricted to runs within since and until (epoch)
+        """
+        sql = "SELECT run_num, run_date, unit, value FROM metrics" \
+              " WHERE machine_id = ? AND level = ? AND metric = ?"
+        values = [machine_id, level, metric]
+        if since is not None:
+            sql += " AND run_date >= ?"
+            values.append(since)
+        if until is not None:
+            sql += " AND run_date < ?"
+            values.append(until)
+        sql += " ORDER BY run_date, unit"
+        return self.conn.execute(sql, values).fetchall()
+
+
+    def history(self, machine_id, metric, level='lane', before=None,
+                num_runs=HISTORY_RUNS):
+        """Values of metric from the num_runs last runs of instrument
+        machine_id before given run date (epoch; default: all)
+        """
+        sql = "SELECT run_date FROM runs WHERE machine_id = ?"
+        values = [machine_id]
+        if before is not None:
+            sql += " AND run_date < ?"
+            values.append(before)
+        sql += " ORDER BY run_date DESC LIMIT 1 OFFSET ?"
+        row = self.conn.execute(sql, values + [num_runs - 1]).fetchone()
+        since = row[0] if row else None
+        return [r[3] for r in self.trend(machine_id, metric, level, since, before)]
+
+
+    def outliers(self, run_num, levels=('lane',), max_z=MAX_ROBUST_Z,
+                 num_runs=HISTORY_RUNS, min_history=MIN_HISTORY):
+        """Values of run, which are outliers compared to the previous
+        num_runs runs of the same instrument. Returns list of (level,
+        unit, metric, value, history median, robust z-score). Metrics
+        with less than min_history previous values and size dependent
+        metrics of muxes and samples are skipped
+        """
+        run_date = self.run_date(run_num)
+        if run_date is None:
+            return []
+        machine_id = machine_id_from_run_num(run_num)
+        sql = "SELECT level, unit, metric, value FROM metrics WHERE run_num = ?" \
+              " AND level IN ({}) ORDER BY level, unit, metric".format(
+                  ", ".join("?" for _ in levels))
+        res = []
+        histories = dict()
+        for level, unit, metric, value in self.conn.execute(sql, [run_num] + list(levels)):
+            if level != 'lane' and metric in SIZE_DEPENDENT_METRICS:
+                continue
+            key = (level, metric)
+            if key not in histories:
+                histories[key] = self.history(machine_id, metric, level, run_date, num_runs)
+            history = histories[key]
+            if len(history) < min_history:
+                continue
+            z = robust_z(value, history)
+            if is_outlier(z, METRICS[metric], max_z):
+                res.append((level, unit, metric, value, median(history), z))
+        return res
+
+
+    def limits(self, level='lane', max_z=MAX_ROBUST_Z, num_runs=HISTORY_RUNS,
+               min_history=MIN_HISTORY):
+        """Learned limits per instrument and metric from its last
+        num_runs runs. Returns dict of (machine_id, metric) to (number
+        of values, median, lower limit, upper limit). Size dependent
+        metrics are only used for lanes
+        """
+        res = dict()
+        machine_ids = [r[0] for r in self.conn.execute(
+            "SELECT DISTINCT machine_id FROM runs ORDER BY machine_id")]
+        for machine_id in machine_ids:
+            for metric, direction in METRICS.items():
+                if level != 'lane' and metric in SIZE_DEPENDENT_METRICS:
+                    continue
+                history = self.history(machine_id, metric, level, num_runs=num_runs)
+                if len(history) < min_history:
+                    continue
+                lower, upper = learned_limits(history, direction, max_z)
+                res[(machine_id, metric)] = (len(history), median(history), lower, upper)
+        return res
@@ -0,0 +1,457 @@
+"""Shared, batched cluster job status
+
+Instead of running qstat once per job and tool, qstat is run once for
+all jobs and the parsed result is cached in a JSON file per host (see
+tools/qstat_cache.py for the polling daemon). Clients read the cache
+and only poll themselves (and update the cache for everyone else) if
+it is missing or stale.
+
+The cache lives in a directory per user (in the system's temporary
+directory), which is created with mode 0700. Cache directories not
+owned by the user or writable by others are ignored.
+
+The qstat command can be overriden with the environment variable
+RPD_QSTAT (e.g. a fake qstat script for testing), SGE's qacct with
+RPD_QACCT and the cache file with RPD_QSTAT_CACHE.
+"""
+
+#--- standard library imports
+#
+import os
+import json
+import stat
+import time
+import fcntl
+import socket
+import logging
+import tempfile
+import subprocess
+
+#--- third-party imports
+#
+#/
+
+#--- project specific imports
+#
+#/
+
+
+__author__ = "Andreas Wilm"
+__email__ = "wilma@gis.a-star.edu.sg"
+__copyright__ = "2017 Genome Institute of Singapore"
+__license__ = "The MIT License (MIT)"
+
+
+# global logger
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(
+    '[{asctime}] {levelname:8s} {filename} {message}', style='{'))
+logger.addHandler(handler)
+
+
+# polling interval of the daemon in seconds
+DEFAULT_INTERVAL = 30
+# clients poll themselves if cache is older than this (seconds)
+DEFAULT_MAX_AGE = 120
+# accounting lags behind qstat. jobs neither listed by qstat nor known
+# to accounting for this many seconds are reported as failed
+ACCOUNTING_GRACE_S = 600
+
+
+def qstat_cmd():
+    """qstat command to use"""
+    return os.environ.get('RPD_QSTAT', 'qstat')
+
+
+def qacct_cmd():
+    """qacct command to use (SGE only)"""
+    return os.environ.get('RPD_QACCT', 'qacct')
+
+
+def default_cache_file():
+    """Per host cache file in per user cache directory"""
+    default = os.path.join(tempfile.gettempdir(), "rpd_qstat_cache.{}".format(os.getuid()),
+                           "{}.json".format(socket.gethostname()))
+    return os.environ.get('RPD_QSTAT_CACHE', default)
+
+
+def private_dir(dirname, create=False):
+    """Whether dirname is a directory owned by us and not writable by
+    others, i.e. safe for the cache. Created with mode 0700 if missing
+    and create is set
+
+    >>> private_dir(tempfile.mkdtemp()), private_dir(tempfile.gettempdir())
+    (True, False)
+    """
+    if create:
+        try:
+            os.mkdir(dirname, 0o700)
+        except FileExistsError:
+            pass
+        except OSError as err:
+            logger.debug("Couldn't create %s: %s", dirname, err)
+            return False
+    try:
+        st = os.lstat(dirname)
+    except OSError:
+        return False
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o022:
+        logger.warning("Ignoring qstat cache directory %s: not a directory owned by us"
+                       " or writable by others", dirname)
+        return False
+    return True
+
+
+def scheduler_type(qstat=None):
+    """Returns 'pbspro' or 'sge' based on qstat --version"""
+    if qstat is None:
+        qstat = qstat_cmd()
+    try:
+        res = subprocess.check_output([qstat, '--version'], stderr=subprocess.STDOUT)
+    except subprocess.CalledProcessError:
+        # SGE's qstat doesn't know --version
+        return 'sge'
+    if 'PBSPro' in res.decode():
+        return 'pbspro'
+    raise ValueError(res.decode())
+
+
+def normalize_jid(jid):
+    """Job ids as key: strip server part of PBS ids and SGE submission
+    messages
+
+    >>> normalize_jid("1234.wlm01")
+    '1234'
+    >>> normalize_jid('Your job 5678 ("x.sh") has been submitted')
+    '5678'
+    >>> normalize_jid(" 42\\n")
+    '42'
+    """
+    jid = jid.strip()
+    if jid.startswith("Your job"):
+        jid = jid.split()[2]
+    return jid.split(".")[0]
+
+
+def parse_sge_qstat(text):
+    """Parse SGE qstat output. Returns dict of job id to dict with
+    name, user, state and submit (submit/start time)
+
+    >>> out = '''job-ID  prior   name       user         state submit/start at     queue                          slots ja-task-ID
+    ... -----------------------------------------------------------------------------------------------------------------
+    ...  123456 0.50500 gatk.maste userrig      r     10/01/2017 10:00:01 production.q@n001               1
+    ...  123457 0.00000 gatk.slave userrig      Eqw   10/01/2017 10:00:05                                16
+    ... '''
+    >>> jobs = parse_sge_qstat(out)
+    >>> sorted(jobs), jobs['123457']['state'], jobs['123456']['submit']
+    (['123456', '123457'], 'Eqw', '10/01/2017 10:00:01')
+    """
+    jobs = dict()
+    for line in text.splitlines():
+        fields = line.split()
+        if len(fields) < 7 or not fields[0].isdigit():
+            continue
+        jobs[fields[0]] = {'name': fields[2], 'user': fields[3], 'state': fields[4],
+                           'submit': " ".join(fields[5:7])}
+    return jobs
+
+
+def parse_pbs_qstat(text):
+    """Parse PBS Pro qstat output. Returns dict of job id to dict with
+    name, user, state and submit (always None)
+
+    >>> out = '''Job id            Name             User              Time Use S Queue
+    ... ----------------  ---------------- ----------------  -------- - -----
+    ... 1234.wlm01        gatk.master      userrig           00:00:05 R normal
+    ... 1235.wlm01        gatk.slave.ma    userrig                  0 Q dq
+    ... '''
+    >>> jobs = parse_pbs_qstat(out)
+    >>> sorted(jobs), jobs['1235']['state'], jobs['1234']['user']
+    (['1234', '1235'], 'Q', 'userrig')
+    """
+    jobs = dict()
+    for line in text.splitlines():
+        fields = line.split()
+        if len(fields) < 6 or not fields[0].split(".")[0].isdigit():
+            continue
+        jobs[normalize_jid(fields[0])] = {'name': fields[1], 'user': fields[2],
+                                          'state': fields[4], 'submit': None}
+    return jobs
+
+
+def poll_qstat(scheduler, qstat=None):
+    """Run qstat once for all jobs of all users and return parsed
+    jobs. Raises subprocess.CalledProcessError if qstat fails
+    """
+    if qstat is None:
+        qstat = qstat_cmd()
+    if scheduler == 'pbspro':
+        cmd = [qstat]
+        parser = parse_pbs_qstat
+    else:
+        cmd = [qstat, '-u', '*']
+        parser = parse_sge_qstat
+    res = subprocess.check_output(cmd, stderr=subprocess.PIPE)
+    return parser(res.decode())
+
+
+def write_cache(cache_file, scheduler, jobs):
+    """Atomically write cache file. Returns False if not writable
+    (e.g. owned by another user's daemon) or the directory is unsafe
+    """
+    if not private_dir(os.path.dirname(os.path.abspath(cache_file)), create=True):
+        return False
+    data = {'timestamp': time.time(), 'host': socket.gethostname(),
+            'scheduler': scheduler, 'jobs': jobs}
+    tmp = "{}.{}.tmp".format(cache_file, os.getpid())
+    try:
+        with open(tmp, 'w') as fh:
+            json.dump(data, fh)
+        os.rename(tmp, cache_file)
+    except OSError as err:
+        logger.debug("Couldn't write qstat cache %s: %s", cache_file, err)
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        return False
+    return True
+
+
+def read_cache(cache_file, max_age=DEFAULT_MAX_AGE):
+    """Returns cached data or None if missing, unreadable, in an
+    unsafe directory or older than max_age seconds
+    """
+    if not private_dir(os.path.dirname(os.path.abspath(cache_file))):
+        return None
+    try:
+        with open(cache_file) as fh:
+            data = json.load(fh)
+    except (OSError, ValueError):
+        return None
+    if time.time() - data.get('timestamp', 0) > max_age:
+        return None
+    return data
+
+
+class QstatCache(object):
+    """Client for the shared qstat cache
+    """
+
+    def __init__(self, cache_file=None, max_age=DEFAULT_MAX_AGE, qstat=None):
+        self.cache_file = cache_file if cache_file else default_cache_file()
+        self.max_age = max_age
+        self.qstat = qstat if qstat else qstat_cmd()
+        self._data = None
+
+
+    def _refresh(self):
+        """poll qstat ourselves and update the cache for everyone
+        else. a lock makes sure concurrent clients don't all poll
+        """
+        lockfile = self.cache_file + ".lock"
+        lockfh = None
+        if private_dir(os.path.dirname(os.path.abspath(lockfile)), create=True):
+            try:
+                lockfh = open(lockfile, 'a')
+            except OSError:
+                pass
+        try:
+            if lockfh:
+                fcntl.flock(lockfh, fcntl.LOCK_EX)
+                # someone else might have refreshed while we were waiting
+                data = read_cache(self.cache_file, self.max_age)
+                if data:
+                    return data
+            scheduler = scheduler_type(self.qstat)
+            jobs = poll_qstat(scheduler, self.qstat)
+            write_cache(self.cache_file, scheduler, jobs)
+            return {'timestamp': time.time(), 'scheduler': scheduler, 'jobs': jobs}
+        finally:
+            if lockfh:
+                fcntl.flock(lockfh, fcntl.LOCK_UN)
+                lockfh.close()
+
+
+    def data(self):
+        """cached data, refreshed if stale"""
+        if self._data is None or time.time() - self._data['timestamp'] > self.max_age:
+            data = read_cache(self.cache_file, self.max_age)
+            if data is None:
+                logger.debug("qstat cache %s missing or stale. Polling", self.cache_file)
+                data = self._refresh()
+            self._data = data
+        return self._data
+
+
+    def jobs(self, user=None):
+        """dict of job id to job info, optionally only for given user"""
+        jobs = self.data()['jobs']
+        if user:
+            jobs = dict((k, v) for k, v in jobs.items() if v['user'] == user)
+        return jobs
+
+
+    def scheduler(self):
+        """scheduler type of cached data"""
+        return self.data()['scheduler']
+
+
+    def job_state(self, jid):
+        """scheduler state of job or None if not known (anymore)"""
+        job = self.jobs().get(normalize_jid(jid))
+        if job:
+            return job['state']
+        return None
+
+
+    def is_running(self, jid):
+        """True if job is queued or running"""
+        return self.job_state(jid) not in [None, 'F']
+
+
+    def missing_for(self, jid, done=False):
+        """Seconds since job was first found neither in qstat nor in
+        accounting (0 on first call), tracked with a marker file next
+        to the cache. done removes the marker, which has to happen
+        whenever the job is listed by qstat, so that the time counts
+        from when the job left qstat
+        """
+        marker = "{}.missing.{}".format(self.cache_file, normalize_jid(jid))
+        if done:
+            if os.path.exists(marker):
+                os.unlink(marker)
+            return 0
+        if not private_dir(os.path.dirname(os.path.abspath(marker)), create=True):
+            return 0
+        try:
+            with open(marker, 'x'):
+                return 0
+        except FileExistsError:
+            return time.time() - os.path.getmtime(marker)
+        except OSError:
+            return 0
+
+
+def parse_qacct(text):
+    """Parse SGE qacct -j output into 'success' or 'failed'
+
+    >>> parse_qacct("jobnumber    123\\nfailed       0    \\nexit_status  0\\n")
+    'success'
+    >>> parse_qacct("failed       100 : assumedly after job\\nexit_status  137\\n")
+    'failed'
+    """
+    failed = exit_status = None
+    for line in text.splitlines():
+        fields = line.split()
+        if len(fields) < 2:
+            continue
+        if fields[0] == 'failed':
+            failed = fields[1]
+        elif fields[0] == 'exit_status':
+            exit_status = fields[1]
+    if failed == '0' and exit_status == '0':
+        return 'success'
+    return 'failed'
+
+
+def parse_pbs_full(text):
+    """Parse exit status from PBS Pro qstat -xf output into
+    'success', 'failed' or 'running' (no exit status yet)
+
+    >>> parse_pbs_full("Job Id: 1234.wlm01\\n    job_state = F\\n    Exit_status = 0\\n")
+    'success'
+    >>> parse_pbs_full("Job Id: 1234.wlm01\\n    job_state = F\\n    Exit_status = 271\\n")
+    'failed'
+    >>> parse_pbs_full("Job Id: 1234.wlm01\\n    job_state = R\\n")
+    'running'
+    """
+    for line in text.splitlines():
+        key, _, value = line.strip().partition(" = ")
+        if key == 'Exit_status':
+            return 'success' if value.strip() == '0' else 'failed'
+    return 'running'
+
+
+def snakemake_status(jid, cache=None, grace_s=ACCOUNTING_GRACE_S):
+    """Status of a cluster job as expected by snakemake's
+    --cluster-status: 'running', 'success' or 'failed'. Queued and
+    running jobs are answered from the cache, jobs no longer listed
+    by qstat are looked up once via accounting. Jobs without
+    accounting record for more than grace_s seconds are reported as
+    failed
+
+    >>> import shutil
+    >>> d = tempfile.mkdtemp()
+    >>> def fake(name, script):
+    ...     path = os.path.join(d, name)
+    ...     with open(path, 'w') as fh:
+    ...         _ = fh.write("#!/bin/sh\\n" + script)
+    ...     os.chmod(path, 0o755)
+    ...     return path
+    >>> qstat = fake("qstat", '[ "$1" = "--version" ] && exit 1\\n'
+    ...              'echo " 123 0.50500 job userrig r 10/01/2017 10:00:01 all.q@n001 1"\\n')
+    >>> os.environ['RPD_QACCT'] = fake("qacct", '[ "$2" = "124" ] || exit 1\\n'
+    ...                                'printf "failed 0\\\\nexit_status 0\\\\n"\\n')
+    >>> cache = QstatCache(os.path.join(d, "cache.json"), qstat=qstat)
+    >>> snakemake_status("123", cache), snakemake_status("124", cache)
+    ('running', 'success')
+    >>> snakemake_status("125", cache), snakemake_status("125", cache, grace_s=-1)
+    ('running', 'failed')
+
+    A fresh job missing from the (stale) cache, then queued, running
+    for longer than the grace period and finished before accounting
+    caught up, is still running and then succeeds
+
+    >>> qstat_out = os.path.join(d, "qstat.out")
+    >>> qstat = fake("qstat", '[ "$1" = "--version" ] && exit 1\\ncat ' + qstat_out + '\\n')
+    >>> os.environ['RPD_QACCT'] = fake("qacct", '[ -e ' + qstat_out + '.acct ] || exit 1\\n'
+    ...                                'printf "failed 0\\\\nexit_status 0\\\\n"\\n')
+    >>> cache = QstatCache(os.path.join(d, "cache2.json"), max_age=-1, qstat=qstat)
+    >>> def qstat_state(state):
+    ...     with open(qstat_out, 'w') as fh:
+    ...         _ = fh.write(" 126 0.50500 job userrig {} 10/01/2017 10:00:01 all.q 1\\n".format(state)
+    ...                      if state else "")
+    >>> qstat_state(None); snakemake_status("126", cache)
+    'running'
+    >>> marker = cache.cache_file + ".missing.126"
+    >>> os.utime(marker, (time.time() - 3600, time.time() - 3600))
+    >>> qstat_state("qw"); snakemake_status("126", cache), os.path.exists(marker)
+    ('running', False)
+    >>> qstat_state("r"); snakemake_status("126", cache)
+    'running'
+    >>> qstat_state(None); snakemake_status("126", cache)
+    'running'
+    >>> open(qstat_out + ".acct", 'w').close(); snakemake_status("126", cache)
+    'success'
+    >>> del os.environ['RPD_QACCT']
+    >>> shutil.rmtree(d)
+    """
+    if cache is None:
+        cache = QstatCache()
+    jid = normalize_jid(jid)
+    state = cache.job_state(jid)
+    if state is not None:
+        # grace period starts once the job has left qstat
+        cache.missing_for(jid, done=True)
+    if state is not None and state != 'F':
+        # SGE error states, e.g. Eqw
+        if 'E' in state and cache.scheduler() == 'sge':
+            return 'failed'
+        return 'running'
+    try:
+        if cache.scheduler() == 'pbspro':
+            res = subprocess.check_output([cache.qstat, '-xf', jid], stderr=subprocess.PIPE)
+            status = parse_pbs_full(res.decode())
+        else:
+            res = subprocess.check_output([qacct_cmd(), '-j', jid], stderr=subprocess.PIPE)
+            status = parse_qacct(res.decode())
+    except (subprocess.CalledProcessError, OSError):
+        # accounting lags behind. snakemake will ask again, but not forever
+        if cache.missing_for(jid) > grace_s:
+            logger.warning("No accounting record for job %s after %ds. Reporting as failed",
+                           jid, grace_s)
+            cache.missing_for(jid, done=True)
+            return 'failed'
+        return 'running'
+    cache.missing_for(jid, done=True)
+    return status
@@ -0,0 +1,399 @@
+"""Queue latency tracking and latency aware submission policy
+
+Submission to start latency is measured per cluster job: snakemake's
+master log has the submission time and external job id of every
+cluster job, and the jobscript (see jobscript.template.sh) appends a
+start event with job id, queue and time to logs/queue_events.tsv of
+the analysis. Both are merged into a central SQLite database, which
+keeps a rolling latency per queue. Jobs still waiting count towards
+the latency with their current wait, unless they can't start anymore
+(analysis ended or snakemake already finished the job). Queue names
+are normalized (see normalize_queue()) on recording and lookup.
+
+The policy then decides per rule, based on its runtime and the
+current latency of the queue, whether it should run locally on the
+master (finishes before it would even start on the cluster), be
+batched with its producer into one cluster job (runtime small
+compared to queue latency) or be submitted as separate cluster job.
+The decision is applied through rule groups (see rulegroups.py) by
+adjusting their thresholds.
+
+The database has to be shared by all users of a site, so that
+latencies are measured over all their jobs. Its location is taken
+from the environment variable RPD_QUEUE_LATENCY_DB, if set (see
+get_queue_latency_db() in pipelines.py for the site default).
+"""
+
+#--- standard library imports
+#
+import os
+import re
+import time
+import sqlite3
+import logging
+from datetime import datetime
+
+#--- third-party imports
+#
+#/
+
+#--- project specific imports
+#
+from benchmarks import jobs_from_snakemake_log
+from benchmarkdb import percentile
+from qstatcache import normalize_jid
+from rulegroups import MAX_LOCAL_S
+from rulegroups import MAX_GROUPED_S
+
+
+__author__ = "Andreas Wilm"
+__email__ = "wilma@gis.a-star.edu.sg"
+__copyright__ = "2017 Genome Institute of Singapore"
+__license__ = "The MIT License (MIT)"
+
+
+# global logger
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(
+    '[{asctime}] {levelname:8s} {filename} {message}', style='{'))
+logger.addHandler(handler)
+
+
+# start events written by jobscripts, relative to analysis dir
+EVENT_LOG = os.path.join("logs", "queue_events.tsv")
+
+# rolling window (seconds), latency percentile and minimum number of jobs
+ROLLING_WINDOW_S = 24 * 60 * 60
+LATENCY_PCT = 50
+MIN_JOBS = 5
+
+# rules are never moved to the master if running longer than this
+# (local cores are limited and shared with snakemake itself)
+MAX_LATENCY_LOCAL_S = 5 * 60
+# rules running shorter than this multiple of the queue latency are
+# batched with their producer
+BATCH_LATENCY_FACTOR = 2.0
+
+TIMESTAMP_FMT = '%a %b %d %H:%M:%S %Y'
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS jobs(
+    analysis_dir        TEXT    NOT NULL,
+    jid                 TEXT    NOT NULL,
+    rule                TEXT,
+    queue               TEXT,
+    enqueued            REAL    NOT NULL,
+    started             REAL,
+    PRIMARY KEY (analysis_dir, jid))''',
+    '''CREATE INDEX IF NOT EXISTS jobs_enqueued ON jobs(enqueued)''',
+]
+
+
+def latency_db_file(dbfile=None):
+    """Database to use: argument, environment or None if not configured"""
+    if dbfile:
+        return dbfile
+    return os.environ.get('RPD_QUEUE_LATENCY_DB')
+
+
+def normalize_queue(queue):
+    """Queue names as key: lower case without host part (SGE's
+    queue@host). None if empty
+
+    >>> normalize_queue("Production.q@n001"), normalize_queue(" dq "), normalize_queue("")
+    ('production.q', 'dq', None)
+    """
+    if not queue:
+        return None
+    queue = queue.strip().split("@")[0].lower()
+    return queue if queue else None
+
+
+def parse_submission(line):
+    """Parse snakemake's cluster submission message. Returns tuple of
+    snakemake jobid and normalized external job id or None
+
+    >>> parse_submission("Submitted job 12 with external jobid '4567.wlm01'.")
+    (12, '4567')
+    >>> parse_submission("Submitted DRMAA job 3 with external jobid 891011.")
+    (3, '891011')
+    >>> parse_submission("Finished job 3.")
+    """
+    m = re.match(r"^Submitted (?:DRMAA )?job (\d+) with external jobid '?(.+?)'?\.$", line)
+    if not m:
+        return None
+    return int(m.group(1)), normalize_jid(m.group(2))
+
+
+def submissions_from_snakemake_log(log):
+    """Returns dict of external job id to tuple of snakemake jobid
+    and submission time (epoch)
+    """
+    submissions = dict()
+    with open(log) as fh:
+        for line in fh:
+            line = line.rstrip("\n")
+            if not line.startswith("["):
+                continue
+            estr = line[1:].split("]")[0]
+            try:
+                etime = datetime.strptime(estr, TIMESTAMP_FMT)
+            except ValueError:
+                continue
+            res = parse_submission(line[len(estr)+2:].lstrip())
+            if res:
+                submissions[res[1]] = (res[0], time.mktime(etime.timetuple()))
+    return submissions
+
+
+def job_ends_from_snakemake_log(fh):
+    """Parse snakemake master log for ends of jobs and analysis.
+    Returns tuple of dict of snakemake jobid to time (epoch) it was
+    last reported as finished, and time the analysis ended (succeeded
+    or failed) or None if still running
+
+    >>> from io import StringIO
+    >>> log = StringIO("[Mon Oct 02 10:00:00 2017] Finished job 3.\\n"
+    ...                "[Mon Oct 02 10:05:00 2017]\\nFinished job 4.\\n")
+    >>> finished, ended = job_ends_from_snakemake_log(log)
+    >>> finished[4] - finished[3], ended
+    (300.0, None)
+    >>> log = StringIO("[Mon Oct 02 10:00:00 2017] Finished job 3.\\n"
+    ...                "[Mon Oct 02 11:00:00 2017] Exiting because a job execution failed.\\n")
+    >>> ended = job_ends_from_snakemake_log(log)[1]
+    >>> ended - job_ends_from_snakemake_log(StringIO("[Mon Oct 02 10:00:00 2017] 3 of 3 steps (100%) done"))[1]
+    3600.0
+    """
+    finished = dict()
+    ended = None
+    last_time = None
+    for line in fh:
+        line = line.rstrip("\n")
+        # optional timestamp prefix or timestamp-only line
+        if line.startswith("["):
+            estr = line[1:].split("]")[0]
+            try:
+                last_time = time.mktime(datetime.strptime(estr, TIMESTAMP_FMT).timetuple())
+            except ValueError:
+                pass
+            else:
+                line = line[len(estr)+2:].lstrip()
+        m = re.match(r'^Finished job (\d+)\.$', line)
+        if m and last_time:
+            finished[int(m.group(1))] = last_time
+        elif last_time and ('steps (100%) done' in line or "Nothing to be done" in line
+                            or line.startswith("Exiting")):
+            ended = last_time
+    return finished, ended
+
+
+def parse_start_events(fh):
+    """Parse start events written by jobscripts. Returns dict of job id
+    to tuple of queue and start time (epoch). Repeated starts (e.g.
+    rescheduled jobs) keep the last one
+
+    >>> from io import StringIO
+    >>> events = parse_start_events(StringIO("start\\t123\\tlong.q\\t1500000000\\nstart\\t124.wlm01\\t\\t1500000060\\n"))
+    >>> events['123'], events['124']
+    (('long.q', 1500000000.0), (None, 1500000060.0))
+    """
+    starts = dict()
+    for line in fh:
+        fields = line.rstrip("\n").split("\t")
+        if len(fields) != 4 or fields[0] != "start" or not fields[1]:
+            continue
+        try:
+            started = float(fields[3])
+        except ValueError:
+            continue
+        starts[normalize_jid(fields[1])] = (normalize_queue(fields[2]), started)
+    return starts
+
+
+def rolling_latency(observed, pending, pct=LATENCY_PCT, min_jobs=MIN_JOBS):
+    """Latency percentile from observed latencies of started jobs.
+    Jobs still pending longer than that prove the latency is at least
+    their current wait and are included. Returns None if there are
+    fewer than min_jobs observations
+
+    >>> rolling_latency([60, 60, 120, 120, 600], [])
+    120.0
+    >>> rolling_latency([60, 60, 120, 120, 600], [10, 3600, 3600, 3600])
+    360.0
+    >>> rolling_latency([60], [])
+    """
+    if len(observed) < min_jobs:
+        return None
+    latency = percentile(observed, pct)
+    waiting = [w for w in pending if w > latency]
+    if waiting:
+        latency = percentile(list(observed) + waiting, pct)
+    return latency
+
+
+def latency_thresholds(latency_s, max_local_s=MAX_LOCAL_S,
+                       max_grouped_s=MAX_GROUPED_S):
+    """Runtime thresholds for running rules locally or batched with
+    their producer (see rulegroups.plan_rule_groups()) given queue
+    latency. High latency raises both. Unknown latency (None) leaves
+    them unchanged
+
+    >>> latency_thresholds(None)
+    (30, 900)
+    >>> latency_thresholds(120)
+    (120, 900)
+    >>> latency_thresholds(3600)
+    (300, 7200.0)
+    """
+    if latency_s is None:
+        return max_local_s, max_grouped_s
+    return (max(max_local_s, min(latency_s, MAX_LATENCY_LOCAL_S)),
+            max(max_grouped_s, BATCH_LATENCY_FACTOR * latency_s))
+
+
+def submission_policy(runtime_s, latency_s):
+    """Decide whether a rule with given runtime runs 'local', is
+    'batch'ed with its producer or is submitted ('submit') given the
+    queue latency
+
+    >>> submission_policy(10, None), submission_policy(600, None), submission_policy(600, 3600)
+    ('local', 'batch', 'batch')
+    >>> submission_policy(200, 3600), submission_policy(3*3600, 3600), submission_policy(3*3600, 60)
+    ('local', 'submit', 'submit')
+    """
+    max_local_s, max_grouped_s = latency_thresholds(latency_s)
+    if runtime_s <= max_local_s:
+        return 'local'
+    elif runtime_s <= max_grouped_s:
+        return 'batch'
+    return 'submit'
+
+
+class QueueLatencyDB(object):
+    """SQLite backed store of job submission and start times
+    """
+
+    def __init__(self, dbfile=None):
+        self.dbfile = latency_db_file(dbfile)
+        assert self.dbfile, ("No queue latency database configured")
+        dbdir = os.path.dirname(self.dbfile)
+        if dbdir and not os.path.exists(dbdir):
+            os.makedirs(dbdir)
+        self.conn = sqlite3.connect(self.dbfile)
+        for stmt in SCHEMA:
+            self.conn.execute(stmt)
+        self.conn.commit()
+
+
+    def close(self):
+        """close db connection"""
+        self.conn.close()
+
+
+    def ingest_analysis(self, analysis_dir):
+        """(Re-)ingest submissions from the master log and start events
+        of an analysis (running or completed). Jobs without start
+        event are dropped if they can't start anymore (e.g. deleted
+        jobs, jobs of ended analyses or missing start events of
+        finished jobs). Returns number of cluster jobs found
+        """
+        analysis_dir = os.path.abspath(analysis_dir)
+        masterlog = os.path.join(analysis_dir, "logs", "snakemake.log")
+        if not os.path.exists(masterlog):
+            return 0
+        submissions = submissions_from_snakemake_log(masterlog)
+        rules = dict((j['jobid'], j['rule']) for j in jobs_from_snakemake_log(masterlog))
+        with open(masterlog) as fh:
+            finished, ended = job_ends_from_snakemake_log(fh)
+        starts = dict()
+        eventlog = os.path.join(analysis_dir, EVENT_LOG)
+        if os.path.exists(eventlog):
+            with open(eventlog) as fh:
+                starts = parse_start_events(fh)
+        # pending jobs are assumed to wait in the queue most jobs of
+        # this analysis started from. unknown if none started
+        queues = [q for q, _ in starts.values() if q]
+        default_queue = max(set(queues), key=queues.count) if queues else None
+        with self.conn:
+            self.conn.execute("DELETE FROM jobs WHERE analysis_dir = ?", (analysis_dir,))
+            for jid, (jobid, enqueued) in submissions.items():
+                queue, started = starts.get(jid, (None, None))
+                if started is None and (ended or finished.get(jobid, 0) >= enqueued):
+                    continue
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?)",
+                    (analysis_dir, jid, rules.get(jobid), queue if queue else default_queue,
+                     enqueued, started))
+        return len(submissions)
+
+
+    def record(self, analysis_dir, jid, queue, enqueued, started=None, rule=None):
+        """Record a single job (e.g. from a fake scheduler)"""
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?)",
+                (os.path.abspath(analysis_dir), normalize_jid(jid), rule,
+                 normalize_queue(queue), enqueued, started))
+
+
+    def latencies(self, queue=None, window_s=ROLLING_WINDOW_S, now=None):
+        """Returns dict of queue to tuple of observed latencies and
+        current waits of pending jobs for jobs submitted within the
+        window. Jobs with unknown queue are ignored
+        """
+        if now is None:
+            now = time.time()
+        sql = "SELECT queue, enqueued, started FROM jobs WHERE enqueued >= ? AND queue IS NOT NULL"
+        values = [now - window_s]
+        if queue:
+            sql += " AND queue = ?"
+            values.append(normalize_queue(queue))
+        res = dict()
+        for q, enqueued, started in self.conn.execute(sql, values):
+            observed, pending = res.setdefault(q, ([], []))
+            if started is not None:
+                observed.append(max(0.0, started - enqueued))
+            else:
+                pending.append(max(0.0, now - enqueued))
+        return res
+
+
+    def queue_latency(self, queue, window_s=ROLLING_WINDOW_S, now=None,
+                      pct=LATENCY_PCT, min_jobs=MIN_JOBS):
+        """Rolling latency in seconds or None if unknown of queue as
+        requested at submission, i.e. a comma separated list of queues
+        is pooled, as are all queues if queue is None (the scheduler
+        picks)
+
+        >>> db = QueueLatencyDB(":memory:")
+        >>> for i in range(5):
+        ...     db.record("a", str(i), "short.q@n00{}".format(i), 1000.0, 1060.0 + i)
+        ...     db.record("a", str(10+i), "Long.q", 1000.0, 1600.0)
+        >>> db.queue_latency("short.q", now=2000), db.queue_latency("short.q,long.q", now=2000)
+        (62.0, 332.0)
+        >>> db.queue_latency(None, now=2000) == db.queue_latency("short.q,long.q", now=2000)
+        True
+        >>> db.close()
+        """
+        res = self.latencies(window_s=window_s, now=now)
+        queues = set(normalize_queue(q) for q in queue.split(",")) if queue else set(res)
+        observed, pending = [], []
+        for q in queues:
+            o, p = res.get(q, ([], []))
+            observed.extend(o)
+            pending.extend(p)
+        return rolling_latency(observed, pending, pct, min_jobs)
+
+
+    def rule_latencies(self, window_s=ROLLING_WINDOW_S, now=None):
+        """Returns dict of (queue, rule) to list of observed latencies"""
+        if now is None:
+            now = time.time()
+        res = dict()
+        for q, rule, enqueued, started in self.conn.execute(
+                "SELECT queue, rule, enqueued, started FROM jobs"
+                " WHERE enqueued >= ? AND started IS NOT NULL AND queue IS NOT NULL",
+                (now - window_s,)):
+            res.setdefault((q, rule), []).append(max(0.0, started - enqueued))
+        return res
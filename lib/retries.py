@@ -0,0 +1,356 @@
+"""Resource escalation for retried cluster jobs
+
+Snakemake resubmits failed jobs (--restart-times) with unchanged
+resources, so jobs killed for exceeding their memory or time limit
+just fail again. Failed jobs are recorded in logs/failed_jobs.tsv of
+the analysis directory by the jobscript itself (see
+jobscript.template.sh), on non-zero exit or when killed with a
+warning signal. tools/cluster_status.py (--cluster-status) and
+tools/cluster_submit.py for blocking submissions (--cluster-sync)
+record them as well, together with their observed peak memory and
+wall time from the scheduler's accounting.
+
+tools/cluster_submit.py wraps the submit command (qsub) and, when it
+sees the same job (rule and wildcards) again and the previous attempt
+is recorded as failed, raises the limits the attempt ran into based
+on the observed usage (looked up once from accounting if not
+recorded), up to a per-rule cap (max_mem and max_time in
+cluster.yaml, either per rule or in __default__). Attempts without
+failure record (e.g. jobs rerun after a pipeline restart) are
+submitted unchanged. The submit wrapper never waits for accounting.
+It is only used if snakemake submits via qsub (DRMAA_OFF=1 in
+run.sh).
+
+Every submission is logged to logs/submissions.tsv in the analysis
+directory, from where escalations are ingested into the benchmark
+warehouse (see benchmarkdb.py).
+"""
+
+#--- standard library imports
+#
+import os
+import re
+import json
+import time
+import logging
+import subprocess
+
+#--- third-party imports
+#
+#/
+
+#--- project specific imports
+#
+from benchmarks import cluster_mem_to_gb
+from benchmarks import cluster_time_to_secs
+from benchmarks import secs_to_cluster_time
+from benchmarks import gb_to_cluster_mem
+from qstatcache import qacct_cmd
+from qstatcache import qstat_cmd
+from qstatcache import normalize_jid
+
+
+__author__ = "Andreas Wilm"
+__email__ = "wilma@gis.a-star.edu.sg"
+__copyright__ = "2017 Genome Institute of Singapore"
+__license__ = "The MIT License (MIT)"
+
+
+# global logger
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(
+    '[{asctime}] {levelname:8s} {filename} {message}', style='{'))
+logger.addHandler(handler)
+
+
+# submissions log relative to analysis dir
+SUBMISSIONS_LOG = os.path.join("logs", "submissions.tsv")
+SUBMISSIONS_COLS = ['timestamp', 'rule', 'wildcards', 'jid', 'attempt',
+                    'mem_gb', 'time_s', 'peak_gb', 'wallclock_s']
+# failed jobs log relative to analysis dir
+FAILED_JOBS_LOG = os.path.join("logs", "failed_jobs.tsv")
+FAILED_JOBS_COLS = ['timestamp', 'jid', 'peak_gb', 'wallclock_s']
+
+# usage above this fraction of the limit means the job ran into it
+AT_LIMIT_FRACTION = 0.9
+# new limit as multiple of observed usage of a job that ran into its limit
+MEM_ESCALATION = 1.5
+TIME_ESCALATION = 2.0
+# caps used if cluster config doesn't define max_mem or max_time
+DEFAULT_MAX_MEM_GB = 256
+DEFAULT_MAX_TIME_S = 7 * 24 * 60 * 60
+
+# memory and time arguments of SGE/UGE (-l mem_free=,h_rt=) and PBS
+# Pro (-l select=...:mem=, -l walltime=)
+MEM_ARG_RE = re.compile(r'((?:^|[,:])(?:mem_free|h_vmem|mem)=)([0-9.]+[kKmMgGtT]?[bB]?)')
+TIME_ARG_RE = re.compile(r'((?:^|[,:])(?:h_rt|walltime)=)([0-9:]+)')
+
+
+def parse_job_properties(jobscript):
+    """Job properties (rule, wildcards etc.) snakemake writes into
+    its jobscripts. Returns empty dict if not found
+    """
+    with open(jobscript) as fh:
+        for line in fh:
+            if line.startswith("# properties = "):
+                try:
+                    return json.loads(line[len("# properties = "):])
+                except ValueError:
+                    break
+    return dict()
+
+
+def job_key(props):
+    """Key identifying a job across attempts
+
+    >>> job_key({'rule': 'star', 'wildcards': {'sample': 'S1'}, 'jobid': 7})
+    ('star', '{"sample": "S1"}')
+    """
+    return props.get('rule'), json.dumps(props.get('wildcards', dict()), sort_keys=True)
+
+
+def parse_size_gb(value):
+    """Parse memory values as reported by accounting into GB
+
+    >>> parse_size_gb("12.5G"), parse_size_gb("2097152kb"), parse_size_gb("1073741824")
+    (12.5, 2.0, 1.0)
+    """
+    value = value.strip().upper()
+    if value.endswith("B") and len(value) > 1 and value[-2] in "KMGT":
+        value = value[:-1]
+    return cluster_mem_to_gb(value)
+
+
+def parse_qacct_usage(text):
+    """Peak memory (GB) and wall time (s) from SGE/UGE qacct -j output
+    (last record if there are several). Either can be None
+
+    >>> parse_qacct_usage("jobnumber 123\\nru_wallclock 3601.5s\\nmaxvmem      15.900G\\n")
+    (15.9, 3601.5)
+    """
+    peak_gb = wallclock_s = None
+    for line in text.splitlines():
+        fields = line.split()
+        if len(fields) < 2:
+            continue
+        if fields[0] == 'maxvmem':
+            peak_gb = parse_size_gb(fields[1])
+        elif fields[0] == 'ru_wallclock':
+            wallclock_s = float(fields[1].rstrip("s"))
+    return peak_gb, wallclock_s
+
+
+def parse_pbs_usage(text):
+    """Peak memory (GB) and wall time (s) from PBS Pro qstat -xf output
+
+    >>> parse_pbs_usage("Job Id: 1.wlm01\\n    resources_used.mem = 4194304kb\\n    resources_used.walltime = 01:00:05\\n")
+    (4.0, 3605.0)
+    """
+    peak_gb = wallclock_s = None
+    for line in text.splitlines():
+        key, _, value = line.strip().partition(" = ")
+        if key == 'resources_used.mem':
+            peak_gb = parse_size_gb(value)
+        elif key == 'resources_used.walltime':
+            wallclock_s = float(cluster_time_to_secs(value.strip()))
+    return peak_gb, wallclock_s
+
+
+def attempt_usage(jid, scheduler):
+    """Observed peak memory (GB) and wall time (s) of a finished job
+    from accounting. Returns (None, None) if not available. Queries
+    only once, i.e. call when the job is known to have finished
+    """
+    jid = normalize_jid(jid)
+    if scheduler == 'pbspro':
+        cmd, parser = [qstat_cmd(), '-xf', jid], parse_pbs_usage
+    else:
+        cmd, parser = [qacct_cmd(), '-j', jid], parse_qacct_usage
+    try:
+        res = subprocess.check_output(cmd, stderr=subprocess.PIPE)
+    except (subprocess.CalledProcessError, OSError):
+        logger.warning("No accounting record for job %s", jid)
+        return None, None
+    return parser(res.decode())
+
+
+def resource_caps(cluster_cfg, rule):
+    """Per rule caps (GB, s) from cluster config keys max_mem and
+    max_time (rule or __default__) or module defaults
+
+    >>> cfg = {'__default__': {'max_mem': '64G'}, 'star': {'max_mem': '128G', 'max_time': '48:00:00'}}
+    >>> resource_caps(cfg, 'star'), resource_caps(cfg, 'bwa')
+    ((128.0, 172800), (64.0, 604800))
+    """
+    cluster_cfg = cluster_cfg if cluster_cfg else dict()
+    default = cluster_cfg.get('__default__', dict())
+    entry = cluster_cfg.get(rule, dict())
+    max_mem = entry.get('max_mem', default.get('max_mem'))
+    max_time = entry.get('max_time', default.get('max_time'))
+    return (cluster_mem_to_gb(max_mem) if max_mem else DEFAULT_MAX_MEM_GB,
+            cluster_time_to_secs(max_time) if max_time else DEFAULT_MAX_TIME_S)
+
+
+def escalate(mem_gb, time_s, peak_gb, wallclock_s, max_mem_gb, max_time_s):
+    """New memory (GB) and time (s) limits for a retry given the
+    limits and observed usage of the failed attempt. Limits are only
+    raised if the attempt ran into them, never above the caps and
+    never lowered. Returns tuple of new memory, new time and list of
+    reasons (empty if nothing changed)
+
+    >>> escalate(16.0, 7200, 16.0, 600.0, 64.0, 86400)
+    (24.0, 7200, ['mem 16.0G -> 24.0G (peak 16.0G)'])
+    >>> escalate(16.0, 7200, 2.0, 7199.0, 64.0, 86400)[1:]
+    (14398, ['time 7200s -> 14398s (ran 7199s)'])
+    >>> escalate(48.0, 7200, 47.0, 60.0, 64.0, 86400)[0]
+    64.0
+    >>> escalate(16.0, 7200, None, None, 64.0, 86400)
+    (16.0, 7200, [])
+    """
+    new_mem, new_time = mem_gb, time_s
+    reasons = []
+    if peak_gb is not None and mem_gb and peak_gb >= AT_LIMIT_FRACTION * mem_gb:
+        new_mem = min(max_mem_gb, max(mem_gb, MEM_ESCALATION * peak_gb))
+        if new_mem > mem_gb:
+            reasons.append("mem {:.1f}G -> {:.1f}G (peak {:.1f}G)".format(mem_gb, new_mem, peak_gb))
+    if wallclock_s is not None and time_s and wallclock_s >= AT_LIMIT_FRACTION * time_s:
+        new_time = int(min(max_time_s, max(time_s, TIME_ESCALATION * wallclock_s)))
+        if new_time > time_s:
+            reasons.append("time {}s -> {}s (ran {:.0f}s)".format(time_s, new_time, wallclock_s))
+    return new_mem, new_time, reasons
+
+
+def submit_resources(args):
+    """Memory (GB) and time (s) requested in submit command args.
+    Either is None if not found
+
+    >>> submit_resources(['qsub', '-l', 'mem_free=16G', '-l', 'h_rt=02:00:00', 'job.sh'])
+    (16.0, 7200)
+    >>> submit_resources(['qsub', '-l', 'select=1:ncpus=8:mem=4g', '-l', 'walltime=01:00:00'])
+    (4.0, 3600)
+    """
+    mem_gb = time_s = None
+    for arg in args:
+        m = MEM_ARG_RE.search(arg)
+        if m and mem_gb is None:
+            mem_gb = parse_size_gb(m.group(2))
+        m = TIME_ARG_RE.search(arg)
+        if m and time_s is None:
+            time_s = cluster_time_to_secs(m.group(2))
+    return mem_gb, time_s
+
+
+def rewrite_submit_args(args, mem_gb, time_s):
+    """Replace memory and time in submit command args
+
+    >>> rewrite_submit_args(['qsub', '-l', 'mem_free=16G', '-l', 'h_rt=02:00:00'], 24.0, 7200)
+    ['qsub', '-l', 'mem_free=24G', '-l', 'h_rt=02:00:00']
+    >>> rewrite_submit_args(['-l', 'select=1:ncpus=8:mem=4g', '-l', 'walltime=01:00:00'], 4.0, 9000)
+    ['-l', 'select=1:ncpus=8:mem=4G', '-l', 'walltime=02:30:00']
+    """
+    new_args = []
+    for arg in args:
+        arg = MEM_ARG_RE.sub(lambda m: m.group(1) + gb_to_cluster_mem(mem_gb), arg)
+        arg = TIME_ARG_RE.sub(lambda m: m.group(1) + secs_to_cluster_time(time_s), arg)
+        new_args.append(arg)
+    return new_args
+
+
+def previous_attempts(logfile, key):
+    """Logged submissions (dicts) of job with given key, oldest first"""
+    attempts = []
+    if not os.path.exists(logfile):
+        return attempts
+    with open(logfile) as fh:
+        for line in fh:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) != len(SUBMISSIONS_COLS) or fields[0] == 'timestamp':
+                continue
+            row = dict(zip(SUBMISSIONS_COLS, fields))
+            if (row['rule'], row['wildcards']) == key:
+                attempts.append(row)
+    return attempts
+
+
+def log_submission(logfile, key, jid, attempt, mem_gb, time_s,
+                   peak_gb=None, wallclock_s=None):
+    """Append submission to log (header is written if new)"""
+    is_new = not os.path.exists(logfile)
+    values = [time.time(), key[0], key[1], normalize_jid(jid), attempt,
+              mem_gb, time_s, peak_gb, wallclock_s]
+    with open(logfile, 'a') as fh:
+        if is_new:
+            fh.write("\t".join(SUBMISSIONS_COLS) + "\n")
+        fh.write("\t".join("" if v is None else str(v) for v in values) + "\n")
+
+
+def log_failed_job(logfile, jid, peak_gb, wallclock_s):
+    """Append failed job and its observed usage to log (header is
+    written if new). Silently skipped if logfile's directory doesn't
+    exist (not an analysis directory)
+    """
+    if not os.path.isdir(os.path.dirname(logfile) or os.curdir):
+        return
+    is_new = not os.path.exists(logfile)
+    values = [time.time(), normalize_jid(jid), peak_gb, wallclock_s]
+    with open(logfile, 'a') as fh:
+        if is_new:
+            fh.write("\t".join(FAILED_JOBS_COLS) + "\n")
+        fh.write("\t".join("" if v is None else str(v) for v in values) + "\n")
+
+
+def failed_job_usage(logfile, jid):
+    """Observed peak memory (GB) and wall time (s) of job jid if
+    logged as failed, otherwise None. Values of repeated records are
+    merged. Either value can be None if not recorded (e.g. by the
+    jobscript) or accounting didn't have it
+
+    >>> import tempfile
+    >>> fd, logfile = tempfile.mkstemp(suffix=".tsv")
+    >>> log_failed_job(logfile, "123.wlm01", None, None)
+    >>> failed_job_usage(logfile, "123"), failed_job_usage(logfile, "124")
+    ((None, None), None)
+    >>> log_failed_job(logfile, "123.wlm01", 15.9, None)
+    >>> log_failed_job(logfile, "123.wlm01", None, None)
+    >>> failed_job_usage(logfile, "123")
+    (15.9, None)
+    >>> os.close(fd); os.unlink(logfile)
+    """
+    if not os.path.exists(logfile):
+        return None
+    jid = normalize_jid(jid)
+    usage = None
+    with open(logfile) as fh:
+        for line in fh:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) != len(FAILED_JOBS_COLS) or fields[1] != jid:
+                continue
+            row = dict(zip(FAILED_JOBS_COLS, fields))
+            peak_gb, wallclock_s = usage if usage else (None, None)
+            usage = (float(row['peak_gb']) if row['peak_gb'] else peak_gb,
+                     float(row['wallclock_s']) if row['wallclock_s'] else wallclock_s)
+    return usage
+
+
+def parse_submissions_log(fh):
+    """Parse submissions log into list of dicts with typed values
+
+    >>> from io import StringIO
+    >>> log = StringIO("\\t".join(SUBMISSIONS_COLS) + "\\n1.0\\tstar\\t{}\\t12\\t2\\t24.0\\t7200\\t15.9\\t600.0\\n")
+    >>> r = parse_submissions_log(log)[0]
+    >>> r['rule'], r['attempt'], r['mem_gb'], r['time_s'], r['peak_gb']
+    ('star', 2, 24.0, 7200, 15.9)
+    """
+    types = {'timestamp': float, 'attempt': int, 'mem_gb': float, 'time_s': int,
+             'peak_gb': float, 'wallclock_s': float}
+    rows = []
+    for line in fh:
+        fields = line.rstrip("\n").split("\t")
+        if len(fields) != len(SUBMISSIONS_COLS) or fields[0] == 'timestamp':
+            continue
+        row = dict()
+        for col, value in zip(SUBMISSIONS_COLS, fields):
+            row[col] = types[col](value) if col in types and value else (value if value else None)
+        rows.append(row)
+    return rows
@@ -0,0 +1,235 @@
+"""Grouped execution of short helper rules
+
+Pipelines can declare rule groups in cfg/groups.yaml, each listing a
+producer rule followed by its short follow-up steps, e.g.
+
+  vcf_index: [gatk_genotyping, bgzip, tabix]
+
+Based on historical runtimes from the benchmark warehouse (see
+benchmarkdb.py) every follower is then either run locally (very
+short), bundled with its producer into one cluster job (short) or
+submitted as a separate cluster job (long). Followers without enough
+history keep whatever the Snakefile declares.
+
+Local decisions are declared with localrules in a generated include
+(see write_rule_plan_include()), groups via --groups (see
+group_args()). Followers (or producers) declared local in the
+Snakefile or shared rules only become cluster jobs if they declare
+their localrules conditionally, e.g.
+
+  if keep_local('bgzip', config.get('rule_plan')):
+      localrules: bgzip
+
+Groups need snakemake>=5: with older versions run.sh ignores
+--groups and keep_local() keeps grouped rules local.
+"""
+
+#--- standard library imports
+#
+import os
+import logging
+
+#--- third-party imports
+#
+import yaml
+
+#--- project specific imports
+#
+from benchmarkdb import BenchmarkDB
+from benchmarks import secs_to_cluster_time
+from benchmarks import cluster_time_to_secs
+
+
+__author__ = "Andreas Wilm"
+__email__ = "wilma@gis.a-star.edu.sg"
+__copyright__ = "2017 Genome Institute of Singapore"
+__license__ = "The MIT License (MIT)"
+
+
+# global logger
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(
+    '[{asctime}] {levelname:8s} {filename} {message}', style='{'))
+logger.addHandler(handler)
+
+
+GROUPS_CFG = "groups.yaml"
+
+# generated include with local decisions, relative to analysis dir
+RULE_PLAN_INCLUDE = "rule_plan.rules"
+
+# followers with runtime below this run on the master node
+MAX_LOCAL_S = 30
+# followers with runtime below this are bundled with their producer
+MAX_GROUPED_S = 15 * 60
+# runtime percentile used for decisions and minimum number of observations
+HISTORY_PCT = 90
+HISTORY_MIN_OBS = 3
+
+
+def load_rule_groups(cfg_dir):
+    """Returns dict of group name to list of rules (producer first) as
+    defined in cfg_dir/groups.yaml or None if missing
+    """
+    cfg = os.path.join(cfg_dir, GROUPS_CFG)
+    if not os.path.exists(cfg):
+        return None
+    with open(cfg) as fh:
+        groups = yaml.safe_load(fh)
+    if not groups:
+        return None
+    seen = set()
+    for name, rules in groups.items():
+        assert isinstance(rules, list) and len(rules) > 1, (
+            "Group {} in {} needs a producer and at least one follower".format(name, cfg))
+        # snakemake allows only one group per rule
+        assert not seen & set(rules), (
+            "Rules {} in {} used in more than one group".format(seen & set(rules), cfg))
+        seen.update(rules)
+    return groups
+
+
+def rule_runtimes(dbfile, pipeline_name=None, site=None,
+                  pct=HISTORY_PCT, min_obs=HISTORY_MIN_OBS):
+    """Returns dict of rule to runtime percentile (in seconds) from
+    benchmark warehouse. Rules with less than min_obs records are
+    ignored
+    """
+    db = BenchmarkDB(dbfile)
+    res = db.percentiles('s', (pct,), ('rule',),
+                         pipeline_name=pipeline_name, site=site)
+    db.close()
+    return dict((k[0], v[1]) for k, v in res.items() if v[0] >= min_obs)
+
+
+def plan_rule_groups(groups, runtimes,
+                     max_local_s=MAX_LOCAL_S, max_grouped_s=MAX_GROUPED_S):
+    """Decide per follower whether it runs local, grouped with its
+    producer or as separate cluster job. Returns dict with keys
+    local (list), cluster (list) and groups (dict of rule to group;
+    producers are only assigned if at least one follower is grouped)
+
+    >>> groups = {'vcf': ['caller', 'bgzip', 'tabix', 'stats']}
+    >>> runtimes = {'caller': 7200, 'bgzip': 300, 'tabix': 5, 'stats': 3600}
+    >>> plan = plan_rule_groups(groups, runtimes)
+    >>> plan['local'], plan['cluster'], sorted(plan['groups'].items())
+    (['tabix'], ['stats'], [('bgzip', 'vcf'), ('caller', 'vcf')])
+    >>> plan_rule_groups(groups, {})
+    {'local': [], 'cluster': [], 'groups': {}}
+    """
+    plan = {'local': [], 'cluster': [], 'groups': dict()}
+    for name, rules in sorted(groups.items()):
+        producer, followers = rules[0], rules[1:]
+        grouped = []
+        for rule in followers:
+            secs = runtimes.get(rule)
+            if secs is None:
+                logger.debug("No runtime history for %s: keeping as declared", rule)
+                continue
+            if secs <= max_local_s:
+                plan['local'].append(rule)
+            elif secs <= max_grouped_s:
+                grouped.append(rule)
+            else:
+                plan['cluster'].append(rule)
+        if grouped:
+            for rule in [producer] + grouped:
+                assert rule not in plan['groups'], (
+                    "Rule {} assigned to more than one group".format(rule))
+                plan['groups'][rule] = name
+    return plan
+
+
+def group_args(plan):
+    """Snakemake command line arguments for grouped rules
+
+    >>> group_args({'groups': {'tabix': 'vcf', 'caller': 'vcf'}})
+    '--groups caller=vcf tabix=vcf'
+    >>> group_args(None)
+    ''
+    """
+    if not plan or not plan.get('groups'):
+        return ""
+    return "--groups " + " ".join(
+        "{}={}".format(r, g) for r, g in sorted(plan['groups'].items()))
+
+
+def add_group_cluster_cfg(cluster_cfg, groups, plan, runtimes):
+    """Add cluster config entries for group jobs: producer resources
+    with time extended by the grouped followers' runtimes
+
+    >>> cfg = {'__default__': {'time': '01:00:00', 'mem': '4G'}, 'caller': {'time': '02:00:00', 'mem': '8G'}}
+    >>> groups = {'vcf': ['caller', 'bgzip', 'tabix']}
+    >>> plan = {'groups': {'caller': 'vcf', 'bgzip': 'vcf'}}
+    >>> add_group_cluster_cfg(cfg, groups, plan, {'bgzip': 300, 'tabix': 5})['vcf']
+    {'time': '02:05:00', 'mem': '8G'}
+    """
+    if not plan or not plan.get('groups'):
+        return cluster_cfg
+    default = cluster_cfg.get('__default__', dict())
+    for name, rules in groups.items():
+        producer = rules[0]
+        if plan['groups'].get(producer) != name:
+            continue
+        entry = dict(cluster_cfg.get(producer, default))
+        extra_s = sum(runtimes.get(r, 0) for r in rules[1:]
+                      if plan['groups'].get(r) == name)
+        if 'time' in entry and extra_s:
+            entry['time'] = secs_to_cluster_time(
+                cluster_time_to_secs(entry['time']) + extra_s)
+        cluster_cfg[name] = entry
+    return cluster_cfg
+
+
+def groups_supported():
+    """Whether the running snakemake supports rule groups (>=5)"""
+    try:
+        from snakemake import __version__
+    except ImportError:
+        return False
+    return int(__version__.split(".")[0]) >= 5
+
+
+def keep_local(rule, plan, with_groups=None):
+    """Whether rule declared local should stay local given plan (see
+    plan_rule_groups()): not if planned as separate cluster job or
+    grouped (only if groups are supported, see groups_supported())
+
+    >>> plan = {'local': ['tabix'], 'cluster': ['stats'], 'groups': {'caller': 'vcf', 'bgzip': 'vcf'}}
+    >>> [keep_local(r, plan, True) for r in ['tabix', 'stats', 'bgzip', 'other']]
+    [True, False, False, True]
+    >>> keep_local('bgzip', plan, False), keep_local('stats', None)
+    (True, True)
+    """
+    if not plan:
+        return True
+    if rule in plan.get('cluster', []):
+        return False
+    if rule in plan.get('groups', dict()):
+        if with_groups is None:
+            with_groups = groups_supported()
+        return not with_groups
+    return True
+
+
+def write_rule_plan_include(plan, rules_file):
+    """Write localrules declaration for rules planned to run local to
+    rules_file, meant to be included by the Snakefile (see
+    logging.rules). Returns rules_file or None if nothing to declare
+
+    >>> import tempfile
+    >>> rules_file = os.path.join(tempfile.mkdtemp(), RULE_PLAN_INCLUDE)
+    >>> write_rule_plan_include({'local': ['tabix', 'md5'], 'cluster': ['stats']}, rules_file) == rules_file
+    True
+    >>> print(open(rules_file).read().strip())
+    # generated from rule plan (see rulegroups.py)
+    localrules: md5, tabix
+    >>> write_rule_plan_include({'local': [], 'cluster': ['stats']}, rules_file)
+    """
+    if not plan or not plan.get('local'):
+        return None
+    with open(rules_file, 'w') as fh:
+        fh.write("# generated from rule plan (see rulegroups.py)\n")
+        fh.write("localrules: {}\n".format(", ".join(sorted(plan['local']))))
+    return rules_file
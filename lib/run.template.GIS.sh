@@ -49,11 +49,17 @@
 
 DEBUG=${{DEBUG:-0}}
 RESTARTS=${{RESTARTS:-{DEFAULT_RESTARTS}}}
+# shared event journal of this site (see lib/eventjournal.py)
+EVENT_JOURNAL="{EVENT_JOURNAL}"
+if [ -n "$EVENT_JOURNAL" ]; then
+    export RPD_EVENT_JOURNAL=$EVENT_JOURNAL
+fi
 export DRMAA_LIBRARY_PATH=$SGE_ROOT/lib/lx-amd64/libdrmaa.so
 DRMAA_OFF=${{DRMAA_OFF:-0}}
 LOCAL_CORES=${{LOCAL_CORES:-1}}
 DEFAULT_SLAVE_Q={DEFAULT_SLAVE_Q}
 LOCAL_MASTER=${{LOCAL_MASTER:-0}}
+CLUSTER_STATUS_ARGS=""
 SNAKEFILE={SNAKEFILE}
 LOGDIR="{LOGDIR}";# should be same as defined above
 DEFAULT_SNAKEMAKE_ARGS="--local-cores $LOCAL_CORES --restart-times $RESTARTS --rerun-incomplete --timestamp --printshellcmds --stats $LOGDIR/snakemake.stats --configfile conf.yaml --latency-wait 60 --max-jobs-per-second 1 --max-status-checks-per-second 0.1 --keep-going"
@@ -75,13 +81,21 @@ if [ "$ENVIRONMENT" == "BATCH" ] || [ $LOCAL_MASTER -eq 1 ]; then
         clustercmd="$clustercmd -q $DEFAULT_SLAVE_Q"
     fi
     if [ "$DRMAA_OFF" -eq 1 ]; then
-        clustercmd="--cluster \"qsub $clustercmd\""
+        # -terse: only print job id (needed for --cluster-status)
+        # submit wrapper escalates resources of retried jobs (see lib/retries.py),
+        # based on failures recorded by the jobscript. not available with DRMAA
+        clustercmd="--cluster \"{CLUSTER_SUBMIT_CMD} qsub -terse $clustercmd\""
+        # job status from shared qstat cache (see tools/qstat_cache.py)
+        CLUSTER_STATUS_ARGS="--cluster-status {CLUSTER_STATUS_CMD}"
 	    #clustercmd="--cluster-sync \"qsub -sync y $clustercmd\""
         # doesn't work. see https://github.com/gis-rpd/pipelines/issues/83
     else
         clustercmd="--drmaa \" $clustercmd -w n\""
     fi
     CLUSTER_ARGS="--cluster-config cluster.yaml $clustercmd --jobname \"{PIPELINE_NAME}.slave.{{rulename}}.{{jobid}}.sh\""
+    # jobscript records job start for queue latency tracking (see lib/queuelatency.py)
+    # and failures for resource escalation of retries (see lib/retries.py)
+    CLUSTER_ARGS="$CLUSTER_ARGS --jobscript {JOBSCRIPT}"
     N_ARG="--jobs 25"
 else
     # run locally
@@ -110,6 +124,25 @@ fi
 # now okay to add CLUSTER_ARGS (allows repeated -l)
 sm_args="$sm_args $CLUSTER_ARGS"
 
+# --cluster-status needs snakemake>=4.6. without it snakemake
+# falls back to its own job marker files
+if [ -n "$CLUSTER_STATUS_ARGS" ]; then
+    if snakemake --help | grep -q -- '--cluster-status'; then
+        sm_args="$sm_args $CLUSTER_STATUS_ARGS"
+    fi
+fi
+
+# rule groups bundle short follow-up rules with their producer into
+# one cluster job (see lib/rulegroups.py). needs snakemake>=5
+GROUP_ARGS="{GROUP_ARGS}"
+if [ -n "$GROUP_ARGS" ] && [ -n "$CLUSTER_ARGS" ]; then
+    if snakemake --help | grep -q -- '--groups'; then
+        sm_args="$sm_args $GROUP_ARGS"
+    else
+        echo "WARNING: snakemake version doesn't support rule groups. Ignoring $GROUP_ARGS" 1>&2
+    fi
+fi
+
 # ANALYSIS_ID created here so that each run gets its own Id
 # iso8601ms timestamp as corresponding python function
 iso8601ns=$(date --iso-8601=ns | tr ':,' '-.');
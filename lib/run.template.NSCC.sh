@@ -46,6 +46,11 @@
 
 DEBUG=${{DEBUG:-0}}
 RESTARTS=${{RESTARTS:-{DEFAULT_RESTARTS}}}
+# shared event journal of this site (see lib/eventjournal.py)
+EVENT_JOURNAL="{EVENT_JOURNAL}"
+if [ -n "$EVENT_JOURNAL" ]; then
+    export RPD_EVENT_JOURNAL=$EVENT_JOURNAL
+fi
 export DRMAA_LIBRARY_PATH=/app/pbs-drmaa/pbs_dramaa_fix/drmaa/lib/libdrmaa.so
 export LD_LIBRARY_PATH=$LD_LIBRARY_PATH:/app/pbs-drmaa/pbs_dramaa_fix/pbs_exec/lib:/app/pbs-drmaa/pbs_dramaa_fix/drmaa/lib
 DRMAA_OFF=${{DRMAA_OFF:-1}}
@@ -81,12 +86,16 @@ if [ "$ENVIRONMENT" == "BATCH" ] || [ $LOCAL_MASTER -eq 1 ]; then
     clustercmd="$clustercmd -v project=13000026"
     if [ "$DRMAA_OFF" -eq 1 ]; then
         #clustercmd="--cluster \"qsub $clustercmd\""
-	    clustercmd="--cluster-sync \"qsub -Wblock=true $clustercmd\""
+        # submit wrapper escalates resources of retried jobs (see lib/retries.py)
+	    clustercmd="--cluster-sync \"{CLUSTER_SUBMIT_CMD} qsub -Wblock=true $clustercmd\""
 	    #clustercmd="--cluster-sync \"qsub -P 13000026 -Wblock=true $clustercmd\""
     else
         clustercmd="--drmaa \" $clustercmd\""
     fi
     CLUSTER_ARGS="--cluster-config cluster.yaml $clustercmd --jobname \"{PIPELINE_NAME}.slave.{{rulename}}.{{jobid}}.sh\""
+    # jobscript records job start for queue latency tracking (see lib/queuelatency.py)
+    # and failures for resource escalation of retries (see lib/retries.py)
+    CLUSTER_ARGS="$CLUSTER_ARGS --jobscript {JOBSCRIPT}"
     N_ARG="--jobs 25"
 else
     # run locally
@@ -116,6 +125,17 @@ fi
 # now okay to add CLUSTER_ARGS (allows repeated -l)
 sm_args="$sm_args $CLUSTER_ARGS"
 
+# rule groups bundle short follow-up rules with their producer into
+# one cluster job (see lib/rulegroups.py). needs snakemake>=5
+GROUP_ARGS="{GROUP_ARGS}"
+if [ -n "$GROUP_ARGS" ] && [ -n "$CLUSTER_ARGS" ]; then
+    if snakemake --help | grep -q -- '--groups'; then
+        sm_args="$sm_args $GROUP_ARGS"
+    else
+        echo "WARNING: snakemake version doesn't support rule groups. Ignoring $GROUP_ARGS" 1>&2
+    fi
+fi
+
 # ANALYSIS_ID created here so that each run gets its own Id
 # iso8601ms timestamp as corresponding python function
 iso8601ns=$(date --iso-8601=ns | tr ':,' '-.');
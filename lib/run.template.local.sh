@@ -22,6 +22,11 @@
 
 DEBUG=${{DEBUG:-0}}
 RESTARTS=${{RESTARTS:-{DEFAULT_RESTARTS}}}
+# shared event journal of this site (see lib/eventjournal.py)
+EVENT_JOURNAL="{EVENT_JOURNAL}"
+if [ -n "$EVENT_JOURNAL" ]; then
+    export RPD_EVENT_JOURNAL=$EVENT_JOURNAL
+fi
 SNAKEFILE={SNAKEFILE}
 LOGDIR="{LOGDIR}";# should be same as defined above
 DEFAULT_SNAKEMAKE_ARGS="--restart-times $RESTARTS --rerun-incomplete --timestamp --printshellcmds --stats $LOGDIR/snakemake.stats --configfile conf.yaml --latency-wait 60"
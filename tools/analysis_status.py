@@ -12,13 +12,18 @@ import os
 import argparse
 import logging
 import glob
-import subprocess
 
 #--- third-party imports
 #/
 
 #--- project specific imports
-#/
+#
+# add lib dir for this pipeline installation to PYTHONPATH
+LIB_PATH = os.path.abspath(os.path.join(os.path.dirname(
+    os.path.realpath(__file__)), "..", "lib"))
+if LIB_PATH not in sys.path:
+    sys.path.insert(0, LIB_PATH)
+from qstatcache import QstatCache
 
 # master log relative to outdir
 MASTERLOG = "snakemake.log"
@@ -32,26 +37,10 @@ handler.setFormatter(logging.Formatter(
 logger.addHandler(handler)
 
 
-def jid_is_running(jid, is_pbspro):
-    """run qstat to find out whether jid is still running
+def jid_is_running(jid, qstat_cache):
+    """use (shared) qstat cache to find out whether jid is still running
     """
-    if is_pbspro:
-        cmd = ['qstat', jid]
-    else:
-        cmd = ['qstat', '-j', jid]
-    try:
-        _ = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
-        return True
-    except subprocess.CalledProcessError as e:
-        if is_pbspro:
-            # Unknown Job Id happens on log rotation.
-            # NOTE (possible workaround): accouting info actually part of OU
-            if not any(['Unknown Job Id' in x for x in [e.output.decode(), e.output.decode()]]):
-                assert any(['has finished' in x for x in [e.output.decode(), e.output.decode()]])
-        else:
-            assert any(["Following jobs do not exist" in x for x in [e.output.decode(), e.output.decode()]])
-            # otherwise communication error?
-            return False
+    return qstat_cache.is_running(jid)
 
 
 def jid_from_cluster_logfile(logfile):
@@ -80,17 +69,6 @@ def main():
     """main function
     """
 
-    # should atually check first if we run qstat at all
-    try:
-        res = subprocess.check_output(['qstat', '--version'], stderr=subprocess.STDOUT)
-    except subprocess.CalledProcessError:
-        is_pbspro = False
-    else:
-        if 'PBSPro' in res.decode():
-            is_pbspro = True
-        else:
-            raise ValueError(res.decode())
-
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument('dir', nargs=1,
                         help="Analysis directory (output dir of pipeline wrapper)")
@@ -111,6 +89,9 @@ def main():
     # script -qqq -> no logging at all
     logger.setLevel(logging.WARN + 10*args.quiet - 10*args.verbose)
 
+    # one qstat call (or none if cache is fresh) for all jobs
+    qstat_cache = QstatCache()
+    is_pbspro = qstat_cache.scheduler() == 'pbspro'
 
     if not os.path.exists(args.dir[0]):
         logger.fatal("Log directory {} doesn't exist".format(args.dir[0]))
@@ -129,7 +110,7 @@ def main():
     print("Found {} slaves (cluster log files)".format(len(cluster_logfiles)))
     slave_jids = [jid_from_cluster_logfile(f) for f in cluster_logfiles]
     for jid in slave_jids:
-        if jid_is_running(jid, is_pbspro):
+        if jid_is_running(jid, qstat_cache):
             print("Slave jid {} still running".format(jid))
         else:
             print("Slave jid {} not running (anymore).".format(jid))
@@ -144,14 +125,14 @@ def main():
                 line = line.rstrip()
                 if is_pbspro:
                     jid = line.strip()
-                    if jid_is_running(jid, is_pbspro):
+                    if jid_is_running(jid, qstat_cache):
                         print("Master jid {} still running".format(jid))
                     else:
                         print("Master jid {} not running (anymore).".format(jid))
 
                 elif line.startswith("Your job") and line.endswith("has been submitted"):
                     jid = line.split()[2]
-                    if jid_is_running(jid, is_pbspro):
+                    if jid_is_running(jid, qstat_cache):
                         print("Master jid {} still running".format(jid))
                     else:
                         print("Master jid {} not running (anymore).".format(jid))
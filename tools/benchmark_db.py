@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""Collect benchmark logs of completed analyses (incl. bundled log
+tarballs) into a central SQLite database and query it for wall time,
+memory and I/O percentiles per rule, pipeline version and site.
+
+Examples:
+- Ingest: benchmark_db.py -d bench.db -i /path/to/analysis1 /path/to/analysis2
+- Query: benchmark_db.py -d bench.db -m s -g rule pipeline_version -r map_sort
+- Regressions: benchmark_db.py -d bench.db -p gatk --compare 2017-06 2017-10
+"""
+
+#--- standard library imports
+#
+import os
+import sys
+import logging
+import argparse
+
+#--- third-party imports
+#
+#/
+
+# --- project specific imports
+#
+# add lib dir for this pipeline installation to PYTHONPATH
+LIB_PATH = os.path.abspath(os.path.join(os.path.dirname(
+    os.path.realpath(__file__)), "..", "lib"))
+if LIB_PATH not in sys.path:
+    sys.path.insert(0, LIB_PATH)
+from benchmarkdb import BenchmarkDB
+from benchmarkdb import METRICS
+from benchmarkdb import GROUP_KEYS
+
+
+__author__ = "Andreas Wilm"
+__email__ = "wilma@gis.a-star.edu.sg"
+__copyright__ = "2017 Genome Institute of Singapore"
+__license__ = "The MIT License (MIT)"
+
+
+# global logger
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(
+    '[{asctime}] {levelname:8s} {filename} {message}', style='{'))
+logger.addHandler(handler)
+
+
+def main():
+    """main function
+    """
+
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-d', "--db", required=True,
+                        help="SQLite database file (created if missing)")
+    parser.add_argument('-i', "--ingest", nargs='+', metavar="ANALYSISDIR",
+                        help="Ingest benchmarks of these analysis directories")
+    parser.add_argument('-f', "--force", action='store_true',
+                        help="Re-ingest already ingested analysis directories")
+    default = 's'
+    parser.add_argument('-m', "--metric", choices=METRICS, default=default,
+                        help="Metric to query (default: {})".format(default))
+    default = ['rule']
+    parser.add_argument('-g', "--group-by", nargs='+', choices=GROUP_KEYS, default=default,
+                        help="Group query results by (default: {})".format(' '.join(default)))
+    default = [50, 90, 99]
+    parser.add_argument('--pct', nargs='+', type=float, default=default,
+                        help="Percentiles to report (default: {})".format(default))
+    parser.add_argument('-r', "--rule",
+                        help="Restrict query to this rule")
+    parser.add_argument('-p', "--pipeline",
+                        help="Restrict query to this pipeline")
+    parser.add_argument('-V', "--pipeline-version",
+                        help="Restrict query to this pipeline version")
+    parser.add_argument('-s', "--site",
+                        help="Restrict query to this site")
+    parser.add_argument('--compare', nargs=2, metavar=("OLD_VERSION", "NEW_VERSION"),
+                        help="Report rules whose median metric regressed between"
+                        " two pipeline versions (requires --pipeline)")
+    default = 1.2
+    parser.add_argument('--min-ratio', type=float, default=default,
+                        help="Minimum new/old ratio reported as regression (default: {})".format(default))
+    parser.add_argument('--retries', action='store_true',
+                        help="Report rules whose jobs needed resource escalating retries")
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help="Increase verbosity")
+    parser.add_argument('-q', '--quiet', action='count', default=0,
+                        help="Decrease verbosity")
+    args = parser.parse_args()
+
+    # Repeateable -v and -q for setting logging level.
+    # See https://www.reddit.com/r/Python/comments/3nctlm/what_python_tools_should_i_be_using_on_every/
+    # and https://gist.github.com/andreas-wilm/b6031a84a33e652680d4
+    # script -vv -> DEBUG
+    # script -v -> INFO
+    # script -> WARNING
+    # script -q -> ERROR
+    # script -qq -> CRITICAL
+    # script -qqq -> no logging at all
+    logger.setLevel(logging.WARN + 10*args.quiet - 10*args.verbose)
+
+    db = BenchmarkDB(args.db)
+
+    if args.ingest:
+        for d in args.ingest:
+            if not os.path.isdir(d):
+                logger.warning("Skipping non-existing directory %s", d)
+                continue
+            n = db.ingest_analysis(d, overwrite=args.force)
+            logger.info("Ingested %d records from %s", n, d)
+        db.close()
+        return
+
+    if args.compare:
+        if not args.pipeline:
+            logger.fatal("--compare requires --pipeline")
+            sys.exit(1)
+        old_version, new_version = args.compare
+        regs = db.regressions(args.pipeline, old_version, new_version,
+                              metric=args.metric, min_ratio=args.min_ratio,
+                              site=args.site)
+        print("\t".join(["rule", old_version, new_version, "ratio"]))
+        for rule, old, new, ratio in regs:
+            print("{}\t{:.1f}\t{:.1f}\t{:.2f}".format(rule, old, new, ratio))
+        db.close()
+        return
+
+    if args.retries:
+        res = db.escalations(pipeline_name=args.pipeline,
+                             pipeline_version=args.pipeline_version, site=args.site)
+        print("\t".join(["rule", "jobs", "retries", "max_attempt", "max_mem_gb"]))
+        for rule, (jobs, retries, max_attempt, max_mem) in sorted(res.items()):
+            print("\t".join([rule, str(jobs), str(retries), str(max_attempt),
+                             "{:.1f}".format(max_mem) if max_mem is not None else "NA"]))
+        db.close()
+        return
+
+    res = db.percentiles(args.metric, args.pct, args.group_by,
+                         rule=args.rule, pipeline_name=args.pipeline,
+                         pipeline_version=args.pipeline_version, site=args.site)
+    print("\t".join(args.group_by + ["n"] + ["p{:g}".format(p) for p in args.pct]))
+    for k, v in sorted(res.items(), key=lambda kv: [str(x) for x in kv[0]]):
+        print("\t".join([str(x) for x in k] + [str(v[0])] + ["{:.1f}".format(x) for x in v[1:]]))
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
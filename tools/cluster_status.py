@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""Job status script for snakemake's --cluster-status. Prints
+running, success or failed for the given job id (or qsub submission
+message) using the shared qstat cache (see qstat_cache.py). Failed
+jobs are recorded with their observed usage for resource escalation
+of retries (see lib/retries.py)
+"""
+
+#--- standard library imports
+#
+import os
+import sys
+
+#--- third-party imports
+#
+#/
+
+# --- project specific imports
+#
+# add lib dir for this pipeline installation to PYTHONPATH
+LIB_PATH = os.path.abspath(os.path.join(os.path.dirname(
+    os.path.realpath(__file__)), "..", "lib"))
+if LIB_PATH not in sys.path:
+    sys.path.insert(0, LIB_PATH)
+from qstatcache import snakemake_status
+from qstatcache import QstatCache
+from retries import attempt_usage
+from retries import log_failed_job
+from retries import FAILED_JOBS_LOG
+
+
+__author__ = "Andreas Wilm"
+__email__ = "wilma@gis.a-star.edu.sg"
+__copyright__ = "2017 Genome Institute of Singapore"
+__license__ = "The MIT License (MIT)"
+
+
+def main():
+    """main function
+    """
+    if len(sys.argv) < 2:
+        sys.stderr.write("Usage: {} jobid\n".format(os.path.basename(sys.argv[0])))
+        sys.exit(1)
+    # snakemake passes whatever the submit command printed
+    jid = " ".join(sys.argv[1:])
+    cache = QstatCache()
+    status = snakemake_status(jid, cache)
+    if status == 'failed':
+        # snakemake doesn't ask again after failed, so recorded once.
+        # cwd is the analysis dir
+        log_failed_job(FAILED_JOBS_LOG, jid, *attempt_usage(jid, cache.scheduler()))
+    print(status)
+
+
+if __name__ == "__main__":
+    main()
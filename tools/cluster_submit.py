@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""Submit wrapper for snakemake's --cluster/--cluster-sync. Usage:
+cluster_submit.py qsub [args] jobscript
+
+Runs the submit command as is, unless the job (rule and wildcards)
+was submitted before and that attempt is recorded as failed. Then
+memory and time limits of the submit command are raised if the
+failed attempt ran into them (see lib/retries.py). All submissions
+are logged to logs/submissions.tsv of the analysis directory (the
+current working directory). Blocking submissions (--cluster-sync)
+that fail are recorded as failed here.
+"""
+
+#--- standard library imports
+#
+import os
+import sys
+import subprocess
+
+#--- third-party imports
+#
+#/
+
+# --- project specific imports
+#
+# add lib dir for this pipeline installation to PYTHONPATH
+LIB_PATH = os.path.abspath(os.path.join(os.path.dirname(
+    os.path.realpath(__file__)), "..", "lib"))
+if LIB_PATH not in sys.path:
+    sys.path.insert(0, LIB_PATH)
+from retries import logger
+from retries import parse_job_properties
+from retries import job_key
+from retries import submit_resources
+from retries import rewrite_submit_args
+from retries import previous_attempts
+from retries import attempt_usage
+from retries import failed_job_usage
+from retries import log_failed_job
+from retries import resource_caps
+from retries import escalate
+from retries import log_submission
+from retries import SUBMISSIONS_LOG
+from retries import FAILED_JOBS_LOG
+from benchmarks import load_cluster_cfg
+from qstatcache import scheduler_type
+
+
+__author__ = "Andreas Wilm"
+__email__ = "wilma@gis.a-star.edu.sg"
+__copyright__ = "2017 Genome Institute of Singapore"
+__license__ = "The MIT License (MIT)"
+
+
+def main():
+    """main function
+    """
+    if len(sys.argv) < 3:
+        sys.stderr.write("Usage: {} qsub [args] jobscript\n".format(
+            os.path.basename(sys.argv[0])))
+        sys.exit(1)
+    args = sys.argv[1:]
+
+    key = job_key(parse_job_properties(args[-1]))
+    mem_gb, time_s = submit_resources(args)
+    attempts = previous_attempts(SUBMISSIONS_LOG, key)
+    # usage of previous attempt is only known if it was recorded as failed
+    usage = failed_job_usage(FAILED_JOBS_LOG, attempts[-1]['jid']) if attempts else None
+    peak_gb = wallclock_s = None
+    if usage:
+        last = attempts[-1]
+        peak_gb, wallclock_s = usage
+        if peak_gb is None and wallclock_s is None:
+            # recorded by the jobscript: usage only known to accounting
+            try:
+                peak_gb, wallclock_s = attempt_usage(last['jid'], scheduler_type())
+            except (ValueError, OSError):
+                pass
+        # start from what the last attempt got, which might have been escalated already
+        if last['mem_gb'] and mem_gb:
+            mem_gb = float(last['mem_gb'])
+        if last['time_s'] and time_s:
+            time_s = int(last['time_s'])
+        max_mem_gb, max_time_s = resource_caps(load_cluster_cfg(os.curdir), key[0])
+        mem_gb, time_s, reasons = escalate(mem_gb, time_s, peak_gb, wallclock_s,
+                                           max_mem_gb, max_time_s)
+        if reasons:
+            logger.warning("Attempt %d of %s %s: %s", len(attempts) + 1,
+                           key[0], key[1], ", ".join(reasons))
+        args = rewrite_submit_args(args, mem_gb, time_s)
+
+    # stdout is the job id snakemake needs, so just pass it on
+    proc = subprocess.run(args, stdout=subprocess.PIPE)
+    out = proc.stdout.decode()
+    sys.stdout.write(out)
+    sys.stdout.flush()
+    if out.strip():
+        jid = out.strip().split()[-1]
+        log_submission(SUBMISSIONS_LOG, key, jid, len(attempts) + 1,
+                       mem_gb, time_s, peak_gb, wallclock_s)
+        if proc.returncode != 0:
+            # blocking submission (--cluster-sync): the job itself failed
+            try:
+                scheduler = scheduler_type()
+            except (ValueError, OSError):
+                scheduler = None
+            if scheduler:
+                log_failed_job(FAILED_JOBS_LOG, jid, *attempt_usage(jid, scheduler))
+    sys.exit(proc.returncode)
+
+
+if __name__ == "__main__":
+    main()
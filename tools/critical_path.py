@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""Critical path analysis of a completed analysis: where did the wall
+time go (compute, queue wait, filesystem latency, serial local rules,
+scheduling gaps) and which rules should be scattered, grouped, moved
+to the cluster or retuned. See lib/critpath.py for details.
+"""
+
+#--- standard library imports
+#
+import os
+import sys
+import logging
+import argparse
+from io import StringIO
+
+#--- third-party imports
+#
+import yaml
+
+# --- project specific imports
+#
+# add lib dir for this pipeline installation to PYTHONPATH
+LIB_PATH = os.path.abspath(os.path.join(os.path.dirname(
+    os.path.realpath(__file__)), "..", "lib"))
+if LIB_PATH not in sys.path:
+    sys.path.insert(0, LIB_PATH)
+from benchmarks import jobs_from_snakemake_log
+from benchmarks import benchmark_logs_in_analysis
+from benchmarks import parse_benchmark_log
+from critpath import job_times_from_snakemake_log
+from critpath import analyze
+from critpath import summarize_by_rule
+from critpath import proposals
+from critpath import CATEGORIES
+
+
+__author__ = "Andreas Wilm"
+__email__ = "wilma@gis.a-star.edu.sg"
+__copyright__ = "2017 Genome Institute of Singapore"
+__license__ = "The MIT License (MIT)"
+
+
+# global logger
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(
+    '[{asctime}] {levelname:8s} {filename} {message}', style='{'))
+logger.addHandler(handler)
+
+
+def main():
+    """main function
+    """
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('analysisdir',
+                        help="Completed analysis directory (output dir of pipeline wrapper)")
+    parser.add_argument('-j', "--jobs", action='store_true',
+                        help="Also list individual jobs on the critical path")
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help="Increase verbosity")
+    parser.add_argument('-q', '--quiet', action='count', default=0,
+                        help="Decrease verbosity")
+    args = parser.parse_args()
+
+    # Repeateable -v and -q for setting logging level.
+    # See https://www.reddit.com/r/Python/comments/3nctlm/what_python_tools_should_i_be_using_on_every/
+    # and https://gist.github.com/andreas-wilm/b6031a84a33e652680d4
+    # script -vv -> DEBUG
+    # script -v -> INFO
+    # script -> WARNING
+    # script -q -> ERROR
+    # script -qq -> CRITICAL
+    # script -qqq -> no logging at all
+    logger.setLevel(logging.WARN + 10*args.quiet - 10*args.verbose)
+
+    masterlog = os.path.join(args.analysisdir, "logs", "snakemake.log")
+    if not os.path.exists(masterlog):
+        logger.fatal("Missing snakemake log %s", masterlog)
+        sys.exit(1)
+    jobs = jobs_from_snakemake_log(masterlog)
+    log_start, times = job_times_from_snakemake_log(masterlog)
+
+    benchmarks = dict()
+    for relpath, content in benchmark_logs_in_analysis(args.analysisdir):
+        values = parse_benchmark_log(StringIO(content))
+        if values:
+            benchmarks[os.path.normpath(relpath)] = values
+    logger.info("Parsed %d jobs and %d benchmark logs", len(jobs), len(benchmarks))
+
+    path = analyze(jobs, log_start, times, benchmarks)
+    if not path:
+        logger.fatal("No finished jobs found in %s", masterlog)
+        sys.exit(1)
+
+    cluster_cfg = None
+    cluster_cfgfile = os.path.join(args.analysisdir, "cluster.yaml")
+    if os.path.exists(cluster_cfgfile):
+        with open(cluster_cfgfile) as fh:
+            cluster_cfg = yaml.safe_load(fh)
+
+    totals = dict((c, sum(item['secs'][c] for item in path)) for c in CATEGORIES)
+    total = sum(totals.values())
+    print("Critical path: {} jobs, {:.1f}h".format(len(path), total / 3600.0))
+    for c in CATEGORIES:
+        print("  {:12s}{:10.0f}s {:5.1f}%".format(c, totals[c], 100.0 * totals[c] / total if total else 0))
+
+    if args.jobs:
+        print()
+        print("\t".join(["jobid", "rule", "wildcards"] + CATEGORIES))
+        for item in path:
+            wildcards = ",".join("{}={}".format(k, v) for k, v in sorted(item['wildcards'].items()))
+            print("\t".join([str(item['jobid']), item['rule'], wildcards] +
+                            ["{:.0f}".format(item['secs'][c]) for c in CATEGORIES]))
+
+    rules = summarize_by_rule(path)
+    print()
+    print("\t".join(["rule", "num_jobs"] + CATEGORIES))
+    for rule, r in sorted(rules.items(), key=lambda x: -sum(
+            x[1][c] for c in CATEGORIES if c != 'local') - x[1]['local_s']):
+        print("\t".join([rule, str(r['num_jobs'])] + ["{:.0f}".format(
+            r['local_s'] if c == 'local' else r[c]) for c in CATEGORIES]))
+
+    props = proposals(rules, cluster_cfg)
+    if props:
+        print()
+        print("Proposals:")
+        for rule, action, reason in props:
+            print("  {}: {} ({})".format(rule, action, reason))
+
+
+if __name__ == "__main__":
+    main()
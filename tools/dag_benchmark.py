@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+"""DAG-scale benchmark for the pipelines' Snakefiles.
+
+Synthesizes sample configs of increasing size (with empty dummy
+fastqs), runs the pipeline wrappers with --no-run and then measures
+snakemake's rule parsing (--list) and dry-run DAG construction time as
+well as peak memory. Results can be stored as baseline and later runs
+compared against it. Exits with 1 if regressions were found.
+
+Needs to be run where references and snakemake are available (e.g. on
+the cluster after sourcing the snakemake environment).
+
+Example:
+  dag_benchmark.py -p gatk star-rsem --scales 1:1 96:4608 -b dagbench.yaml --save-baseline
+"""
+
+#--- standard library imports
+#
+import os
+import sys
+import re
+import gzip
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import subprocess
+
+#--- third-party imports
+#
+import yaml
+
+# --- project specific imports
+#
+# add lib dir for this pipeline installation to PYTHONPATH
+LIB_PATH = os.path.abspath(os.path.join(os.path.dirname(
+    os.path.realpath(__file__)), "..", "lib"))
+if LIB_PATH not in sys.path:
+    sys.path.insert(0, LIB_PATH)
+from readunits import ReadUnit
+from readunits import create_rg_id_from_ru
+from readunits import key_for_readunit
+
+
+__author__ = "Andreas Wilm"
+__email__ = "wilma@gis.a-star.edu.sg"
+__copyright__ = "2017 Genome Institute of Singapore"
+__license__ = "The MIT License (MIT)"
+
+
+# only dump() and following do not automatically create aliases
+yaml.Dumper.ignore_aliases = lambda *args: True
+
+
+# global logger
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(
+    '[{asctime}] {levelname:8s} {filename} {message}', style='{'))
+logger.addHandler(handler)
+
+
+PIPELINE_ROOTDIR = os.path.abspath(os.path.join(os.path.dirname(
+    os.path.realpath(__file__)), ".."))
+
+# wrapper (relative to PIPELINE_ROOTDIR), extra wrapper args and
+# fixed sample names (None: any)
+PIPELINES = {
+    'gatk': ("variant-calling/gatk/gatk.py", ['-t', 'WGS'], None),
+    'lacer-lofreq': ("variant-calling/lacer-lofreq/lacer-lofreq.py", ['-t', 'WGS'], None),
+    'lofreq-somatic': ("somatic/lofreq-somatic/lofreq-somatic.py", ['-t', 'WGS'], ['normal', 'tumor']),
+    'mutect': ("somatic/mutect/mutect.py", ['-t', 'WGS'], ['normal', 'tumor']),
+    'BWA-MEM': ("mapping/BWA-MEM/BWA-MEM.py", [], None),
+    'star-rsem': ("rnaseq/star-rsem/star-rsem.py", [], None),
+    'SG10K': ("custom/SG10K/SG10K.py", [], None),
+    'shotgun-metagenomics': ("metagenomics/shotgun-metagenomics/shotgun-metagenomics.py", [], None),
+}
+
+# samples:readunits. largest is what combine_runs_split_sample.py was written for
+DEFAULT_SCALES = ["1:1", "8:64", "96:4608"]
+
+# metrics compared against baseline
+METRICS = ['wrapper_s', 'parse_s', 'dag_s', 'peak_rss_mb']
+# relative increase flagged as regression...
+DEFAULT_TOLERANCE = 0.25
+# ...but only if absolute increase exceeds this (noise)
+MIN_DELTA = {'wrapper_s': 1.0, 'parse_s': 1.0, 'dag_s': 1.0, 'peak_rss_mb': 50.0}
+
+
+def parse_scale(scale):
+    """Parse samples:readunits
+
+    >>> parse_scale("96:4608")
+    (96, 4608)
+    """
+    num_samples, num_units = [int(x) for x in scale.split(":")]
+    assert num_units >= num_samples > 0, ("Need at least one readunit per sample")
+    return num_samples, num_units
+
+
+def synthesize_sample_cfg(workdir, num_samples, num_units, sample_names=None):
+    """Create empty dummy fastqs and a sample config with num_units
+    readunits spread evenly over num_samples samples. Returns config
+    file name
+    """
+    if sample_names:
+        num_samples = len(sample_names)
+    else:
+        sample_names = ["S{:04d}".format(i+1) for i in range(num_samples)]
+    fqdir = os.path.join(workdir, "fastq")
+    os.makedirs(fqdir)
+
+    samples = dict((s, []) for s in sample_names)
+    readunits = dict()
+    for i in range(num_units):
+        sample = sample_names[i % num_samples]
+        lane = i // num_samples % 8 + 1
+        fqs = []
+        for n in [1, 2]:
+            fq = os.path.join(fqdir, "{}_U{:05d}_R{}.fastq.gz".format(sample, i+1, n))
+            gzip.open(fq, 'wb').close()
+            fqs.append(fq)
+        ru = ReadUnit("RUN{:04d}".format(i // (8*num_samples) + 1), "FC0001",
+                      "LIB-{}".format(sample), str(lane), None, fqs[0], fqs[1])
+        ru = ru._replace(rg_id=create_rg_id_from_ru(ru))
+        key = key_for_readunit(ru)
+        readunits[key] = dict(ru._asdict())
+        samples[sample].append(key)
+
+    cfgfile = os.path.join(workdir, "samples.yaml")
+    with open(cfgfile, 'w') as fh:
+        yaml.dump(dict(samples=samples, readunits=readunits), fh, default_flow_style=False)
+    return cfgfile
+
+
+def timed_run(cmd, cwd=None, stdout=subprocess.DEVNULL):
+    """Run command and return tuple of exit status, wall time in
+    seconds and peak memory (max RSS) of the process in MB
+    """
+    start = time.time()
+    proc = subprocess.Popen(cmd, cwd=cwd, stdout=stdout, stderr=subprocess.STDOUT)
+    _, status, rusage = os.wait4(proc.pid, 0)
+    # avoid Popen trying to wait for the already reaped process
+    proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+    # ru_maxrss is in KB on Linux
+    return proc.returncode, time.time() - start, rusage.ru_maxrss / 1024.0
+
+
+def num_jobs_from_dryrun(logfile):
+    """Best guess of DAG size: total of snakemake's job counts table
+    (last line consisting of a number only)
+    """
+    num_jobs = None
+    with open(logfile) as fh:
+        for line in fh:
+            if re.match(r'^\s*\d+\s*$', line):
+                num_jobs = int(line)
+    return num_jobs
+
+
+def benchmark_pipeline(pipeline, num_samples, num_units, workdir, snakemake="snakemake"):
+    """Benchmark one pipeline at one scale. Returns dict of metrics or
+    None on failure
+    """
+    wrapper, extra_args, sample_names = PIPELINES[pipeline]
+    cfgfile = synthesize_sample_cfg(workdir, num_samples, num_units, sample_names)
+    outdir = os.path.join(workdir, "analysis")
+    wrapper_log = os.path.join(workdir, "wrapper.log")
+
+    cmd = [sys.executable, os.path.join(PIPELINE_ROOTDIR, wrapper),
+           '-S', cfgfile, '-o', outdir, '--no-run', '--no-mail'] + extra_args
+    with open(wrapper_log, 'w') as fh:
+        res, wrapper_s, _ = timed_run(cmd, stdout=fh)
+    if res != 0:
+        logger.error("Wrapper for %s failed. See %s", pipeline, wrapper_log)
+        return None
+
+    snakefile = os.path.join(PIPELINE_ROOTDIR, os.path.dirname(wrapper), "Snakefile")
+    sm_args = [snakemake, '-s', snakefile, '--configfile', 'conf.yaml',
+               '--config', 'ANALYSIS_ID=dag_benchmark']
+    # parsing only: --list doesn't build the DAG
+    parse_log = os.path.join(workdir, "snakemake.list.log")
+    with open(parse_log, 'w') as fh:
+        res, parse_s, parse_rss = timed_run(sm_args + ['--list'], cwd=outdir, stdout=fh)
+    if res != 0:
+        logger.error("snakemake --list for %s failed. See %s", pipeline, parse_log)
+        return None
+    dag_log = os.path.join(workdir, "snakemake.dryrun.log")
+    with open(dag_log, 'w') as fh:
+        res, dryrun_s, dag_rss = timed_run(sm_args + ['--dryrun', '--quiet'], cwd=outdir, stdout=fh)
+    if res != 0:
+        logger.error("snakemake --dryrun for %s failed. See %s", pipeline, dag_log)
+        return None
+
+    return {'wrapper_s': wrapper_s, 'parse_s': parse_s,
+            'dag_s': max(0.0, dryrun_s - parse_s),
+            'peak_rss_mb': max(parse_rss, dag_rss),
+            'num_jobs': num_jobs_from_dryrun(dag_log)}
+
+
+def find_regressions(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """Compare results against baseline (both dicts of key to metrics).
+    Returns list of (key, metric, baseline value, new value)
+
+    >>> base = {'gatk/1:1': {'dag_s': 10.0, 'peak_rss_mb': 100.0}}
+    >>> new = {'gatk/1:1': {'dag_s': 20.0, 'peak_rss_mb': 110.0}}
+    >>> find_regressions(new, base)
+    [('gatk/1:1', 'dag_s', 10.0, 20.0)]
+    """
+    regs = []
+    for key, metrics in sorted(results.items()):
+        base = baseline.get(key)
+        if not base:
+            continue
+        for m in METRICS:
+            old, new = base.get(m), metrics.get(m)
+            if old is None or new is None:
+                continue
+            if new > old * (1.0 + tolerance) and new - old > MIN_DELTA[m]:
+                regs.append((key, m, old, new))
+    return regs
+
+
+def main():
+    """main function
+    """
+
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-p', "--pipelines", nargs='+', choices=sorted(PIPELINES),
+                        default=sorted(PIPELINES),
+                        help="Pipelines to benchmark (default: all)")
+    parser.add_argument("--scales", nargs='+', default=DEFAULT_SCALES,
+                        help="Config sizes as samples:readunits (default: {})".format(
+                            " ".join(DEFAULT_SCALES)))
+    parser.add_argument('-b', "--baseline",
+                        help="Baseline file (yaml) to compare against")
+    parser.add_argument("--save-baseline", action='store_true',
+                        help="Write results to baseline file instead of comparing")
+    default = DEFAULT_TOLERANCE
+    parser.add_argument("--tolerance", type=float, default=default,
+                        help="Relative increase reported as regression (default: {})".format(default))
+    default = "snakemake"
+    parser.add_argument("--snakemake", default=default,
+                        help="Snakemake executable (default: {})".format(default))
+    parser.add_argument("--keep", action='store_true',
+                        help="Keep work directories (logs, configs)")
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help="Increase verbosity")
+    parser.add_argument('-q', '--quiet', action='count', default=0,
+                        help="Decrease verbosity")
+    args = parser.parse_args()
+
+    # Repeateable -v and -q for setting logging level.
+    # See https://www.reddit.com/r/Python/comments/3nctlm/what_python_tools_should_i_be_using_on_every/
+    # and https://gist.github.com/andreas-wilm/b6031a84a33e652680d4
+    # script -vv -> DEBUG
+    # script -v -> INFO
+    # script -> WARNING
+    # script -q -> ERROR
+    # script -qq -> CRITICAL
+    # script -qqq -> no logging at all
+    logger.setLevel(logging.WARN + 10*args.quiet - 10*args.verbose)
+
+    if args.save_baseline and not args.baseline:
+        logger.fatal("--save-baseline requires --baseline")
+        sys.exit(1)
+    scales = [parse_scale(s) for s in args.scales]
+
+    results = dict()
+    print("\t".join(["pipeline", "samples", "readunits", "num_jobs"] + METRICS))
+    for pipeline in args.pipelines:
+        for num_samples, num_units in scales:
+            key = "{}/{}:{}".format(pipeline, num_samples, num_units)
+            workdir = tempfile.mkdtemp(prefix="dag_benchmark.{}.".format(pipeline))
+            logger.info("Benchmarking %s in %s", key, workdir)
+            metrics = benchmark_pipeline(pipeline, num_samples, num_units, workdir, args.snakemake)
+            if args.keep or metrics is None:
+                logger.info("Keeping %s", workdir)
+            else:
+                shutil.rmtree(workdir)
+            if metrics is None:
+                continue
+            results[key] = metrics
+            print("\t".join([pipeline, str(num_samples), str(num_units), str(metrics['num_jobs'])]
+                            + ["{:.1f}".format(metrics[m]) for m in METRICS]))
+            sys.stdout.flush()
+
+    if not args.baseline:
+        return
+    if args.save_baseline:
+        baseline = dict()
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as fh:
+                baseline = yaml.safe_load(fh) or dict()
+        baseline.update(results)
+        with open(args.baseline, 'w') as fh:
+            yaml.dump(baseline, fh, default_flow_style=False)
+        logger.info("Baseline written to %s", args.baseline)
+        return
+
+    with open(args.baseline) as fh:
+        baseline = yaml.safe_load(fh)
+    regs = find_regressions(results, baseline, args.tolerance)
+    for key, metric, old, new in regs:
+        logger.warning("Regression in %s: %s %.1f -> %.1f", key, metric, old, new)
+    if regs:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""Report CPU utilization, memory headroom and I/O wait share per rule
+and pipeline version from the benchmark warehouse (see benchmark_db.py
+and lib/efficiency.py), trended across releases.
+
+Rules wasting requested threads (e.g. a single-threaded tool given
+multiple slots), requesting far more memory than used or being I/O
+bound are flagged for their latest pipeline version.
+"""
+
+#--- standard library imports
+#
+import os
+import sys
+import logging
+import argparse
+
+#--- third-party imports
+#
+#/
+
+# --- project specific imports
+#
+# add lib dir for this pipeline installation to PYTHONPATH
+LIB_PATH = os.path.abspath(os.path.join(os.path.dirname(
+    os.path.realpath(__file__)), "..", "lib"))
+if LIB_PATH not in sys.path:
+    sys.path.insert(0, LIB_PATH)
+from benchmarkdb import BenchmarkDB
+from efficiency import efficiency_by_rule_version
+from efficiency import efficiency_flags
+from efficiency import EFFICIENCY_KEYS
+
+
+__author__ = "Andreas Wilm"
+__email__ = "wilma@gis.a-star.edu.sg"
+__copyright__ = "2017 Genome Institute of Singapore"
+__license__ = "The MIT License (MIT)"
+
+
+# global logger
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(
+    '[{asctime}] {levelname:8s} {filename} {message}', style='{'))
+logger.addHandler(handler)
+
+
+def fmt(value):
+    """format report value"""
+    if value is None:
+        return "NA"
+    if isinstance(value, float):
+        return "{:.2f}".format(value)
+    return str(value)
+
+
+def main():
+    """main function
+    """
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-d', "--db", required=True,
+                        help="Benchmark database (see benchmark_db.py)")
+    parser.add_argument('-p', "--pipeline",
+                        help="Restrict report to this pipeline")
+    parser.add_argument('-s', "--site",
+                        help="Restrict report to this site")
+    parser.add_argument('-r', "--rule",
+                        help="Restrict report to this rule")
+    default = 'cpu_util'
+    parser.add_argument('-t', "--trend", choices=EFFICIENCY_KEYS[2:], default=default,
+                        help="Metric to trend across pipeline versions (default: {})".format(default))
+    parser.add_argument('-f', "--flagged-only", action='store_true',
+                        help="Only report flagged rules")
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help="Increase verbosity")
+    parser.add_argument('-q', '--quiet', action='count', default=0,
+                        help="Decrease verbosity")
+    args = parser.parse_args()
+
+    # Repeateable -v and -q for setting logging level.
+    # See https://www.reddit.com/r/Python/comments/3nctlm/what_python_tools_should_i_be_using_on_every/
+    # and https://gist.github.com/andreas-wilm/b6031a84a33e652680d4
+    # script -vv -> DEBUG
+    # script -v -> INFO
+    # script -> WARNING
+    # script -q -> ERROR
+    # script -qq -> CRITICAL
+    # script -qqq -> no logging at all
+    logger.setLevel(logging.WARN + 10*args.quiet - 10*args.verbose)
+
+    if not os.path.exists(args.db):
+        logger.fatal("Non-existing database %s", args.db)
+        sys.exit(1)
+    db = BenchmarkDB(args.db)
+    records = list(db.usage_records(rule=args.rule, pipeline_name=args.pipeline, site=args.site))
+    db.close()
+    if not records:
+        logger.fatal("No benchmark records found")
+        sys.exit(1)
+    versions, summaries = efficiency_by_rule_version(records)
+    rules = sorted(set(k[0] for k in summaries))
+
+    # flags are based on latest version a rule was seen in
+    latest = dict()
+    for rule in rules:
+        version = [v for v in versions if (rule, v) in summaries][-1]
+        latest[rule] = (version, efficiency_flags(summaries[(rule, version)]))
+    if args.flagged_only:
+        rules = [r for r in rules if latest[r][1]]
+
+    print("\t".join(["rule", "pipeline_version"] + EFFICIENCY_KEYS))
+    for rule in rules:
+        for version in versions:
+            if (rule, version) in summaries:
+                s = summaries[(rule, version)]
+                print("\t".join([rule, str(version)] + [fmt(s[k]) for k in EFFICIENCY_KEYS]))
+
+    if len(versions) > 1:
+        print()
+        print("\t".join(["rule"] + [str(v) for v in versions]) + "\t# {}".format(args.trend))
+        for rule in rules:
+            print("\t".join([rule] + [fmt(summaries[(rule, v)][args.trend])
+                                      if (rule, v) in summaries else "-" for v in versions]))
+
+    flagged = [r for r in rules if latest[r][1]]
+    if flagged:
+        print()
+        print("Flagged rules:")
+        for rule in flagged:
+            version, flags = latest[rule]
+            for issue, reason in flags:
+                print("  {} ({}): {}: {}".format(rule, version, issue, reason))
+
+
+if __name__ == "__main__":
+    main()
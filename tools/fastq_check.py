@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""Integrity check, statistics and FastQC for gzipped fastq files in
+one read per file: the gzip stream is validated (like gzip -t), reads,
+bases and MD5 computed and the uncompressed data fed to FastQC through
+a named pipe (see lib/fastqstream.py). FastQC output ends up next to
+each fastq as usual.
+
+Exits non-zero if any file is corrupt or FastQC failed on it.
+"""
+
+#--- standard library imports
+#
+import os
+import sys
+import time
+import errno
+import shutil
+import logging
+import argparse
+import tempfile
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+
+#--- third-party imports
+#
+#/
+
+# --- project specific imports
+#
+# add lib dir for this pipeline installation to PYTHONPATH
+LIB_PATH = os.path.abspath(os.path.join(os.path.dirname(
+    os.path.realpath(__file__)), "..", "lib"))
+if LIB_PATH not in sys.path:
+    sys.path.insert(0, LIB_PATH)
+from fastqstream import check_fastq
+from fastqstream import FastqCheckError
+from fastqstream import STATS_COLS
+
+
+__author__ = "Andreas Wilm"
+__email__ = "wilma@gis.a-star.edu.sg"
+__copyright__ = "2017 Genome Institute of Singapore"
+__license__ = "The MIT License (MIT)"
+
+
+# global logger
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(
+    '[{asctime}] {levelname:8s} {filename} {message}', style='{'))
+logger.addHandler(handler)
+
+
+FASTQC = "fastqc"
+
+# polling interval while waiting for fastqc to open the pipe
+FIFO_WAIT_S = 0.1
+
+
+def fastqc_outputs(fastq):
+    """fastqc output files for given fastq
+
+    >>> fastqc_outputs("out/Sample_A/A_S1_L001_R1_001.fastq.gz")
+    ['out/Sample_A/A_S1_L001_R1_001_fastqc.zip', 'out/Sample_A/A_S1_L001_R1_001_fastqc.html']
+    """
+    prefix = fastq
+    for ext in [".gz", ".fastq", ".fq"]:
+        if prefix.endswith(ext):
+            prefix = prefix[:-len(ext)]
+    return [prefix + "_fastqc.zip", prefix + "_fastqc.html"]
+
+
+def open_fifo_writer(fifo, proc):
+    """Open named pipe for writing once its reader (proc) opened it.
+    Fails instead of blocking forever if proc exits before
+    """
+    while True:
+        try:
+            fd = os.open(fifo, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError as err:
+            if err.errno != errno.ENXIO:
+                raise
+            if proc.poll() is not None:
+                raise FastqCheckError("{} exited with {} before reading {}".format(
+                    FASTQC, proc.returncode, fifo))
+            time.sleep(FIFO_WAIT_S)
+            continue
+        os.set_blocking(fd, True)
+        return fd
+
+
+def check_and_qc(fastq, run_fastqc=True):
+    """Check fastq and optionally run fastqc on it in the same pass.
+    Returns stats (see check_fastq())
+    """
+    if not run_fastqc:
+        return check_fastq(fastq)
+    tmpdir = tempfile.mkdtemp(prefix="fastq_check.")
+    # fastqc names its output after the input, so the pipe is named
+    # like the fastq (minus .gz since data is uncompressed)
+    fifo = os.path.join(tmpdir, os.path.basename(fastq)[:-len(".gz")]
+                        if fastq.endswith(".gz") else os.path.basename(fastq))
+    os.mkfifo(fifo)
+    outdir = os.path.dirname(os.path.abspath(fastq))
+    proc = subprocess.Popen([FASTQC, "-o", outdir, fifo])
+    try:
+        with os.fdopen(open_fifo_writer(fifo, proc), 'wb') as fh:
+            stats = check_fastq(fastq, fh)
+    except FastqCheckError:
+        proc.kill()
+        proc.wait()
+        # don't leave a report on partial data behind
+        for f in fastqc_outputs(fastq):
+            if os.path.exists(f):
+                os.unlink(f)
+        raise
+    except BrokenPipeError:
+        proc.wait()
+        raise FastqCheckError("{} stopped reading {} (exit status {})".format(
+            FASTQC, fastq, proc.returncode))
+    finally:
+        shutil.rmtree(tmpdir)
+    if proc.wait() != 0:
+        raise FastqCheckError("{} failed on {} with exit status {}".format(
+            FASTQC, fastq, proc.returncode))
+    return stats
+
+
+def main():
+    """main function
+    """
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('fastqs', nargs='+', metavar="FASTQ",
+                        help="Gzipped fastq files")
+    default = 1
+    parser.add_argument('-t', "--threads", type=int, default=default,
+                        help="Number of files processed in parallel (default: {})".format(default))
+    parser.add_argument('-s', "--stats",
+                        help="Write per file statistics (TSV) to this file instead of stdout")
+    parser.add_argument('--no-fastqc', action='store_true',
+                        help="Only check files and compute statistics")
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help="Increase verbosity")
+    parser.add_argument('-q', '--quiet', action='count', default=0,
+                        help="Decrease verbosity")
+    args = parser.parse_args()
+
+    # Repeateable -v and -q for setting logging level.
+    # See https://www.reddit.com/r/Python/comments/3nctlm/what_python_tools_should_i_be_using_on_every/
+    # and https://gist.github.com/andreas-wilm/b6031a84a33e652680d4
+    # script -vv -> DEBUG
+    # script -v -> INFO
+    # script -> WARNING
+    # script -q -> ERROR
+    # script -qq -> CRITICAL
+    # script -qqq -> no logging at all
+    logger.setLevel(logging.WARN + 10*args.quiet - 10*args.verbose)
+
+    for f in args.fastqs:
+        if not os.path.exists(f):
+            logger.fatal("Non-existing file %s", f)
+            sys.exit(1)
+
+    results = []
+    num_failed = 0
+    with ProcessPoolExecutor(max_workers=args.threads) as executor:
+        futures = [(f, executor.submit(check_and_qc, f, not args.no_fastqc))
+                   for f in args.fastqs]
+        for f, future in futures:
+            try:
+                results.append(future.result())
+                logger.info("Checked %s", f)
+            except FastqCheckError as err:
+                logger.error(str(err))
+                num_failed += 1
+
+    fh = open(args.stats, 'w') if args.stats else sys.stdout
+    fh.write("\t".join(STATS_COLS) + "\n")
+    for stats in results:
+        fh.write("\t".join(str(stats[k]) for k in STATS_COLS) + "\n")
+    if fh != sys.stdout:
+        fh.close()
+
+    if num_failed:
+        logger.fatal("%d of %d files failed", num_failed, len(args.fastqs))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
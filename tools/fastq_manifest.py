@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""Verify fastqs against the checksum manifest written by the
+bcl2fastq pipeline (see lib/manifest.py). Only stats files, i.e.
+doesn't re-read data. Optionally writes the checksums in md5sum
+format.
+
+Exits non-zero if any file is missing or changed.
+"""
+
+#--- standard library imports
+#
+import os
+import sys
+import logging
+import argparse
+
+#--- third-party imports
+#
+#/
+
+# --- project specific imports
+#
+# add lib dir for this pipeline installation to PYTHONPATH
+LIB_PATH = os.path.abspath(os.path.join(os.path.dirname(
+    os.path.realpath(__file__)), "..", "lib"))
+if LIB_PATH not in sys.path:
+    sys.path.insert(0, LIB_PATH)
+from manifest import MANIFEST
+from manifest import read_manifest
+from manifest import verify_files
+from manifest import write_md5sums
+
+
+__author__ = "Andreas Wilm"
+__email__ = "wilma@gis.a-star.edu.sg"
+__copyright__ = "2017 Genome Institute of Singapore"
+__license__ = "The MIT License (MIT)"
+
+
+# global logger
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(
+    '[{asctime}] {levelname:8s} {filename} {message}', style='{'))
+logger.addHandler(handler)
+
+
+def main():
+    """main function
+    """
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-d', "--dir", required=True,
+                        help="Directory the manifest refers to, e.g. bcl2fastq result dir (out)")
+    parser.add_argument('-m', "--manifest",
+                        help="Manifest (default: {} in dir)".format(MANIFEST))
+    parser.add_argument('--no-mtime', action='store_true',
+                        help="Only check sizes, e.g. for copies not preserving times")
+    parser.add_argument('--md5sums',
+                        help="Write checksums to this file in md5sum format")
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help="Increase verbosity")
+    parser.add_argument('-q', '--quiet', action='count', default=0,
+                        help="Decrease verbosity")
+    args = parser.parse_args()
+
+    # Repeateable -v and -q for setting logging level.
+    # See https://www.reddit.com/r/Python/comments/3nctlm/what_python_tools_should_i_be_using_on_every/
+    # and https://gist.github.com/andreas-wilm/b6031a84a33e652680d4
+    # script -vv -> DEBUG
+    # script -v -> INFO
+    # script -> WARNING
+    # script -q -> ERROR
+    # script -qq -> CRITICAL
+    # script -qqq -> no logging at all
+    logger.setLevel(logging.WARN + 10*args.quiet - 10*args.verbose)
+
+    manifest = args.manifest if args.manifest else os.path.join(args.dir, MANIFEST)
+    if not os.path.exists(manifest):
+        logger.fatal("Non-existing manifest %s", manifest)
+        sys.exit(1)
+    entries = read_manifest(manifest)
+
+    problems = verify_files(entries, args.dir, check_mtime=not args.no_mtime)
+    for p in problems:
+        logger.error(p)
+    if problems:
+        logger.fatal("%d of %d files failed verification", len(problems), len(entries))
+        sys.exit(1)
+    logger.info("All %d files in %s verified", len(entries), manifest)
+
+    if args.md5sums:
+        write_md5sums(entries, args.md5sums)
+
+
+if __name__ == "__main__":
+    main()
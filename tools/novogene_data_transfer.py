@@ -32,6 +32,11 @@ from utils import generate_timestamp
 from config import novogene_conf
 from config import rest_services
 from readunits import readunits_for_sampledir
+from manifest import MANIFEST
+from manifest import read_manifest
+from manifest import subdir_entries
+from manifest import verify_files
+from manifest import write_md5sums
 
 __author__ = "Lavanya Veeravalli"
 __email__ = "veeravallil@gis.a-star.edu.sg"
@@ -178,6 +183,23 @@ def get_mux_details(run_number, mux_id, fastq_dest):
     return {'samples': samples_dict,
         'readunits': readunits_dict}
 
+def verify_transfer(bcl_path, mux, fastq_dest):
+    """Verify copied fastqs against the checksum manifest of the run
+    and leave md5sums next to them, so that nobody needs to re-hash.
+    Returns list of problems (empty if all good or no manifest)
+    """
+    manifest = os.path.join(bcl_path, "out", MANIFEST)
+    if not os.path.exists(manifest):
+        logger.warning("No manifest %s: can't verify transfer", manifest)
+        return []
+    project_dir = "Project_" + mux
+    entries = subdir_entries(read_manifest(manifest), project_dir)
+    # rsync -a preserves times, so mtime can be checked as well
+    problems = verify_files(entries, os.path.join(fastq_dest, project_dir))
+    if not problems:
+        write_md5sums(entries, os.path.join(fastq_dest, project_dir, "md5sum.txt"))
+    return problems
+
 def start_data_transfer(connection, mux, mux_info, site, mail_to):
     """ Data transfer from source to destination
     """
@@ -215,6 +237,14 @@ def start_data_transfer(connection, mux, mux_info, site, mail_to):
             #Delete the partial info being rsync
             update_downstream_mux(connection, run_number, analysis_id, downstream_id, "ERROR")
             sys.exit(1)
+        problems = verify_transfer(bcl_path, mux, fastq_dest)
+        if problems:
+            body = "Copied data doesn't match checksum manifest:\n" + "\n".join(problems)
+            subject = "{} from {}: SG10K data transfer ({}) failed".format(mux, run_number, site)
+            logger.fatal(body)
+            send_mail(subject, body, toaddr=mail_to, ccaddr=None)
+            update_downstream_mux(connection, run_number, analysis_id, downstream_id, "ERROR")
+            sys.exit(1)
         #Update the mongoDB for successful data transfer
         sample_info = get_mux_details(run_number, mux, fastq_dest)
         #Touch rsync complete file
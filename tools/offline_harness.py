@@ -0,0 +1,729 @@
+#!/usr/bin/env python3
+"""Offline performance harness for cron tools and wrapper helpers
+
+Brings up local stand-ins for the services the framework talks to and
+drives the tools through scaled-up workloads, reporting run times:
+
+- ELM REST stub (run_details, lib_details, user_mail_mapper and
+  upload endpoints) serving synthesized runs
+- SMTP sink counting mails
+- Fake qsub/qstat/qacct on PATH (SGE flavour)
+- Local mongod seeded with synthesized runcomplete and pipeline_runs
+  documents (optional: needs mongod and pymongo, or --mongo-uri)
+
+All tools run with a generated etc dir (via RPD_ETC) as production
+user, but with their dry-run options where available. The exception
+is bcl2fastq_starter_launch, which runs two overlapping starters for
+real against a stub bcl2fastq wrapper and checks that each pending
+run is launched exactly once and logged in launches.tsv, and
+pipeline_wrapper, which runs a pipeline wrapper (BWA-MEM) end to end:
+config, cluster config, run.sh and jobscript are generated and run.sh
+is submitted to the fake qsub. Nothing leaves the machine.
+
+Example:
+  offline_harness.py -w /tmp/harness --scales 10 100 1000 -r 3
+"""
+
+#--- standard library imports
+#
+import os
+import sys
+import glob
+import gzip
+import time
+import json
+import shutil
+import socket
+import logging
+import argparse
+import tempfile
+import functools
+import threading
+import subprocess
+import socketserver
+from http.server import HTTPServer
+from http.server import BaseHTTPRequestHandler
+from collections import Counter
+
+#--- third-party imports
+#
+import yaml
+
+#--- project specific imports
+#
+#/
+
+
+__author__ = "Andreas Wilm"
+__email__ = "wilma@gis.a-star.edu.sg"
+__copyright__ = "2017 Genome Institute of Singapore"
+__license__ = "The MIT License (MIT)"
+
+
+# global logger
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(
+    '[{asctime}] {levelname:8s} {filename} {message}', style='{'))
+logger.addHandler(handler)
+
+
+PIPELINE_ROOTDIR = os.path.abspath(os.path.join(os.path.dirname(
+    os.path.realpath(__file__)), ".."))
+
+DEFAULT_SCALES = [10, 100, 1000]
+DEFAULT_REPEATS = 3
+
+SITE = "GIS"
+MACHINE_ID = "HS001"
+NUM_LANES = 8
+
+# fake SGE. jobs are kept one per line in $RPD_FAKE_SGE/jobs as "jid name".
+# if RPD_FAKE_SGE_LATENCY is set, the jobscript (last argument) is run
+# in the background after that many seconds, e.g. to test queue
+# latency tracking (see lib/queuelatency.py)
+FAKE_QSUB = """#!/bin/bash
+d=${RPD_FAKE_SGE:?}
+exec 9>>$d/jobs.lock
+flock 9
+jid=$(( $(cat $d/last_jid 2>/dev/null || echo 1000) + 1 ))
+echo $jid > $d/last_jid
+name=job
+script=${@: -1}
+while [ $# -gt 0 ]; do
+    [ "$1" == "-N" ] && name=$2
+    shift
+done
+echo "$jid $name" >> $d/jobs
+if [ -n "$RPD_FAKE_SGE_LATENCY" ] && [ -f "$script" ]; then
+    (sleep $RPD_FAKE_SGE_LATENCY; JOB_ID=$jid QUEUE=fake.q bash "$script") </dev/null &>/dev/null 9>&- &
+fi
+echo "Your job $jid (\\"$name\\") has been submitted"
+"""
+
+FAKE_QSTAT = """#!/bin/bash
+d=${RPD_FAKE_SGE:?}
+[ "$1" == "--version" ] && exit 1
+echo "job-ID  prior   name       user         state submit/start at     queue                          slots ja-task-ID"
+echo "-----------------------------------------------------------------------------------------------------------------"
+[ -e $d/jobs ] || exit 0
+while read jid name; do
+    printf " %s 0.50500 %-10.10s userrig      r     %s production.q@fake 1\\n" $jid $name "$(date +'%m/%d/%Y %H:%M:%S')"
+done < $d/jobs
+"""
+
+FAKE_QACCT = """#!/bin/bash
+echo "jobnumber    ${2:-0}"
+echo "failed       0"
+echo "exit_status  0"
+"""
+
+# files generated by a pipeline wrapper (see lib/pipelines.py) relative
+# to its output directory
+WRAPPER_OUTPUT_FILES = ["run.sh", "jobscript.sh", "cluster.yaml", "conf.yaml",
+                        os.path.join("logs", "submission.log")]
+
+# stand-in for bcl2fastq.py next to (a symlink of) bcl2fastq_starter.py:
+# records launched runs (one per line) and takes a moment like qsub
+STUB_BCL2FASTQ_WRAPPER = """#!/bin/bash
+while [ $# -gt 0 ]; do
+    [ "$1" == "-r" ] && run=$2
+    shift
+done
+sleep 0.2
+echo $run >> {launched}
+echo "Submitted $run"
+"""
+
+
+def free_port():
+    """Returns a free local TCP port"""
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def run_num_for(i):
+    """Run number of i-th synthesized run
+
+    >>> run_num_for(7)
+    'HS001-PE-R00007'
+    """
+    return "{}-PE-R{:05d}".format(MACHINE_ID, i)
+
+
+def barcode_for(i):
+    """Unique 8bp barcode for i-th library of a MUX
+
+    >>> barcode_for(0), barcode_for(5)
+    ('AAAAAAAA', 'AAAAAACC')
+    """
+    bases = "ACGT"
+    bc = ""
+    for _ in range(8):
+        bc = bases[i % 4] + bc
+        i //= 4
+    return bc
+
+
+def synthesize_run_details(run_num, libs_per_mux):
+    """ELM run_details record: one MUX per lane with libs_per_mux
+    libraries and a requestor each
+
+    >>> rd = synthesize_run_details("HS001-PE-R00001", 3)
+    >>> len(rd['lanes']), len(rd['lanes'][0]['Children']), rd['lanes'][1]['requestor']
+    (8, 3, 'user2')
+    """
+    lanes = []
+    for lane in range(1, NUM_LANES+1):
+        mux_id = "MUX{:05d}".format(lane)
+        children = [{'libraryId': "{}-{:04d}".format(mux_id, i+1),
+                     'barcode': barcode_for(i), 'libtech': "Illumina TruSeq"}
+                    for i in range(libs_per_mux)]
+        lanes.append({'laneId': str(lane), 'libraryId': mux_id, 'libtech': "Illumina TruSeq",
+                      'requestor': "user{}".format(lane), 'Children': children})
+    return {'runId': run_num, 'runPass': 'Pass', 'lanes': lanes}
+
+
+class RestStubHandler(BaseHTTPRequestHandler):
+    """Answers ELM endpoints. Run details are synthesized with
+    server.libs_per_mux libraries per MUX
+    """
+
+    def _reply(self, data, status=200):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def _count(self, endpoint):
+        with self.server.lock:
+            self.server.counts[endpoint] = self.server.counts.get(endpoint, 0) + 1
+
+
+    def do_GET(self):
+        """GET endpoints"""
+        parts = self.path.strip("/").split("/")
+        endpoint = parts[0]
+        self._count(endpoint)
+        if endpoint == 'run_details' and len(parts) == 2:
+            self._reply(synthesize_run_details(parts[1], self.server.libs_per_mux))
+        elif endpoint == 'lib_details' and len(parts) == 2:
+            self._reply({'libraryId': parts[1], 'plexes': [
+                {'libraryId': "{}-{:04d}".format(parts[1], i+1)}
+                for i in range(self.server.libs_per_mux)]})
+        elif endpoint == 'user_mail_mapper' and len(parts) == 2:
+            # mimic AD lookup latency
+            time.sleep(self.server.latency)
+            self._reply({'userEmail': "{}@localhost".format(parts[1])})
+        else:
+            self._reply({'error': 'unknown endpoint'}, 404)
+
+
+    def do_POST(self):
+        """upload endpoints"""
+        endpoint = self.path.strip("/").split("/")[0]
+        self._count(endpoint)
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+        self._reply({'status': 'OK'})
+
+
+    def log_message(self, format, *args):
+        logger.debug("REST stub: " + format, *args)
+
+
+class SmtpSinkHandler(socketserver.StreamRequestHandler):
+    """Minimal SMTP server accepting and counting all mails"""
+
+    def _send(self, line):
+        self.wfile.write((line + "\r\n").encode())
+
+
+    def handle(self):
+        self._send("220 localhost SMTP sink")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            cmd = line.decode(errors='replace').strip().upper()
+            if cmd.startswith("DATA"):
+                self._send("354 End data with <CR><LF>.<CR><LF>")
+                for data in iter(self.rfile.readline, b''):
+                    if data.rstrip(b"\r\n") == b".":
+                        break
+                with self.server.lock:
+                    self.server.counts['mails'] = self.server.counts.get('mails', 0) + 1
+                self._send("250 OK")
+            elif cmd.startswith("QUIT"):
+                self._send("221 Bye")
+                return
+            else:
+                # EHLO, HELO, MAIL, RCPT, RSET, NOOP
+                self._send("250 OK")
+
+
+def start_server(server_class, handler_class, **attrs):
+    """Start server on free local port in a daemon thread"""
+    server = server_class(('127.0.0.1', 0), handler_class)
+    server.lock = threading.Lock()
+    server.counts = dict()
+    for k, v in attrs.items():
+        setattr(server, k, v)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    """Threaded HTTP server"""
+    daemon_threads = True
+
+
+class ThreadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """Threaded TCP server"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def write_etc(etcdir, workdir, rest_port, smtp_port, mongo_uri):
+    """Write config files pointing at the stand-ins"""
+    os.makedirs(etcdir)
+    rest_base = "http://127.0.0.1:{}".format(rest_port)
+    rest = dict()
+    for endpoint, template in [('run_details', 'run_details/run_num'),
+                               ('lib_details', 'lib_details/lib_id'),
+                               ('user_mail_mapper', 'user_mail_mapper/'),
+                               ('sra_upload', 'sra_upload'),
+                               ('stats_upload', 'stats_upload')]:
+        url = "{}/{}".format(rest_base, template)
+        rest[endpoint] = {'production': url, 'testing': url}
+    site = {'name': SITE,
+            'smtp_server': "127.0.0.1:{}".format(smtp_port),
+            'init': "/dev/null",
+            'master_submission_cmd': "qsub",
+            'snakemake_env': "snakemake",
+            'default_master_q': {'enduser': 'fake.q', 'production': 'fake.q'},
+            'default_slave_q': {'enduser': 'fake.q', 'production': 'fake.q'},
+            'bcl2fastq_seqdir_base': os.path.join(workdir, "seq"),
+            'bcl2fastq_outdir_base': {'devel': os.path.join(workdir, "out", "bcl2fastq"),
+                                      'production': os.path.join(workdir, "out", "bcl2fastq")},
+            'downstream_outdir_base': {'devel': os.path.join(workdir, "out", "downstream"),
+                                       'production': os.path.join(workdir, "out", "downstream")}}
+    bcl2fastq = {'non_bcl_tech': ["Nanopore"],
+                 'non_mux_tech': ["10X Chromium"],
+                 'tool': {"Smart-seq": "bcl2fastq"},
+                 'minReadLength': 36,
+                 'bcl2fastq_custom_args': {
+                     'indexreads': "--create-fastq-for-index-reads",
+                     'minReadLength': ["--minimum-trimmed-read-length",
+                                       "--mask-short-adapter-reads"]}}
+    bcl2fastq_qc = {'email': "rpd@localhost",
+                    'min-pf-cluster-in-mil': {'HiSeq': 100},
+                    'min-pf-clusters': {'HiSeq': 80},
+                    'min-percent-perfect-barcode': 80,
+                    'min-percent-q30-bases': {'HiSeq': 75},
+                    'min-lane-yield-gb': {'HiSeq': 20},
+                    'max-percent-undetermined': 20}
+    mongo = {'test': mongo_uri or "mongodb://127.0.0.1:1/",
+             'production': mongo_uri or "mongodb://127.0.0.1:1/"}
+    for name, cfg in [('site.yaml', site), ('rest.yaml', rest), ('mongo.yaml', mongo),
+                      ('bcl2fastq.yaml', bcl2fastq), ('bcl2fastq_qc.yaml', bcl2fastq_qc),
+                      ('legacy_wrapper.yaml', dict()), ('novogene.yaml', dict())]:
+        with open(os.path.join(etcdir, name), 'w') as fh:
+            yaml.dump(cfg, fh, default_flow_style=False)
+
+
+def write_fake_cluster(bindir):
+    """Write fake qsub, qstat and qacct"""
+    os.makedirs(bindir)
+    for name, script in [('qsub', FAKE_QSUB), ('qstat', FAKE_QSTAT), ('qacct', FAKE_QACCT)]:
+        path = os.path.join(bindir, name)
+        with open(path, 'w') as fh:
+            fh.write(script)
+        os.chmod(path, 0o755)
+
+
+def write_starter_stub(stubdir, launched):
+    """bcl2fastq_starter.py symlinked into stubdir next to a stub
+    wrapper recording launched runs in file launched. Returns path of
+    starter
+    """
+    os.makedirs(stubdir)
+    starter = os.path.join(stubdir, "bcl2fastq_starter.py")
+    # realpath of the symlink points to the real lib dir
+    os.symlink(os.path.join(PIPELINE_ROOTDIR, "bcl2fastq", "bcl2fastq_starter.py"), starter)
+    wrapper = os.path.join(stubdir, "bcl2fastq.py")
+    with open(wrapper, 'w') as fh:
+        fh.write(STUB_BCL2FASTQ_WRAPPER.format(launched=launched))
+    os.chmod(wrapper, 0o755)
+    return starter
+
+
+def check_launches(launched, lock_dir, num_runs):
+    """Check that each of the num_runs pending runs was launched
+    exactly once (as recorded by the stub wrapper) and logged as such
+    in launches.tsv. Returns error message or None
+    """
+    counts = Counter()
+    if os.path.exists(launched):
+        with open(launched) as fh:
+            counts = Counter(line.strip() for line in fh if line.strip())
+    if len(counts) != num_runs:
+        return "{} of {} runs launched".format(len(counts), num_runs)
+    multi = sorted(r for r, n in counts.items() if n > 1)
+    if multi:
+        return "Runs launched more than once: {}".format(" ".join(multi))
+    tsv = os.path.join(lock_dir, "launches.tsv")
+    if not os.path.exists(tsv):
+        return "Missing {}".format(tsv)
+    with open(tsv) as fh:
+        logged = Counter(line.split("\t")[0] for line in fh if line.split("\t")[1:2] == ["LAUNCHED"])
+    if logged != counts:
+        return "launches.tsv doesn't match launched runs"
+    return None
+
+
+def seed_fake_jobs(sgedir, num_jobs):
+    """Reset fake SGE to num_jobs running jobs"""
+    if os.path.exists(sgedir):
+        shutil.rmtree(sgedir)
+    os.makedirs(sgedir)
+    with open(os.path.join(sgedir, "jobs"), 'w') as fh:
+        for i in range(num_jobs):
+            fh.write("{} job{}\n".format(2000+i, i))
+    with open(os.path.join(sgedir, "last_jid"), 'w') as fh:
+        fh.write("{}\n".format(2000+num_jobs))
+
+
+def synthesize_rundirs(seqdir, num_runs):
+    """Create minimal run folders (RunInfo.xml only). Returns list of
+    rundirs
+    """
+    runinfo = """<?xml version="1.0"?>
+<RunInfo Version="2">
+  <Run Id="{run}" Number="1">
+    <Flowcell>{fc}</Flowcell>
+    <Reads>
+      <Read Number="1" NumCycles="151" IsIndexedRead="N" />
+      <Read Number="2" NumCycles="8" IsIndexedRead="Y" />
+      <Read Number="3" NumCycles="8" IsIndexedRead="Y" />
+      <Read Number="4" NumCycles="151" IsIndexedRead="N" />
+    </Reads>
+  </Run>
+</RunInfo>
+"""
+    rundirs = []
+    for i in range(1, num_runs+1):
+        fc = "AC{:05d}XX".format(i)
+        rundir = os.path.join(seqdir, MACHINE_ID, "{}_{}".format(run_num_for(i), fc))
+        os.makedirs(rundir, exist_ok=True)
+        with open(os.path.join(rundir, "RunInfo.xml"), 'w') as fh:
+            fh.write(runinfo.format(run=run_num_for(i), fc=fc))
+        rundirs.append(rundir)
+    return rundirs
+
+
+def synthesize_analysis_input(inputdir, num_readunits):
+    """Create tiny reference and num_readunits empty fastq pairs of one
+    sample. Returns sample config and references config
+    """
+    os.makedirs(inputdir)
+    reffa = os.path.join(inputdir, "ref.fa")
+    with open(reffa, 'w') as fh:
+        fh.write(">chr1\n{}\n".format("ACGT" * 25))
+    with open(reffa + ".fai", 'w') as fh:
+        fh.write("chr1\t100\t6\t100\t101\n")
+    refs_cfg = os.path.join(inputdir, "references.yaml")
+    with open(refs_cfg, 'w') as fh:
+        yaml.dump({'genome': reffa}, fh, default_flow_style=False)
+    readunits = dict()
+    for i in range(num_readunits):
+        ru = {'run_id': run_num_for(1), 'flowcell_id': "AC00001XX",
+              'library_id': "MUX00001-0001", 'lane_id': str(i % NUM_LANES + 1),
+              'rg_id': "rg{}".format(i)}
+        for key in ['fq1', 'fq2']:
+            ru[key] = os.path.join(inputdir, "{}_{}.fastq.gz".format(i, key[-1]))
+            with gzip.open(ru[key], 'wb'):
+                pass
+        readunits["ru{}".format(i)] = ru
+    sample_cfg = os.path.join(inputdir, "sample.yaml")
+    with open(sample_cfg, 'w') as fh:
+        yaml.dump({'samples': {'sample': sorted(readunits)}, 'readunits': readunits},
+                  fh, default_flow_style=False)
+    return sample_cfg, refs_cfg
+
+
+def check_wrapper_outputs(analysis_base, num_analyses):
+    """Check that num_analyses pipeline wrapper runs in analysis_base
+    generated all files, a syntactically valid run.sh and submitted it
+    to the fake qsub. Returns error message or None
+    """
+    outdirs = glob.glob(os.path.join(analysis_base, "analysis.*"))
+    if len(outdirs) != num_analyses:
+        return "{} of {} analysis directories created".format(len(outdirs), num_analyses)
+    for outdir in outdirs:
+        for f in WRAPPER_OUTPUT_FILES:
+            if not os.path.exists(os.path.join(outdir, f)):
+                return "Missing {} in {}".format(f, outdir)
+        if subprocess.call(['bash', '-n', os.path.join(outdir, "run.sh")]) != 0:
+            return "Syntax error in {}".format(os.path.join(outdir, "run.sh"))
+        with open(os.path.join(outdir, "jobscript.sh")) as fh:
+            # placeholder left for snakemake
+            if "{exec_job}" not in fh.read():
+                return "No job placeholder in {}".format(os.path.join(outdir, "jobscript.sh"))
+        with open(os.path.join(outdir, "logs", "submission.log")) as fh:
+            if "has been submitted" not in fh.read():
+                return "run.sh in {} not submitted".format(outdir)
+    return None
+
+
+def start_mongod(workdir, mongod="mongod"):
+    """Start local mongod. Returns process and connection URI"""
+    dbpath = os.path.join(workdir, "mongodb")
+    os.makedirs(dbpath)
+    port = free_port()
+    logfile = os.path.join(workdir, "mongod.log")
+    proc = subprocess.Popen([mongod, '--dbpath', dbpath, '--port', str(port),
+                             '--bind_ip', '127.0.0.1', '--logpath', logfile])
+    uri = "mongodb://127.0.0.1:{}/".format(port)
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return proc, uri
+        except OSError:
+            time.sleep(0.1)
+    proc.terminate()
+    raise OSError("mongod didn't come up. See {}".format(logfile))
+
+
+def seed_mongo(uri, workdir, num_docs):
+    """Replace gisds collections with num_docs synthesized documents
+    each: runs waiting for bcl2fastq, runs being processed and
+    downstream analyses
+    """
+    import pymongo
+    conn = pymongo.MongoClient(uri)
+    db = conn.gisds
+    now_ms = int(time.time()) * 1000 - 60 * 1000
+    db.runcomplete.drop()
+    db.pipeline_runs.drop()
+    docs = []
+    for i in range(1, num_docs+1):
+        docs.append({'run': run_num_for(i), 'timestamp': now_ms})
+        docs.append({'run': run_num_for(num_docs+i), 'timestamp': now_ms,
+                     'analysis': [{'analysis_id': "2017-01-01T00:00:00.000000+00:00",
+                                   'Status': "STARTED",
+                                   'out_dir': os.path.join(workdir, "out", "bcl2fastq", str(i))}]})
+    db.runcomplete.insert_many(docs)
+    docs = []
+    for i in range(1, num_docs+1):
+        docs.append({'ctime': now_ms, 'site': SITE, 'requestor': "user{}".format(i % 10),
+                     'pipeline_name': "gatk", 'pipeline_version': "current",
+                     'execution': {'status': "STARTED",
+                                   'out_dir': os.path.join(workdir, "out", "downstream", str(i))}})
+    db.pipeline_runs.insert_many(docs)
+    db.runcomplete.create_index('run')
+    conn.close()
+
+
+def workloads(workdir, scale, repeats):
+    """List of (name, command, needs mongo, check) for given scale.
+    check is None or a function called after all repeats, returning
+    an error message or None
+    """
+    bcl2fastq_dir = os.path.join(PIPELINE_ROOTDIR, "bcl2fastq")
+    tools_dir = os.path.join(PIPELINE_ROOTDIR, "tools")
+    py = sys.executable
+    samplesheet_dir = os.path.join(workdir, "samplesheets")
+    os.makedirs(samplesheet_dir, exist_ok=True)
+    rundir = synthesize_rundirs(os.path.join(workdir, "seq"), 1)[0]
+    # real launches: fresh lock dir per scale, as run numbers repeat across scales
+    launchdir = os.path.join(workdir, "launches.{}".format(scale))
+    launched = os.path.join(launchdir, "launched.txt")
+    lock_dir = os.path.join(launchdir, "locks")
+    starter = write_starter_stub(os.path.join(launchdir, "bin"), launched)
+    starter_cmd = " ".join([py, starter, '-t', '-j', '8', '--lock-dir', lock_dir])
+    # wrapper run per repeat, each into a new output directory
+    analysis_base = os.path.join(workdir, "analyses.{}".format(scale))
+    sample_cfg, refs_cfg = synthesize_analysis_input(os.path.join(analysis_base, "input"), scale)
+    wrapper_cmd = " ".join([py, os.path.join(PIPELINE_ROOTDIR, "mapping", "BWA-MEM", "BWA-MEM.py"),
+                            '-S', sample_cfg, '--references-cfg', refs_cfg,
+                            '-o', '$(mktemp -u -d {}/analysis.XXXXXX)'.format(analysis_base)])
+    return [
+        ('generate_bcl2fastq_cfg',
+         [py, os.path.join(bcl2fastq_dir, "generate_bcl2fastq_cfg.py"),
+          '-r', rundir, '-o', samplesheet_dir, '--force-overwrite'], False, None),
+        ('qstat_cache',
+         [py, os.path.join(tools_dir, "qstat_cache.py"), '--once',
+          '-c', os.path.join(workdir, "qstat_cache.json")], False, None),
+        ('cluster_status',
+         [py, os.path.join(tools_dir, "cluster_status.py"), str(2000 + scale // 2)], False, None),
+        ('bcl2fastq_starter',
+         [py, os.path.join(bcl2fastq_dir, "bcl2fastq_starter.py"), '-t', '-n'], True, None),
+        # two overlapping cron invocations. repeats must not launch again
+        ('bcl2fastq_starter_launch',
+         ['bash', '-c', "{0} & p=$!; {0}; r=$?; wait $p && exit $r".format(starter_cmd)], True,
+         functools.partial(check_launches, launched, lock_dir, scale)),
+        ('bcl2fastq_dbupdate',
+         [py, os.path.join(bcl2fastq_dir, "bcl2fastq_dbupdate.py"), '-t', '-n'], True, None),
+        ('downstream_handler',
+         [py, os.path.join(PIPELINE_ROOTDIR, "downstream-handlers", "downstream_handler.py"),
+          '-t', '-n'], True, None),
+        ('pipeline_wrapper',
+         ['bash', '-c', wrapper_cmd], False,
+         functools.partial(check_wrapper_outputs, analysis_base, repeats)),
+    ]
+
+
+def main():
+    """main function
+    """
+
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-w', "--workdir",
+                        help="Work directory (default: new temporary directory, removed at exit)")
+    parser.add_argument("--scales", type=int, nargs='+', default=DEFAULT_SCALES,
+                        help="Workload sizes: DB documents, cluster jobs and"
+                        " libraries per MUX (default: {})".format(
+                            " ".join(str(s) for s in DEFAULT_SCALES)))
+    default = DEFAULT_REPEATS
+    parser.add_argument('-r', "--repeats", type=int, default=default,
+                        help="Repeats per workload (default: {})".format(default))
+    parser.add_argument('-l', "--workloads", nargs='+',
+                        help="Only run these workloads")
+    default = 0.05
+    parser.add_argument("--rest-latency", type=float, default=default,
+                        help="Simulated latency of user_mail_mapper in seconds (default: {})".format(default))
+    mongo_group = parser.add_mutually_exclusive_group()
+    mongo_group.add_argument("--mongod",
+                             help="Start this mongod binary (skips DB workloads if not given)")
+    mongo_group.add_argument("--mongo-uri",
+                             help="Use this (throwaway!) MongoDB instead of starting one")
+    parser.add_argument('-o', "--report",
+                        help="Also write report as yaml to this file")
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help="Increase verbosity")
+    parser.add_argument('-q', '--quiet', action='count', default=0,
+                        help="Decrease verbosity")
+    args = parser.parse_args()
+
+    # Repeateable -v and -q for setting logging level.
+    # See https://www.reddit.com/r/Python/comments/3nctlm/what_python_tools_should_i_be_using_on_every/
+    # and https://gist.github.com/andreas-wilm/b6031a84a33e652680d4
+    # script -vv -> DEBUG
+    # script -v -> INFO
+    # script -> WARNING
+    # script -q -> ERROR
+    # script -qq -> CRITICAL
+    # script -qqq -> no logging at all
+    logger.setLevel(logging.WARN + 10*args.quiet - 10*args.verbose)
+
+    if args.workdir:
+        workdir = os.path.abspath(args.workdir)
+        if os.path.exists(workdir):
+            logger.fatal("Work directory %s already exists", workdir)
+            sys.exit(1)
+        os.makedirs(workdir)
+    else:
+        workdir = tempfile.mkdtemp(prefix="offline_harness.")
+    logger.info("Using work directory %s", workdir)
+
+    rest = start_server(ThreadingHTTPServer, RestStubHandler,
+                        libs_per_mux=1, latency=args.rest_latency)
+    smtp = start_server(ThreadingTCPServer, SmtpSinkHandler)
+    mongod_proc = None
+    mongo_uri = args.mongo_uri
+    if args.mongod:
+        mongod_proc, mongo_uri = start_mongod(workdir, args.mongod)
+    if not mongo_uri:
+        logger.warning("No MongoDB given: skipping DB workloads")
+
+    etcdir = os.path.join(workdir, "etc")
+    write_etc(etcdir, workdir, rest.server_address[1], smtp.server_address[1], mongo_uri)
+    bindir = os.path.join(workdir, "bin")
+    write_fake_cluster(bindir)
+    sgedir = os.path.join(workdir, "sge")
+    logdir = os.path.join(workdir, "logs")
+    os.makedirs(logdir)
+
+    env = dict(os.environ)
+    env.update({'RPD_ETC': etcdir,
+                'PATH': bindir + os.pathsep + env.get('PATH', ''),
+                'RPD_FAKE_SGE': sgedir,
+                'RPD_QSTAT': os.path.join(bindir, "qstat"),
+                'RPD_QACCT': os.path.join(bindir, "qacct"),
+                'RPD_QSTAT_CACHE': os.path.join(workdir, "qstat_cache.json"),
+                'RPD_EVENT_JOURNAL': os.path.join(workdir, "events.jsonl"),
+                'USER': "userrig", 'LOGNAME': "userrig"})
+
+    report = []
+    print("\t".join(["workload", "scale", "status", "min_s", "median_s", "max_s",
+                     "rest_calls", "mails", "jobs_submitted"]))
+    try:
+        for scale in args.scales:
+            rest.libs_per_mux = scale
+            seed_fake_jobs(sgedir, scale)
+            if mongo_uri:
+                seed_mongo(mongo_uri, workdir, scale)
+            for name, cmd, needs_mongo, check in workloads(workdir, scale, args.repeats):
+                if args.workloads and name not in args.workloads:
+                    continue
+                if needs_mongo and not mongo_uri:
+                    continue
+                rest.counts.clear()
+                smtp.counts.clear()
+                jobs_before = sum(1 for _ in open(os.path.join(sgedir, "jobs")))
+                times = []
+                status = "OK"
+                for i in range(args.repeats):
+                    logfile = os.path.join(logdir, "{}.{}.{}.log".format(name, scale, i+1))
+                    with open(logfile, 'w') as fh:
+                        start = time.time()
+                        res = subprocess.call(cmd, stdout=fh, stderr=subprocess.STDOUT, env=env)
+                        times.append(time.time() - start)
+                    if res != 0:
+                        logger.warning("%s failed with exit status %d. See %s", name, res, logfile)
+                        status = "FAILED"
+                        break
+                if status == "OK" and check:
+                    err = check()
+                    if err:
+                        logger.warning("%s check failed: %s", name, err)
+                        status = "FAILED"
+                times.sort()
+                num_runs = len(times)
+                jobs_after = sum(1 for _ in open(os.path.join(sgedir, "jobs")))
+                rec = {'workload': name, 'scale': scale, 'status': status,
+                       'min_s': times[0], 'median_s': times[num_runs//2], 'max_s': times[-1],
+                       'rest_calls': sum(rest.counts.values()) // num_runs,
+                       'mails': smtp.counts.get('mails', 0) // num_runs,
+                       'jobs_submitted': (jobs_after - jobs_before) // num_runs}
+                report.append(rec)
+                print("\t".join([name, str(scale), status] +
+                                ["{:.2f}".format(rec[k]) for k in ['min_s', 'median_s', 'max_s']] +
+                                [str(rec[k]) for k in ['rest_calls', 'mails', 'jobs_submitted']]))
+                sys.stdout.flush()
+    finally:
+        rest.shutdown()
+        smtp.shutdown()
+        if mongod_proc:
+            mongod_proc.terminate()
+            mongod_proc.wait()
+        if not args.workdir:
+            shutil.rmtree(workdir)
+
+    if args.report:
+        with open(args.report, 'w') as fh:
+            yaml.dump(report, fh, default_flow_style=False)
+
+
+if __name__ == "__main__":
+    main()
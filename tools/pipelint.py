@@ -12,6 +12,9 @@ import glob
 import subprocess
 import argparse
 import re
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
 #--- third-party imports
 #
 import yaml
@@ -24,6 +27,8 @@ LIB_PATH = os.path.abspath(os.path.join(os.path.dirname(
 if LIB_PATH not in sys.path:
     sys.path.insert(0, LIB_PATH)
 from pipelines import get_init_call
+from benchmarkdb import BenchmarkDB
+from rulegroups import MAX_LOCAL_S
 
 
 __author__ = "Andreas WILM"
@@ -106,10 +111,18 @@ def check_benchmark_naming(snakefile):
     return is_ok
 
 
-def check_modules(pipeline_dir):
-    """FIXME"""
+# module check results are cached per MODULEPATH and module. results
+# from parsing a modulefile stay valid until the modulefile changes,
+# successful module loads (no modulefile found, e.g. aliases) for
+# MODULE_CACHE_TTL seconds
+MODULE_CACHE_FILE = os.path.join(os.path.expanduser("~"), ".cache", "rpd", "pipelint_modules.json")
+MODULE_CACHE_TTL = 24 * 3600
+TCL_PATH_RE = re.compile(r'^\s*(?:prepend|append)-path\s+PATH\s+(\S+)', re.M)
+LUA_PATH_RE = re.compile(r'^\s*(?:prepend|append)_path\s*\(\s*["\']PATH["\']\s*,\s*["\']([^"\']+)["\']', re.M)
 
-    is_ok = True
+
+def modules_for_pipeline(pipeline_dir):
+    """Returns list of modules (name/version) used by pipeline"""
     module_cfgs = glob.glob(os.path.join(pipeline_dir, "cfg/modules.yaml"))
     assert len(module_cfgs) > 0
     modules = dict()
@@ -118,23 +131,386 @@ def check_modules(pipeline_dir):
             d = yaml.safe_load(fh)
         for p, v in d.items():
             modules[p] = v
+    return sorted("{}/{}".format(p, v) for p, v in modules.items())
 
-    for p, v in modules.items():
-        m = "{}/{}".format(p, v)
-        cmd = ' '.join(get_init_call())
-        cmd += "; module load {}".format(m)
-        try:
-            _ = subprocess.check_output(cmd, shell=True, stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError:
-            sys.stderr.write("FAILED: {}\n".format(cmd))
-            is_ok = False
-        #else:
-        #    print("OK: {}".format(cmd))
+
+def get_modulepath():
+    """MODULEPATH after sourcing init (one shell for all checks)"""
+    cmd = ' '.join(get_init_call()) + '; echo "$MODULEPATH"'
+    res = subprocess.check_output(cmd, shell=True, stderr=subprocess.DEVNULL)
+    lines = res.decode().strip().splitlines()
+    return lines[-1] if lines else ""
+
+
+def find_modulefile(module, modulepath):
+    """Returns first modulefile (Tcl or Lua) for module in modulepath or None"""
+    for d in modulepath.split(":"):
+        if not d:
+            continue
+        for f in [os.path.join(d, module), os.path.join(d, module + ".lua")]:
+            if os.path.isfile(f):
+                return f
+    return None
+
+
+def modulefile_problems(modulefile):
+    """Parse modulefile instead of loading it. Returns list of
+    problems (empty if ok): not a modulefile or PATH entries that
+    don't exist. Entries with variables are not checked.
+    """
+    with open(modulefile) as fh:
+        content = fh.read()
+    if modulefile.endswith(".lua"):
+        paths = LUA_PATH_RE.findall(content)
+    else:
+        if not content.startswith("#%Module"):
+            return ["{} is not a modulefile".format(modulefile)]
+        paths = TCL_PATH_RE.findall(content)
+    return ["{}: missing {}".format(modulefile, p) for p in paths
+            if not any(c in p for c in "$[") and not os.path.isdir(p)]
+
+
+def module_load_ok(module):
+    """Fallback: actually load module in a shell"""
+    cmd = ' '.join(get_init_call())
+    cmd += "; module load {}".format(module)
+    try:
+        _ = subprocess.check_output(cmd, shell=True, stderr=subprocess.STDOUT)
+    except subprocess.CalledProcessError:
+        sys.stderr.write("FAILED: {}\n".format(cmd))
+        return False
+    return True
+
+
+def load_module_cache(cache_file):
+    """Returns cached results or empty dict"""
+    try:
+        with open(cache_file) as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return dict()
+
+
+def save_module_cache(cache, cache_file):
+    """Atomically write cache"""
+    tmp = "{}.{}.tmp".format(cache_file, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        with open(tmp, 'w') as fh:
+            json.dump(cache, fh, indent=1)
+        os.rename(tmp, cache_file)
+    except OSError as err:
+        logger.warning("Couldn't write module cache %s: %s", cache_file, err)
+
+
+def resolve_module(module, modulepath, cache):
+    """Check one module, using and updating cache (dict of module to
+    result for this modulepath). Returns True if ok
+    """
+    modulefile = find_modulefile(module, modulepath)
+    cached = cache.get(module)
+    if modulefile:
+        mtime = os.path.getmtime(modulefile)
+        if cached and cached['modulefile'] == modulefile and cached['mtime'] == mtime:
+            return cached['ok']
+        problems = modulefile_problems(modulefile)
+        for p in problems:
+            sys.stderr.write("FAILED: module {}: {}\n".format(module, p))
+        cache[module] = {'modulefile': modulefile, 'mtime': mtime, 'ok': not problems}
+    else:
+        # only successful loads are cached, so that fixes show up immediately
+        if cached and cached['modulefile'] is None and cached['ok'] \
+           and time.time() - cached['checked'] < MODULE_CACHE_TTL:
+            return True
+        cache[module] = {'modulefile': None, 'checked': time.time(),
+                         'ok': module_load_ok(module)}
+    return cache[module]['ok']
+
+
+def check_all_modules(modules, num_threads=None, cache_file=MODULE_CACHE_FILE):
+    """Check given modules in parallel. Returns dict of module to ok
+    status. Pass cache_file=None to disable caching
+    """
+    modulepath = get_modulepath()
+    cache = load_module_cache(cache_file) if cache_file else dict()
+    # results depend on where modules are looked up (e.g. devel vs production init)
+    path_cache = cache.setdefault(modulepath, dict())
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        results = dict(zip(modules, executor.map(
+            lambda m: resolve_module(m, modulepath, path_cache), modules)))
+    if cache_file:
+        save_module_cache(cache, cache_file)
+    return results
+
+
+def check_modules(pipeline_dir, results=None):
+    """check that all modules of pipeline can be loaded. results can
+    be precomputed for several pipelines at once with
+    check_all_modules()
+    """
+    modules = modules_for_pipeline(pipeline_dir)
+    if results is None:
+        results = check_all_modules(modules)
+    return all(results[m] for m in modules)
+
+
+
+# performance lint
+#
+# tools too heavy to run on the master node as localrule. only
+# matched in command position (optionally with a path), see heavy_tool()
+HEAVY_TOOLS_RE = re.compile(
+    r'^(?:[^\s\'"]*/)?(bwa|samtools (?:sort|merge)|GenomeAnalysisTK|gatk|java|picard|STAR|rsem-calculate-expression'
+    r'|lofreq|bcl2fastq|fastqc|spades\.py|bbnorm\.sh|tadpole\.sh|kraken|metaphlan2?\.py|diamond|nucmer)(?![\w./-])')
+# python string literals, i.e. the shell commands of a rule
+STRING_LITERAL_RE = re.compile(r'"""(.*?)"""|\'\'\'(.*?)\'\'\'|"((?:[^"\\\n]|\\.)*)"|\'((?:[^\'\\\n]|\\.)*)\'', re.S)
+# shell() calls in run blocks: the literals passed as command
+SHELL_CALL_RE = re.compile(r'\bshell\(\s*((?:[rRfF]?(?:""".*?"""|\'\'\'.*?\'\'\'|"(?:[^"\\\n]|\\.)*"|\'(?:[^\'\\\n]|\\.)*\')\s*)+)', re.S)
+# separators after which a new command starts
+CMD_SEP_RE = re.compile(r'\|\||&&|\$\(|[;|&\n`(]')
+# words in front of the actual command
+CMD_PREFIXES = ('time', 'nice', 'exec', 'then', 'do', 'else', 'if', '{{', '{', '!')
+# single threaded (re)compression
+SERIAL_COMPRESS_RE = re.compile(r'\|\s*gzip\b|\bbgzip\s+-@\s*1\b')
+# producers of empty or constant streams, not worth compressing in parallel
+CONSTANT_STREAM_CMDS = ('echo', 'printf', 'true', ':', 'cat /dev/null')
+DECOMPRESS_RECOMPRESS_RE = re.compile(r'\b(zcat|gzip -dc|gunzip -c)\b[^|;]*\|\s*(gzip|bgzip)\b')
+# hardcoded thread options of common tools
+THREAD_OPT_RE = re.compile(r'(?:\s-t|\s-@|\s-p|--threads|--num-threads|--runThreadN|\s-nct|\s-nt)[\s=]+(\d+)\b')
+SLEEP_RE = re.compile(r'\bsleep\(?\s*(\d+)')
+# outputs of these types are large and should be temp() if only intermediate
+LARGE_OUTPUT_RE = re.compile(r'[\'"]([^\'"]+\.(?:bam|sam|fastq|fq)(?:\.gz)?)[\'"]')
+
+
+def parse_rules(snakefile):
+    """Very simple Snakefile parser: returns dict of rule name to dict
+    with lineno, local and directives (dict of directive name to raw
+    text)
+    """
+    rules = dict()
+    localrules = set()
+    rule = directive = None
+    with open(snakefile) as fh:
+        for lineno, line in enumerate(fh, 1):
+            line = line.rstrip("\n")
+            if line.startswith("localrules:"):
+                localrules.update(r.strip() for r in line.split(":", 1)[1].split(",") if r.strip())
+                continue
+            m = re.match(r'^rule (\w+)\s*:', line)
+            if m:
+                rule = {'lineno': lineno, 'directives': dict()}
+                rules[m.group(1)] = rule
+                directive = None
+                continue
+            if rule is None or not line.strip() or line.lstrip().startswith("#"):
+                continue
+            if not line.startswith((" ", "\t")):
+                rule = directive = None
+                continue
+            m = re.match(r'^(?:    |\t)(\w+):(.*)$', line)
+            if m:
+                directive = m.group(1)
+                rule['directives'][directive] = m.group(2)
+            elif directive:
+                rule['directives'][directive] += "\n" + line
+    for name, rule in rules.items():
+        rule['local'] = name in localrules
+    return rules
+
+
+def rule_commands(directives):
+    """Returns shell commands of a rule, i.e. the string literals of its
+    shell directive and those passed to shell() in its run block
+    """
+    literals = lambda text: "".join(
+        next(g for g in m.groups() if g is not None)
+        for m in STRING_LITERAL_RE.finditer(text))
+    cmds = [literals(directives.get('shell', ''))]
+    cmds.extend(literals(m.group(1)) for m in SHELL_CALL_RE.finditer(directives.get('run', '')))
+    return "\n".join(cmds)
+
+
+def heavy_tool(cmds):
+    """Returns first heavy tool run in command position in cmds or None.
+    Tool names in arguments, paths or quoted strings don't count
+
+    >>> heavy_tool("fastqc -t {threads} {input} >& {log}")
+    'fastqc'
+    >>> heavy_tool("cd {wildcards.muxdir}; /opt/bin/bcl2fastq -R . 2>&1 | tee {log}")
+    'bcl2fastq'
+    >>> heavy_tool("zcat {input} | samtools sort -o {output} -")
+    'samtools sort'
+    >>> heavy_tool("find fastqc/ -name '*.zip' > {output}")
+    >>> heavy_tool("ls 'out/bwa' \\"fastqc\\" fastqc.log; samtools view -c {input}")
+    """
+    for cmd in CMD_SEP_RE.split(cmds):
+        m = HEAVY_TOOLS_RE.search(" ".join(_command_words(cmd)))
+        if m:
+            return m.group(1)
+    return None
+
+
+def _command_words(cmd):
+    """words of cmd without prefixes and variable assignments"""
+    words = cmd.split()
+    while words and (words[0] in CMD_PREFIXES or re.match(r'^\w+=', words[0])):
+        words.pop(0)
+    return words
+
+
+def serial_compression(cmds):
+    """Returns True if cmds compress single threaded. Compressing
+    empty or constant streams (e.g. creating an empty gzip file)
+    doesn't count
+
+    >>> serial_compression("samtools view {input} | gzip > {output}")
+    True
+    >>> serial_compression("bgzip -@ 1 {input}")
+    True
+    >>> serial_compression('echo -n \\"\\" | gzip > {output.gvcf}; touch {output.tbi}')
+    False
+    >>> serial_compression("time cat /dev/null | gzip > {output}")
+    False
+    """
+    for m in SERIAL_COMPRESS_RE.finditer(cmds):
+        if m.group().startswith("|"):
+            producer = " ".join(_command_words(CMD_SEP_RE.split(cmds[:m.start()])[-1]))
+            if any(producer == c or producer.startswith(c + " ") for c in CONSTANT_STREAM_CMDS):
+                continue
+        return True
+    return False
+
+
+def loops_over_shell(run):
+    """Returns True if shell() is called inside the body of a for loop
+    in run block
+
+    >>> loops_over_shell("        for f in input:\\n            shell('gzip {f}')\\n")
+    True
+    >>> loops_over_shell("        for line in fh:\\n            n += 1\\n        if n:\\n            shell('gatk')\\n")
+    False
+    """
+    loop_indent = None
+    for line in run.splitlines():
+        if not line.strip() or line.lstrip().startswith("#"):
+            continue
+        indent = len(line) - len(line.lstrip())
+        if loop_indent is not None and indent <= loop_indent:
+            loop_indent = None
+        if loop_indent is None:
+            if re.match(r'^\s*(async\s+)?for\s.*:\s*(#.*)?$', line):
+                loop_indent = indent
+        elif 'shell(' in line:
+            return True
+    return False
+
+
+def perf_findings(rules):
+    """Returns list of (rule, lineno, check, message, sleep seconds)
+    for performance problems in parsed rules
+    """
+    findings = []
+    consumed = "\n".join(r['directives'].get('input', '') for r in rules.values())
+    for name, rule in sorted(rules.items()):
+        d = rule['directives']
+        cmds = d.get('shell', '') + d.get('run', '')
+        # string literals only, i.e. without python code of run blocks
+        literals = "\n".join(next(g for g in m.groups() if g is not None)
+                             for m in STRING_LITERAL_RE.finditer(cmds))
+        add = lambda check, msg, sleep_s=0: findings.append(
+            (name, rule['lineno'], check, msg, sleep_s))
+
+        if DECOMPRESS_RECOMPRESS_RE.search(cmds):
+            add('compression', "decompresses and recompresses (zcat | gzip): copy or stream instead")
+        elif serial_compression(literals):
+            add('compression', "single threaded compression: use pigz -p {threads} or bgzip -@ {threads}")
+
+        if rule['local']:
+            tool = heavy_tool(rule_commands(d))
+            if tool:
+                add('localrule', "heavy tool '{}' run as localrule on master node".format(tool))
+
+        if 'run' in d and loops_over_shell(d['run']):
+            add('run_loop', "run block loops over shell calls: use one shell command or scatter the rule")
+
+        m = SLEEP_RE.search(cmds)
+        if m:
+            add('sleep', "fixed sleep of {}s".format(m.group(1)), int(m.group(1)))
+
+        if 'threads' not in d:
+            if '{threads}' in cmds:
+                add('threads', "uses {threads} without threads directive, i.e. runs single threaded")
+            else:
+                m = THREAD_OPT_RE.search(cmds)
+                if m and int(m.group(1)) > 1:
+                    add('threads', "hardcoded {} threads without threads directive".format(m.group(1)))
+
+        for out in LARGE_OUTPUT_RE.findall(d.get('output', '')):
+            if "temp(" in d['output'] or "protected(" in d['output']:
+                break
+            if out in consumed or "rules.{}.output".format(name) in consumed:
+                add('temp', "large intermediate {} not marked temp()".format(out))
+                break
+    return findings
+
+
+def perf_impact(check, hist, sleep_s=0):
+    """Impact estimate from benchmark history (n, median s, median
+    io_out MB) or empty string. Savings are only given where they are
+    known (sleeps), otherwise the runtime spent in the rule
+
+    >>> perf_impact('compression', (100, 360.0, 2048.0))
+    ' [100 jobs, median 360s: ~10.0h total]'
+    >>> perf_impact('sleep', (100, 360.0, None), sleep_s=60)
+    ' [100 jobs: ~1.7h saved]'
+    >>> perf_impact('temp', (10, 60.0, 2048.0))
+    ' [10 jobs, median 2.0G written per job]'
+    """
+    if not hist:
+        return ""
+    n, median_s, median_io_out = hist
+    if check == 'sleep':
+        return " [{} jobs: ~{:.1f}h saved]".format(n, n * sleep_s / 3600.0)
+    if check == 'temp':
+        if median_io_out is None:
+            return ""
+        return " [{} jobs, median {:.1f}G written per job]".format(n, median_io_out / 1024.0)
+    if check == 'localrule':
+        if median_s <= MAX_LOCAL_S:
+            return " [{} jobs, median {:.0f}s: fine as localrule]".format(n, median_s)
+        return " [{} jobs, median {:.0f}s: ~{:.1f}h serial on master]".format(
+            n, median_s, n * median_s / 3600.0)
+    return " [{} jobs, median {:.0f}s: ~{:.1f}h total]".format(
+        n, median_s, n * median_s / 3600.0)
+
+
+def load_perf_history(dbfile, pipeline_name=None):
+    """Returns dict of rule to (n, median s, median io_out)"""
+    db = BenchmarkDB(dbfile)
+    runtimes = db.percentiles('s', (50,), ('rule',), pipeline_name=pipeline_name)
+    io_out = db.percentiles('io_out', (50,), ('rule',), pipeline_name=pipeline_name)
+    db.close()
+    hist = dict()
+    for k, (n, median_s) in runtimes.items():
+        hist[k[0]] = (n, median_s, io_out[k][1] if k in io_out else None)
+    return hist
+
+
+def check_performance(snakefile, history=None):
+    """check rules for common performance problems"""
+    is_ok = True
+    history = history or dict()
+    for rule, lineno, check, msg, sleep_s in perf_findings(parse_rules(snakefile)):
+        print("WARN: {}:{} rule {}: {}{}".format(
+            snakefile, lineno, rule, msg, perf_impact(check, history.get(rule), sleep_s)))
+        is_ok = False
     return is_ok
 
         
 def main(pipelinedirs,
-         no_modules_check=False, no_benchmark_check=False):
+         no_modules_check=False, no_benchmark_check=False,
+         no_perf_check=False, benchmark_db=None,
+         module_threads=None, no_module_cache=False):
     """main function"""
 
     logger.warning("include other existing tools here: check_cluster_conf.py...")
@@ -142,8 +518,12 @@ def main(pipelinedirs,
     snakefiles = [os.path.join(d, "Snakefile") for d in pipelinedirs]
 
     if not no_modules_check:
+        # resolve modules of all pipelines at once
+        modules = sorted(set(m for d in pipelinedirs for m in modules_for_pipeline(d)))
+        results = check_all_modules(modules, module_threads,
+                                    None if no_module_cache else MODULE_CACHE_FILE)
         for d in pipelinedirs:
-            if not check_modules(d):
+            if not check_modules(d, results):
                 print("FAILED: Modules check for {}".format(d))
             else:
                 print("OK: Modules check for {}".format(d))
@@ -165,6 +545,16 @@ def main(pipelinedirs,
                 print("FAILED: Benchmarking naming for {}".format(f))
             else:
                 print("OK: Benchmarking naming for {}".format(f))
+
+    history = None
+    if not no_perf_check and benchmark_db:
+        history = load_perf_history(benchmark_db)
+    for f in list(set(includes)) + snakefiles:
+        if not no_perf_check:
+            if not check_performance(f, history):
+                print("FAILED: Performance check for {}".format(f))
+            else:
+                print("OK: Performance check for {}".format(f))
                 
     
 if __name__ == "__main__":
@@ -173,9 +563,22 @@ if __name__ == "__main__":
                         help="Skip modules check")
     parser.add_argument('-B', "--no-benchmark-check", action="store_true",
                         help="Skip benchmark rule checks")
+    parser.add_argument('-j', "--module-threads", type=int,
+                        help="Number of modules to check in parallel (default: one per CPU and then some)")
+    parser.add_argument("--no-module-cache", action="store_true",
+                        help="Don't use or update cached module check results in {}".format(
+                            MODULE_CACHE_FILE))
+    parser.add_argument('-P', "--no-perf-check", action="store_true",
+                        help="Skip performance checks")
+    parser.add_argument('-d', "--benchmark-db",
+                        help="Benchmark database (see benchmark_db.py) for impact estimates")
     parser.add_argument('pipelinedir', nargs='*')
     args = parser.parse_args()
     
     main(args.pipelinedir,
          no_modules_check=args.no_modules_check,
-         no_benchmark_check=args.no_benchmark_check)
+         no_benchmark_check=args.no_benchmark_check,
+         no_perf_check=args.no_perf_check,
+         benchmark_db=args.benchmark_db,
+         module_threads=args.module_threads,
+         no_module_cache=args.no_module_cache)
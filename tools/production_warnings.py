@@ -23,6 +23,7 @@ if LIB_PATH not in sys.path:
     sys.path.insert(0, LIB_PATH)
 from pipelines import generate_window
 from mongodb import mongodb_conn
+from qstatcache import QstatCache
 
 
 __author__ = "LIEW Jun Xian"
@@ -50,34 +51,32 @@ MAX_RUN = 3
 
 def check_qstat():
     """
-    run several checks on qstat
+    run several checks on qstat (via shared qstat cache)
     warnings returned as strings/lines
     """
-    qstat_cmd = ["qstat", "-u", "userrig"]
     warnings = ""
     try:
-        _ = check_output(qstat_cmd)
-    except CalledProcessError:
+        jobs = QstatCache().jobs(user="userrig")
+    except (CalledProcessError, OSError, ValueError):
         warnings += ("[qstat fail]")
         return warnings
 
     count_qw = 0
     count_eqw = 0
     count_all = 0
-    for line in check_output(qstat_cmd).splitlines():
-        if str.isdigit(str(line.split()[0], "utf-8")):
-            count_all += 1
-            status = str(line.split()[4], "utf-8")
-            if status == "qw":
-                count_qw += 1
-            if status == "Eqw":
-                count_eqw += 1
-            if status == 'r':
-                submit = datetime.datetime.strptime(str(line.split()[5], "utf-8"), "%m/%d/%Y")
-                if ((datetime.date.today() - datetime.date(submit.year, submit.month, \
-                    submit.day)).days) > MAX_AGE:
-                    warnings += ("[age > " + str(MAX_AGE) + " days]:\t" + "job-ID " + \
-                        str(line.split()[0], "utf-8") + "\n")
+    for jid, job in sorted(jobs.items()):
+        count_all += 1
+        status = job['state']
+        if status == "qw":
+            count_qw += 1
+        if status == "Eqw":
+            count_eqw += 1
+        if status == 'r' and job['submit']:
+            submit = datetime.datetime.strptime(job['submit'].split()[0], "%m/%d/%Y")
+            if ((datetime.date.today() - datetime.date(submit.year, submit.month, \
+                submit.day)).days) > MAX_AGE:
+                warnings += ("[age > " + str(MAX_AGE) + " days]:\t" + "job-ID " + \
+                    jid + "\n")
     if count_qw > MAX_QW:
         warnings += ("[qw > " + str(MAX_QW) + " jobs]:\t" + str(count_qw) + "\n")
     if count_eqw > MAX_EQW:
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""Project CPU hours, memory hours, wall time and cost of an analysis
+per site before launching it, based on the benchmark warehouse (see
+benchmark_db.py and lib/projection.py). Cost rates per site are taken
+from the site config (cost_rates).
+
+With --choose only the name of the cheapest or fastest site is printed
+(for use in launch scripts). Exits with 2 if the analysis is projected
+to be a runaway, i.e. far above what previous analyses of this
+pipeline used.
+"""
+
+#--- standard library imports
+#
+import os
+import sys
+import logging
+import argparse
+
+#--- third-party imports
+#
+#/
+
+# --- project specific imports
+#
+# add lib dir for this pipeline installation to PYTHONPATH
+LIB_PATH = os.path.abspath(os.path.join(os.path.dirname(
+    os.path.realpath(__file__)), "..", "lib"))
+if LIB_PATH not in sys.path:
+    sys.path.insert(0, LIB_PATH)
+from config import site_cfg
+from readunits import get_samples_and_readunits_from_cfgfile
+from benchmarks import input_bytes_from_cfg
+from projection import project_analysis
+from projection import choose_site
+from projection import is_runaway
+from projection import PROJECTION_KEYS
+
+
+__author__ = "Andreas Wilm"
+__email__ = "wilma@gis.a-star.edu.sg"
+__copyright__ = "2017 Genome Institute of Singapore"
+__license__ = "The MIT License (MIT)"
+
+
+# global logger
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(
+    '[{asctime}] {levelname:8s} {filename} {message}', style='{'))
+logger.addHandler(handler)
+
+
+def main():
+    """main function
+    """
+
+    cost_rates = site_cfg.get('cost_rates', dict())
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-S', "--sample-cfg", required=True,
+                        help="Sample config file (as used by the pipeline wrappers)")
+    parser.add_argument('-p', "--pipeline", required=True,
+                        help="Pipeline name (as in ELM section of pipeline config)")
+    default = site_cfg.get('benchmark_db')
+    parser.add_argument('-d', "--db", default=default,
+                        help="Benchmark database (default: {})".format(default))
+    default = sorted(cost_rates) if cost_rates else [site_cfg['name']]
+    parser.add_argument('-s', "--sites", nargs='+', default=default,
+                        help="Sites to project for (default: {})".format(default))
+    parser.add_argument('-r', "--rules", action='store_true',
+                        help="Also report per rule projections")
+    parser.add_argument("--choose", choices=['cheapest', 'fastest'],
+                        help="Only print the cheapest or fastest site")
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help="Increase verbosity")
+    parser.add_argument('-q', '--quiet', action='count', default=0,
+                        help="Decrease verbosity")
+    args = parser.parse_args()
+
+    # Repeateable -v and -q for setting logging level.
+    # See https://www.reddit.com/r/Python/comments/3nctlm/what_python_tools_should_i_be_using_on_every/
+    # and https://gist.github.com/andreas-wilm/b6031a84a33e652680d4
+    # script -vv -> DEBUG
+    # script -v -> INFO
+    # script -> WARNING
+    # script -q -> ERROR
+    # script -qq -> CRITICAL
+    # script -qqq -> no logging at all
+    logger.setLevel(logging.WARN + 10*args.quiet - 10*args.verbose)
+
+    if not args.db or not os.path.exists(args.db):
+        logger.fatal("Missing benchmark database %s", args.db)
+        sys.exit(1)
+
+    samples, readunits = get_samples_and_readunits_from_cfgfile(args.sample_cfg)
+    input_bytes = input_bytes_from_cfg({'samples': samples, 'readunits': readunits})
+    if not input_bytes or not input_bytes['total']:
+        logger.fatal("Couldn't determine input size from %s", args.sample_cfg)
+        sys.exit(1)
+
+    projections = project_analysis(args.db, args.pipeline, input_bytes,
+                                   args.sites, cost_rates)
+    if not projections:
+        logger.fatal("No benchmark records for pipeline %s", args.pipeline)
+        sys.exit(1)
+
+    if args.choose:
+        site = choose_site(projections, 'cost' if args.choose == 'cheapest' else 'wall_h')
+        if not site:
+            logger.fatal("No site to choose from (missing cost rates?)")
+            sys.exit(1)
+        print(site)
+    else:
+        print("\t".join(["site"] + PROJECTION_KEYS + ["cost", "model_site"]))
+        for site, p in sorted(projections.items()):
+            print("\t".join([site, str(p['num_jobs'])] + [
+                "{:.1f}".format(p[k]) for k in PROJECTION_KEYS[1:]] + [
+                    "{:.2f}".format(p['cost']) if p['cost'] is not None else "NA",
+                    p['model_site'] if p['model_site'] else "ALL"]))
+            if args.rules:
+                for rule, r in sorted(p['rules'].items(), key=lambda x: -x[1]['cpu_h']):
+                    print("\t".join(["  " + rule, str(r['num_jobs'])] + [
+                        "{:.1f}".format(r[k]) for k in PROJECTION_KEYS[1:]]))
+
+    runaway = [site for site, p in projections.items() if is_runaway(p)]
+    for site in runaway:
+        p = projections[site]
+        logger.warning("Runaway analysis at %s: projected %.0f CPU hours"
+                       " exceed limit of %.0f based on previous analyses",
+                       site, p['cpu_h'], p['runaway_cpu_h'])
+    if runaway:
+        sys.exit(2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""Query the bcl2fastq QC metrics database (see lib/qcmetricsdb.py),
+which bcl2fastq_qc.py fills with lane, mux and sample metrics of every
+run: per-instrument trends of a metric, outliers of a run compared to
+previous runs of its instrument and limits learned per instrument.
+
+Examples:
+- Trend: qc_metrics.py -m pct_q30_bases -i HS007 --since 2017-01-01
+- Outliers: qc_metrics.py -o HS007-PE-R00123_BHXXXXXX
+- Learned limits: qc_metrics.py --limits
+"""
+
+#--- standard library imports
+#
+import os
+import sys
+import logging
+import argparse
+from datetime import datetime
+
+#--- third-party imports
+#
+#/
+
+# --- project specific imports
+#
+# add lib dir for this pipeline installation to PYTHONPATH
+LIB_PATH = os.path.abspath(os.path.join(os.path.dirname(
+    os.path.realpath(__file__)), "..", "lib"))
+if LIB_PATH not in sys.path:
+    sys.path.insert(0, LIB_PATH)
+from qcmetricsdb import QCMetricsDB
+from qcmetricsdb import qc_db_file
+from qcmetricsdb import LEVELS
+from qcmetricsdb import METRICS
+from qcmetricsdb import MAX_ROBUST_Z
+from qcmetricsdb import HISTORY_RUNS
+
+
+__author__ = "Andreas Wilm"
+__email__ = "wilma@gis.a-star.edu.sg"
+__copyright__ = "2017 Genome Institute of Singapore"
+__license__ = "The MIT License (MIT)"
+
+
+# global logger
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(
+    '[{asctime}] {levelname:8s} {filename} {message}', style='{'))
+logger.addHandler(handler)
+
+
+def date_to_epoch(date):
+    """epoch of date given as YYYY-MM-DD"""
+    return datetime.strptime(date, "%Y-%m-%d").timestamp()
+
+
+def fmt(value):
+    """format value for output"""
+    return "{:.2f}".format(value) if value is not None else "NA"
+
+
+def main():
+    """main function
+    """
+
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    default = qc_db_file()
+    parser.add_argument('-d', "--db", default=default,
+                        help="QC metrics database (default: {})".format(default))
+    parser.add_argument('-m', "--metric", choices=list(METRICS.keys()),
+                        help="Report trend of this metric (requires --instrument)")
+    parser.add_argument('-i', "--instrument",
+                        help="Instrument (machine id, e.g. HS007)")
+    default = 'lane'
+    parser.add_argument('-l', "--level", choices=LEVELS, default=default,
+                        help="Level of metrics for trend, outliers and limits (default: {})".format(default))
+    parser.add_argument('--since',
+                        help="Restrict trend to runs since this date (YYYY-MM-DD)")
+    parser.add_argument('--until',
+                        help="Restrict trend to runs before this date (YYYY-MM-DD)")
+    parser.add_argument('-o', "--outliers", metavar="RUN_NUM",
+                        help="Report outliers of this run")
+    parser.add_argument('--limits', action='store_true',
+                        help="Report limits learned per instrument and metric")
+    default = MAX_ROBUST_Z
+    parser.add_argument('-z', "--max-z", type=float, default=default,
+                        help="Robust z-score beyond which values are outliers (default: {})".format(default))
+    default = HISTORY_RUNS
+    parser.add_argument('-n', "--num-runs", type=int, default=default,
+                        help="Number of previous runs used as history (default: {})".format(default))
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help="Increase verbosity")
+    parser.add_argument('-q', '--quiet', action='count', default=0,
+                        help="Decrease verbosity")
+    args = parser.parse_args()
+
+    # Repeateable -v and -q for setting logging level.
+    # See https://www.reddit.com/r/Python/comments/3nctlm/what_python_tools_should_i_be_using_on_every/
+    # and https://gist.github.com/andreas-wilm/b6031a84a33e652680d4
+    # script -vv -> DEBUG
+    # script -v -> INFO
+    # script -> WARNING
+    # script -q -> ERROR
+    # script -qq -> CRITICAL
+    # script -qqq -> no logging at all
+    logger.setLevel(logging.WARN + 10*args.quiet - 10*args.verbose)
+
+    if not os.path.exists(args.db):
+        logger.fatal("Non-existing database %s", args.db)
+        sys.exit(1)
+    db = QCMetricsDB(args.db)
+
+    if args.outliers:
+        if db.run_date(args.outliers) is None:
+            logger.fatal("Run %s not in database", args.outliers)
+            db.close()
+            sys.exit(1)
+        print("\t".join(["level", "unit", "metric", "value", "median", "robust_z"]))
+        for level, unit, metric, value, median, z in db.outliers(
+                args.outliers, levels=(args.level,), max_z=args.max_z, num_runs=args.num_runs):
+            print("\t".join([level, unit, metric, fmt(value), fmt(median), str(z)]))
+
+    elif args.limits:
+        print("\t".join(["instrument", "metric", "n", "median", "lower", "upper"]))
+        res = db.limits(args.level, max_z=args.max_z, num_runs=args.num_runs)
+        for (machine_id, metric), (n, median, lower, upper) in sorted(res.items()):
+            print("\t".join([machine_id, metric, str(n), fmt(median), fmt(lower), fmt(upper)]))
+
+    elif args.metric:
+        if not args.instrument:
+            logger.fatal("--metric requires --instrument")
+            db.close()
+            sys.exit(1)
+        since = date_to_epoch(args.since) if args.since else None
+        until = date_to_epoch(args.until) if args.until else None
+        print("\t".join(["run_num", "date", "unit", args.metric]))
+        for run_num, run_date, unit, value in db.trend(
+                args.instrument, args.metric, args.level, since, until):
+            print("\t".join([run_num, datetime.fromtimestamp(run_date).strftime("%Y-%m-%d"),
+                             unit, fmt(value)]))
+
+    else:
+        logger.fatal("Nothing to do: need one of --metric, --outliers or --limits")
+        db.close()
+        sys.exit(1)
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
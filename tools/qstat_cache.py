@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""Poll qstat once per interval for all jobs and cache the parsed
+state in a per host JSON file, which is then used by all tools and
+snakemake instances of the same user on this host (see
+lib/qstatcache.py). Run as background daemon or with --once from
+cron.
+"""
+
+#--- standard library imports
+#
+import os
+import sys
+import time
+import logging
+import argparse
+import subprocess
+
+#--- third-party imports
+#
+#/
+
+# --- project specific imports
+#
+# add lib dir for this pipeline installation to PYTHONPATH
+LIB_PATH = os.path.abspath(os.path.join(os.path.dirname(
+    os.path.realpath(__file__)), "..", "lib"))
+if LIB_PATH not in sys.path:
+    sys.path.insert(0, LIB_PATH)
+from qstatcache import scheduler_type
+from qstatcache import poll_qstat
+from qstatcache import write_cache
+from qstatcache import default_cache_file
+from qstatcache import qstat_cmd
+from qstatcache import DEFAULT_INTERVAL
+
+
+__author__ = "Andreas Wilm"
+__email__ = "wilma@gis.a-star.edu.sg"
+__copyright__ = "2017 Genome Institute of Singapore"
+__license__ = "The MIT License (MIT)"
+
+
+# global logger
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(
+    '[{asctime}] {levelname:8s} {filename} {message}', style='{'))
+logger.addHandler(handler)
+
+
+def main():
+    """main function
+    """
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    default = default_cache_file()
+    parser.add_argument('-c', "--cache-file", default=default,
+                        help="Cache file (default: {})".format(default))
+    default = DEFAULT_INTERVAL
+    parser.add_argument('-i', "--interval", type=int, default=default,
+                        help="Polling interval in seconds (default: {})".format(default))
+    default = qstat_cmd()
+    parser.add_argument("--qstat", default=default,
+                        help="qstat command, e.g. fake qstat for testing (default: {})".format(default))
+    parser.add_argument("--once", action='store_true',
+                        help="Poll once and exit (e.g. for use in cron)")
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help="Increase verbosity")
+    parser.add_argument('-q', '--quiet', action='count', default=0,
+                        help="Decrease verbosity")
+    args = parser.parse_args()
+
+    # Repeateable -v and -q for setting logging level.
+    # See https://www.reddit.com/r/Python/comments/3nctlm/what_python_tools_should_i_be_using_on_every/
+    # and https://gist.github.com/andreas-wilm/b6031a84a33e652680d4
+    # script -vv -> DEBUG
+    # script -v -> INFO
+    # script -> WARNING
+    # script -q -> ERROR
+    # script -qq -> CRITICAL
+    # script -qqq -> no logging at all
+    logger.setLevel(logging.WARN + 10*args.quiet - 10*args.verbose)
+
+    scheduler = scheduler_type(args.qstat)
+    logger.info("Polling %s (%s) every %ds into %s",
+                args.qstat, scheduler, args.interval, args.cache_file)
+    while True:
+        start = time.time()
+        try:
+            jobs = poll_qstat(scheduler, args.qstat)
+        except subprocess.CalledProcessError as err:
+            # keep old cache. clients fall back to polling once it's stale
+            logger.warning("qstat failed: %s", err)
+        else:
+            if not write_cache(args.cache_file, scheduler, jobs):
+                logger.fatal("Can't write to %s", args.cache_file)
+                sys.exit(1)
+            logger.debug("Cached %d jobs in %.1fs", len(jobs), time.time()-start)
+        if args.once:
+            break
+        time.sleep(max(0, args.interval - (time.time() - start)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""Track cluster queue latency (submission to start) and report the
+rolling latency per queue, plus optionally the resulting per rule
+decision to run locally, batch with its producer or submit (see
+lib/queuelatency.py).
+
+Run with -i over running and completed analysis directories (e.g.
+from cron) to keep the latency database up to date.
+"""
+
+#--- standard library imports
+#
+import os
+import sys
+import logging
+import argparse
+
+#--- third-party imports
+#
+#/
+
+# --- project specific imports
+#
+# add lib dir for this pipeline installation to PYTHONPATH
+LIB_PATH = os.path.abspath(os.path.join(os.path.dirname(
+    os.path.realpath(__file__)), "..", "lib"))
+if LIB_PATH not in sys.path:
+    sys.path.insert(0, LIB_PATH)
+from queuelatency import QueueLatencyDB
+from pipelines import get_queue_latency_db
+from queuelatency import rolling_latency
+from queuelatency import submission_policy
+from queuelatency import ROLLING_WINDOW_S
+from rulegroups import rule_runtimes
+from benchmarkdb import percentile
+
+
+__author__ = "Andreas Wilm"
+__email__ = "wilma@gis.a-star.edu.sg"
+__copyright__ = "2017 Genome Institute of Singapore"
+__license__ = "The MIT License (MIT)"
+
+
+# global logger
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(
+    '[{asctime}] {levelname:8s} {filename} {message}', style='{'))
+logger.addHandler(handler)
+
+
+def main():
+    """main function
+    """
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-i', "--ingest", nargs='+', metavar="ANALYSISDIR",
+                        help="Ingest submissions and job starts of these analysis directories")
+    default = get_queue_latency_db()
+    parser.add_argument('-d', "--db", default=default,
+                        help="Queue latency database shared by all users of the site"
+                        " (default: {})".format(default))
+    default = ROLLING_WINDOW_S / 3600.0
+    parser.add_argument('-w', "--window", type=float, default=default,
+                        help="Rolling window in hours (default: {})".format(default))
+    parser.add_argument('-b', "--benchmark-db",
+                        help="Benchmark database: report per rule policy based on rule runtimes")
+    parser.add_argument('-p', "--pipeline",
+                        help="Restrict rule runtimes to this pipeline (requires --benchmark-db)")
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help="Increase verbosity")
+    parser.add_argument('-q', '--quiet', action='count', default=0,
+                        help="Decrease verbosity")
+    args = parser.parse_args()
+
+    # Repeateable -v and -q for setting logging level.
+    # See https://www.reddit.com/r/Python/comments/3nctlm/what_python_tools_should_i_be_using_on_every/
+    # and https://gist.github.com/andreas-wilm/b6031a84a33e652680d4
+    # script -vv -> DEBUG
+    # script -v -> INFO
+    # script -> WARNING
+    # script -q -> ERROR
+    # script -qq -> CRITICAL
+    # script -qqq -> no logging at all
+    logger.setLevel(logging.WARN + 10*args.quiet - 10*args.verbose)
+
+    if not args.db:
+        logger.fatal("No queue latency database configured: use --db,"
+                     " RPD_QUEUE_LATENCY_DB or queue_latency_db in the site config")
+        sys.exit(1)
+    db = QueueLatencyDB(args.db)
+    if args.ingest:
+        for d in args.ingest:
+            if not os.path.isdir(d):
+                logger.warning("Skipping non-existing directory %s", d)
+                continue
+            n = db.ingest_analysis(d)
+            logger.info("Ingested %d cluster jobs from %s", n, d)
+        db.close()
+        return
+
+    window_s = args.window * 3600
+    latencies = db.latencies(window_s=window_s)
+    db.close()
+    if not latencies:
+        logger.warning("No jobs submitted within the last %.1fh", args.window)
+        return
+
+    print("\t".join(["queue", "started", "pending", "p50_s", "p90_s", "rolling_s"]))
+    rolling = dict()
+    for queue, (observed, pending) in sorted(latencies.items()):
+        rolling[queue] = rolling_latency(observed, pending)
+        print("\t".join([queue, str(len(observed)), str(len(pending))] + [
+            "{:.0f}".format(percentile(observed, p)) if observed else "NA" for p in [50, 90]] + [
+                "{:.0f}".format(rolling[queue]) if rolling[queue] is not None else "NA"]))
+
+    if args.benchmark_db:
+        if not os.path.exists(args.benchmark_db):
+            logger.fatal("Non-existing benchmark database %s", args.benchmark_db)
+            sys.exit(1)
+        runtimes = rule_runtimes(args.benchmark_db, args.pipeline)
+        queues = sorted(q for q in rolling if rolling[q] is not None)
+        print()
+        print("\t".join(["rule", "runtime_s"] + queues))
+        for rule, secs in sorted(runtimes.items()):
+            print("\t".join([rule, "{:.0f}".format(secs)] + [
+                submission_policy(secs, rolling[q]) for q in queues]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""Fit per-rule resource models (wall time and memory as function of
+input size and threads) from benchmark logs of completed analyses and
+report expected savings in reserved memory-hours compared to a static
+cluster config. Core-hours used only depend on the actual runtime and
+are the same for both. Tighter time limits only help scheduling
+(backfill) and are reported separately as limit core-hours.
+
+Save the model as cfg/resources.<SITE>.yaml in a pipeline directory to
+have it applied to the cluster config at launch time.
+"""
+
+#--- standard library imports
+#
+import os
+import sys
+import logging
+import argparse
+
+#--- third-party imports
+#
+import yaml
+
+# --- project specific imports
+#
+# add lib dir for this pipeline installation to PYTHONPATH
+LIB_PATH = os.path.abspath(os.path.join(os.path.dirname(
+    os.path.realpath(__file__)), "..", "lib"))
+if LIB_PATH not in sys.path:
+    sys.path.insert(0, LIB_PATH)
+from benchmarks import benchmarks_from_analysis
+from benchmarks import ResourceModel
+from benchmarks import DEFAULT_MARGIN
+from benchmarks import MIN_TIME_S
+from benchmarks import MIN_MEM_GB
+from benchmarks import cluster_time_to_secs
+from benchmarks import cluster_mem_to_gb
+from benchmarkdb import BenchmarkDB
+
+
+__author__ = "Andreas Wilm"
+__email__ = "wilma@gis.a-star.edu.sg"
+__copyright__ = "2017 Genome Institute of Singapore"
+__license__ = "The MIT License (MIT)"
+
+
+# global logger
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(
+    '[{asctime}] {levelname:8s} {filename} {message}', style='{'))
+logger.addHandler(handler)
+
+
+def reserved_hours(records, cluster_cfg, model, margin):
+    """Compute core-hours (threads times actual runtime), limit
+    core-hours (threads times time limit; a scheduling/backfill metric
+    only, since jobs release their cores when done) and reserved
+    memory-hours (memory limit times actual runtime) for all records
+    using static cluster config and model predictions. Returns dict
+    per rule with five values: core-h, static limit core-h, model
+    limit core-h, static mem-h and model mem-h (memory in GB)
+    """
+    default = cluster_cfg.get('__default__', dict())
+    hours = dict()
+    for r in records:
+        static = cluster_cfg.get(r.rule, default)
+        if 'time' not in static or 'mem' not in static:
+            continue
+        threads = r.threads if r.threads else 1
+        static_time_h = cluster_time_to_secs(static['time']) / 3600.0
+        static_mem_gb = cluster_mem_to_gb(static['mem'])
+        time_s, mem_mb = model.predict(r.rule, r.input_bytes, threads, margin)
+        model_time_h = max(MIN_TIME_S, time_s) / 3600.0 if time_s else static_time_h
+        model_mem_gb = max(MIN_MEM_GB, mem_mb / 1024.0) if mem_mb else static_mem_gb
+        run_h = r.s / 3600.0
+        h = hours.setdefault(r.rule, [0.0, 0.0, 0.0, 0.0, 0.0])
+        h[0] += threads * run_h
+        h[1] += threads * static_time_h
+        h[2] += threads * model_time_h
+        h[3] += static_mem_gb * run_h
+        h[4] += model_mem_gb * run_h
+    return hours
+
+
+def main():
+    """main function
+    """
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('analysisdir', nargs='*',
+                        help="Completed analysis directories (output dir of pipeline wrapper)")
+    parser.add_argument('-d', "--db",
+                        help="Use records from this benchmark database (see benchmark_db.py)"
+                        " instead of analysis directories")
+    parser.add_argument('-s', "--site",
+                        help="Only use records from this site (requires --db)")
+    parser.add_argument('-o', "--model-out",
+                        help="Write fitted model to this yaml file")
+    parser.add_argument('-c', "--cluster-cfg",
+                        help="Static cluster config to compare against (savings report)")
+    parser.add_argument('-p', "--pipeline",
+                        help="Only use analyses of this pipeline")
+    default = DEFAULT_MARGIN
+    parser.add_argument('-m', "--margin", type=float, default=default,
+                        help="Safety margin on top of predictions (default: {})".format(default))
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help="Increase verbosity")
+    parser.add_argument('-q', '--quiet', action='count', default=0,
+                        help="Decrease verbosity")
+    args = parser.parse_args()
+
+    # Repeateable -v and -q for setting logging level.
+    # See https://www.reddit.com/r/Python/comments/3nctlm/what_python_tools_should_i_be_using_on_every/
+    # and https://gist.github.com/andreas-wilm/b6031a84a33e652680d4
+    # script -vv -> DEBUG
+    # script -v -> INFO
+    # script -> WARNING
+    # script -q -> ERROR
+    # script -qq -> CRITICAL
+    # script -qqq -> no logging at all
+    logger.setLevel(logging.WARN + 10*args.quiet - 10*args.verbose)
+
+    records = []
+    if args.db:
+        db = BenchmarkDB(args.db)
+        records.extend(db.records(pipeline_name=args.pipeline, site=args.site))
+        db.close()
+    for d in args.analysisdir:
+        if not os.path.isdir(d):
+            logger.warning("Skipping non-existing directory %s", d)
+            continue
+        if args.pipeline:
+            cfgfile = os.path.join(d, "conf.yaml")
+            if not os.path.exists(cfgfile):
+                logger.warning("Skipping %s: missing %s", d, cfgfile)
+                continue
+            with open(cfgfile) as fh:
+                cfg = yaml.safe_load(fh)
+            if cfg.get('ELM', {}).get('pipeline_name') != args.pipeline:
+                continue
+        recs = benchmarks_from_analysis(d)
+        logger.info("Found %d benchmark records in %s", len(recs), d)
+        records.extend(recs)
+    if not records:
+        logger.fatal("No benchmark records found")
+        sys.exit(1)
+
+    model = ResourceModel().fit(records)
+    if args.model_out:
+        model.dump(args.model_out)
+        logger.info("Model written to %s", args.model_out)
+
+    if not args.cluster_cfg:
+        return
+    with open(args.cluster_cfg) as fh:
+        cluster_cfg = yaml.safe_load(fh)
+    hours = reserved_hours(records, cluster_cfg, model, args.margin)
+    print("\t".join(["rule", "core-h",
+                     "static limit core-h (scheduling)", "model limit core-h (scheduling)",
+                     "static mem-h (GB)", "model mem-h (GB)"]))
+    totals = [0.0, 0.0, 0.0, 0.0, 0.0]
+    for rule, h in sorted(hours.items()):
+        print("\t".join([rule] + ["{:.1f}".format(x) for x in h]))
+        totals = [t + x for t, x in zip(totals, h)]
+    print("\t".join(["TOTAL"] + ["{:.1f}".format(x) for x in totals]))
+    if totals[3]:
+        print("Expected savings: {:.1f} GB memory-hours ({:.0f}%)"
+              " (core-hours used unchanged: {:.1f})".format(
+                  totals[3]-totals[4], 100.0*(totals[3]-totals[4])/totals[3], totals[0]))
+    if totals[1]:
+        print("Scheduling/backfill only: time limits reserve {:.1f} fewer core-hours ({:.0f}%)".format(
+            totals[1]-totals[2], 100.0*(totals[1]-totals[2])/totals[1]))
+
+
+if __name__ == "__main__":
+    main()
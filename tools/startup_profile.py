@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+"""Profile startup cost of wrappers and cron tools: module import
+times (python -X importtime) and side-effect work done before the
+actual work starts, i.e. subprocesses, network connections (REST,
+MongoDB, SMTP) and config/data files read (via audit hooks).
+
+Each entry point is run with --help, which covers module level code
+and argparse defaults. Results are checked against per-entry-point
+budgets (see startup_budget.yaml next to this script). Entry points
+default to the ones listed in the budget file. Exits with 1 if a
+budget was exceeded.
+"""
+
+#--- standard library imports
+#
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import tempfile
+import subprocess
+
+#--- third-party imports
+#
+import yaml
+
+#--- project specific imports
+#
+#/
+
+
+__author__ = "Andreas Wilm"
+__email__ = "wilma@gis.a-star.edu.sg"
+__copyright__ = "2017 Genome Institute of Singapore"
+__license__ = "The MIT License (MIT)"
+
+
+# global logger
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(
+    '[{asctime}] {levelname:8s} {filename} {message}', style='{'))
+logger.addHandler(handler)
+
+
+PIPELINE_ROOTDIR = os.path.abspath(os.path.join(os.path.dirname(
+    os.path.realpath(__file__)), ".."))
+
+DEFAULT_BUDGET_FILE = os.path.join(os.path.dirname(
+    os.path.realpath(__file__)), "startup_budget.yaml")
+
+# metrics that can be budgeted
+METRICS = ['wall_s', 'import_s', 'subprocess', 'network', 'file_reads']
+
+# run inside the profiled interpreter: record audit events of interest
+# and dump them as json to argv[1] at exit. argv[2] is the script and
+# argv[3:] its args
+BOOTSTRAP = r'''
+import sys, os, json, time, atexit, runpy
+_out, _script = sys.argv[1], sys.argv[2]
+_root = {root!r}
+_events = []
+_active = [True]
+_t0 = time.time()
+_code_ext = ('.py', '.pyc', '.so', '.pth')
+
+def _origin():
+    f = sys._getframe(2)
+    while f:
+        fn = f.f_code.co_filename
+        if fn.startswith(_root):
+            return "{{}}:{{}}".format(os.path.relpath(fn, _root), f.f_lineno)
+        f = f.f_back
+    return None
+
+def _hook(event, args):
+    if not _active[0]:
+        return
+    if event == 'subprocess.Popen':
+        what = 'subprocess'
+        detail = " ".join(str(a) for a in args[1]) if isinstance(args[1], (list, tuple)) else str(args[1])
+    elif event in ('socket.connect', 'socket.getaddrinfo'):
+        what = 'network'
+        detail = str(args[1]) if event == 'socket.connect' else "{{}}:{{}}".format(args[0], args[1])
+    elif event == 'open':
+        path = args[0]
+        if not isinstance(path, str) or path.endswith(_code_ext) or os.path.isdir(path):
+            return
+        # os.open has no mode, only flags
+        if args[1] is None:
+            if args[2] & (os.O_WRONLY | os.O_RDWR):
+                return
+        elif 'r' not in args[1] or '+' in args[1]:
+            return
+        what = 'file_reads'
+        detail = path
+    else:
+        return
+    _active[0] = False
+    try:
+        _events.append({{'type': what, 'event': event, 'detail': detail,
+                        'origin': _origin(), 't': time.time() - _t0}})
+    finally:
+        _active[0] = True
+
+def _dump():
+    _active[0] = False
+    with open(_out, 'w') as fh:
+        json.dump(_events, fh)
+
+atexit.register(_dump)
+sys.addaudithook(_hook)
+sys.argv = sys.argv[2:]
+sys.path[0] = os.path.dirname(os.path.abspath(_script))
+runpy.run_path(_script, run_name='__main__')
+'''.format(root=PIPELINE_ROOTDIR)
+
+
+def parse_importtime(text):
+    """Parse python -X importtime output (stderr). Returns list of
+    (module, self seconds, cumulative seconds, nesting level)
+
+    >>> err = '''import time: self [us] | cumulative | imported package
+    ... import time:       200 |        200 |     _io
+    ... import time:      1000 |       3000 |   yaml
+    ... import time:     50000 |      60000 | pipelines
+    ... some other stderr line'''
+    >>> parse_importtime(err)[1:]
+    [('yaml', 0.001, 0.003, 1), ('pipelines', 0.05, 0.06, 0)]
+    """
+    imports = []
+    for line in text.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue
+        name = fields[2].rstrip()
+        # one leading space, then two per level
+        level = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append((name.strip(), int(fields[0]) / 1e6, int(fields[1]) / 1e6, level))
+    return imports
+
+
+def summarize(wall_s, imports, events):
+    """Summary metrics for one entry point
+
+    >>> imports = [('yaml', 0.001, 0.003, 1), ('pipelines', 0.05, 0.06, 0)]
+    >>> events = [{'type': 'network'}, {'type': 'file_reads'}, {'type': 'file_reads'}]
+    >>> s = summarize(1.5, imports, events)
+    >>> s['import_s'], s['network'], s['file_reads'], s['subprocess']
+    (0.06, 1, 2, 0)
+    """
+    summary = {'wall_s': wall_s,
+               'import_s': sum(i[2] for i in imports if i[3] == 0)}
+    for what in ['subprocess', 'network', 'file_reads']:
+        summary[what] = sum(1 for e in events if e['type'] == what)
+    return summary
+
+
+def profile_entry_point(script, args=None, python=sys.executable):
+    """Run script (with args, default --help) under import time
+    profiling and audit hooks. Returns tuple of exit status, summary,
+    imports and events
+    """
+    if args is None:
+        args = ['--help']
+    fd, eventfile = tempfile.mkstemp(prefix="startup_profile.", suffix=".json")
+    os.close(fd)
+    cmd = [python, '-X', 'importtime', '-c', BOOTSTRAP, eventfile, script] + args
+    start = time.time()
+    proc = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    wall_s = time.time() - start
+    stderr = proc.stderr.decode(errors='replace')
+    try:
+        with open(eventfile) as fh:
+            events = json.load(fh)
+    except ValueError:
+        events = []
+    os.unlink(eventfile)
+    if proc.returncode != 0:
+        # print the non-importtime part, i.e. the actual error
+        logger.warning("%s exited with %d:\n%s", script, proc.returncode, "\n".join(
+            l for l in stderr.splitlines() if not l.startswith("import time:")))
+    imports = parse_importtime(stderr)
+    return proc.returncode, summarize(wall_s, imports, events), imports, events
+
+
+def check_budget(summary, budget):
+    """Returns list of (metric, value, limit) exceeding budget
+
+    >>> check_budget({'wall_s': 3.0, 'network': 1, 'subprocess': 0}, {'wall_s': 2.0, 'network': 0})
+    [('wall_s', 3.0, 2.0), ('network', 1, 0)]
+    """
+    return [(m, summary[m], budget[m]) for m in METRICS
+            if m in budget and m in summary and summary[m] > budget[m]]
+
+
+def load_budgets(budget_file):
+    """Returns dict of entry point to budget with __default__ merged in"""
+    with open(budget_file) as fh:
+        cfg = yaml.safe_load(fh) or dict()
+    default = cfg.pop('__default__', dict())
+    budgets = dict()
+    for entry_point, budget in cfg.items():
+        budgets[entry_point] = dict(default)
+        budgets[entry_point].update(budget or dict())
+    budgets['__default__'] = default
+    return budgets
+
+
+def main():
+    """main function
+    """
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('entry_points', nargs='*',
+                        help="Scripts to profile, relative to pipeline root dir"
+                        " (default: all in budget file)")
+    default = DEFAULT_BUDGET_FILE
+    parser.add_argument('-b', "--budget", default=default,
+                        help="Budget file (default: {})".format(default))
+    default = 10
+    parser.add_argument('-n', "--top", type=int, default=default,
+                        help="Report this many slowest imports per entry point (default: {})".format(default))
+    parser.add_argument("--events", action='store_true',
+                        help="Report individual side-effect events and their origin")
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help="Increase verbosity")
+    parser.add_argument('-q', '--quiet', action='count', default=0,
+                        help="Decrease verbosity")
+    args = parser.parse_args()
+
+    # Repeateable -v and -q for setting logging level.
+    # See https://www.reddit.com/r/Python/comments/3nctlm/what_python_tools_should_i_be_using_on_every/
+    # and https://gist.github.com/andreas-wilm/b6031a84a33e652680d4
+    # script -vv -> DEBUG
+    # script -v -> INFO
+    # script -> WARNING
+    # script -q -> ERROR
+    # script -qq -> CRITICAL
+    # script -qqq -> no logging at all
+    logger.setLevel(logging.WARN + 10*args.quiet - 10*args.verbose)
+
+    budgets = load_budgets(args.budget)
+    entry_points = args.entry_points
+    if not entry_points:
+        entry_points = sorted(k for k in budgets if k != '__default__')
+
+    num_over = 0
+    print("\t".join(["entry_point", "status"] + METRICS))
+    for entry_point in entry_points:
+        script = os.path.join(PIPELINE_ROOTDIR, entry_point)
+        if not os.path.exists(script):
+            logger.error("Skipping non-existing %s", script)
+            continue
+        res, summary, imports, events = profile_entry_point(script)
+        over = check_budget(summary, budgets.get(entry_point, budgets['__default__']))
+        status = "OK"
+        if res != 0:
+            status = "FAILED"
+        elif over:
+            status = "OVER"
+        print("\t".join([entry_point, status] + [
+            "{:.2f}".format(summary[m]) if isinstance(summary[m], float) else str(summary[m])
+            for m in METRICS]))
+        for metric, value, limit in over:
+            logger.warning("%s: %s %s exceeds budget of %s", entry_point, metric, value, limit)
+        if over or res != 0:
+            num_over += 1
+
+        if args.top:
+            for name, _, cum_s, level in sorted(imports, key=lambda i: -i[2])[:args.top]:
+                print("  import\t{:.3f}\t{}{}".format(cum_s, "  " * level, name))
+        if args.events:
+            for e in events:
+                print("  {}\t{:.3f}\t{}\t{}".format(e['type'], e['t'], e['detail'], e['origin']))
+        sys.stdout.flush()
+
+    if num_over:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()